@@ -1,13 +1,24 @@
 
+import os
 from fastapi import APIRouter, HTTPException
-from app.models.api_models import ConvertRequest, ConvertResponse, HealthResponse, ExecutionStep
+from app.models.api_models import ConvertRequest, ConvertResponse, HealthResponse, ExecutionStep, AppliedRewrite
 from app.core.parser import QlikParser
+from app.core.includes import IncludeCache, IncludeError, IncludeResolver
+from app.core.cache import ConversionCache, conversion_key
 from app.core.transformer import ASTTransformer
-from app.core.codegen import PySparkCodeGenerator
+from app.core.codegen import ConcurrencyOptions, PersistOptions, PySparkCodeGenerator, WriteOptions
+from app.core.migration import MigrationManifest
+from app.core.optimizer import IROptimizer
+from app.core.schema import SchemaError, SchemaResolver, load_schema_csv, load_schema_json
 from app.core.semantic import SemanticModelGenerator
 
 router = APIRouter()
 
+# Shared across requests so each include library is parsed once per process.
+_include_cache = IncludeCache(os.getenv("QLIK_INCLUDE_CACHE_DIR"))
+
+_conversion_cache = ConversionCache(os.getenv("QLIK_CONVERSION_CACHE_DIR"))
+
 @router.get("/health", response_model=HealthResponse)
 async def health_check():
 
@@ -21,16 +32,37 @@ async def convert_script(request: ConvertRequest):
 
     try:
 
-        parser = QlikParser()
-        ast = parser.parse(request.script)
+        resolver = IncludeResolver.from_environment(cache=_include_cache)
+        qvd_manifest = MigrationManifest.from_environment()
+        schemas = SchemaResolver(resolver, qvd_manifest, _declared_tables(request), request.table_rows)
+        cache_key = conversion_key(request.script, schemas.fingerprint())
+        cached = _conversion_cache.get(cache_key, resolver, schemas)
+
+        if cached is not None:
+            ast, data_model = cached
+        else:
+            parser = QlikParser(include_resolver=resolver)
+            ast = parser.parse(request.script)
+
+            transformer = ASTTransformer(schema_resolver=schemas)
+            data_model = transformer.transform(ast)
+            _conversion_cache.put(cache_key, ast, data_model, parser.includes, schemas.sources)
 
-        transformer = ASTTransformer()
-        data_model = transformer.transform(ast)
+        optimizer = IROptimizer(disabled=request.options.disabled_optimizations)
+        data_model, rewrites = optimizer.optimize(data_model)
 
         codegen = PySparkCodeGenerator(
-            fabric_compatible=request.options.fabric_compatible
+            fabric_compatible=request.options.fabric_compatible,
+            qvd_manifest=qvd_manifest,
+            write_options=_write_options(request),
+            persist_options=PersistOptions(
+                storage_level=request.options.persist_storage_level,
+                min_rows=request.options.persist_min_rows
+            ),
+            concurrency_options=ConcurrencyOptions(max_workers=request.options.concurrent_tables)
         )
         pyspark_code = codegen.generate(data_model, mode=request.mode)
+        warnings.extend(codegen.warnings)
 
         semantic_gen = SemanticModelGenerator()
         semantic_model = semantic_gen.generate(data_model)
@@ -42,17 +74,42 @@ async def convert_script(request: ConvertRequest):
             pyspark_code=pyspark_code,
             semantic_model=semantic_model,
             execution_plan=execution_plan,
+            optimizations=[AppliedRewrite(**rewrite._asdict()) for rewrite in rewrites],
             warnings=warnings,
             errors=errors
         )
 
+    except (IncludeError, SchemaError) as e:
+        raise HTTPException(status_code=400, detail=f"Conversion failed: {str(e)}")
     except Exception as e:
         errors.append(str(e))
         raise HTTPException(status_code=500, detail=f"Conversion failed: {str(e)}")
 
+def _write_options(request: ConvertRequest) -> WriteOptions:
+
+    options = request.options
+    return WriteOptions(
+        format=options.output_format,
+        partition_by=options.partition_by or None,
+        target_file_size=options.target_file_size,
+        optimize_write=options.optimize_write,
+        v_order=options.v_order,
+        lakehouse_schema=options.lakehouse_schema
+    )
+
+def _declared_tables(request: ConvertRequest) -> dict:
+
+    tables = {}
+    if request.schema_csv:
+        tables.update(load_schema_csv(request.schema_csv))
+    if request.schema_fields:
+        tables.update(load_schema_json([field.model_dump() for field in request.schema_fields]))
+    return tables
+
 def _build_execution_plan(data_model) -> list:
 
     plan = []
+    stages = {name: index for index, stage in enumerate(data_model.execution_stages, 1) for name in stage}
 
     for idx, table_name in enumerate(data_model.execution_order, 1):
         if table_name not in data_model.tables:
@@ -82,7 +139,8 @@ def _build_execution_plan(data_model) -> list:
             table_name=table_name,
             operation=operation,
             dependencies=dependencies,
-            description=description
+            description=description,
+            stage=stages.get(table_name)
         )
         plan.append(step)
 
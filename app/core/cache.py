@@ -0,0 +1,164 @@
+
+import hashlib
+import os
+import pickle
+import threading
+from collections import OrderedDict
+from pathlib import Path
+from typing import Dict, Optional, Tuple, Union
+from app.core.includes import IncludeResolver
+from app.core.parser import PARSER_VERSION
+from app.core.schema import SchemaResolver
+from app.models.ast_models import Script
+from app.models.ir_models import DataModel
+
+# Bump when Script, DataModel or the entry layout change shape.
+CACHE_FORMAT_VERSION = 10
+
+PICKLE_PROTOCOL = 5
+
+MAX_MEMORY_ENTRIES = 256
+
+MAX_DISK_BYTES = 1 << 30
+
+HASH_CHUNK_SIZE = 1 << 20
+
+def conversion_key(script: Union[str, bytes], context: str = "") -> str:
+
+    # ``context`` names other inputs that shape the result, such as the
+    # schema file's fingerprint.
+    digest = hashlib.sha256(f"qlik-conversion:{PARSER_VERSION}:{CACHE_FORMAT_VERSION}:{context}:".encode())
+    digest.update(script.encode("utf-8") if isinstance(script, str) else script)
+    return digest.hexdigest()
+
+def file_conversion_key(path: str, context: str = "") -> str:
+
+    digest = hashlib.sha256(f"qlik-conversion:{PARSER_VERSION}:{CACHE_FORMAT_VERSION}:{context}:".encode())
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+class ConversionCache:
+
+    # Parsed Scripts and transformed DataModels keyed by script hash. Entries
+    # are kept pickled, so every hit returns a fresh copy callers may modify;
+    # an in-memory LRU sits in front of a size-bounded directory evicted by
+    # access time.
+
+    def __init__(self, cache_dir: Optional[str] = None, max_memory_entries: int = MAX_MEMORY_ENTRIES,
+                 max_disk_bytes: int = MAX_DISK_BYTES):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_memory_entries = max_memory_entries
+        self.max_disk_bytes = max_disk_bytes
+        self._entries: "OrderedDict[str, bytes]" = OrderedDict()
+        self._lock = threading.Lock()
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, key: str, resolver: Optional[IncludeResolver] = None,
+            schemas: Optional[SchemaResolver] = None) -> Optional[Tuple[Script, DataModel]]:
+
+        payload = self._read(key)
+        if payload is None:
+            return None
+        try:
+            script, data_model, includes, sources = pickle.loads(payload)
+        except (pickle.UnpicklingError, EOFError, AttributeError, ImportError, ValueError):
+            self._discard(key)
+            return None
+
+        # The script text is unchanged, but an included file may not be.
+        for path, digest in includes.items():
+            loaded = resolver.read(path) if resolver is not None else None
+            if (loaded[1] if loaded is not None else None) != digest:
+                return None
+        # Nor may the source files whose schemas typed the columns.
+        for path, token in sources.items():
+            if (schemas.token(path) if schemas is not None else None) != token:
+                return None
+        return script, data_model
+
+    def put(self, key: str, script: Script, data_model: DataModel,
+            includes: Optional[Dict[str, Optional[str]]] = None, sources: Optional[Dict[str, Optional[str]]] = None):
+
+        payload = pickle.dumps((script, data_model, dict(includes or {}), dict(sources or {})), protocol=PICKLE_PROTOCOL)
+        self._remember(key, payload)
+        if self.cache_dir is None:
+            return
+
+        path = self._disk_path(key)
+        temp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            temp.write_bytes(payload)
+            os.replace(temp, path)
+        except OSError:
+            temp.unlink(missing_ok=True)
+            return
+        self._evict_disk()
+
+    def clear(self):
+
+        with self._lock:
+            self._entries.clear()
+        if self.cache_dir is not None:
+            for path in self.cache_dir.glob("conversion-*.pickle"):
+                path.unlink(missing_ok=True)
+
+    def _read(self, key: str) -> Optional[bytes]:
+
+        with self._lock:
+            payload = self._entries.get(key)
+            if payload is not None:
+                self._entries.move_to_end(key)
+                return payload
+        if self.cache_dir is None:
+            return None
+
+        path = self._disk_path(key)
+        try:
+            payload = path.read_bytes()
+            os.utime(path)
+        except OSError:
+            return None
+        self._remember(key, payload)
+        return payload
+
+    def _remember(self, key: str, payload: bytes):
+
+        with self._lock:
+            self._entries[key] = payload
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_memory_entries:
+                self._entries.popitem(last=False)
+
+    def _discard(self, key: str):
+
+        with self._lock:
+            self._entries.pop(key, None)
+        if self.cache_dir is not None:
+            self._disk_path(key).unlink(missing_ok=True)
+
+    def _evict_disk(self):
+
+        # Least recently used files go first; reads refresh the modification time.
+        files = []
+        total = 0
+        for path in self.cache_dir.glob("conversion-*.pickle"):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, path))
+            total += stat.st_size
+
+        files.sort()
+        for _, size, path in files:
+            if total <= self.max_disk_bytes:
+                break
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def _disk_path(self, key: str) -> Path:
+
+        return self.cache_dir / f"conversion-{key}.pickle"
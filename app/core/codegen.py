@@ -1,45 +1,259 @@
 
+import hashlib
+import os
 import re
-from typing import List, Dict, Optional
+from typing import List, Dict, NamedTuple, Optional, Set, Tuple
 from app.models.ir_models import (
-    DataModel, TableDefinition, ColumnDefinition,
+    DataModel, TableDefinition, ColumnDefinition, MappingDefinition, Transformation,
     SelectTransformation, FilterTransformation, JoinTransformation,
-    AggregationTransformation, DataType
+    AggregationTransformation, SemiJoinTransformation, UnionTransformation, DataType,
+    StoreDefinition, DeriveTransformation
 )
+from app.models.ast_models import (
+    Expression, FunctionCall, FieldReference, Literal,
+    VariableReference, BinaryOperation, UnaryOperation
+)
+from app.core.expression import field_references, try_parse_expression, walk
+from app.core.migration import OUTPUT_FORMATS, MigrationManifest
+from app.core.qvd import qvd_parquet_path
 from app.utils.qlik_functions import QlikFunctionMapper
 
+PYSPARK_OPERATORS = {
+    "=": "==",
+    "<>": "!=",
+    "AND": "&",
+    "OR": "|",
+    "XOR": "!=",
+}
+
+LOGICAL_OPERATORS = {"AND", "OR", "XOR"}
+
+COMPARISON_OPERATORS = {"=", "<>", "<", ">", "<=", ">="}
+
+MAX_TRANSLATION_CACHE_SIZE = 65536
+
+# Mappings up to this many rows become a create_map() expression; INLINE
+# ones are written into the code, others collected from the source.
+MAP_LITERAL_MAX_ROWS = 1000
+
+# Larger mappings up to this many rows are broadcast to every executor;
+# beyond it, or when the size is unknown, ApplyMap is a shuffled join.
+MAP_BROADCAST_MAX_ROWS = 2_000_000
+
+# Exists()/KEEP key sets from tables of at most this many rows in total
+# are broadcast.
+KEY_SET_BROADCAST_MAX_ROWS = 5_000_000
+
+# Joined tables of at most this many rows are broadcast, and joins onto
+# the same table are run smallest first.
+JOIN_BROADCAST_MAX_ROWS = 1_000_000
+
+# Text sources known only by file size are estimated at this many bytes a row.
+BYTES_PER_ROW_ESTIMATE = 100
+
+# Readers that take an explicit schema and several paths.
+SCHEMA_READERS = {"csv", "parquet", "json"}
+
+# Readers that match columns by name, so files whose columns are in a
+# different order can still be read together.
+SELF_DESCRIBING_READERS = {"parquet", "json"}
+
+# pyspark.StorageLevel constants a reused table may be persisted at.
+STORAGE_LEVELS = {
+    "MEMORY_ONLY", "MEMORY_ONLY_2", "MEMORY_AND_DISK", "MEMORY_AND_DISK_2",
+    "MEMORY_AND_DISK_DESER", "DISK_ONLY", "DISK_ONLY_2", "DISK_ONLY_3", "OFF_HEAP",
+}
+
+_DF_NAMES: Dict[str, str] = {}
+
+# PySpark translations of Qlik expressions, by their text as written.
+_TRANSLATIONS: Dict[str, str] = {}
+
+class WriteOptions(NamedTuple):
+
+    # How STORE statements are written.
+    format: str = "delta"
+    # Table name -> columns its output is partitioned by.
+    partition_by: Optional[Dict[str, List[str]]] = None
+    # Default target file size of new Delta tables, e.g. "128mb".
+    target_file_size: Optional[str] = None
+    optimize_write: bool = False
+    # Fabric's V-Order layout for Parquet files.
+    v_order: bool = False
+    # Lakehouse schema to save tables into, instead of writing to paths.
+    lakehouse_schema: Optional[str] = None
+
+    @classmethod
+    def from_environment(cls) -> "WriteOptions":
+
+        # QLIK_WRITE_FORMAT=parquet QLIK_PARTITION_BY="Sales=Year,Month;Orders=Region"
+        # QLIK_TARGET_FILE_SIZE=128mb QLIK_OPTIMIZE_WRITE=1 QLIK_V_ORDER=1 QLIK_LAKEHOUSE_SCHEMA=sales
+        partition_by = {}
+        for entry in (os.getenv("QLIK_PARTITION_BY") or "").split(";"):
+            table, _, columns = entry.partition("=")
+            if table.strip() and columns.strip():
+                partition_by[table.strip()] = [c.strip() for c in columns.split(",") if c.strip()]
+        return cls(
+            format=os.getenv("QLIK_WRITE_FORMAT") or "delta",
+            partition_by=partition_by or None,
+            target_file_size=os.getenv("QLIK_TARGET_FILE_SIZE") or None,
+            optimize_write=os.getenv("QLIK_OPTIMIZE_WRITE", "") not in ("", "0"),
+            v_order=os.getenv("QLIK_V_ORDER", "") not in ("", "0"),
+            lakehouse_schema=os.getenv("QLIK_LAKEHOUSE_SCHEMA") or None
+        )
+
+class PersistOptions(NamedTuple):
+
+    # Tables read by two or more later steps are persisted at this level,
+    # or never when it is None.
+    storage_level: Optional[str] = "MEMORY_AND_DISK"
+    # Tables known to have fewer rows are cheaper to recompute than to cache.
+    min_rows: int = 100_000
+
+    @classmethod
+    def from_environment(cls) -> "PersistOptions":
+
+        # QLIK_PERSIST_LEVEL=DISK_ONLY (or "none") QLIK_PERSIST_MIN_ROWS=1000000
+        level = os.getenv("QLIK_PERSIST_LEVEL") or "MEMORY_AND_DISK"
+        min_rows = os.getenv("QLIK_PERSIST_MIN_ROWS")
+        return cls(
+            storage_level=None if level.lower() == "none" else level.upper(),
+            min_rows=int(min_rows) if min_rows else cls._field_defaults["min_rows"]
+        )
+
+class ConcurrencyOptions(NamedTuple):
+
+    # Tables of one execution stage built at once, each in its own FAIR
+    # scheduler pool; 1 builds every table in turn.
+    max_workers: int = 1
+
+    @classmethod
+    def from_environment(cls) -> "ConcurrencyOptions":
+
+        # QLIK_CONCURRENT_TABLES=8
+        workers = os.getenv("QLIK_CONCURRENT_TABLES")
+        return cls(max_workers=int(workers) if workers else cls._field_defaults["max_workers"])
+
 class PySparkCodeGenerator:
 
-    def __init__(self, fabric_compatible: bool = True):
+    def __init__(self, fabric_compatible: bool = True, qvd_manifest: Optional[MigrationManifest] = None,
+                 write_options: Optional[WriteOptions] = None, persist_options: Optional[PersistOptions] = None,
+                 concurrency_options: Optional[ConcurrencyOptions] = None):
         self.fabric_compatible = fabric_compatible
+        # Where migrate_qvd.py put each QVD; unlisted ones are expected as
+        # Parquet next to the original.
+        self.qvd_manifest = qvd_manifest
+        self.write_options = write_options or WriteOptions()
+        if self.write_options.format not in OUTPUT_FORMATS:
+            raise ValueError(f"Unsupported write format: {self.write_options.format}")
+        self.persist_options = persist_options or PersistOptions()
+        if self.persist_options.storage_level not in STORAGE_LEVELS | {None}:
+            raise ValueError(f"Unsupported storage level: {self.persist_options.storage_level}")
+        self.concurrency_options = concurrency_options or ConcurrencyOptions()
+        if self.concurrency_options.max_workers < 1:
+            raise ValueError(f"Concurrent tables must be at least 1, not {self.concurrency_options.max_workers}")
         self.function_mapper = QlikFunctionMapper()
         self.indent = "    "
-
-    def generate(self, data_model: DataModel, mode: str = "transformation") -> str:
-
+        # How each mapping's ApplyMap calls are compiled, per generate() call.
+        self._mappings: Dict[str, MappingDefinition] = {}
+        self._tables: Dict[str, TableDefinition] = {}
+        self._map_strategies: Dict[str, str] = {}
+        self._block_strategies: Optional[Tuple[Dict[str, str], Dict[str, Tuple[str, str, str]]]] = None
+        # Reader of each file this model STOREs, for loads that read it back.
+        self._stored: Dict[str, Tuple[str, str, str]] = {}
+        # Stores of the incremental-load pattern, by table, compiled to MERGE.
+        self._merges: Dict[str, StoreDefinition] = {}
+        self._uncacheable = False
+        # Problems found by the last generate() call, for the caller to report.
+        self.warnings: List[str] = []
+
+    def generate(self, data_model: DataModel, mode: str = "transformation",
+                 table_blocks: Optional[Dict[str, Tuple[TableDefinition, List[str]]]] = None) -> str:
+
+        # ``table_blocks`` carries each table's generated lines between calls;
+        # a block is reused while its TableDefinition is the same object.
         code_lines = []
 
-        code_lines.extend(self._generate_header())
+        self._mappings = data_model.mappings
+        self._tables = data_model.tables
+        self._map_strategies = {name: self._mapping_strategy(m) for name, m in data_model.mappings.items()}
+        self._stored = {_normalize_path(store.target_path): self._stored_reader(store) for store in data_model.stores}
+        self._merges = {
+            store.table_name: store for store in data_model.stores
+            if store.merge_keys and self._store_format(store) == "delta" and _is_merge_shape(data_model.tables.get(store.table_name))
+        }
+        strategies = (self._map_strategies, self._stored, self._merges)
+        if table_blocks is not None and strategies != self._block_strategies:
+            # Blocks using ApplyMap depend on how each mapping is compiled,
+            # and loads of stored files on where they are written.
+            table_blocks.clear()
+        self._block_strategies = strategies
+        writes = self._schedule_writes(data_model)
+        self.warnings = _join_warnings(data_model)
+        persisted, unpersists = self._schedule_persists(data_model, writes)
+
+        concurrent = self.concurrency_options.max_workers > 1
+        code_lines.extend(self._generate_header(bool(persisted), concurrent))
 
         if data_model.variables:
             code_lines.extend(self._generate_variables(data_model.variables))
             code_lines.append("")
 
+        if data_model.stores:
+            code_lines.extend(self._generate_write_settings())
+
         for mapping_name, mapping in data_model.mappings.items():
             code_lines.extend(self._generate_mapping(mapping_name, mapping))
             code_lines.append("")
 
-        for table_name in data_model.execution_order:
-            if table_name in data_model.tables:
-                table = data_model.tables[table_name]
-                code_lines.extend(self._generate_table(table, mode))
+        def table_lines(table_name: str) -> List[str]:
+            table = data_model.tables[table_name]
+            cached = table_blocks.get(table_name) if table_blocks is not None else None
+            if cached is not None and cached[0] is table:
+                lines = list(cached[1])
+            else:
+                lines = self._generate_table(table, mode)
+                if table_blocks is not None:
+                    table_blocks[table_name] = (table, lines)
+                lines = list(lines)
+            if table_name in persisted:
+                lines.extend(self._generate_persist(table_name, persisted[table_name]))
+            for store in writes.get(table_name, ()):
+                lines.extend(self._generate_write(store, table))
+            return lines
+
+        if concurrent:
+            code_lines.extend(self._generate_stages(data_model, writes, unpersists, table_lines))
+        else:
+            for table_name in data_model.execution_order:
+                if table_name in data_model.tables:
+                    code_lines.extend(table_lines(table_name))
+                    for released in unpersists.get(table_name, ()):
+                        code_lines.append(f"{self._to_df_name(released)}.unpersist()")
+                    code_lines.append("")
+
+        for store in data_model.stores:
+            if store.table_name not in data_model.tables:
+                code_lines.append(f"# STORE {store.table_name} INTO {store.target_path}: the table is not loaded")
                 code_lines.append("")
 
         code_lines.extend(self._generate_footer(data_model))
 
         return "\n".join(code_lines)
 
-    def _generate_header(self) -> List[str]:
+    def _generate_header(self, persisted: bool = False, concurrent: bool = False) -> List[str]:
+
+        lines = self._generate_imports()
+        if persisted:
+            lines.insert(1, "from pyspark import StorageLevel")
+        if concurrent:
+            lines.insert(1, "from concurrent.futures import ThreadPoolExecutor")
+        if self._merges:
+            last_import = max(i for i, line in enumerate(lines) if line.startswith("from "))
+            lines.insert(last_import + 1, "from delta.tables import DeltaTable")
+        return lines
+
+    def _generate_imports(self) -> List[str]:
 
         if self.fabric_compatible:
             return [
@@ -73,63 +287,587 @@ class PySparkCodeGenerator:
             lines.append(f"{var_name} = {python_value}")
         return lines
 
-    def _generate_mapping(self, mapping_name: str, mapping) -> List[str]:
+    def _generate_mapping(self, mapping_name: str, mapping: MappingDefinition) -> List[str]:
 
         lines = [f"# Mapping: {mapping_name}"]
 
         df_name = f"map_{mapping_name}"
-        source_code = self._generate_source_load(mapping.source_table, df_name)
-        lines.append(source_code)
+        strategy = self._map_strategies[mapping_name]
+        if strategy == "literal":
+            pairs = ", ".join(f"lit({key!r}), lit({value!r})" for key, value in self._inline_pairs(mapping))
+            lines.append(f"{df_name}_expr = create_map({pairs})")
+            return lines
 
-        lines.append(f"{df_name} = {df_name}.select('{mapping.key_column}', '{mapping.value_column}')")
+        if mapping.source_type == "inline" and mapping.inline_data is not None:
+            lines.append(f"{df_name} = spark.createDataFrame([")
+            for row in mapping.inline_data.rows():
+                lines.append(f"{self.indent}{row!r},")
+            lines.append(f"], {mapping.inline_data.headers!r})")
+        elif mapping.source_type == "external":
+            source = TableDefinition(name=mapping_name, source_path=mapping.source_table,
+                                     source_columns=mapping.source_columns)
+            lines.extend(self._generate_external_load(source, df_name))
+        else:
+            lines.append(f"{df_name} = {self._to_df_name(mapping.source_table)}")
 
         if mapping.filter_condition:
             condition = self._convert_expression(mapping.filter_condition)
             lines.append(f"{df_name} = {df_name}.filter({condition})")
 
-        lines.append(f"{df_name}_dict = {df_name}.rdd.collectAsMap()")
+        lines.append(f"{df_name} = {df_name}.select('{mapping.key_column}', '{mapping.value_column}')")
+
+        if strategy == "collect":
+            # Qlik keeps the first value of a repeated key; null keys never match.
+            lines.append(f"{df_name}_pairs = {{}}")
+            lines.append(f"for key, value in {df_name}.collect():")
+            lines.append(f"{self.indent}if key is not None:")
+            lines.append(f"{self.indent * 2}{df_name}_pairs.setdefault(key, value)")
+            lines.append(f"{df_name}_expr = create_map([lit(v) for pair in {df_name}_pairs.items() for v in pair])")
+        else:
+            # One row per key, so the join in ApplyMap cannot add rows.
+            lines.append(f"{df_name} = {df_name}.dropDuplicates(['{mapping.key_column}'])")
 
         return lines
 
+    def _mapping_strategy(self, mapping: MappingDefinition) -> str:
+
+        rows = mapping.row_count
+        if rows is not None and rows <= MAP_LITERAL_MAX_ROWS:
+            if self._inline_pairs(mapping) is not None:
+                return "literal"
+            return "collect"
+        if rows is not None and rows <= MAP_BROADCAST_MAX_ROWS:
+            return "broadcast"
+        return "join"
+
+    def _inline_pairs(self, mapping: MappingDefinition) -> Optional[List[Tuple]]:
+
+        # Key/value pairs of an unfiltered INLINE mapping, first value per key.
+        data = mapping.inline_data
+        if data is None or mapping.filter_condition:
+            return None
+        columns = data.columns
+        if mapping.key_column not in columns or mapping.value_column not in columns:
+            return None
+        pairs = {}
+        for key, value in zip(columns[mapping.key_column], columns[mapping.value_column]):
+            if key is not None:
+                pairs.setdefault(key, value)
+        return list(pairs.items())
+
+    def _applymap_joins(self, expressions: List[str], input_df: str, df_name: str) -> Tuple[List[str], List[str]]:
+
+        # ApplyMap over a joined mapping reads a column added by a left join
+        # ahead of the expression; returns the joins and the added columns.
+        lines = []
+        added = []
+        for expression in expressions:
+            node = try_parse_expression(expression) if "applymap" in expression.lower() else None
+            if node is None:
+                continue
+            for call in walk(node):
+                target = self._applymap_target(call)
+                if target is None or self._map_strategies[target[0]] not in ("broadcast", "join"):
+                    continue
+                map_name, key = target
+                column = self._applymap_column(map_name, key)
+                if column in added:
+                    continue
+                mapping = f"map_{map_name}.select(col('{self._mappings[map_name].key_column}').alias('{column}_key'), " \
+                          f"col('{self._mappings[map_name].value_column}').alias('{column}'))"
+                if self._map_strategies[map_name] == "broadcast":
+                    mapping = f"broadcast({mapping})"
+                key_code = self._as_column(*self._translate(key))
+                lines.append(f"{df_name} = {input_df}.join({mapping}, {key_code} == col('{column}_key'), 'left')"
+                             f".drop('{column}_key')")
+                input_df = df_name
+                added.append(column)
+        return lines, added
+
+    def _applymap_target(self, node: Expression) -> Optional[Tuple[str, Expression]]:
+
+        # The mapping and key expression of an ApplyMap call on a known mapping.
+        if not isinstance(node, FunctionCall) or len(node.arguments) < 2:
+            return None
+        if self.function_mapper.canonical_name(node.function_name) != "ApplyMap":
+            return None
+        name = node.arguments[0]
+        if not isinstance(name, Literal) or name.kind != "string" or name.value not in self._map_strategies:
+            return None
+        return name.value, node.arguments[1]
+
+    def _applymap_column(self, map_name: str, key: Expression) -> str:
+
+        digest = hashlib.sha1(self._translate(key)[0].encode()).hexdigest()[:8]
+        return f"__{map_name}_{digest}"
+
     def _generate_table(self, table: TableDefinition, mode: str) -> List[str]:
 
         lines = [f"# Table: {table.name}"]
         df_name = self._to_df_name(table.name)
 
+        if table.name in self._merges:
+            lines.extend(self._generate_merge_table(table, self._merges[table.name], df_name, mode))
+            return lines
+
+        union = table.transformations[-1] if table.transformations else None
+        paths = self._single_read_paths(table, union) if isinstance(union, UnionTransformation) else None
+        if paths is not None:
+            lines.extend(self._generate_external_load(table, df_name, paths))
+            return lines
+
+        lines.extend(self._generate_table_body(table, df_name, mode))
+        return lines
+
+    def _generate_table_body(self, table: TableDefinition, df_name: str, mode: str) -> List[str]:
+
+        lines = []
         if table.source_type == "external":
-            lines.append(self._generate_external_load(table, df_name))
+            paths = [self._file_reader(path)[1] for path in table.source_paths] if table.source_paths else None
+            lines.extend(self._generate_external_load(table, df_name, paths))
         elif table.source_type == "resident":
             lines.append(self._generate_resident_load(table, df_name))
         elif table.source_type == "inline":
             lines.extend(self._generate_inline_load(table, df_name))
 
-        for trans in table.transformations:
+        joins = 0
+        for trans in _plan_joins(table.transformations):
             if isinstance(trans, SelectTransformation):
                 lines.extend(self._generate_select(trans, df_name))
             elif isinstance(trans, FilterTransformation):
                 lines.extend(self._generate_filter(trans, df_name))
             elif isinstance(trans, JoinTransformation):
-                lines.extend(self._generate_join(trans, df_name))
+                joins += 1
+                lines.extend(self._generate_join(trans, df_name, f"{df_name}_join{joins}", _estimated_rows(table), mode))
             elif isinstance(trans, AggregationTransformation):
                 lines.extend(self._generate_aggregation(trans, df_name))
+            elif isinstance(trans, SemiJoinTransformation):
+                lines.extend(self._generate_semi_join(trans, table.name, df_name))
+            elif isinstance(trans, UnionTransformation):
+                lines.extend(self._generate_union(trans, df_name, mode))
+            elif isinstance(trans, DeriveTransformation):
+                lines.extend(self._generate_derive(trans, df_name))
 
         return lines
 
-    def _generate_external_load(self, table: TableDefinition, df_name: str) -> str:
+    def _generate_union(self, trans: UnionTransformation, df_name: str, mode: str) -> List[str]:
+
+        lines = []
+        part_names = []
+        for index, part in enumerate(trans.parts, 2):
+            part_df = f"{df_name}_part{index}"
+            lines.append(f"# Concatenated: {part.name}")
+            lines.extend(self._generate_table_body(part, part_df, mode))
+            part_names.append(part_df)
+
+        if len(part_names) == 1:
+            lines.append(f"{df_name} = {df_name}.unionByName({part_names[0]}, allowMissingColumns=True)")
+            return lines
 
-        source_path = table.source_path or "data.csv"
+        # Pairwise rounds keep the plan's union tree log2(n) deep; a chain
+        # of unionByName calls makes Spark's analysis time grow quadratically.
+        lines.append(f"{df_name}_parts = [{', '.join([df_name] + part_names)}]")
+        lines.append(f"while len({df_name}_parts) > 1:")
+        lines.append(f"{self.indent}{df_name}_parts = [")
+        lines.append(f"{self.indent * 2}{df_name}_parts[i].unionByName({df_name}_parts[i + 1], allowMissingColumns=True)")
+        lines.append(f"{self.indent * 2}if i + 1 < len({df_name}_parts) else {df_name}_parts[i]")
+        lines.append(f"{self.indent * 2}for i in range(0, len({df_name}_parts), 2)")
+        lines.append(f"{self.indent}]")
+        lines.append(f"{df_name} = {df_name}_parts[0]")
+        return lines
+
+    def _single_read_paths(self, table: TableDefinition, union: UnionTransformation) -> Optional[List[str]]:
+
+        # Plain loads of files with the same fields and format, as from a
+        # FOR loop over monthly files, are read by one multi-path call. CSV
+        # headers apply by position, so CSV parts keep their own reads.
+        reads = [table] + union.parts
+        if table.transformations != [union] or any(part.transformations for part in union.parts):
+            return None
+        if any(read.source_type != "external" or not read.source_path for read in reads):
+            return None
+        readers = [self._file_reader(read.source_path) for read in reads]
+        if readers[0][0] not in SELF_DESCRIBING_READERS:
+            return None
+        first = reads[0]
+        for read, reader in zip(reads, readers):
+            if reader[0] != readers[0][0] or reader[2] != readers[0][2]:
+                return None
+            if read.columns != first.columns or read.source_columns != first.source_columns \
+                    or read.cast_columns != first.cast_columns:
+                return None
+        return [self._file_reader(path)[1] for read in reads for path in read.source_paths or [read.source_path]]
+
+    def _generate_external_load(self, table: TableDefinition, df_name: str,
+                                paths: Optional[List[str]] = None) -> List[str]:
+
+        # ``paths`` reads several files of the same format in one call.
+        method, path, options = self._file_reader(table.source_path or "data.csv")
+        if paths is None:
+            location = f"'{path}'"
+        elif method == "parquet":
+            location = ", ".join(f"'{p}'" for p in paths)
+        else:
+            location = "[" + ", ".join(f"'{p}'" for p in paths) + "]"
+        reader_call = f"{method}({location}{', ' + options if options else ''})"
+
+        if method not in SCHEMA_READERS:
+            lines = [f"{df_name} = spark.read.{reader_call}"]
+        # A known source schema saves Spark a pass over the files to infer one.
+        elif not table.source_columns:
+            if method == "csv":
+                # Columns all cast to declared types need no inferring pass.
+                infer = not self._declares_read(table)
+                reader_call = f"{reader_call[:-1]}, inferSchema={infer})"
+            lines = [f"{df_name} = spark.read.{reader_call}"]
+        else:
+            lines = [
+                self._struct_type(table.source_columns, df_name),
+                f"{df_name} = spark.read.schema({df_name}_schema).{reader_call}"
+            ]
+        if table.read_columns:
+            # Parquet and Delta scans then read only these columns.
+            lines.append(f"{df_name} = {df_name}.select({', '.join(repr(c) for c in table.read_columns)})")
+        casts = [
+            f"'{column.name}': col('{column.name}').cast({self._to_spark_type(column.data_type)})"
+            for column in table.cast_columns if not table.read_columns or column.name in table.read_columns
+        ]
+        if casts:
+            # Types from the schema file, which names fields, not file columns.
+            lines.append(f"{df_name} = {df_name}.withColumns({{{', '.join(casts)}}})")
+        return lines
 
+    def _declares_read(self, table: TableDefinition) -> bool:
+
+        # Whether every column the read uses has a type from the schema file.
+        declared = {column.name for column in table.cast_columns}
+        if not declared:
+            return False
+        if table.read_columns:
+            return set(table.read_columns) <= declared
+        expressions = [column.source_expression or column.name for column in table.columns]
+        expressions += [trans.condition for trans in table.transformations if isinstance(trans, FilterTransformation)]
+        for expression in expressions:
+            node = try_parse_expression(expression)
+            if node is None or not set(field_references(node)) <= declared:
+                return False
+        return True
+
+    def _file_reader(self, source_path: str) -> Tuple[str, str, str]:
+
+        # The DataFrameReader method, path and options for a source file.
+        stored = self._stored.get(_normalize_path(source_path))
+        if stored is not None:
+            # Written earlier in the same script by a STORE.
+            return stored
         if source_path.endswith('.csv') or source_path.endswith('.txt'):
-            return f"{df_name} = spark.read.csv('{source_path}', header=True, inferSchema=True)"
+            return "csv", source_path, "header=True"
         elif source_path.endswith('.parquet'):
-            return f"{df_name} = spark.read.parquet('{source_path}')"
+            return "parquet", source_path, ""
         elif source_path.endswith('.json'):
-            return f"{df_name} = spark.read.json('{source_path}')"
+            return "json", source_path, ""
         elif source_path.endswith('.xlsx') or source_path.endswith('.xls'):
-            return f"{df_name} = spark.read.format('excel').load('{source_path}')"
+            return "format('excel').load", source_path, ""
+        elif source_path.lower().endswith('.qvd'):
+            # Spark cannot read QVD, so read the migrated copy instead.
+            migrated = self.qvd_manifest.locate(source_path) if self.qvd_manifest else None
+            if migrated is None:
+                return "parquet", qvd_parquet_path(source_path), ""
+            path, output_format = migrated
+            if output_format == "delta":
+                return "format('delta').load", path, ""
+            return "parquet", path, ""
         else:
 
-            return f"{df_name} = spark.read.csv('{source_path}', header=True, inferSchema=True)"
+            return "csv", source_path, "header=True"
+
+    def _struct_type(self, columns: List[ColumnDefinition], df_name: str) -> str:
+
+        schema_fields = [
+            f"StructField('{col.name}', {self._to_spark_type(col.data_type)}, {col.nullable})"
+            for col in columns
+        ]
+        return f"{df_name}_schema = StructType([{', '.join(schema_fields)}])"
+
+    def _schedule_writes(self, data_model: DataModel) -> Dict[str, List[StoreDefinition]]:
+
+        # Each STORE is written after the last table in the execution order
+        # that reads the stored table, or right after the table when none do,
+        # but ahead of any load of the stored file.
+        order = [name for name in data_model.execution_order if name in data_model.tables]
+        last_use: Dict[str, int] = {}
+        file_readers: Dict[str, List[int]] = {}
+        for index, table_name in enumerate(order):
+            table = data_model.tables[table_name]
+            last_use[table_name] = index
+            for dependency in _table_inputs(table):
+                if dependency in last_use:
+                    last_use[dependency] = index
+            for path in _table_files(table):
+                file_readers.setdefault(_normalize_path(path), []).append(index)
+
+        writes: Dict[str, List[StoreDefinition]] = {}
+        for store in data_model.stores:
+            if store.table_name not in last_use or self._merges.get(store.table_name) is store:
+                continue
+            own = order.index(store.table_name)
+            position = last_use[store.table_name]
+            for reader in file_readers.get(_normalize_path(store.target_path), ()):
+                if reader > own:
+                    position = min(position, reader - 1)
+            writes.setdefault(order[position], []).append(store)
+        return writes
+
+    def _generate_merge_table(self, table: TableDefinition, store: StoreDefinition, df_name: str,
+                              mode: str) -> List[str]:
+
+        # Runs after the first read only the rows changed since the last
+        # one, found by the watermark kept in the Delta table's properties,
+        # and merge them on the keys rather than rewriting the history.
+        union = table.transformations[-1]
+        base = table.transformations[:-1]
+        kind, target = self._store_target(store)
+        method = self._stored_reader(store)[0]
+        watermark = store.watermark_column
+        if kind == "table":
+            exists = f"spark.catalog.tableExists('{target}')"
+            handle = f"DeltaTable.forName(spark, '{target}')"
+            sql_name = target
+        else:
+            exists = f"DeltaTable.isDeltaTable(spark, '{target}')"
+            handle = f"DeltaTable.forPath(spark, '{target}')"
+            sql_name = f"delta.`{target}`"
+
+        lines = [
+            f"# Incremental load: changed rows are merged into {store.target_path} on {', '.join(store.merge_keys)}",
+            f"{df_name}_target = {handle} if {exists} else None",
+            f"{df_name}_watermark = {df_name}_target.detail().first()['properties'].get('qlik.watermark') "
+            f"if {df_name}_target is not None else None",
+        ]
+        lines.extend(self._generate_table_body(
+            table.model_copy(update={"transformations": []}), df_name, mode
+        ))
+
+        # Rows at the watermark are read again, which the merge makes harmless.
+        lines.append(f"if {df_name}_watermark is not None:")
+        lines.append(f"{self.indent}{df_name} = {df_name}.filter(col('{watermark}') >= lit({df_name}_watermark))")
+        if store.changes_condition:
+            lines.append(f"{self.indent}{df_name} = {df_name}.filter({self._convert_expression(store.changes_condition)})")
+        lines.append("else:")
+        for trans in base:
+            if isinstance(trans, FilterTransformation):
+                lines.extend(self.indent + line for line in self._generate_filter(trans, df_name))
+        for trans in base:
+            if isinstance(trans, SelectTransformation):
+                lines.extend(self._generate_select(trans, df_name))
+
+        keys = " AND ".join(f"t.`{key}` = s.`{key}`" for key in store.merge_keys)
+        lines.append(f"{df_name}_high = {df_name}.agg(max(col('{watermark}'))).first()[0]")
+        lines.append(f"if {df_name}_target is not None:")
+        lines.append(
+            f"{self.indent}{df_name}_target.alias('t').merge({df_name}.alias('s'), \"{keys}\")"
+            ".whenMatchedUpdateAll().whenNotMatchedInsertAll().execute()"
+        )
+        lines.append("else:")
+        # The first run takes the history from the migrated QVD, as the
+        # script would, and writes the whole table.
+        stored = self._stored.pop(_normalize_path(store.target_path), None)
+        try:
+            first_run = self._generate_union(union, df_name, mode)
+        finally:
+            if stored is not None:
+                self._stored[_normalize_path(store.target_path)] = stored
+        first_run.extend(self._generate_write(store, table))
+        lines.extend(self.indent + line for line in first_run)
+        lines.append(f"if {df_name}_high is not None:")
+        lines.append(
+            f"{self.indent}spark.sql(f\"ALTER TABLE {sql_name} SET TBLPROPERTIES "
+            f"('qlik.watermark' = '{{{df_name}_high}}')\")"
+        )
+        lines.append(f"{df_name} = spark.read.{method}('{target}')")
+        return lines
+
+    def _schedule_persists(self, data_model: DataModel, writes: Dict[str, List[StoreDefinition]]
+                           ) -> Tuple[Dict[str, int], Dict[str, List[str]]]:
+
+        # Counts the later tables and STORE writes reading each table. One
+        # read twice or more is persisted rather than recomputed from its
+        # sources each time, and unpersisted after the table of its last read.
+        level = self.persist_options.storage_level
+        if level is None:
+            return {}, {}
+        order = [name for name in data_model.execution_order if name in data_model.tables]
+        consumers: Dict[str, int] = {}
+        last_read: Dict[str, str] = {}
+        for table_name in order:
+            for dependency in _table_inputs(data_model.tables[table_name]):
+                if dependency in data_model.tables:
+                    consumers[dependency] = consumers.get(dependency, 0) + 1
+                    last_read[dependency] = table_name
+            for store in writes.get(table_name, ()):
+                consumers[store.table_name] = consumers.get(store.table_name, 0) + 1
+                last_read[store.table_name] = table_name
+
+        persisted = {}
+        unpersists: Dict[str, List[str]] = {}
+        for table_name in order:
+            rows = data_model.tables[table_name].row_count
+            if consumers.get(table_name, 0) < 2 or (rows is not None and rows < self.persist_options.min_rows):
+                continue
+            persisted[table_name] = consumers[table_name]
+            unpersists.setdefault(last_read[table_name], []).append(table_name)
+        return persisted, unpersists
+
+    def _generate_persist(self, table_name: str, consumers: int) -> List[str]:
+
+        df_name = self._to_df_name(table_name)
+        return [
+            f"# {table_name} is read {consumers} times below",
+            f"{df_name} = {df_name}.persist(StorageLevel.{self.persist_options.storage_level})"
+        ]
+
+    def _generate_stages(self, data_model: DataModel, writes: Dict[str, List[StoreDefinition]],
+                         unpersists: Dict[str, List[str]], table_lines) -> List[str]:
+
+        # Each table becomes a function, and each stage's functions run on a
+        # thread pool; its Spark jobs go to a FAIR scheduler pool of its own,
+        # so a small table's jobs are not queued behind a large one's.
+        stages = self._runner_stages(data_model, writes)
+        df_names = {self._to_df_name(name) for name in data_model.tables}
+        lines = [
+            "# Tables of a stage read none of each other and are built at once. Their jobs",
+            "# share the cluster fairly when the session runs with spark.scheduler.mode=FAIR.",
+            "def run_stage(*loads):",
+            f"{self.indent}with ThreadPoolExecutor(max_workers=min(len(loads), {self.concurrency_options.max_workers})) as executor:",
+            f"{self.indent * 2}for future in [executor.submit(load) for load in loads]:",
+            f"{self.indent * 3}future.result()",
+            "",
+        ]
+
+        # Persisted tables are released after the stage of their last reader.
+        releases: Dict[int, List[str]] = {}
+        for index, stage in enumerate(stages):
+            for table_name in stage:
+                releases.setdefault(index, []).extend(unpersists.get(table_name, ()))
+
+        for index, stage in enumerate(stages):
+            loads = []
+            for table_name in stage:
+                df_name = self._to_df_name(table_name)
+                body = table_lines(table_name)
+                assigned = []
+                for line in body:
+                    match = re.match(r"\s*(\w+) = ", line)
+                    if match and match.group(1) in df_names and match.group(1) not in assigned:
+                        assigned.append(match.group(1))
+                loads.append(f"load_{df_name[3:]}")
+                lines.append(f"def {loads[-1]}():")
+                if assigned:
+                    lines.append(f"{self.indent}global {', '.join(assigned)}")
+                lines.append(f"{self.indent}spark.sparkContext.setLocalProperty('spark.scheduler.pool', '{df_name[3:]}')")
+                lines.extend(f"{self.indent}{line}" if line else line for line in body)
+                lines.append("")
+            lines.append(f"# Stage {index + 1}: {', '.join(stage)}")
+            lines.append(f"run_stage({', '.join(loads)})")
+            for released in releases.get(index, ()):
+                lines.append(f"{self._to_df_name(released)}.unpersist()")
+            lines.append("")
+        return lines
+
+    def _runner_stages(self, data_model: DataModel, writes: Dict[str, List[StoreDefinition]]) -> List[List[str]]:
+
+        # The model's stages, with a load of a STOREd file kept in order with
+        # the function writing it, and that function after the stage building
+        # the table it writes.
+        order = [name for name in data_model.execution_order if name in data_model.tables]
+        stage_of = {name: index for index, stage in enumerate(data_model.execution_stages) for name in stage}
+        writers = {_normalize_path(store.target_path): name for name, stores in writes.items() for store in stores}
+        writers.update({_normalize_path(store.target_path): name for name, store in self._merges.items()})
+        readers: Dict[str, List[str]] = {}
+        done: Dict[str, int] = {}
+        for table_name in order:
+            table = data_model.tables[table_name]
+            written = [store.target_path for store in writes.get(table_name, ())]
+            if table_name in self._merges:
+                written.append(self._merges[table_name].target_path)
+            inputs = _table_inputs(table) | {store.table_name for store in writes.get(table_name, ())} | {
+                writers[_normalize_path(path)] for path in _table_files(table) if _normalize_path(path) in writers
+            } | {reader for path in written for reader in readers.get(_normalize_path(path), ()) if reader != table_name}
+            for path in _table_files(table):
+                readers.setdefault(_normalize_path(path), []).append(table_name)
+            stage = max([stage_of.get(table_name, len(done))] + [done[name] + 1 for name in inputs if name in done])
+            done[table_name] = stage
+
+        stages: List[List[str]] = [[] for _ in range(max(done.values(), default=-1) + 1)]
+        for table_name in order:
+            stages[done[table_name]].append(table_name)
+        return [stage for stage in stages if stage]
+
+    def _generate_write_settings(self) -> List[str]:
+
+        options = self.write_options
+        lines = []
+        if options.target_file_size and options.format == "delta":
+            lines.append("# Target file size of the Delta tables written below")
+            lines.append(
+                f"spark.conf.set('spark.databricks.delta.properties.defaults.targetFileSize', "
+                f"{options.target_file_size!r})"
+            )
+            lines.append("")
+        return lines
+
+    def _generate_write(self, store: StoreDefinition, table: TableDefinition) -> List[str]:
+
+        options = self.write_options
+        output_format = self._store_format(store)
+        source = self._to_df_name(store.table_name)
+        columns = [column.name for column in table.columns]
+        if store.columns:
+            select_exprs = [
+                self._convert_aliased(column.source_expression, column.name)
+                if column.source_expression else f"col('{column.name}')"
+                for column in store.columns
+            ]
+            source = f"{source}.select({', '.join(select_exprs)})"
+            columns = [column.name for column in store.columns]
+
+        writer = f"{source}.write.format('{output_format}').mode('overwrite')"
+        if options.optimize_write and output_format == "delta":
+            writer += ".option('optimizeWrite', 'true')"
+        if options.v_order:
+            writer += ".option('parquet.vorder.enabled', 'true')"
+        partitions = [c for c in (options.partition_by or {}).get(store.table_name, []) if c in columns]
+        if partitions:
+            writer += f".partitionBy({', '.join(repr(c) for c in partitions)})"
+
+        kind, target = self._store_target(store)
+        call = "saveAsTable" if kind == "table" else "save"
+        return [f"# Store: {store.table_name} -> {store.target_path}", f"{writer}.{call}('{target}')"]
+
+    def _store_format(self, store: StoreDefinition) -> str:
+
+        return "parquet" if store.file_format == "parquet" else self.write_options.format
+
+    def _store_target(self, store: StoreDefinition) -> Tuple[str, str]:
+
+        # A Lakehouse table named after the file, or the file's path with
+        # the output format's extension.
+        name = re.split(r"[/\\]", store.target_path)[-1]
+        stem = name.rsplit(".", 1)[0] if "." in name else name
+        if self.write_options.lakehouse_schema:
+            table_name = re.sub(r"\W+", "_", stem).strip("_").lower() or "table"
+            return "table", f"{self.write_options.lakehouse_schema}.{table_name}"
+        path = store.target_path[:len(store.target_path) - len(name)] + stem
+        return "path", path + OUTPUT_FORMATS[self._store_format(store)]
+
+    def _stored_reader(self, store: StoreDefinition) -> Tuple[str, str, str]:
+
+        kind, target = self._store_target(store)
+        if kind == "table":
+            return "table", target, ""
+        if self._store_format(store) == "delta":
+            return "format('delta').load", target, ""
+        return "parquet", target, ""
 
     def _generate_resident_load(self, table: TableDefinition, df_name: str) -> str:
 
@@ -139,35 +877,33 @@ class PySparkCodeGenerator:
 
     def _generate_inline_load(self, table: TableDefinition, df_name: str) -> List[str]:
 
-        lines = []
-
-        schema_fields = []
-        for col in table.columns:
-            spark_type = self._to_spark_type(col.data_type)
-            schema_fields.append(f"StructField('{col.name}', {spark_type}, {col.nullable})")
+        lines = [self._struct_type(table.columns, df_name)]
 
-        schema_str = ", ".join(schema_fields)
-        lines.append(f"{df_name}_schema = StructType([{schema_str}])")
-
-        lines.append(f"{df_name}_data = []  # Add inline data here")
+        if table.inline_data is not None:
+            lines.append(f"{df_name}_data = [")
+            for row in table.inline_data.rows():
+                lines.append(f"{self.indent}{row!r},")
+            lines.append("]")
+        else:
+            lines.append(f"{df_name}_data = []  # Add inline data here")
         lines.append(f"{df_name} = spark.createDataFrame({df_name}_data, {df_name}_schema)")
 
         return lines
 
     def _generate_select(self, trans: SelectTransformation, df_name: str) -> List[str]:
 
-        lines = []
-
         if trans.is_distinct:
-            lines.append(f"{df_name} = {df_name}.distinct()")
-            return lines
+            return [f"{df_name} = {df_name}.distinct()"]
+
+        lines, _ = self._applymap_joins(
+            [col.source_expression for col in trans.columns if col.source_expression], df_name, df_name
+        )
 
         select_exprs = []
         for col in trans.columns:
             if col.source_expression:
 
-                expr = self._convert_expression(col.source_expression)
-                select_exprs.append(f"{expr}.alias('{col.name}')")
+                select_exprs.append(self._convert_aliased(col.source_expression, col.name))
             else:
 
                 select_exprs.append(f"col('{col.name}')")
@@ -178,41 +914,97 @@ class PySparkCodeGenerator:
 
         return lines
 
+    def _generate_derive(self, trans: DeriveTransformation, df_name: str) -> List[str]:
+
+        lines, _ = self._applymap_joins([col.source_expression for col in trans.columns], df_name, df_name)
+        for col in trans.columns:
+            lines.append(f"{df_name} = {df_name}.withColumn('{col.name}', {self._convert_expression(col.source_expression)})")
+        return lines
+
     def _generate_filter(self, trans: FilterTransformation, df_name: str) -> List[str]:
 
+        lines, added = self._applymap_joins([trans.condition], df_name, df_name)
         condition = self._convert_expression(trans.condition)
-        return [f"{df_name} = {df_name}.filter({condition})"]
+        lines.append(f"{df_name} = {df_name}.filter({condition})")
+        if added:
+            lines.append(f"{df_name} = {df_name}.drop({', '.join(repr(c) for c in added)})")
+        return lines
 
-    def _generate_join(self, trans: JoinTransformation, df_name: str) -> List[str]:
+    def _generate_join(self, trans: JoinTransformation, df_name: str, right_df: str,
+                       left_rows: Optional[int], mode: str) -> List[str]:
 
+        # ``df_name`` holds the table joined into; the joined load is built
+        # as ``right_df``. A side small enough is broadcast, when the join
+        # type lets Spark build its hash table from that side.
         lines = []
+        if trans.right is not None:
+            lines.append(f"# Joined: {trans.right.name}")
+            lines.extend(self._generate_table_body(trans.right, right_df, mode))
+            right_rows = _estimated_rows(trans.right)
+        else:
+            right_df = self._to_df_name(trans.right_table)
+            right_rows = _estimated_rows(self._tables[trans.right_table]) if trans.right_table in self._tables else None
+        left_df = df_name if trans.left_table == trans.table_name else self._to_df_name(trans.left_table)
 
-        left_df = self._to_df_name(trans.left_table)
-        right_df = self._to_df_name(trans.right_table)
+        join_type = trans.join_type
+        right_small = right_rows is not None and right_rows <= JOIN_BROADCAST_MAX_ROWS
+        left_small = left_rows is not None and left_rows <= JOIN_BROADCAST_MAX_ROWS
+        if right_small and (join_type == "left" or join_type == "inner" and (not left_small or right_rows <= left_rows)):
+            right_df = f"broadcast({right_df})"
+        elif left_small and join_type in ("right", "inner"):
+            left_df = f"broadcast({left_df})"
 
         if trans.join_keys:
-            join_cond = " & ".join([f"({left_df}['{key}'] == {right_df}['{key}'])" for key in trans.join_keys])
+            # Joining on the names keeps one copy of each key field, as Qlik does.
+            lines.append(f"{df_name} = {left_df}.join({right_df}, {trans.join_keys!r}, '{join_type}')")
         elif trans.join_condition:
             join_cond = self._convert_expression(trans.join_condition)
+            lines.append(f"{df_name} = {left_df}.join({right_df}, {join_cond}, '{join_type}')")
         else:
+            lines.append("# WARNING: no common fields, so every row is paired with every row")
+            lines.append(f"{df_name} = {left_df}.crossJoin({right_df})")
 
-            join_cond = "True"
+        return lines
 
-        join_type = trans.join_type
-        lines.append(f"{df_name} = {left_df}.join({right_df}, {join_cond}, '{join_type}')")
+    def _generate_semi_join(self, trans: SemiJoinTransformation, table_name: str, df_name: str) -> List[str]:
 
+        # ``df_name`` holds ``table_name``, which may be a concatenated part.
+        target = df_name if trans.table_name == table_name else self._to_df_name(trans.table_name)
+        source = df_name if trans.source_table == table_name else self._to_df_name(trans.source_table)
+        if not trans.key_tables:
+            # Nothing has loaded the field, so Exists() never matches.
+            lines = [f"{target} = {source}" if trans.anti else f"{target} = {source}.limit(0)"]
+        else:
+            aliases = [f"__key{i}" for i in range(len(trans.key_columns))]
+            selects = ", ".join(f"col('{column}').alias('{alias}')" for column, alias in zip(trans.key_columns, aliases))
+            key_sets = [f"{self._to_df_name(name)}.select({selects})" for name in trans.key_tables]
+            keys = key_sets[0] + "".join(f".unionByName({key_set})" for key_set in key_sets[1:])
+            rows = [self._tables[name].row_count if name in self._tables else None for name in trans.key_tables]
+            if None not in rows and sum(rows) <= KEY_SET_BROADCAST_MAX_ROWS:
+                keys = f"broadcast({keys})"
+
+            conditions = [
+                f"{self._convert_expression(expression)} == col('{alias}')"
+                for expression, alias in zip(trans.key_expressions, aliases)
+            ]
+            condition = conditions[0] if len(conditions) == 1 else " & ".join(f"({c})" for c in conditions)
+            how = "left_anti" if trans.anti else "left_semi"
+            lines = [f"{target} = {source}.join({keys}, {condition}, '{how}')"]
+
+        if trans.distinct_columns:
+            lines.append(f"{target} = {target}.dropDuplicates({trans.distinct_columns!r})")
         return lines
 
     def _generate_aggregation(self, trans: AggregationTransformation, df_name: str) -> List[str]:
 
-        lines = []
-
         source_df = self._to_df_name(trans.source_table)
+        lines, added = self._applymap_joins(list(trans.aggregations.values()), source_df, df_name)
+        if added:
+            source_df = df_name
 
         agg_exprs = []
         for col_name, agg_expr in trans.aggregations.items():
-            converted_expr = self._convert_expression(agg_expr)
-            agg_exprs.append(f"{converted_expr}.alias('{col_name}')")
+            agg_exprs.append(self._convert_aliased(agg_expr, col_name))
 
         group_cols = ", ".join([f"col('{col}')" for col in trans.group_by_columns])
         agg_str = ", ".join(agg_exprs)
@@ -221,23 +1013,6 @@ class PySparkCodeGenerator:
 
         return lines
 
-    def _generate_source_load(self, source: str, df_name: str) -> str:
-
-        if '.' in source and any(ext in source for ext in ['.csv', '.txt', '.parquet', '.json']):
-
-            if source.endswith('.csv') or source.endswith('.txt'):
-                return f"{df_name} = spark.read.csv('{source}', header=True, inferSchema=True)"
-            elif source.endswith('.parquet'):
-                return f"{df_name} = spark.read.parquet('{source}')"
-            elif source.endswith('.json'):
-                return f"{df_name} = spark.read.json('{source}')"
-        else:
-
-            source_df = self._to_df_name(source)
-            return f"{df_name} = {source_df}"
-
-        return f"{df_name} = spark.read.csv('{source}', header=True, inferSchema=True)"
-
     def _generate_footer(self, data_model: DataModel) -> List[str]:
 
         lines = [
@@ -253,53 +1028,148 @@ class PySparkCodeGenerator:
 
     def _convert_expression(self, expr: str) -> str:
 
-        expr = self._wrap_column_refs(expr)
+        # Translations are memoized per process by the expression's text, so
+        # the many repeated expressions of a script are converted once.
+        cached = _TRANSLATIONS.get(expr)
+        if cached is not None:
+            return cached
 
-        expr = self._convert_functions(expr)
-
-        expr = expr.replace(' AND ', ' & ')
-        expr = expr.replace(' and ', ' & ')
-        expr = expr.replace(' OR ', ' | ')
-        expr = expr.replace(' or ', ' | ')
-        expr = expr.replace(' NOT ', ' ~ ')
-        expr = expr.replace(' not ', ' ~ ')
-        expr = re.sub(r'(?<![=!<>])=(?!=)', '==', expr)
-        expr = expr.replace('<>', '!=')
-
-        return expr
-
-    def _convert_functions(self, expr: str) -> str:
-
-        pattern = r'(\w+)\((.*?)\)'
-
-        def replace_func(match):
-            func_name = match.group(1)
-            args_str = match.group(2)
-
-            args = [arg.strip() for arg in args_str.split(',')]
-
-            pyspark_func = self.function_mapper.map_function(func_name, args)
-            return pyspark_func
-
-        expr = re.sub(pattern, replace_func, expr)
-        return expr
+        node = try_parse_expression(expr)
+        self._uncacheable = False
+        if node is None:
+            converted = f"expr({expr!r})"
+        else:
+            converted = self._as_column(*self._translate(node))
+        if self._uncacheable:
+            # ApplyMap depends on the mappings of the model being generated.
+            return converted
+
+        if len(_TRANSLATIONS) >= MAX_TRANSLATION_CACHE_SIZE:
+            _TRANSLATIONS.clear()
+        _TRANSLATIONS[expr] = converted
+        return converted
+
+    def _convert_aliased(self, expr: str, name: str) -> str:
+
+        # .alias() binds tighter than the operators, so it would name only
+        # the last operand of ``A * 1.2`` without the parentheses.
+        converted = self._convert_expression(expr)
+        if isinstance(try_parse_expression(expr), (BinaryOperation, UnaryOperation)):
+            converted = f"({converted})"
+        return f"{converted}.alias('{name}')"
+
+    def _translate(self, node: Expression) -> Tuple[str, bool]:
+
+        # Returns the PySpark source for ``node`` and whether it is a Column
+        # (as opposed to a plain Python literal or variable).
+        if isinstance(node, FieldReference):
+            return f"col({node.name!r})", True
+
+        if isinstance(node, Literal):
+            if node.kind == "string":
+                return repr(node.value), False
+            return node.value, False
+
+        if isinstance(node, VariableReference):
+            if node.text.isidentifier():
+                return node.text, False
+            return f"expr({node.text!r})", True
+
+        if isinstance(node, FunctionCall):
+            return self._translate_call(node), True
+
+        if isinstance(node, UnaryOperation):
+            operand, is_column = self._translate(node.operand)
+            operand = self._parenthesize(node.operand, operand)
+            if node.operator == "NOT":
+                return f"~{self._as_column(operand, is_column)}", True
+            return f"-{operand}", is_column
+
+        return self._translate_binary(node)
+
+    def _translate_binary(self, node: BinaryOperation) -> Tuple[str, bool]:
+
+        operator = node.operator
+
+        if operator == "&":
+            parts = []
+            for operand in self._flatten_concat(node):
+                parts.append(self._as_column(*self._translate(operand)))
+            return f"concat({', '.join(parts)})", True
+
+        left, left_is_column = self._translate(node.left)
+        right, right_is_column = self._translate(node.right)
+
+        if operator == "LIKE":
+            pattern = right
+            if isinstance(node.right, Literal):
+                pattern = repr(node.right.value.replace("*", "%").replace("?", "_"))
+            left = self._parenthesize(node.left, self._as_column(left, left_is_column))
+            return f"{left}.like({pattern})", True
+
+        is_column = left_is_column or right_is_column
+        if operator in LOGICAL_OPERATORS or (operator in COMPARISON_OPERATORS and not is_column):
+            left = self._as_column(left, left_is_column)
+            is_column = True
+
+        left = self._parenthesize(node.left, left)
+        right = self._parenthesize(node.right, right)
+        return f"{left} {PYSPARK_OPERATORS.get(operator, operator)} {right}", is_column
+
+    def _translate_call(self, node: FunctionCall) -> str:
+
+        name = self.function_mapper.canonical_name(node.function_name)
+        special = name in self.function_mapper.SPECIAL_FUNCTIONS
+
+        args = []
+        for argument in node.arguments:
+            code, is_column = self._translate(argument)
+            # Special handlers place literal arguments themselves (formats,
+            # delimiters, counts); plain column functions need lit() for strings.
+            if not is_column and not special and isinstance(argument, Literal) and argument.kind == "string":
+                code = f"lit({code})"
+            args.append(code)
+
+        if name == "ApplyMap":
+            return self._translate_applymap(node)
+
+        if node.distinct and name == "Count":
+            return f"countDistinct({', '.join(args)})"
+        return self.function_mapper.map_function(name, args)
+
+    def _translate_applymap(self, node: FunctionCall) -> str:
+
+        # Unmatched keys give the default, or the key itself without one.
+        self._uncacheable = True
+        target = self._applymap_target(node)
+        key = node.arguments[1] if len(node.arguments) > 1 else Literal(value="", kind="string")
+        key_code = self._as_column(*self._translate(key))
+        default = self._as_column(*self._translate(node.arguments[2])) if len(node.arguments) > 2 else key_code
+        if target is None:
+            return default
+
+        map_name = target[0]
+        if self._map_strategies[map_name] in ("literal", "collect"):
+            value = f"map_{map_name}_expr[{key_code}]"
+        else:
+            value = f"col('{self._applymap_column(map_name, key)}')"
+        return f"coalesce({value}, {default})"
 
-    def _wrap_column_refs(self, expr: str) -> str:
+    def _flatten_concat(self, node: Expression) -> List[Expression]:
 
-        if 'col(' in expr or expr.strip().startswith("'") or expr.strip().startswith('"'):
-            return expr
+        if isinstance(node, BinaryOperation) and node.operator == "&":
+            return self._flatten_concat(node.left) + self._flatten_concat(node.right)
+        return [node]
 
-        pattern = r'\b([A-Za-z_]\w*)\b(?!\s*\()'
+    def _parenthesize(self, node: Expression, code: str) -> str:
 
-        def wrap_col(match):
-            col_name = match.group(1)
+        if isinstance(node, BinaryOperation) or (isinstance(node, UnaryOperation) and node.operator == "NOT"):
+            return f"({code})"
+        return code
 
-            keywords = {'and', 'or', 'not', 'True', 'False', 'None'}
-            if col_name.lower() in keywords:
-                return col_name
-            return f"col('{col_name}')"
+    def _as_column(self, code: str, is_column: bool) -> str:
 
-        return re.sub(pattern, wrap_col, expr)
+        return code if is_column else f"lit({code})"
 
     def _convert_expression_to_python(self, expr: str) -> str:
 
@@ -320,9 +1190,14 @@ class PySparkCodeGenerator:
 
     def _to_df_name(self, table_name: str) -> str:
 
-        df_name = re.sub(r'[^a-zA-Z0-9_]', '_', table_name)
-        df_name = re.sub(r'^(\d)', r'_\1', df_name)  
-        return f"df_{df_name.lower()}"
+        df_name = _DF_NAMES.get(table_name)
+        if df_name is None:
+            df_name = re.sub(r'[^a-zA-Z0-9_]', '_', table_name)
+            df_name = re.sub(r'^(\d)', r'_\1', df_name)
+            if len(_DF_NAMES) >= MAX_TRANSLATION_CACHE_SIZE:
+                _DF_NAMES.clear()
+            df_name = _DF_NAMES[table_name] = f"df_{df_name.lower()}"
+        return df_name
 
     def _to_spark_type(self, data_type: DataType) -> str:
 
@@ -337,3 +1212,80 @@ class PySparkCodeGenerator:
             DataType.DECIMAL: "DecimalType()",
         }
         return type_map.get(data_type, "StringType()")
+
+def _normalize_path(path: str) -> str:
+
+    return path.replace("\\", "/").lower()
+
+def _is_merge_shape(table: Optional[TableDefinition]) -> bool:
+
+    # The table is still new rows plus the concatenated history, as when
+    # the pattern was found; later loads into it compile it as written.
+    if table is None or not table.transformations:
+        return False
+    union = table.transformations[-1]
+    return isinstance(union, UnionTransformation) and len(union.parts) == 1
+
+def _table_inputs(table: TableDefinition) -> Set[str]:
+
+    inputs = {dependency for trans in table.transformations for dependency in trans.dependencies}
+    if table.source_type == "resident" and table.source_path:
+        inputs.add(table.source_path)
+    inputs.discard(table.name)
+    return inputs
+
+def _table_files(table: TableDefinition) -> List[str]:
+
+    files = [] if table.source_type != "external" else table.source_paths or [table.source_path]
+    for trans in table.transformations:
+        if isinstance(trans, UnionTransformation):
+            for part in trans.parts:
+                files.extend(_table_files(part))
+        elif isinstance(trans, JoinTransformation) and trans.right is not None:
+            files.extend(_table_files(trans.right))
+    return [path for path in files if path]
+
+def _estimated_rows(table: TableDefinition) -> Optional[int]:
+
+    if table.row_count is not None:
+        return table.row_count
+    if table.size_bytes is not None:
+        return table.size_bytes // BYTES_PER_ROW_ESTIMATE
+    return None
+
+def _plan_joins(transformations: List[Transformation]) -> List[Transformation]:
+
+    # Runs of LEFT and INNER joins onto the table, each keyed only on fields
+    # none of the others adds, give the same result in any order, so the
+    # smallest joined loads go first. Unknown sizes go last.
+    planned: List[Transformation] = []
+    run: List[JoinTransformation] = []
+    for trans in transformations + [None]:
+        if isinstance(trans, JoinTransformation) and trans.right is not None \
+                and trans.join_type in ("left", "inner") and trans.join_keys:
+            run.append(trans)
+            continue
+        added = [{column.name for column in join.right.columns} - set(join.join_keys) for join in run]
+        independent = all(
+            not set(join.join_keys) & columns
+            for i, join in enumerate(run) for j, columns in enumerate(added) if i != j
+        )
+        if independent:
+            run.sort(key=lambda join: (_estimated_rows(join.right) is None, _estimated_rows(join.right) or 0))
+        planned.extend(run)
+        run = []
+        if trans is not None:
+            planned.append(trans)
+    return planned
+
+def _join_warnings(data_model: DataModel) -> List[str]:
+
+    warnings = []
+    for table in data_model.tables.values():
+        for trans in table.transformations:
+            if isinstance(trans, JoinTransformation) and not trans.join_keys and not trans.join_condition:
+                warnings.append(
+                    f"JOIN of {trans.right_table} into {trans.table_name} has no common fields "
+                    f"and becomes a cross join of every row with every row"
+                )
+    return warnings
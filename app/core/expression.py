@@ -0,0 +1,294 @@
+
+from typing import Callable, Dict, Iterator, List, Optional
+from app.core.lexer import QlikLexer, Token, TokenType, join_tokens
+from app.models.ast_models import (
+    Expression, FunctionCall, FieldReference, Literal,
+    VariableReference, BinaryOperation, UnaryOperation
+)
+
+# Qlik operator precedence, loosest first. Comparisons bind looser than
+# string concatenation (&), which binds looser than arithmetic.
+BINARY_PRECEDENCE: Dict[str, int] = {
+    "OR": 1, "XOR": 1,
+    "AND": 2,
+    "=": 4, "<>": 4, "<": 4, ">": 4, "<=": 4, ">=": 4, "LIKE": 4,
+    "&": 5,
+    "+": 6, "-": 6,
+    "*": 7, "/": 7,
+}
+
+NOT_PRECEDENCE = 3
+UNARY_PRECEDENCE = 8
+
+WORD_OPERATORS = {"AND", "OR", "XOR", "LIKE"}
+
+CALL_QUALIFIERS = {"DISTINCT", "TOTAL", "ALL"}
+
+MAX_CACHE_SIZE = 65536
+
+# Deeper nesting is left unparsed rather than risking Python's recursion limit.
+MAX_NESTING_DEPTH = 100
+
+_EXPRESSION_CACHE: Dict[str, Expression] = {}
+
+class ExpressionSyntaxError(ValueError):
+    pass
+
+class ExpressionParser:
+
+    def __init__(self, tokens: List[Token]):
+        self.tokens = [t for t in tokens if t.type != TokenType.EOF]
+        self.pos = 0
+        self.depth = 0
+
+    def parse(self) -> Expression:
+
+        if not self.tokens:
+            raise ExpressionSyntaxError("empty expression")
+        node = self._parse_binary(1)
+        if self.pos < len(self.tokens):
+            raise ExpressionSyntaxError(f"unexpected '{self.tokens[self.pos].value}'")
+        return node
+
+    def _peek(self) -> Optional[Token]:
+
+        return self.tokens[self.pos] if self.pos < len(self.tokens) else None
+
+    def _advance(self) -> Token:
+
+        token = self._peek()
+        if token is None:
+            raise ExpressionSyntaxError("unexpected end of expression")
+        self.pos += 1
+        return token
+
+    def _expect(self, token_type: TokenType) -> Token:
+
+        token = self._advance()
+        if token.type != token_type:
+            raise ExpressionSyntaxError(f"expected {token_type.value}, found '{token.value}'")
+        return token
+
+    def _binary_operator(self) -> Optional[str]:
+
+        token = self._peek()
+        if token is None:
+            return None
+        if token.type == TokenType.OPERATOR and token.value in BINARY_PRECEDENCE:
+            return token.value
+        if token.type == TokenType.IDENT and token.upper in WORD_OPERATORS:
+            return token.upper
+        return None
+
+    def _parse_binary(self, min_precedence: int) -> Expression:
+
+        left = self._parse_unary()
+
+        while True:
+            operator = self._binary_operator()
+            if operator is None or BINARY_PRECEDENCE[operator] < min_precedence:
+                return left
+            self._advance()
+            # All binary operators are left-associative.
+            right = self._parse_binary(BINARY_PRECEDENCE[operator] + 1)
+            left = BinaryOperation(operator=operator, left=left, right=right)
+
+    def _parse_unary(self) -> Expression:
+
+        self.depth += 1
+        if self.depth > MAX_NESTING_DEPTH:
+            raise ExpressionSyntaxError("expression nested too deeply")
+        try:
+            return self._parse_prefixed()
+        finally:
+            self.depth -= 1
+
+    def _parse_prefixed(self) -> Expression:
+
+        token = self._peek()
+        if token is not None and token.is_keyword("NOT"):
+            self._advance()
+            return UnaryOperation(operator="NOT", operand=self._parse_binary(NOT_PRECEDENCE))
+        if token is not None and token.type == TokenType.OPERATOR and token.value in ("-", "+"):
+            self._advance()
+            operand = self._parse_unary()
+            if token.value == "+":
+                return operand
+            if isinstance(operand, Literal) and operand.kind == "number":
+                return Literal(value="-" + operand.value, kind="number")
+            return UnaryOperation(operator="-", operand=operand)
+        return self._parse_primary()
+
+    def _parse_primary(self) -> Expression:
+
+        token = self._advance()
+
+        if token.type == TokenType.LPAREN:
+            node = self._parse_binary(1)
+            self._expect(TokenType.RPAREN)
+            return node
+
+        if token.type == TokenType.NUMBER:
+            return Literal(value=token.value, kind="number")
+
+        if token.type == TokenType.STRING:
+            return Literal(value=token.value[1:-1].replace("''", "'"), kind="string")
+
+        if token.type == TokenType.VARIABLE:
+            return VariableReference(text=token.value[2:-1])
+
+        if token.type in (TokenType.BRACKET, TokenType.QUOTED_IDENT):
+            return FieldReference(name=token.value[1:-1])
+
+        if token.type == TokenType.IDENT:
+            following = self._peek()
+            if following is not None and following.type == TokenType.LPAREN:
+                return self._parse_call(token.value)
+            return FieldReference(name=token.value)
+
+        if token.type == TokenType.OPERATOR and token.value == "*":
+            return FieldReference(name="*")
+
+        raise ExpressionSyntaxError(f"unexpected '{token.value}'")
+
+    def _parse_call(self, function_name: str) -> FunctionCall:
+
+        self._expect(TokenType.LPAREN)
+        arguments: List[Expression] = []
+        distinct = False
+
+        following = self._peek()
+        while following is not None and following.type == TokenType.IDENT \
+                and following.upper in CALL_QUALIFIERS \
+                and self.pos + 1 < len(self.tokens) \
+                and self.tokens[self.pos + 1].type not in (TokenType.COMMA, TokenType.RPAREN, TokenType.LPAREN):
+            distinct = distinct or following.upper == "DISTINCT"
+            self._advance()
+            following = self._peek()
+
+        if following is not None and following.type == TokenType.RPAREN:
+            self._advance()
+            return FunctionCall(function_name=function_name, arguments=arguments, distinct=distinct)
+
+        while True:
+            arguments.append(self._parse_binary(1))
+            token = self._advance()
+            if token.type == TokenType.RPAREN:
+                break
+            if token.type != TokenType.COMMA:
+                raise ExpressionSyntaxError(f"expected ',' or ')', found '{token.value}'")
+
+        return FunctionCall(function_name=function_name, arguments=arguments, distinct=distinct)
+
+def parse_expression_tokens(tokens: List[Token], text: Optional[str] = None) -> Expression:
+
+    # Trees are memoized by normalized text and shared between callers,
+    # so they must be treated as immutable.
+    key = text if text is not None else join_tokens(tokens)
+    node = _EXPRESSION_CACHE.get(key)
+    if node is None:
+        node = ExpressionParser(tokens).parse()
+        _cache_expression(key, node)
+    return node
+
+def parse_expression(text: str) -> Expression:
+
+    node = _EXPRESSION_CACHE.get(text)
+    if node is None:
+        tokens = QlikLexer().tokenize(text)
+        node = parse_expression_tokens(tokens)
+        _cache_expression(text, node)
+    return node
+
+def _cache_expression(key: str, node: Expression):
+
+    if len(_EXPRESSION_CACHE) >= MAX_CACHE_SIZE:
+        _EXPRESSION_CACHE.clear()
+    _EXPRESSION_CACHE[key] = node
+
+def try_parse_expression(text: str) -> Optional[Expression]:
+
+    try:
+        return parse_expression(text)
+    except ExpressionSyntaxError:
+        return None
+
+def walk(node: Expression) -> Iterator[Expression]:
+
+    stack = [node]
+    while stack:
+        current = stack.pop()
+        yield current
+        if isinstance(current, FunctionCall):
+            stack.extend(reversed(current.arguments))
+        elif isinstance(current, BinaryOperation):
+            stack.append(current.right)
+            stack.append(current.left)
+        elif isinstance(current, UnaryOperation):
+            stack.append(current.operand)
+
+def replace_nodes(node: Expression, replace: Callable[[Expression], Optional[Expression]]) -> Expression:
+
+    # A copy of ``node`` with every subtree ``replace`` maps to a new node
+    # swapped out; trees are shared, so they are never changed in place.
+    replacement = replace(node)
+    if replacement is not None:
+        return replacement
+    if isinstance(node, FunctionCall):
+        return node.model_copy(update={"arguments": [replace_nodes(a, replace) for a in node.arguments]})
+    if isinstance(node, BinaryOperation):
+        return node.model_copy(update={
+            "left": replace_nodes(node.left, replace),
+            "right": replace_nodes(node.right, replace),
+        })
+    if isinstance(node, UnaryOperation):
+        return node.model_copy(update={"operand": replace_nodes(node.operand, replace)})
+    return node
+
+def field_references(node: Expression) -> List[str]:
+
+    names = []
+    for current in walk(node):
+        if isinstance(current, FieldReference) and current.name not in names:
+            names.append(current.name)
+    return names
+
+def conjuncts(node: Expression) -> List[Expression]:
+
+    # The terms of an AND chain, in order.
+    if isinstance(node, BinaryOperation) and node.operator == "AND":
+        return conjuncts(node.left) + conjuncts(node.right)
+    return [node]
+
+def to_qlik(node: Expression) -> str:
+
+    if isinstance(node, Literal):
+        if node.kind == "string":
+            return "'" + node.value.replace("'", "''") + "'"
+        return node.value
+    if isinstance(node, FieldReference):
+        if node.name == "*" or node.name.replace("_", "a").isalnum():
+            return node.name
+        return f"[{node.name}]"
+    if isinstance(node, VariableReference):
+        return f"$({node.text})"
+    if isinstance(node, FunctionCall):
+        prefix = "DISTINCT " if node.distinct else ""
+        return f"{node.function_name}({prefix}{', '.join(to_qlik(a) for a in node.arguments)})"
+    if isinstance(node, UnaryOperation):
+        if node.operator == "NOT":
+            return f"NOT {_to_qlik_operand(node.operand, NOT_PRECEDENCE)}"
+        return f"-{_to_qlik_operand(node.operand, UNARY_PRECEDENCE)}"
+    precedence = BINARY_PRECEDENCE[node.operator]
+    left = _to_qlik_operand(node.left, precedence)
+    right = _to_qlik_operand(node.right, precedence + 1)
+    return f"{left} {node.operator} {right}"
+
+def _to_qlik_operand(node: Expression, precedence: int) -> str:
+
+    text = to_qlik(node)
+    if isinstance(node, BinaryOperation) and BINARY_PRECEDENCE[node.operator] < precedence:
+        return f"({text})"
+    if isinstance(node, UnaryOperation) and node.operator == "NOT" and precedence > NOT_PRECEDENCE:
+        return f"({text})"
+    return text
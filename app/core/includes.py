@@ -0,0 +1,194 @@
+
+import hashlib
+import os
+import pickle
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from app.core.lexer import Token
+
+# Bump when the cached token or statement layout changes.
+CACHE_FORMAT_VERSION = 1
+
+MAX_MEMORY_ENTRIES = 1024
+
+MAX_INCLUDE_DEPTH = 32
+
+INCLUDE_DIRECTIVE = re.compile(r"\$\(\s*(must_include|include)\s*=\s*(.*?)\s*\)", re.IGNORECASE | re.DOTALL)
+
+# Directives whose path holds no further macros can be read before parsing.
+_LITERAL_INCLUDE = re.compile(r"\$\(\s*(?:must_)?include\s*=\s*([^$()]+?)\s*\)", re.IGNORECASE)
+
+_LIB_PREFIX = "lib://"
+
+class IncludeError(Exception):
+    pass
+
+class ParsedInclude(NamedTuple):
+
+    tokens: List[Token]
+    # Statements are cached only for macro-free files, whose parse cannot
+    # depend on the variables defined by the including script.
+    statements: Optional[list]
+
+class IncludeCache:
+
+    # Parsed include files keyed by content hash, in memory with an optional
+    # on-disk tier shared by every process pointed at the same directory.
+
+    def __init__(self, cache_dir: Optional[str] = None, max_entries: int = MAX_MEMORY_ENTRIES):
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        self.max_entries = max_entries
+        self._entries: Dict[str, ParsedInclude] = {}
+        self._lock = threading.Lock()
+        if self.cache_dir is not None:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    def get(self, digest: str) -> Optional[ParsedInclude]:
+
+        with self._lock:
+            entry = self._entries.get(digest)
+        if entry is not None or self.cache_dir is None:
+            return entry
+
+        try:
+            with open(self._disk_path(digest), "rb") as f:
+                entry = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError, AttributeError, ImportError):
+            return None
+        self._remember(digest, entry)
+        return entry
+
+    def put(self, digest: str, entry: ParsedInclude):
+
+        self._remember(digest, entry)
+        if self.cache_dir is None:
+            return
+
+        path = self._disk_path(digest)
+        temp = path.with_name(f"{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        try:
+            with open(temp, "wb") as f:
+                pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp, path)
+        except OSError:
+            temp.unlink(missing_ok=True)
+
+    def _remember(self, digest: str, entry: ParsedInclude):
+
+        with self._lock:
+            if len(self._entries) >= self.max_entries:
+                self._entries.pop(next(iter(self._entries)))
+            self._entries[digest] = entry
+
+    def _disk_path(self, digest: str) -> Path:
+
+        return self.cache_dir / f"include-v{CACHE_FORMAT_VERSION}-{digest}.pickle"
+
+class IncludeResolver:
+
+    def __init__(self, roots: Optional[Dict[str, str]] = None, base_dir: Optional[str] = None,
+                 cache: Optional[IncludeCache] = None, max_workers: int = 8):
+        # ``roots`` maps lib:// connection names to directories. Plain paths
+        # are only allowed when ``base_dir`` is given.
+        self.roots = {name.lower(): Path(path) for name, path in (roots or {}).items()}
+        self.base_dir = Path(base_dir) if base_dir is not None else None
+        # Every resolved path must stay inside one of these.
+        self._allowed = [root.resolve() for root in self.roots.values()]
+        if self.base_dir is not None:
+            self._allowed.append(self.base_dir.resolve())
+        self.cache = cache if cache is not None else IncludeCache()
+        self.max_workers = max_workers
+        self._files: Dict[Path, Optional[Tuple[str, str]]] = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_environment(cls, base_dir: Optional[str] = None,
+                         cache: Optional[IncludeCache] = None) -> Optional["IncludeResolver"]:
+
+        # QLIK_LIB_ROOTS="Shared=/mnt/qlik/shared;Config=/mnt/qlik/config"
+        spec = os.getenv("QLIK_LIB_ROOTS", "")
+        roots = dict(
+            item.split("=", 1) for item in spec.split(";") if "=" in item
+        )
+        if not roots and base_dir is None:
+            return None
+        if cache is None:
+            cache = IncludeCache(os.getenv("QLIK_INCLUDE_CACHE_DIR"))
+        return cls(roots=roots, base_dir=base_dir, cache=cache)
+
+    def resolve_path(self, path: str) -> Optional[Path]:
+
+        path = path.strip()
+        if len(path) >= 2 and (path[0], path[-1]) in (("[", "]"), ("'", "'"), ('"', '"')):
+            path = path[1:-1].strip()
+
+        if path.lower().startswith(_LIB_PREFIX):
+            connection, _, rest = path[len(_LIB_PREFIX):].partition("/")
+            root = self.roots.get(connection.lower())
+            if root is None:
+                return None
+            resolved = (root / rest).resolve()
+            # Keep lib:// paths inside their connection root.
+            if not resolved.is_relative_to(root.resolve()):
+                return None
+            return resolved
+
+        if self.base_dir is None:
+            return None
+        # '..' and absolute paths may not leave the base directory or roots.
+        resolved = (self.base_dir / path).resolve()
+        if not any(resolved.is_relative_to(allowed) for allowed in self._allowed):
+            return None
+        return resolved
+
+    def read(self, path: str) -> Optional[Tuple[str, str]]:
+
+        # Returns the file text and its content hash, or None if missing.
+        resolved = self.resolve_path(path)
+        if resolved is None:
+            return None
+        with self._lock:
+            if resolved in self._files:
+                return self._files[resolved]
+        return self._load(resolved)
+
+    def prefetch(self, script_text: str):
+
+        # Reads every include reachable through literal paths concurrently,
+        # level by level, so parsing never waits on the file system for them.
+        pending = self._literal_paths(script_text)
+        if not pending:
+            return
+        seen = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending:
+                batch = [p for p in dict.fromkeys(pending) if p not in seen and p not in self._files]
+                seen.update(batch)
+                pending = []
+                for loaded in pool.map(self._load, batch):
+                    if loaded is not None:
+                        pending.extend(self._literal_paths(loaded[0]))
+
+    def _literal_paths(self, text: str) -> List[Path]:
+
+        paths = []
+        for m in _LITERAL_INCLUDE.finditer(text):
+            resolved = self.resolve_path(m.group(1))
+            if resolved is not None:
+                paths.append(resolved)
+        return paths
+
+    def _load(self, resolved: Path) -> Optional[Tuple[str, str]]:
+
+        try:
+            data = resolved.read_bytes()
+        except OSError:
+            loaded = None
+        else:
+            loaded = (data.decode("utf-8-sig"), hashlib.sha256(data).hexdigest())
+        with self._lock:
+            self._files[resolved] = loaded
+        return loaded
@@ -0,0 +1,444 @@
+
+from typing import Any, Dict, List, NamedTuple, Optional, Set, Tuple
+from app.core.codegen import ConcurrencyOptions, PersistOptions, PySparkCodeGenerator, WriteOptions
+from app.core.optimizer import IROptimizer
+from app.core.includes import INCLUDE_DIRECTIVE, IncludeResolver
+from app.core.lexer import QlikLexer, TokenType, group_loops, loop_balance
+from app.core.migration import MigrationManifest
+from app.core.parser import QlikParser
+from app.core.schema import SchemaResolver
+from app.core.semantic import SemanticModelGenerator
+from app.core.transformer import ASTTransformer, expand_loops
+from app.models.ast_models import DropStatement, LoadStatement, LoadType, MappingLoad, Script, StoreStatement, VariableAssignment
+from app.models.ir_models import DataModel, DataType, MappingDefinition, StoreDefinition, TableDefinition
+
+# One-character matches for these mean a string, quoted name, bracket or
+# comment was left open, so lexing a region alone may not match a full lex.
+_OPENERS = {"'", '"', "["}
+
+class _Chunk:
+
+    # One statement's source text, from just after the previous ';' up to
+    # and including its own, with what it parsed and transformed to.
+
+    __slots__ = ("text", "has_macros", "has_include", "env_key", "statements", "assignments", "records")
+
+    def __init__(self, text: str):
+        self.text = text
+        self.has_macros = "$(" in text
+        self.has_include = self.has_macros and INCLUDE_DIRECTIVE.search(text) is not None
+        self.env_key: Optional[int] = None
+        self.statements: Optional[list] = None
+        self.assignments: List[VariableAssignment] = []
+        self.records: List["_TransformRecord"] = []
+
+class _TransformRecord(NamedTuple):
+
+    statement: object
+    counter_before: int
+    counter_after: int
+    # Column types the statement looked up and those it assigned.
+    reads: Dict[str, Optional[DataType]]
+    writes: List[Tuple[str, DataType]]
+    # Tables whose definitions the statement read or extended, as they were
+    # then (None for tables that did not exist yet).
+    inputs: Dict[str, Optional[TableDefinition]]
+    # The table layout and dropped tables, when the statement scanned them.
+    layout: Optional[Tuple[int, Tuple[str, ...]]]
+    # Files it loaded, with the schema resolver's token for each.
+    sources: Dict[str, Optional[str]]
+    table: Optional[TableDefinition]
+    mapping: Optional[MappingDefinition]
+    variable: Optional[VariableAssignment]
+    store: Optional[StoreDefinition]
+
+class _RecordingTypes(dict):
+
+    def __init__(self):
+        super().__init__()
+        self.reads: Dict[str, Optional[DataType]] = {}
+        self.writes: List[Tuple[str, DataType]] = []
+
+    def get(self, key, default=None):
+
+        value = dict.get(self, key)
+        self.reads.setdefault(key, value)
+        return default if value is None else value
+
+    def __setitem__(self, key, value):
+
+        self.writes.append((key, value))
+        dict.__setitem__(self, key, value)
+
+class _RecordingTables(dict):
+
+    # Tables by name, noting what each name held before a statement set it,
+    # which names the statement looked up and whether it scanned them all.
+    # ``layout`` hashes the sequence of table names and field lists set, so
+    # equal values mean every scan (Exists(), auto-concatenation, the
+    # previous table) sees the same tables and fields.
+
+    def __init__(self):
+        super().__init__()
+        self.replaced: Dict[str, Optional[TableDefinition]] = {}
+        self.looked_up: Set[str] = set()
+        self.scanned = False
+        self.layout = 0
+
+    def reset(self):
+
+        self.replaced, self.looked_up, self.scanned = {}, set(), False
+
+    def get(self, key, default=None):
+
+        self.looked_up.add(key)
+        return dict.get(self, key, default)
+
+    def __getitem__(self, key):
+
+        self.looked_up.add(key)
+        return dict.__getitem__(self, key)
+
+    def __contains__(self, key):
+
+        self.looked_up.add(key)
+        return dict.__contains__(self, key)
+
+    def __iter__(self):
+
+        self.scanned = True
+        return dict.__iter__(self)
+
+    def __reversed__(self):
+
+        self.scanned = True
+        return dict.__reversed__(self)
+
+    def keys(self):
+
+        self.scanned = True
+        return dict.keys(self)
+
+    def values(self):
+
+        self.scanned = True
+        return dict.values(self)
+
+    def items(self):
+
+        self.scanned = True
+        return dict.items(self)
+
+    def __setitem__(self, key, value):
+
+        old = dict.get(self, key)
+        self.replaced.setdefault(key, old)
+        fields = tuple(column.name for column in value.columns)
+        if old is None or tuple(column.name for column in old.columns) != fields:
+            self.layout = hash((self.layout, key, fields))
+        dict.__setitem__(self, key, value)
+
+class IncrementalResult:
+
+    def __init__(self, script: Script, data_model: DataModel, pyspark_code: str,
+                 reparsed_statements: int, retransformed_tables: List[str]):
+        self.script = script
+        self.data_model = data_model
+        self.pyspark_code = pyspark_code
+        self.reparsed_statements = reparsed_statements
+        self.retransformed_tables = retransformed_tables
+        self._semantic_model: Optional[Dict[str, Any]] = None
+
+    @property
+    def semantic_model(self) -> Dict[str, Any]:
+
+        # Built on first use; editors usually only need the code.
+        if self._semantic_model is None:
+            self._semantic_model = SemanticModelGenerator().generate(self.data_model)
+        return self._semantic_model
+
+class IncrementalConverter:
+
+    # Keeps the previous run's statements, transform results and generated
+    # table blocks, and on each call redoes only what the edit affects.
+
+    def __init__(self, fabric_compatible: bool = True, mode: str = "transformation",
+                 include_resolver: Optional[IncludeResolver] = None,
+                 write_options: Optional[WriteOptions] = None, persist_options: Optional[PersistOptions] = None,
+                 optimizer: Optional[IROptimizer] = None, concurrency_options: Optional[ConcurrencyOptions] = None,
+                 schema_resolver: Optional[SchemaResolver] = None, qvd_manifest: Optional[MigrationManifest] = None):
+        self.codegen = PySparkCodeGenerator(fabric_compatible=fabric_compatible, qvd_manifest=qvd_manifest,
+                                            write_options=write_options, persist_options=persist_options,
+                                            concurrency_options=concurrency_options)
+        self.schema_resolver = schema_resolver
+        # Its rules rewrite an unchanged table to the same object again, so
+        # the table blocks generated from it are still reused.
+        self.optimizer = optimizer if optimizer is not None else IROptimizer()
+        self.mode = mode
+        self.include_resolver = include_resolver
+        self._text: Optional[str] = None
+        self._chunks: List[_Chunk] = []
+        self._data_model: Optional[DataModel] = None
+        self._result: Optional[IncrementalResult] = None
+        self._table_blocks: Dict[str, Tuple[TableDefinition, List[str]]] = {}
+
+    def convert(self, script_text: str) -> IncrementalResult:
+
+        if script_text == self._text and self._result is not None:
+            result = self._result
+            return IncrementalResult(result.script, result.data_model, result.pyspark_code, 0, [])
+
+        previous = {chunk.text: chunk for chunk in self._chunks}
+        self._chunks = self._split_changed(script_text)
+        self._text = script_text
+
+        reparsed, statements = self._parse(previous)
+        data_model, retransformed = self._transform()
+        optimized, _ = self.optimizer.optimize(data_model)
+        pyspark_code = self.codegen.generate(optimized, self.mode, self._table_blocks)
+        for name in [name for name in self._table_blocks if name not in optimized.tables]:
+            del self._table_blocks[name]
+
+        # The next edit is transformed against the model before optimizing.
+        self._data_model = data_model
+        self._result = IncrementalResult(
+            script=Script.model_construct(statements=statements),
+            data_model=optimized,
+            pyspark_code=pyspark_code,
+            reparsed_statements=reparsed,
+            retransformed_tables=retransformed
+        )
+        return self._result
+
+    def _split_changed(self, text: str) -> List[_Chunk]:
+
+        old = self._text
+        if old is None:
+            return self._split(text, 0, len(text)) or []
+        if old == text:
+            return self._chunks
+
+        # Only the statements overlapping the edited span are re-lexed.
+        prefix = _common_prefix_length(old, text)
+        suffix = _common_suffix_length(old, text, min(len(old), len(text)) - prefix)
+
+        chunks = self._chunks
+        first, start = 0, 0
+        while first < len(chunks) and start + len(chunks[first].text) <= prefix:
+            start += len(chunks[first].text)
+            first += 1
+        last, tail = len(chunks), 0
+        while last > first and tail + len(chunks[last - 1].text) <= suffix:
+            tail += len(chunks[last - 1].text)
+            last -= 1
+
+        region = self._split(text, start, len(text) - tail)
+        if region is None:
+            return self._split(text, 0, len(text)) or []
+        return chunks[:first] + region + chunks[last:]
+
+    def _split(self, text: str, start: int, end: int) -> Optional[List[_Chunk]]:
+
+        # Returns None when the region does not lex the same on its own as
+        # within the whole script (an opener left unclosed, or no ';' at its
+        # end), so the caller falls back to splitting everything.
+        segment = text[start:end]
+        tokens = QlikLexer().tokenize(segment)
+        # Running to the end of the script, the region lexes exactly as a whole.
+        open_ended = end == len(text)
+
+        chunks = []
+        chunk_start = 0
+        previous = None
+        for token in tokens:
+            if token.type is TokenType.SEMICOLON:
+                chunks.append(_Chunk(segment[chunk_start:token.end]))
+                chunk_start = token.end
+            elif token.type is TokenType.OPERATOR and not open_ended:
+                if token.value in _OPENERS:
+                    return None
+                if token.value == "*" and previous is not None and previous.value == "/" \
+                        and previous.end == token.start:
+                    return None
+            previous = token
+
+        if chunk_start < len(segment):
+            if not open_ended:
+                return None
+            chunks.append(_Chunk(segment[chunk_start:]))
+        # A FOR loop is one chunk from its FOR line through its NEXT.
+        if not open_ended and loop_balance(segment) != 0:
+            return None
+        if any(loop_balance(chunk.text) for chunk in chunks):
+            chunks = [_Chunk(text) for text in group_loops(chunk.text for chunk in chunks)]
+        return chunks
+
+    def _parse(self, previous: Dict[str, _Chunk]) -> Tuple[int, list]:
+
+        # Statements are replayed in order so macros see the same variables
+        # as in a full parse; a chunk is reused when its text is unchanged
+        # and, if it holds macros, the variables before it are too.
+        parser = QlikParser(include_resolver=self.include_resolver)
+        env_key = 0
+        reparsed = 0
+        statements = []
+
+        for chunk in self._chunks:
+            old = previous.get(chunk.text)
+            reusable = old is not None and old.statements is not None and not chunk.has_include \
+                and (not chunk.has_macros or old.env_key == env_key)
+
+            if not chunk.text.strip():
+                chunk.statements, chunk.assignments, chunk.records = [], [], []
+            elif reusable:
+                if old is not chunk:
+                    chunk.statements, chunk.assignments, chunk.records = old.statements, old.assignments, old.records
+                for statement in chunk.assignments:
+                    parser.assign_variable(statement.variable_name, statement.value, statement.is_let)
+            else:
+                chunk.statements = expand_loops(parser.parse(chunk.text).statements)
+                chunk.assignments = [s for s in chunk.statements if isinstance(s, VariableAssignment)]
+                chunk.records = []
+                reparsed += 1
+
+            chunk.env_key = env_key
+            for statement in chunk.assignments:
+                env_key = hash((env_key, statement.variable_name, parser.variables.get(statement.variable_name)))
+            statements.extend(chunk.statements)
+
+        return reparsed, statements
+
+    def _transform(self) -> Tuple[DataModel, List[str]]:
+
+        transformer = ASTTransformer(schema_resolver=self.schema_resolver)
+        types = _RecordingTypes()
+        transformer.column_types = types
+        tables = transformer.data_model.tables = _RecordingTables()
+        old_tables = self._data_model.tables if self._data_model is not None else {}
+        retransformed: List[str] = []
+
+        for chunk in self._chunks:
+            records = chunk.records
+            updated = []
+            for index, statement in enumerate(chunk.statements):
+                record = records[index] if index < len(records) else None
+                if record is not None and record.statement is statement and self._can_reuse(record, transformer, types):
+                    self._replay(record, transformer, types)
+                    updated.append(record)
+                    continue
+
+                types.reads, types.writes = {}, []
+                counter_before = transformer.table_counter
+                tables.reset()
+                layout = (tables.layout, tuple(transformer.data_model.dropped_tables))
+                result = transformer.add_statement(statement)
+                looked_up, scanned = tables.looked_up, tables.scanned
+
+                table = result if isinstance(result, TableDefinition) else None
+                if table is not None:
+                    if result.name not in retransformed:
+                        retransformed.append(result.name)
+                    old_table = old_tables.get(result.name)
+                    if old_table is not None and old_table == result:
+                        # Keep the previous object so its code block, and
+                        # the records reading it, are reused.
+                        table = old_table
+                        transformer.data_model.tables[table.name] = table
+
+                updated.append(_TransformRecord(
+                    statement=statement,
+                    counter_before=counter_before,
+                    counter_after=transformer.table_counter,
+                    reads=types.reads,
+                    writes=types.writes,
+                    inputs={
+                        name: tables.replaced[name] if name in tables.replaced else dict.get(tables, name)
+                        for name in looked_up | _table_inputs(statement, table)
+                    },
+                    layout=layout if scanned else None,
+                    sources=self._source_tokens(statement),
+                    table=table,
+                    mapping=result if isinstance(result, MappingDefinition) else None,
+                    variable=statement if isinstance(statement, VariableAssignment) else None,
+                    store=result if isinstance(result, StoreDefinition) else None
+                ))
+            chunk.records = updated
+
+        transformer.data_model.tables = dict(tables)
+        return transformer.finalize(self._data_model), retransformed
+
+    def _can_reuse(self, record: _TransformRecord, transformer: ASTTransformer, types: _RecordingTypes) -> bool:
+
+        # Every table the statement read must be the very object it saw, so
+        # one renamed, removed or changed since then redoes the statement; a
+        # statement that scanned every table also needs the same layout.
+        if record.counter_before != transformer.table_counter:
+            return False
+        tables = transformer.data_model.tables
+        if any(dict.get(tables, name) is not table for name, table in record.inputs.items()):
+            return False
+        if record.layout is not None and record.layout != (tables.layout, tuple(transformer.data_model.dropped_tables)):
+            return False
+        if record.sources != self._source_tokens(record.statement):
+            return False
+        return all(dict.get(types, name) == value for name, value in record.reads.items())
+
+    def _source_tokens(self, statement: object) -> Dict[str, Optional[str]]:
+
+        # A file load is typed from its source, so it is redone once the file changes.
+        if self.schema_resolver is None or not isinstance(statement, (LoadStatement, MappingLoad)) \
+                or statement.load_type != LoadType.EXTERNAL or not statement.source:
+            return {}
+        paths = getattr(statement, "sources", None) or [statement.source]
+        return {path: self.schema_resolver.token(path) for path in paths}
+
+    def _replay(self, record: _TransformRecord, transformer: ASTTransformer, types: _RecordingTypes):
+
+        transformer.table_counter = record.counter_after
+        for name, data_type in record.writes:
+            dict.__setitem__(types, name, data_type)
+
+        if record.table is not None:
+            transformer.data_model.tables[record.table.name] = record.table
+        elif record.mapping is not None:
+            transformer.data_model.mappings[record.mapping.mapping_name] = record.mapping
+        elif record.variable is not None or isinstance(record.statement, DropStatement):
+            transformer.add_statement(record.statement)
+        elif record.store is not None:
+            transformer.data_model.stores.append(record.store)
+
+def _table_inputs(statement: object, table: Optional[TableDefinition]) -> Set[str]:
+
+    names = []
+    if isinstance(statement, LoadStatement):
+        names = [statement.source, statement.join_clause.table_name if statement.join_clause else None]
+    elif isinstance(statement, StoreStatement):
+        # Whether a STORE is an incremental merge depends on its table.
+        names = [statement.table_name]
+    if table is not None:
+        # A join also reads an earlier table of the same name.
+        names.append(table.name)
+    return {name for name in names if name}
+
+def _common_prefix_length(a: str, b: str) -> int:
+
+    # Binary search over slice comparisons, which run at C speed.
+    low, high = 0, min(len(a), len(b))
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[:middle] == b[:middle]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+def _common_suffix_length(a: str, b: str, limit: int) -> int:
+
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if a[len(a) - middle:] == b[len(b) - middle:]:
+            low = middle
+        else:
+            high = middle - 1
+    return low
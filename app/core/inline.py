@@ -0,0 +1,195 @@
+
+import re
+from array import array
+from itertools import accumulate
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple, Union
+
+class StringColumn(Sequence):
+
+    # All values live in one string; ``offsets[i]:offsets[i + 1]`` is row i.
+    # Null cells are tracked separately so empty strings stay distinct.
+
+    def __init__(self, values: Sequence[Optional[str]]):
+        texts = [v if v is not None else "" for v in values]
+        self.data = "".join(texts)
+        self.offsets = array('q', accumulate(map(len, texts), initial=0))
+        self.nulls = array('b', [v is None for v in values])
+
+    def __len__(self) -> int:
+        return len(self.nulls)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if self.nulls[index]:
+            return None
+        return self.data[self.offsets[index]:self.offsets[index + 1]]
+
+    def __eq__(self, other) -> bool:
+        return list(self) == list(other)
+
+Column = Union[array, StringColumn]
+
+class InlineTable:
+
+    # An INLINE block is kept as an offset range into the script text and
+    # only split into cells when headers, columns or rows are first used.
+
+    def __init__(self, source: str, start: int, end: int, delimiter: str = ",",
+                 has_labels: bool = True):
+        self.source = source
+        self.start = start
+        self.end = end
+        self.delimiter = delimiter
+        self.has_labels = has_labels
+        self._headers: Optional[List[str]] = None
+        self._columns: Optional[Dict[str, Column]] = None
+
+    @property
+    def text(self) -> str:
+        return self.source[self.start:self.end]
+
+    @property
+    def headers(self) -> List[str]:
+
+        if self._headers is None:
+            first_row = next(self._iter_rows(), [])
+            if self.has_labels:
+                self._headers = [value or "" for value in first_row]
+            else:
+                self._headers = [f"@{i}" for i in range(1, len(first_row) + 1)]
+        return self._headers
+
+    @property
+    def columns(self) -> Dict[str, Column]:
+
+        if self._columns is None:
+            self._columns = self._decode_columns()
+        return self._columns
+
+    @property
+    def row_count(self) -> int:
+
+        columns = self.columns
+        return len(next(iter(columns.values()))) if columns else 0
+
+    def rows(self) -> Iterator[Tuple]:
+
+        columns = list(self.columns.values())
+        for i in range(self.row_count):
+            yield tuple(column[i] for column in columns)
+
+    def _iter_rows(self) -> Iterator[List[Optional[str]]]:
+
+        delimiter = self.delimiter
+        pattern = _cell_pattern(delimiter)
+
+        for line in self.text.split("\n"):
+            if not line or line.isspace():
+                continue
+            if "'" in line or '"' in line:
+                row = []
+                pos = 0
+                while True:
+                    m = pattern.match(line, pos)
+                    if m.group("double") is not None:
+                        row.append(m.group("double").replace('""', '"'))
+                    elif m.group("single") is not None:
+                        row.append(m.group("single").replace("''", "'"))
+                    else:
+                        row.append(m.group("plain").strip() or None)
+                    if not m.group("sep"):
+                        break
+                    pos = m.end()
+            else:
+                row = [cell.strip() or None for cell in line.split(delimiter)]
+            yield row
+
+    def _decode_columns(self) -> Dict[str, Column]:
+
+        rows = self._iter_rows()
+        if self.has_labels:
+            next(rows, None)
+
+        headers = self.headers
+        width = len(headers)
+        padding = [None] * width
+        raw = list(zip(*(row[:width] if len(row) >= width else row + padding[len(row):] for row in rows)))
+        if not raw:
+            raw = [() for _ in headers]
+
+        return {name: _to_typed_column(values) for name, values in zip(headers, raw)}
+
+    def __eq__(self, other) -> bool:
+
+        if not isinstance(other, InlineTable):
+            return NotImplemented
+        return (self.text, self.delimiter, self.has_labels) == (other.text, other.delimiter, other.has_labels)
+
+    def __getstate__(self):
+
+        # Serialize only this block, not the whole script it points into.
+        return {"source": self.text, "delimiter": self.delimiter, "has_labels": self.has_labels}
+
+    def __setstate__(self, state):
+
+        self.__init__(state["source"], 0, len(state["source"]), state["delimiter"], state["has_labels"])
+
+    def __repr__(self) -> str:
+
+        return f"InlineTable(headers={self.headers!r}, delimiter={self.delimiter!r})"
+
+_CELL_PATTERNS: Dict[str, "re.Pattern"] = {}
+
+def _cell_pattern(delimiter: str) -> "re.Pattern":
+
+    if delimiter not in _CELL_PATTERNS:
+        d = re.escape(delimiter)
+        _CELL_PATTERNS[delimiter] = re.compile(
+            rf"""[ \t]*(?:
+                  "(?P<double>[^"]*(?:""[^"]*)*)"[ \t\r]*(?={d}|$)
+                | '(?P<single>[^']*(?:''[^']*)*)'[ \t\r]*(?={d}|$)
+                | (?P<plain>[^{d}]*)
+            )(?P<sep>{d}|$)""",
+            re.VERBOSE
+        )
+    return _CELL_PATTERNS[delimiter]
+
+def _to_typed_column(values: Sequence[Optional[str]]) -> Column:
+
+    if values and all(v is not None for v in values):
+        try:
+            return array('q', [int(v) for v in values])
+        except (ValueError, OverflowError):
+            pass
+        try:
+            return array('d', [float(v) for v in values])
+        except ValueError:
+            pass
+    return StringColumn(values)
+
+def parse_format_spec(spec: str) -> Dict[str, object]:
+
+    # Reads the options of a ``(txt, delimiter is ';', no labels)`` spec.
+    options: Dict[str, object] = {}
+    for item in _SPEC_ITEM.findall(spec.strip().lstrip("(").rstrip(")")):
+        item = item.strip()
+        lowered = item.lower()
+        if lowered.startswith("delimiter is"):
+            value = item[len("delimiter is"):].strip()
+            if len(value) >= 2 and value[0] == value[-1] and value[0] in "'\"":
+                value = value[1:-1]
+            options["delimiter"] = _DELIMITER_ALIASES.get(value.lower(), value)
+        elif lowered == "no labels":
+            options["has_labels"] = False
+        elif lowered in ("embedded labels", "explicit labels"):
+            options["has_labels"] = True
+        elif lowered:
+            options.setdefault("format", lowered)
+    return options
+
+_SPEC_ITEM = re.compile(r"(?:'[^']*'|\"[^\"]*\"|[^,])+")
+
+_DELIMITER_ALIASES = {"\\t": "\t", "tab": "\t", "spaces": " "}
@@ -0,0 +1,283 @@
+
+import re
+from enum import Enum
+from typing import Iterable, Iterator, List, NamedTuple, Optional
+
+class TokenType(str, Enum):
+    IDENT = "ident"
+    NUMBER = "number"
+    STRING = "string"
+    QUOTED_IDENT = "quoted_ident"
+    BRACKET = "bracket"
+    VARIABLE = "variable"
+    OPERATOR = "operator"
+    LPAREN = "lparen"
+    RPAREN = "rparen"
+    COMMA = "comma"
+    SEMICOLON = "semicolon"
+    COLON = "colon"
+    EOF = "eof"
+
+class Token(NamedTuple):
+
+    type: TokenType
+    value: str
+    start: int
+    end: int
+    line: int
+
+    @property
+    def upper(self) -> str:
+        return self.value.upper()
+
+    def is_keyword(self, *keywords: str) -> bool:
+        return self.type == TokenType.IDENT and self.value.upper() in keywords
+
+# Every alternative is either a fixed string or an unrolled loop
+# (``x[^x]*(?:...)*``), so each character of the input is consumed by
+# exactly one branch and the scan never backtracks. Leading whitespace is
+# folded into each match and the branches are ordered by frequency.
+_TOKEN_PATTERN = re.compile(r"""\s*(?:
+      (?P<ident>(?:[^\W\d]|@)[\w\#.]*)
+    | (?P<comma>,)
+    | (?P<lparen>\()
+    | (?P<rparen>\))
+    | (?P<string>'[^']*(?:''[^']*)*')
+    | (?P<line_comment>//[^\n]*)
+    | (?P<block_comment>/\*[^*]*\*+(?:[^/*][^*]*\*+)*/)
+    | (?P<number>\d+(?:\.\d+)?(?:[eE][+-]?\d+)?)
+    | (?P<operator><>|<=|>=|[-+*/&=<>!^])
+    | (?P<quoted_ident>"[^"]*")
+    | (?P<bracket>\[[^\]]*\])
+    | (?P<variable>\$\()
+    | (?P<semicolon>;)
+    | (?P<colon>:)
+    | (?P<other>.)
+    | \Z)
+""", re.VERBOSE | re.DOTALL)
+
+_GROUP_TYPES = {
+    "string": TokenType.STRING,
+    "quoted_ident": TokenType.QUOTED_IDENT,
+    "bracket": TokenType.BRACKET,
+    "variable": TokenType.VARIABLE,
+    "number": TokenType.NUMBER,
+    "ident": TokenType.IDENT,
+    "operator": TokenType.OPERATOR,
+    "lparen": TokenType.LPAREN,
+    "rparen": TokenType.RPAREN,
+    "comma": TokenType.COMMA,
+    "semicolon": TokenType.SEMICOLON,
+    "colon": TokenType.COLON,
+    "other": TokenType.OPERATOR,
+}
+
+_SKIPPED_GROUPS = {None, "line_comment", "block_comment", "rem"}
+_MULTILINE_GROUPS = {"string", "quoted_ident", "bracket", "variable"}
+
+_LOOKAHEAD_MARGIN = 4
+_REM_END = re.compile(r"[^;]*;?")
+_PARENS = re.compile(r"[()]")
+
+_BLOCK_COMMENT = r"/\*[^*]*\*+(?:[^/*][^*]*\*+)*/"
+
+# What can hide a semicolon from the lexer, or is one.
+_STATEMENT_BREAK = re.compile(r"""'[^']*(?:''[^']*)*'|"[^"]*"|\[[^\]]*\]|//[^\n]*|""" + _BLOCK_COMMENT + r"|\$\(|;")
+_SKIPPED = re.compile(r"(?:\s+|//[^\n]*|" + _BLOCK_COMMENT + r")*")
+_REM = re.compile(r"REM(?![\w#.])", re.IGNORECASE)
+
+# Lines opening and closing a FOR loop, which spans statements.
+LOOP_START = re.compile(r"^[ \t]*FOR[ \t]+(?:EACH\b|[\w.]+[ \t]*=)", re.IGNORECASE | re.MULTILINE)
+_LOOP_END = re.compile(r"^[ \t]*NEXT\b", re.IGNORECASE | re.MULTILINE)
+
+_new_token = tuple.__new__
+
+class QlikLexer:
+
+    def __init__(self, at_statement_start: bool = True):
+        self.line = 1
+        self._at_statement_start = at_statement_start
+        self._consumed = 0
+
+    def tokenize(self, script_text: str) -> List[Token]:
+
+        tokens = self._scan(script_text, 0, final=True)
+        end = len(script_text)
+        tokens.append(_new_token(Token, (TokenType.EOF, "", end, end, self.line)))
+        return tokens
+
+    def iter_tokens(self, chunks: Iterable[str]) -> Iterator[Token]:
+
+        buffer = ""
+        base = 0
+        chunk_iter = iter(chunks)
+        lookahead = next(chunk_iter, None)
+
+        while lookahead is not None:
+            # Grow the buffer geometrically while a single token spans
+            # several chunks so long INLINE blocks stay linear overall.
+            pending = [buffer]
+            pending_size = 0
+            while lookahead is not None and pending_size < max(len(buffer), 1):
+                pending.append(lookahead)
+                pending_size += len(lookahead)
+                lookahead = next(chunk_iter, None)
+            buffer = "".join(pending)
+
+            yield from self._scan(buffer, base, final=lookahead is None)
+
+            buffer = buffer[self._consumed:]
+            base += self._consumed
+
+        end = base + len(buffer)
+        yield _new_token(Token, (TokenType.EOF, "", end, end, self.line))
+
+    def _scan(self, text: str, base: int, final: bool) -> List[Token]:
+
+        tokens: List[Token] = []
+        append = tokens.append
+        pos = 0
+        length = len(text)
+        line = self.line
+        count = text.count
+        group_types = _GROUP_TYPES
+        skipped = _SKIPPED_GROUPS
+        multiline = _MULTILINE_GROUPS
+        semicolon = TokenType.SEMICOLON
+        self._consumed = 0
+
+        while pos < length:
+            for m in _TOKEN_PATTERN.finditer(text, pos):
+                kind = m.lastgroup
+                end = m.end()
+                start = m.start(kind) if kind else end
+                restart = False
+
+                if kind == "variable":
+                    end = _match_parens(text, end)
+                    restart = True
+                elif self._at_statement_start and kind == "ident" and m.group(kind).upper() == "REM":
+                    kind = "rem"
+                    end = _REM_END.match(text, end).end()
+                    restart = True
+
+                if not final and self._is_incomplete(text, start, end, kind):
+                    self.line = line
+                    return tokens
+
+                line += count("\n", self._consumed, start)
+                if kind in skipped:
+                    line += count("\n", start, end)
+                else:
+                    token_type = group_types[kind]
+                    token = _new_token(Token, (token_type, text[start:end], base + start, base + end, line))
+                    if kind in multiline:
+                        line += count("\n", start, end)
+                    self._at_statement_start = token_type is semicolon
+                    append(token)
+                self._consumed = end
+
+                if restart or end >= length:
+                    pos = end
+                    break
+            else:
+                pos = length
+
+        self.line = line
+        return tokens
+
+    def _is_incomplete(self, text: str, pos: int, end: int, kind: str) -> bool:
+
+        # A token close to the end of the buffer may continue in the next
+        # chunk (``1.`` -> ``1.5``, ``<`` -> ``<>``), a string followed by a
+        # quote may be an escaped ``''``, and an opener that fell through to
+        # a one-character match has not seen its closing delimiter yet.
+        if end + _LOOKAHEAD_MARGIN >= len(text):
+            return True
+        if kind == "rem":
+            return text[end - 1] != ";"
+        if kind == "string":
+            return text[end] == "'"
+        if kind is None:
+            return False
+        char = text[pos]
+        if kind == "other":
+            return char in ("'", '"', "[")
+        return char == "/" and kind == "operator" and text[pos + 1] == "*"
+
+def split_statements(script_text: str) -> List[str]:
+
+    # Cuts the script after each semicolon the lexer would emit, without
+    # building tokens: only quotes, comments, macros and REM are tracked.
+    statements = []
+    start = pos = 0
+    at_statement_start = True
+    while True:
+        if at_statement_start:
+            m = _REM.match(script_text, _SKIPPED.match(script_text, pos).end())
+            if m is not None:
+                pos = _REM_END.match(script_text, m.end()).end()
+                continue
+            at_statement_start = False
+        m = _STATEMENT_BREAK.search(script_text, pos)
+        if m is None:
+            break
+        pos = m.end()
+        if m.group() == ";":
+            statements.append(script_text[start:pos])
+            start = pos
+            at_statement_start = True
+        elif m.group() == "$(":
+            pos = _match_parens(script_text, pos)
+
+    if start < len(script_text):
+        statements.append(script_text[start:])
+    return statements
+
+def loop_balance(text: str) -> int:
+
+    # FOR lines opened minus NEXT lines closed in ``text``.
+    return len(LOOP_START.findall(text)) - len(_LOOP_END.findall(text))
+
+def group_loops(statements: Iterable[str]) -> List[str]:
+
+    # Joins the statements from a FOR line through its NEXT into one text,
+    # since a loop's body is parsed once per value.
+    grouped = []
+    pending = []
+    depth = 0
+    for text in statements:
+        if depth > 0 or LOOP_START.search(text):
+            pending.append(text)
+            depth = max(depth + loop_balance(text), 0)
+            if depth == 0:
+                grouped.append("".join(pending))
+                pending = []
+        else:
+            grouped.append(text)
+    if pending:
+        grouped.append("".join(pending))
+    return grouped
+
+def _match_parens(text: str, pos: int) -> int:
+
+    depth = 1
+    search = _PARENS.search
+    while depth:
+        m = search(text, pos)
+        if m is None:
+            return len(text)
+        depth += 1 if m.group() == "(" else -1
+        pos = m.end()
+    return pos
+
+def join_tokens(tokens: List[Token]) -> str:
+
+    parts = []
+    previous: Optional[Token] = None
+    for token in tokens:
+        if previous is not None and token.start > previous.end:
+            parts.append(" ")
+        parts.append(token.value)
+        previous = token
+    return "".join(parts)
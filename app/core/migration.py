@@ -0,0 +1,236 @@
+
+import json
+import os
+import shutil
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+from app.core.qvd import DEFAULT_BATCH_ROWS, QvdReader, qvd_header_digest
+
+MANIFEST_NAME = "_qvd_manifest.json"
+
+# Bump when the manifest layout changes.
+MANIFEST_VERSION = 2
+
+OUTPUT_FORMATS = {"parquet": ".parquet", "delta": ".delta"}
+
+class MigrationError(Exception):
+    pass
+
+class MigrationResult(NamedTuple):
+
+    migrated: List[str]
+    skipped: List[str]
+    # Source path relative to the source root -> error message.
+    failed: Dict[str, str]
+
+class MigrationManifest:
+
+    # Records every migrated QVD by its path relative to the source root,
+    # with what identifies its content, so re-runs skip unchanged files
+    # and generated code can find the migrated copy.
+
+    def __init__(self, path: Optional[str] = None, target_uri: Optional[str] = None,
+                 entries: Optional[Dict[str, dict]] = None):
+        self.path = Path(path) if path else None
+        # Where generated code reads the output from; defaults to the
+        # directory holding the manifest.
+        self.target_uri = target_uri or (str(self.path.parent) if self.path else "")
+        self.entries: Dict[str, dict] = dict(entries or {})
+        self._by_name: Optional[Dict[str, List[str]]] = None
+
+    @classmethod
+    def load(cls, path: str) -> "MigrationManifest":
+
+        try:
+            with open(path, encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return cls(path)
+        except (OSError, ValueError) as e:
+            raise MigrationError(f"Unreadable QVD manifest {path}: {e}") from e
+        if data.get("version") != MANIFEST_VERSION:
+            return cls(path)
+        return cls(path, data.get("target_uri"), data.get("files", {}))
+
+    @classmethod
+    def from_environment(cls) -> Optional["MigrationManifest"]:
+
+        # QLIK_QVD_MANIFEST=/lakehouse/Files/qvd/_qvd_manifest.json
+        path = os.getenv("QLIK_QVD_MANIFEST")
+        return cls.load(path) if path else None
+
+    def save(self):
+
+        temp = self.path.with_name(f"{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        payload = {"version": MANIFEST_VERSION, "target_uri": self.target_uri, "files": self.entries}
+        try:
+            temp.write_text(json.dumps(payload, indent=2, sort_keys=True), encoding="utf-8")
+            os.replace(temp, self.path)
+        except OSError:
+            temp.unlink(missing_ok=True)
+            raise
+
+    def locate(self, source_path: str) -> Optional[Tuple[str, str]]:
+
+        # Returns the migrated location of a script's QVD and its format.
+        entry = self.entry(source_path)
+        if entry is None:
+            return None
+        return f"{self.target_uri.rstrip('/')}/{entry['output']}", entry["format"]
+
+    def entry(self, source_path: str) -> Optional[dict]:
+
+        # Matches a script's QVD path (``lib://Data/sales/orders.qvd``) to
+        # the entry with the longest common trailing path.
+        if self._by_name is None:
+            self._by_name = {}
+            for key in self.entries:
+                self._by_name.setdefault(key.rsplit("/", 1)[-1].lower(), []).append(key)
+
+        normalized = source_path.replace("\\", "/").lower()
+        best = None
+        for key in self._by_name.get(normalized.rsplit("/", 1)[-1], ()):
+            lowered = key.lower()
+            if normalized == lowered or normalized.endswith("/" + lowered):
+                if best is None or len(key) > len(best):
+                    best = key
+        return self.entries[best] if best is not None else None
+
+def migrate_directory(source_dir: str, target_dir: str, output_format: str = "parquet",
+                      partition_by: Optional[str] = None, max_workers: Optional[int] = None,
+                      target_uri: Optional[str] = None, force: bool = False,
+                      batch_rows: int = DEFAULT_BATCH_ROWS) -> MigrationResult:
+
+    # Converts every QVD under ``source_dir`` into ``target_dir``, keeping
+    # the relative layout, one file per worker process.
+    if output_format not in OUTPUT_FORMATS:
+        raise MigrationError(f"Unsupported output format: {output_format}")
+    source_root = Path(source_dir)
+    target_root = Path(target_dir)
+    target_root.mkdir(parents=True, exist_ok=True)
+
+    manifest = MigrationManifest.load(str(target_root / MANIFEST_NAME))
+    if target_uri:
+        manifest.target_uri = target_uri
+
+    pending = []
+    skipped = []
+    for source in sorted(source_root.rglob("*")):
+        if not source.is_file() or source.suffix.lower() != ".qvd":
+            continue
+        key = source.relative_to(source_root).as_posix()
+        fingerprint = _fingerprint(source)
+        output = key[:-len(source.suffix)] + OUTPUT_FORMATS[output_format]
+        entry = manifest.entries.get(key)
+        if not force and entry is not None and _is_current(entry, fingerprint, output_format, partition_by) \
+                and (target_root / entry["output"]).exists():
+            skipped.append(key)
+            continue
+        pending.append((key, str(source), str(target_root / output), output, fingerprint))
+
+    migrated = []
+    failed = {}
+    jobs = [(source, output_path, output_format, partition_by, batch_rows)
+            for _, source, output_path, _, _ in pending]
+    if len(jobs) > 1 and max_workers != 1:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            outcomes = list(pool.map(_migrate_job, jobs))
+    else:
+        outcomes = [_migrate_job(job) for job in jobs]
+
+    for (key, _, _, output, fingerprint), (columns, rows, error) in zip(pending, outcomes):
+        if error is not None:
+            failed[key] = error
+            continue
+        manifest.entries[key] = dict(
+            fingerprint,
+            output=output,
+            format=output_format,
+            partition_by=partition_by,
+            columns=columns,
+            rows=rows
+        )
+        migrated.append(key)
+
+    manifest.save()
+    return MigrationResult(migrated=migrated, skipped=skipped, failed=failed)
+
+def migrate_file(source: str, output: str, output_format: str = "parquet",
+                 partition_by: Optional[str] = None, batch_rows: int = DEFAULT_BATCH_ROWS) -> Tuple[Dict[str, str], int]:
+
+    # Streams one QVD into a Parquet dataset or Delta table, one row group
+    # per batch, and swaps it into place once complete. Returns the
+    # column types written and the row count.
+    import pyarrow as pa
+
+    output_path = Path(output)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    temp = output_path.with_name(f"{output_path.name}.{os.getpid()}.tmp")
+    shutil.rmtree(temp, ignore_errors=True)
+
+    with QvdReader(source) as reader:
+        schema = reader.arrow_schema()
+        columns = {name: data_type.value for name, data_type in reader.data_types().items()}
+        partitioning = [partition_by] if partition_by in columns else None
+        batches = pa.RecordBatchReader.from_batches(schema, reader.iter_record_batches(batch_rows))
+        try:
+            if output_format == "delta":
+                _write_delta(temp, batches, partitioning)
+            else:
+                _write_parquet(temp, batches, partitioning, batch_rows)
+        except BaseException:
+            shutil.rmtree(temp, ignore_errors=True)
+            raise
+        rows = reader.header.record_count
+
+    if output_path.exists():
+        shutil.rmtree(output_path)
+    os.replace(temp, output_path)
+    return columns, rows
+
+def _write_parquet(path: Path, batches, partitioning: Optional[List[str]], batch_rows: int):
+
+    import pyarrow.dataset as ds
+
+    ds.write_dataset(
+        batches,
+        str(path),
+        format="parquet",
+        partitioning=partitioning,
+        partitioning_flavor="hive" if partitioning else None,
+        max_rows_per_group=batch_rows
+    )
+
+def _write_delta(path: Path, batches, partitioning: Optional[List[str]]):
+
+    try:
+        from deltalake import write_deltalake
+    except ImportError as e:
+        raise MigrationError("Delta output needs the 'deltalake' package") from e
+    write_deltalake(str(path), batches, partition_by=partitioning, mode="overwrite")
+
+def _migrate_job(job: tuple) -> Tuple[Dict[str, str], int, Optional[str]]:
+
+    # Runs in worker processes; failures are reported per file.
+    try:
+        columns, rows = migrate_file(*job)
+    except Exception as e:
+        return {}, 0, str(e)
+    return columns, rows, None
+
+def _fingerprint(source: Path) -> dict:
+
+    stat = source.stat()
+    return {
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+        "header_sha256": qvd_header_digest(str(source)),
+    }
+
+def _is_current(entry: dict, fingerprint: dict, output_format: str, partition_by: Optional[str]) -> bool:
+
+    if entry.get("format") != output_format or entry.get("partition_by") != partition_by:
+        return False
+    return all(entry.get(name) == value for name, value in fingerprint.items())
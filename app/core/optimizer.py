@@ -0,0 +1,924 @@
+
+import os
+import re
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+from app.core.expression import conjuncts, field_references, replace_nodes, to_qlik, try_parse_expression, walk
+from app.models.ast_models import BinaryOperation, Expression, FieldReference, FunctionCall, Literal
+from app.models.ir_models import (
+    DataModel, DataType, TableDefinition, ColumnDefinition, Transformation, SelectTransformation, FilterTransformation,
+    JoinTransformation, AggregationTransformation, SemiJoinTransformation, UnionTransformation,
+    DeriveTransformation
+)
+from app.utils.qlik_functions import QlikFunctionMapper
+
+# Functions whose value depends on the row's position, on other rows or on
+# other tables, so two calls are not known to agree.
+UNSHARED_FUNCTIONS = {
+    "applymap", "exists", "rowno", "recno", "iterno", "autonumber", "peek", "previous",
+    "rand", "fieldvalue", "noofrows", "filename", "filebasename", "filepath",
+}
+
+ARITHMETIC_OPERATORS = {"+", "-", "*", "/", "&"}
+
+# Functions naming a field in a string rather than referencing it.
+FIELD_NAME_FUNCTIONS = {"peek", "fieldvalue", "fieldvaluecount", "lookup", "exists"}
+
+# Conditions using these are evaluated where the script put them.
+POSITIONAL_FUNCTIONS = UNSHARED_FUNCTIONS - {"applymap"}
+
+# Comparisons with the sides swapped.
+FLIPPED_COMPARISONS = {"=": "=", "<": ">", ">": "<", "<=": ">=", ">=": "<="}
+
+NUMERIC_TYPES = {DataType.INTEGER, DataType.LONG, DataType.DOUBLE, DataType.DECIMAL, DataType.BOOLEAN}
+
+# Fields a date range may compare against ISO date strings; a string or
+# untyped field would compare as text.
+DATE_TYPES = {DataType.DATE, DataType.TIMESTAMP}
+
+ISO_DATE = re.compile(r"\d{4}-\d{2}-\d{2}$")
+
+# Prefix of the columns holding shared subexpressions.
+SHARED_COLUMN_PREFIX = "__cse"
+
+class Rewrite(NamedTuple):
+
+    rule: str
+    table: str
+    description: str
+
+class OptimizerRule:
+
+    # A rewrite of the data model. Rules build new models and tables rather
+    # than changing the ones given, which cached and incremental results
+    # share, and keep an unchanged table as the same object.
+    name = ""
+
+    def __init__(self):
+        # Results by the id() of the input table, which is kept alive with
+        # them, so an unchanged table is rewritten to the same object again.
+        self._memo: Dict[int, Tuple[TableDefinition, TableDefinition, List[str]]] = {}
+
+    def apply(self, data_model: DataModel) -> Tuple[DataModel, List[Rewrite]]:
+
+        tables = {}
+        rewrites = []
+        memo = {}
+        for name, table in data_model.tables.items():
+            cached = self._memo.get(id(table))
+            if cached is None or cached[0] is not table:
+                cached = (table, *self.rewrite_table(table, data_model))
+            memo[id(table)] = cached
+            tables[name] = cached[1]
+            rewrites.extend(Rewrite(self.name, name, note) for note in cached[2])
+        self._memo = memo
+
+        if all(tables[name] is table for name, table in data_model.tables.items()):
+            return data_model, rewrites
+        return data_model.model_copy(update={"tables": tables}), rewrites
+
+    def rewrite_table(self, table: TableDefinition, data_model: DataModel) -> Tuple[TableDefinition, List[str]]:
+
+        # The table's own steps, then those of its concatenated and joined loads.
+        steps, notes = self.rewrite_steps(table, data_model)
+        nested = []
+        for trans in steps:
+            if isinstance(trans, UnionTransformation):
+                parts = [self.rewrite_table(part, data_model) for part in trans.parts]
+                notes = notes + [note for _, part_notes in parts for note in part_notes]
+                if any(new is not old for (new, _), old in zip(parts, trans.parts)):
+                    trans = trans.model_copy(update={"parts": [new for new, _ in parts]})
+            elif isinstance(trans, JoinTransformation) and trans.right is not None:
+                right, right_notes = self.rewrite_table(trans.right, data_model)
+                notes = notes + right_notes
+                if right is not trans.right:
+                    trans = trans.model_copy(update={"right": right})
+            nested.append(trans)
+
+        if all(new is old for new, old in zip(nested, table.transformations)) and len(nested) == len(table.transformations):
+            return table, notes
+        return table.model_copy(update={"transformations": nested}), notes
+
+    def rewrite_steps(self, table: TableDefinition, data_model: DataModel) -> Tuple[List[Transformation], List[str]]:
+
+        return table.transformations, []
+
+class DeadTableElimination(OptimizerRule):
+
+    # Removes tables a DROP TABLE took out of the final model before anything
+    # read or stored them, and mappings no ApplyMap uses (Qlik drops mapping
+    # tables at the end of the script). Tables still in the final model are
+    # outputs, read or not.
+    name = "dead_tables"
+
+    def apply(self, data_model: DataModel) -> Tuple[DataModel, List[Rewrite]]:
+
+        tables = data_model.tables
+        live: Set[str] = set()
+        live_mappings: Set[str] = set()
+        pending = [name for name in tables if name not in data_model.dropped_tables]
+        pending += [store.table_name for store in data_model.stores if store.table_name in tables]
+        for store in data_model.stores:
+            live_mappings.update(_applymaps(column.source_expression for column in store.columns))
+
+        while pending:
+            name = pending.pop()
+            if name in live or name not in tables:
+                continue
+            live.add(name)
+            pending.extend(_table_reads(tables[name]))
+            for mapping_name in _applymaps(_table_expressions(tables[name])):
+                mapping = data_model.mappings.get(mapping_name)
+                if mapping is not None and mapping_name not in live_mappings:
+                    live_mappings.add(mapping_name)
+                    if mapping.source_type == "resident":
+                        pending.append(mapping.source_table)
+
+        dead_tables = [name for name in tables if name not in live]
+        dead_mappings = [name for name in data_model.mappings if name not in live_mappings]
+        if not dead_tables and not dead_mappings:
+            return data_model, []
+
+        rewrites = [Rewrite(self.name, name, "removed: dropped before anything read or stored it") for name in dead_tables]
+        rewrites += [Rewrite(self.name, name, "removed mapping: no ApplyMap uses it") for name in dead_mappings]
+        return data_model.model_copy(update={
+            "tables": {name: table for name, table in tables.items() if name in live},
+            "mappings": {name: mapping for name, mapping in data_model.mappings.items() if name in live_mappings},
+            "execution_order": [name for name in data_model.execution_order if name not in dead_tables],
+            "execution_stages": [
+                live_stage for live_stage in ([name for name in stage if name not in dead_tables]
+                                              for stage in data_model.execution_stages) if live_stage
+            ],
+            "relationships": [
+                rel for rel in data_model.relationships
+                if rel.from_table not in dead_tables and rel.to_table not in dead_tables
+            ],
+            "dropped_tables": [name for name in data_model.dropped_tables if name not in dead_tables],
+        }), rewrites
+
+class PredicatePushdown(OptimizerRule):
+
+    # Moves each WHERE condition as close to its table's scan as the fields
+    # it reads allow: ahead of the select a resident load starts with, and
+    # of joins that do not add those fields. Conditions on a dropped table
+    # only one load reads move into that table.
+    name = "predicate_pushdown"
+
+    def __init__(self):
+        super().__init__()
+        self._moved: Dict[Tuple[int, int], Tuple[TableDefinition, TableDefinition, TableDefinition, TableDefinition, List[str]]] = {}
+
+    def apply(self, data_model: DataModel) -> Tuple[DataModel, List[Rewrite]]:
+
+        data_model, rewrites = super().apply(data_model)
+        tables = dict(data_model.tables)
+        moved = {}
+        for name in data_model.tables:
+            source = _pushdown_source(tables[name], data_model)
+            if source is None:
+                continue
+            key = (id(tables[name]), id(tables[source]))
+            cached = self._moved.get(key)
+            if cached is None or cached[0] is not tables[name] or cached[1] is not tables[source]:
+                cached = (tables[name], tables[source], *_move_into_source(tables[name], tables[source]))
+            moved[key] = cached
+            tables[name], tables[source] = cached[2], cached[3]
+            rewrites.extend(Rewrite(self.name, name, note) for note in cached[4])
+        self._moved = moved
+
+        if all(tables[name] is table for name, table in data_model.tables.items()):
+            return data_model, rewrites
+        return data_model.model_copy(update={"tables": tables}), rewrites
+
+    def rewrite_steps(self, table: TableDefinition, data_model: DataModel) -> Tuple[List[Transformation], List[str]]:
+
+        if _is_merged(table, data_model):
+            return table.transformations, []
+        steps = list(table.transformations)
+        notes = []
+        index = 0
+        while index < len(steps):
+            trans = steps[index]
+            node = try_parse_expression(trans.condition) if isinstance(trans, FilterTransformation) else None
+            if node is None or not _is_movable(node):
+                index += 1
+                continue
+            moves = [_sink(steps, index, term, trans.source_table, table.name) for term in conjuncts(node)]
+            if all(position == index for position, _, _ in moves):
+                index += 1
+                continue
+
+            # Terms landing on the same step stay one filter.
+            groups: Dict[Tuple[int, str], List[Expression]] = {}
+            for position, moved, source in moves:
+                groups.setdefault((position, source), []).append(moved)
+            del steps[index]
+            for (position, source), terms in sorted(groups.items(), key=lambda item: item[0][0], reverse=True):
+                condition = to_qlik(_conjunction(terms))
+                if position < index:
+                    notes.append(f"moved {condition} ahead of the {steps[position].operation}")
+                steps.insert(position, trans.model_copy(update={"condition": condition, "source_table": source}))
+            index += len(groups)
+        return steps, notes
+
+class SargablePredicates(OptimizerRule):
+
+    # Rewrites comparisons of a function of a field into comparisons of the
+    # field itself, which Spark pushes into Parquet/Delta statistics and
+    # partition pruning: Year(d) = 2024 becomes a date range when d is a
+    # date or timestamp, Left(s, 3) = 'abc' a LIKE prefix. Month(d) is a
+    # range only next to Year(d).
+    name = "sargable_predicates"
+
+    def rewrite_steps(self, table: TableDefinition, data_model: DataModel) -> Tuple[List[Transformation], List[str]]:
+
+        if _is_merged(table, data_model):
+            return table.transformations, []
+        types = _column_types(table, data_model)
+        steps = []
+        notes = []
+        for trans in table.transformations:
+            node = try_parse_expression(trans.condition) if isinstance(trans, FilterTransformation) else None
+            terms = _sargable(conjuncts(node), types) if node is not None else None
+            if terms is not None:
+                condition = to_qlik(_conjunction(terms))
+                notes.append(f"rewrote {trans.condition} as {condition}")
+                trans = trans.model_copy(update={"condition": condition})
+            steps.append(trans)
+        return steps, notes
+
+class StepFusion(OptimizerRule):
+
+    # Merges consecutive filters of a table into one, and a projection of
+    # a projection into a single select.
+    name = "fuse_steps"
+
+    def rewrite_steps(self, table: TableDefinition, data_model: DataModel) -> Tuple[List[Transformation], List[str]]:
+
+        steps: List[Transformation] = []
+        notes = []
+        for trans in table.transformations:
+            previous = steps[-1] if steps else None
+            fused = None
+            if isinstance(trans, FilterTransformation) and isinstance(previous, FilterTransformation) \
+                    and trans.table_name == previous.table_name:
+                fused = _fuse_filters(previous, trans)
+            elif isinstance(trans, SelectTransformation) and isinstance(previous, SelectTransformation):
+                fused = _fuse_selects(previous, trans)
+            if fused is None:
+                steps.append(trans)
+            else:
+                steps[-1] = fused
+                notes.append(f"fused two {trans.operation} steps")
+        return steps, notes
+
+class CommonSubexpressionElimination(OptimizerRule):
+
+    # Computes an expression repeated across a load's WHERE clause and its
+    # fields, such as Year(OrderDate), once as a column the filter and the
+    # select then read; the select leaves that column out.
+    name = "common_subexpressions"
+
+    def rewrite_steps(self, table: TableDefinition, data_model: DataModel) -> Tuple[List[Transformation], List[str]]:
+
+        if _is_merged(table, data_model):
+            return table.transformations, []
+        steps = list(table.transformations)
+        notes = []
+        shared = 0
+        start = 0
+        while start < len(steps):
+            end = start
+            while end < len(steps) and isinstance(steps[end], FilterTransformation):
+                end += 1
+            select = steps[end] if end < len(steps) else None
+            if end == start or not isinstance(select, SelectTransformation) or select.is_distinct \
+                    or select.source_table != select.table_name:
+                start = max(end, start + 1)
+                continue
+
+            rewritten = _share_subexpressions(steps[start:end], select, shared)
+            if rewritten is not None:
+                derive, filters, select, texts = rewritten
+                steps[start:end + 1] = [derive] + filters + [select]
+                notes.extend(f"computed {text} once as {SHARED_COLUMN_PREFIX}{shared + i}" for i, text in enumerate(texts))
+                shared += len(texts)
+                end += 1
+            start = end + 1
+        return steps, notes
+
+class ColumnPruning(OptimizerRule):
+
+    # Narrows each file read to the columns used downstream: the fields of
+    # tables in the final model and of STOREs, and what the loads reading
+    # a table need from it, worked out backward through each table's steps.
+    name = "prune_columns"
+
+    def __init__(self):
+        super().__init__()
+        self._narrowed: Dict[int, Tuple[TableDefinition, Optional[frozenset], TableDefinition, List[str]]] = {}
+
+    def apply(self, data_model: DataModel) -> Tuple[DataModel, List[Rewrite]]:
+
+        demands = _column_demands(data_model)
+        tables = {}
+        rewrites = []
+        narrowed = {}
+        for name, table in data_model.tables.items():
+            needed = frozenset(demands[name]) if demands[name] is not None else None
+            cached = self._narrowed.get(id(table))
+            if cached is None or cached[0] is not table or cached[1] != needed:
+                notes = []
+                cached = (table, needed, _narrow(table, demands[name], lambda *_: None, notes), notes)
+            narrowed[id(table)] = cached
+            tables[name] = cached[2]
+            rewrites.extend(Rewrite(self.name, name, note) for note in cached[3])
+        self._narrowed = narrowed
+
+        if all(tables[name] is table for name, table in data_model.tables.items()):
+            return data_model, rewrites
+        return data_model.model_copy(update={"tables": tables}), rewrites
+
+DEFAULT_RULES = (
+    DeadTableElimination, PredicatePushdown, SargablePredicates, StepFusion, CommonSubexpressionElimination,
+    ColumnPruning
+)
+
+RULE_NAMES = [rule.name for rule in DEFAULT_RULES]
+
+class IROptimizer:
+
+    # Runs each enabled rule over the DataModel between ASTTransformer and
+    # PySparkCodeGenerator, and reports what they rewrote.
+
+    def __init__(self, disabled: Iterable[str] = (), rules: Optional[List[OptimizerRule]] = None):
+        disabled = set(disabled)
+        unknown = disabled - set(RULE_NAMES) - {rule.name for rule in rules or []}
+        if unknown:
+            raise ValueError(f"Unknown optimizer rules: {', '.join(sorted(unknown))}")
+        rules = rules if rules is not None else [rule() for rule in DEFAULT_RULES]
+        self.rules = [rule for rule in rules if rule.name not in disabled]
+
+    @classmethod
+    def from_environment(cls) -> "IROptimizer":
+
+        # QLIK_OPTIMIZER_DISABLE="common_subexpressions,fuse_steps"
+        names = os.getenv("QLIK_OPTIMIZER_DISABLE") or ""
+        return cls(disabled=[name.strip() for name in names.split(",") if name.strip()])
+
+    def optimize(self, data_model: DataModel) -> Tuple[DataModel, List[Rewrite]]:
+
+        rewrites = []
+        for rule in self.rules:
+            data_model, applied = rule.apply(data_model)
+            rewrites.extend(applied)
+        return data_model, rewrites
+
+def _table_reads(table: TableDefinition) -> Set[str]:
+
+    reads = {dependency for trans in table.transformations for dependency in trans.dependencies}
+    if table.source_type == "resident" and table.source_path:
+        reads.add(table.source_path)
+    reads.discard(table.name)
+    return reads
+
+def _table_expressions(table: TableDefinition) -> List[Optional[str]]:
+
+    # Every Qlik expression the table's steps evaluate, nested loads included.
+    expressions = [column.source_expression for column in table.columns]
+    for trans in table.transformations:
+        if isinstance(trans, (SelectTransformation, DeriveTransformation)):
+            expressions.extend(column.source_expression for column in trans.columns)
+        elif isinstance(trans, FilterTransformation):
+            expressions.append(trans.condition)
+        elif isinstance(trans, AggregationTransformation):
+            expressions.extend(trans.aggregations.values())
+        elif isinstance(trans, SemiJoinTransformation):
+            expressions.extend(trans.key_expressions)
+        elif isinstance(trans, UnionTransformation):
+            for part in trans.parts:
+                expressions.extend(_table_expressions(part))
+        elif isinstance(trans, JoinTransformation):
+            expressions.append(trans.join_condition)
+            if trans.right is not None:
+                expressions.extend(_table_expressions(trans.right))
+    return expressions
+
+def _applymaps(expressions: Iterable[Optional[str]]) -> Set[str]:
+
+    names = set()
+    for expression in expressions:
+        node = try_parse_expression(expression) if expression else None
+        for current in walk(node) if node is not None else ():
+            if isinstance(current, FunctionCall) and len(current.arguments) >= 2 \
+                    and QlikFunctionMapper.canonical_name(current.function_name) == "ApplyMap":
+                name = current.arguments[0]
+                if isinstance(name, Literal) and name.kind == "string":
+                    names.add(name.value)
+    return names
+
+def _fuse_filters(first: FilterTransformation, second: FilterTransformation) -> Optional[FilterTransformation]:
+
+    left = try_parse_expression(first.condition)
+    right = try_parse_expression(second.condition)
+    if left is None or right is None:
+        return None
+    condition = to_qlik(BinaryOperation(operator="AND", left=left, right=right))
+    dependencies = first.dependencies + [dep for dep in second.dependencies if dep not in first.dependencies]
+    return first.model_copy(update={"condition": condition, "dependencies": dependencies})
+
+def _fuse_selects(first: SelectTransformation, second: SelectTransformation) -> Optional[SelectTransformation]:
+
+    # ``second`` reads the columns ``first`` produces; each of its fields is
+    # replaced by the expression ``first`` computed it with.
+    if first.is_distinct or second.is_distinct or second.source_table != second.table_name \
+            or first.table_name != second.table_name:
+        return None
+
+    columns = []
+    for column in second.columns:
+        node = try_parse_expression(column.source_expression) if column.source_expression \
+            else FieldReference(name=column.name)
+        node = _through_select(node, first) if node is not None else None
+        if node is None or any(isinstance(n, FunctionCall) and QlikFunctionMapper.is_aggregate_function(n.function_name)
+                               for n in walk(node)):
+            return None
+        plain = isinstance(node, FieldReference) and node.name == column.name
+        columns.append(column.model_copy(update={"source_expression": None if plain else to_qlik(node)}))
+
+    dependencies = first.dependencies + [dep for dep in second.dependencies if dep not in first.dependencies]
+    return first.model_copy(update={"columns": columns, "dependencies": dependencies})
+
+def _through_select(node: Expression, select: SelectTransformation) -> Optional[Expression]:
+
+    # ``node`` over the columns ``select`` produces, rewritten over its input.
+    produced: Dict[str, Expression] = {}
+    for column in select.columns:
+        expression = try_parse_expression(column.source_expression) if column.source_expression \
+            else FieldReference(name=column.name)
+        if expression is None:
+            return None
+        produced[column.name] = expression
+    if any(name not in produced for name in field_references(node)):
+        return None
+    return replace_nodes(node, lambda n: produced[n.name] if isinstance(n, FieldReference) else None)
+
+def _is_merged(table: TableDefinition, data_model: DataModel) -> bool:
+
+    # Incremental merges compile the watermark filter themselves.
+    return any(store.table_name == table.name and store.merge_keys for store in data_model.stores)
+
+def _conjunction(terms: List[Expression]) -> Expression:
+
+    node = terms[0]
+    for term in terms[1:]:
+        node = BinaryOperation(operator="AND", left=node, right=term)
+    return node
+
+def _is_movable(node: Expression) -> bool:
+
+    return not any(
+        isinstance(n, FunctionCall) and (n.function_name.lower() in POSITIONAL_FUNCTIONS
+                                         or QlikFunctionMapper.is_aggregate_function(n.function_name))
+        for n in walk(node)
+    )
+
+def _sink(steps: List[Transformation], index: int, node: Expression, source: str, table_name: str
+          ) -> Tuple[int, Expression, str]:
+
+    # The earliest step a condition now run before ``steps[index]`` can run
+    # before, the condition as written there, and the table whose rows it
+    # reads (a resident load's conditions read its source's rows).
+    position = index
+    while position > 0:
+        step = steps[position - 1]
+        names = set(field_references(node))
+        if isinstance(step, SelectTransformation) and not step.is_distinct \
+                and not (step.source_table != table_name and step.source_table == source):
+            through = _through_select(node, step)
+            if through is None or not _is_movable(through):
+                break
+            node, source = through, step.source_table or source
+        elif isinstance(step, DeriveTransformation):
+            if names & {column.name for column in step.columns}:
+                break
+        elif isinstance(step, JoinTransformation):
+            if step.join_type not in ("left", "inner") or step.right is None \
+                    or names & ({column.name for column in step.right.columns} - set(step.join_keys)):
+                break
+        elif not isinstance(step, (SemiJoinTransformation, SelectTransformation)):
+            # Next to an earlier filter, it is fused with it.
+            break
+        position -= 1
+    return position, node, source
+
+def _pushdown_source(table: TableDefinition, data_model: DataModel) -> Optional[str]:
+
+    # The dropped, unstored table that this resident load is the only reader of.
+    source = table.source_path if table.source_type == "resident" else None
+    if source is None or source == table.name or source not in data_model.dropped_tables \
+            or source not in data_model.tables or _is_merged(table, data_model):
+        return None
+    if any(store.table_name == source for store in data_model.stores) \
+            or any(m.source_type == "resident" and m.source_table == source for m in data_model.mappings.values()):
+        return None
+    readers = [name for name, other in data_model.tables.items() if source in _table_reads(other)]
+    return source if readers == [table.name] else None
+
+def _move_into_source(table: TableDefinition, source: TableDefinition) -> Tuple[TableDefinition, TableDefinition, List[str]]:
+
+    # The conditions a resident load starts with, on the fields of its
+    # source, go to the source when they can run ahead of one of its steps.
+    steps = list(table.transformations)
+    columns = {column.name for column in source.columns}
+    groups: Dict[Tuple[int, str], List[Expression]] = {}
+    index = 0
+    while index < len(steps) and isinstance(steps[index], FilterTransformation) \
+            and steps[index].source_table == source.name:
+        trans = steps[index]
+        node = try_parse_expression(trans.condition)
+        terms = conjuncts(node) if node is not None and _is_movable(node) else []
+        kept = []
+        for term in terms:
+            position, moved, reads = _sink(source.transformations, len(source.transformations), term, source.name, source.name)
+            if position == len(source.transformations) or not set(field_references(term)) <= columns:
+                kept.append(term)
+            else:
+                groups.setdefault((position, reads), []).append(moved)
+        if terms and not kept:
+            del steps[index]
+            continue
+        if len(kept) < len(terms):
+            steps[index] = trans.model_copy(update={"condition": to_qlik(_conjunction(kept))})
+        index += 1
+
+    if not groups:
+        return table, source, []
+    source_steps = list(source.transformations)
+    notes = []
+    for (position, reads), terms in sorted(groups.items(), key=lambda item: item[0][0], reverse=True):
+        condition = to_qlik(_conjunction(terms))
+        notes.append(f"moved {condition} into {source.name}, ahead of its {source_steps[position].operation}")
+        source_steps.insert(position, FilterTransformation(
+            table_name=source.name,
+            source_table=reads,
+            condition=condition
+        ))
+    return (table.model_copy(update={"transformations": steps}),
+            source.model_copy(update={"transformations": source_steps}), notes[::-1])
+
+def _column_types(table: TableDefinition, data_model: DataModel) -> Dict[str, DataType]:
+
+    columns = list(table.source_columns) + list(table.columns)
+    source = data_model.tables.get(table.source_path) if table.source_type == "resident" else None
+    if source is not None:
+        columns = list(source.columns) + columns
+    return {column.name: column.data_type for column in columns}
+
+def _compared_call(node: Expression) -> Optional[Tuple[FunctionCall, str, Expression]]:
+
+    # (call, operator, value) of a comparison of a function call, written
+    # with the call on the left.
+    if not isinstance(node, BinaryOperation) or node.operator not in FLIPPED_COMPARISONS:
+        return None
+    if isinstance(node.left, FunctionCall):
+        return node.left, node.operator, node.right
+    if isinstance(node.right, FunctionCall):
+        return node.right, FLIPPED_COMPARISONS[node.operator], node.left
+    return None
+
+def _field_argument(call: FunctionCall, types: Dict[str, DataType], arguments: int = 1,
+                    dates: bool = False) -> Optional[str]:
+
+    # The field a date or text function is applied to. Date functions need
+    # a field known to hold dates; text functions leave numeric fields
+    # alone, their values not comparing with strings.
+    if len(call.arguments) != arguments or not isinstance(call.arguments[0], FieldReference):
+        return None
+    name = call.arguments[0].name
+    if dates:
+        return name if types.get(name) in DATE_TYPES else None
+    return None if types.get(name) in NUMERIC_TYPES else name
+
+def _integer(node: Expression) -> Optional[int]:
+
+    if isinstance(node, Literal) and node.kind == "number" and node.value.lstrip("-").isdigit():
+        return int(node.value)
+    return None
+
+def _date_value(node: Expression) -> Optional[date]:
+
+    # A date written as 'YYYY-MM-DD' or MakeDate(Y[, M[, D]]).
+    try:
+        if isinstance(node, Literal) and node.kind == "string" and ISO_DATE.match(node.value):
+            return date.fromisoformat(node.value)
+        if isinstance(node, FunctionCall) and QlikFunctionMapper.canonical_name(node.function_name) == "MakeDate" \
+                and 1 <= len(node.arguments) <= 3:
+            parts = [_integer(argument) for argument in node.arguments]
+            if None not in parts:
+                return date(*(parts + [1, 1])[:3])
+    except ValueError:
+        pass
+    return None
+
+def _period(node: Expression, types: Dict[str, DataType]) -> Optional[Tuple[str, str, date, date]]:
+
+    # (field, operator, first day, day after) of Year(d) or Date(d) compared
+    # with a constant.
+    compared = _compared_call(node)
+    if compared is None:
+        return None
+    call, operator, value = compared
+    name = QlikFunctionMapper.canonical_name(call.function_name)
+    field = _field_argument(call, types, dates=True)
+    if field is None:
+        return None
+    if name == "Year":
+        year = _integer(value)
+        if year is not None and 1 <= year < 9999:
+            return field, operator, date(year, 1, 1), date(year + 1, 1, 1)
+    elif name == "Date":
+        day = _date_value(value)
+        if day is not None and day < date.max:
+            return field, operator, day, day + timedelta(days=1)
+    return None
+
+def _month(node: Expression, types: Dict[str, DataType]) -> Optional[Tuple[str, int]]:
+
+    compared = _compared_call(node)
+    if compared is None or compared[1] != "=" or QlikFunctionMapper.canonical_name(compared[0].function_name) != "Month":
+        return None
+    field = _field_argument(compared[0], types, dates=True)
+    month = _integer(compared[2])
+    return (field, month) if field is not None and month is not None and 1 <= month <= 12 else None
+
+def _range(field: str, operator: str, start: date, end: date) -> List[Expression]:
+
+    column = FieldReference(name=field)
+    first = Literal(value=start.isoformat(), kind="string")
+    after = Literal(value=end.isoformat(), kind="string")
+    bounds = {
+        "=": [(">=", first), ("<", after)],
+        ">=": [(">=", first)],
+        ">": [(">=", after)],
+        "<": [("<", first)],
+        "<=": [("<", after)],
+    }[operator]
+    return [BinaryOperation(operator=op, left=column, right=bound) for op, bound in bounds]
+
+def _prefix(node: Expression, types: Dict[str, DataType]) -> Optional[Expression]:
+
+    # Left(s, n) = 'abc' with n the length of 'abc' is s LIKE 'abc*'.
+    compared = _compared_call(node)
+    if compared is None or compared[1] != "=" or QlikFunctionMapper.canonical_name(compared[0].function_name) != "Left":
+        return None
+    call, _, value = compared
+    field = _field_argument(call, types, arguments=2)
+    if field is None or not isinstance(value, Literal) or value.kind != "string" \
+            or _integer(call.arguments[1]) != len(value.value) or any(c in value.value for c in "*?%_"):
+        return None
+    return BinaryOperation(operator="LIKE", left=FieldReference(name=field), right=Literal(value=value.value + "*"))
+
+def _sargable(terms: List[Expression], types: Dict[str, DataType]) -> Optional[List[Expression]]:
+
+    # Year(d) = N next to Month(d) = M is that month's range.
+    months = {}
+    for index, term in enumerate(terms):
+        month = _month(term, types)
+        if month is not None:
+            months.setdefault(month[0], (index, month[1]))
+    paired = {}
+    for index, term in enumerate(terms):
+        compared = _compared_call(term)
+        period = _period(term, types) if compared is not None and compared[1] == "=" else None
+        if period is not None and period[0] in months \
+                and QlikFunctionMapper.canonical_name(compared[0].function_name) == "Year":
+            paired[index] = months.pop(period[0])
+
+    rewritten = []
+    changed = False
+    skipped = {month_index for month_index, _ in paired.values()}
+    for index, term in enumerate(terms):
+        if index in skipped:
+            continue
+        period = _period(term, types)
+        prefix = _prefix(term, types) if period is None else None
+        if period is not None:
+            field, operator, start, end = period
+            if index in paired:
+                month = paired[index][1]
+                start = date(start.year, month, 1)
+                end = date(start.year + month // 12, month % 12 + 1, 1)
+            rewritten.extend(_range(field, operator, start, end))
+        elif prefix is not None:
+            rewritten.append(prefix)
+        else:
+            rewritten.append(term)
+            continue
+        changed = True
+    return rewritten if changed else None
+
+def _is_shareable(node: Expression) -> bool:
+
+    # A call or arithmetic over fields worth computing once, whose every
+    # evaluation on a row gives the same value.
+    if not (isinstance(node, FunctionCall) or isinstance(node, BinaryOperation) and node.operator in ARITHMETIC_OPERATORS):
+        return False
+    has_field = False
+    for current in walk(node):
+        if isinstance(current, FunctionCall):
+            name = current.function_name.lower()
+            if name in UNSHARED_FUNCTIONS or QlikFunctionMapper.is_aggregate_function(current.function_name):
+                return False
+        elif isinstance(current, FieldReference):
+            has_field = True
+    return has_field
+
+def _share_subexpressions(filters: List[FilterTransformation], select: SelectTransformation, first_index: int
+                          ) -> Optional[Tuple[DeriveTransformation, List[FilterTransformation], SelectTransformation, List[str]]]:
+
+    conditions = [try_parse_expression(trans.condition) for trans in filters]
+    expressions = [try_parse_expression(column.source_expression) if column.source_expression else None
+                   for column in select.columns]
+    if None in conditions or any(e is None for e, c in zip(expressions, select.columns) if c.source_expression):
+        return None
+
+    # The largest repeated subexpression is shared first, then the count
+    # is taken again over the rewritten trees.
+    texts = []
+    while True:
+        counts: Dict[str, int] = {}
+        for tree in conditions + [e for e in expressions if e is not None]:
+            for node in walk(tree):
+                if _is_shareable(node):
+                    text = to_qlik(node)
+                    counts[text] = counts.get(text, 0) + 1
+        repeated = [text for text, count in counts.items() if count > 1]
+        if not repeated:
+            break
+        text = max(repeated, key=len)
+        reference = FieldReference(name=f"{SHARED_COLUMN_PREFIX}{first_index + len(texts)}")
+
+        def share(node: Expression) -> Optional[Expression]:
+            return reference if _is_shareable(node) and to_qlik(node) == text else None
+
+        conditions = [replace_nodes(tree, share) for tree in conditions]
+        expressions = [replace_nodes(tree, share) if tree is not None else None for tree in expressions]
+        texts.append(text)
+
+    if not texts:
+        return None
+    derive = DeriveTransformation(
+        table_name=select.table_name,
+        columns=[
+            ColumnDefinition(name=f"{SHARED_COLUMN_PREFIX}{first_index + i}", source_expression=text)
+            for i, text in enumerate(texts)
+        ]
+    )
+    filters = [trans.model_copy(update={"condition": to_qlik(tree)}) for trans, tree in zip(filters, conditions)]
+    columns = [
+        column.model_copy(update={"source_expression": to_qlik(tree)}) if tree is not None else column
+        for column, tree in zip(select.columns, expressions)
+    ]
+    return derive, filters, select.model_copy(update={"columns": columns}), texts
+
+def _output_columns(table: TableDefinition) -> Optional[Set[str]]:
+
+    # None when the load's fields are not known (LOAD * of an unread schema).
+    names = {column.name for column in table.columns}
+    return names if names and "*" not in names else None
+
+def _references(expressions: Iterable[str]) -> Optional[Set[str]]:
+
+    names: Set[str] = set()
+    for expression in expressions:
+        node = try_parse_expression(expression)
+        if node is None or any(isinstance(n, FunctionCall) and n.function_name.lower() in FIELD_NAME_FUNCTIONS
+                               for n in walk(node)):
+            return None
+        names.update(field_references(node))
+    return names if "*" not in names else None
+
+def _union(needed: Optional[Set[str]], names: Optional[Iterable[str]]) -> Optional[Set[str]]:
+
+    return None if needed is None or names is None else needed | set(names)
+
+def _column_demands(data_model: DataModel) -> Dict[str, Optional[Set[str]]]:
+
+    # The columns each table must provide (None: all of them). Demands only
+    # grow, so passing over the tables until none changes settles them.
+    tables = data_model.tables
+    demands: Dict[str, Optional[Set[str]]] = {name: set() for name in tables}
+
+    def demand(name: str, columns: Optional[Set[str]]):
+        if name in demands and demands[name] is not None:
+            demands[name] = _union(demands[name], columns)
+
+    for name, table in tables.items():
+        if name not in data_model.dropped_tables or _is_merged(table, data_model):
+            demand(name, _output_columns(table))
+    for store in data_model.stores:
+        expressions = [column.source_expression or column.name for column in store.columns]
+        demand(store.table_name, _references(expressions) if expressions else None)
+    for mapping in data_model.mappings.values():
+        if mapping.source_type == "resident":
+            expressions = [mapping.key_column, mapping.value_column] + \
+                ([mapping.filter_condition] if mapping.filter_condition else [])
+            demand(mapping.source_table, _references(expressions))
+
+    order = [name for name in data_model.execution_order if name in tables]
+    order += [name for name in tables if name not in order]
+    while True:
+        before = {name: None if columns is None else set(columns) for name, columns in demands.items()}
+        for name in reversed(order):
+            _narrow(tables[name], demands[name], demand, [])
+        if demands == before:
+            return demands
+
+def _narrow(table: TableDefinition, needed: Optional[Set[str]], demand, notes: List[str]) -> TableDefinition:
+
+    # ``table`` with its read narrowed to what ``needed`` (None: every
+    # column) takes from it; the other tables its steps read are passed to
+    # ``demand`` with the columns they must provide.
+    steps = list(table.transformations)
+    for index in reversed(range(len(steps))):
+        trans = steps[index]
+        if isinstance(trans, SelectTransformation):
+            if trans.is_distinct:
+                needed = None
+            elif trans.columns:
+                columns = [column for column in trans.columns if needed is None or column.name in needed]
+                needed = _references(column.source_expression or column.name for column in columns)
+        elif isinstance(trans, FilterTransformation):
+            needed = _union(needed, _references([trans.condition]))
+        elif isinstance(trans, DeriveTransformation):
+            derived = {column.name for column in trans.columns}
+            needed = _union(needed - derived if needed is not None else None,
+                            _references(column.source_expression for column in trans.columns))
+        elif isinstance(trans, AggregationTransformation):
+            needed = _union(set(trans.group_by_columns), _references(trans.aggregations.values()))
+            if trans.source_table != table.name:
+                demand(trans.source_table, needed)
+        elif isinstance(trans, SemiJoinTransformation):
+            keys = _references(trans.key_expressions)
+            if trans.table_name == table.name:
+                needed = _union(_union(needed, keys), trans.distinct_columns)
+            else:
+                demand(trans.table_name, keys)
+            for key_table in trans.key_tables:
+                if key_table == table.name:
+                    needed = _union(needed, trans.key_columns)
+                else:
+                    demand(key_table, set(trans.key_columns))
+        elif isinstance(trans, JoinTransformation):
+            keys = set(trans.join_keys)
+            condition = _references([trans.join_condition]) if trans.join_condition else set()
+            if trans.right is None:
+                demand(trans.right_table, None)
+                needed = _union(_union(needed, keys), condition)
+                continue
+            added = {column.name for column in trans.right.columns} - keys
+            right_needed = None if needed is None or _output_columns(trans.right) is None \
+                else (needed & _output_columns(trans.right)) | keys
+            right = _narrow(trans.right, _union(right_needed, condition), demand, notes)
+            if right is not trans.right:
+                steps[index] = trans.model_copy(update={"right": right})
+            needed = _union(_union(needed - added if needed is not None else None, keys), condition)
+        elif isinstance(trans, UnionTransformation):
+            parts = []
+            for part in trans.parts:
+                columns = _output_columns(part)
+                parts.append(_narrow(part, needed & columns if needed is not None and columns else None, demand, notes))
+            if any(new is not old for new, old in zip(parts, trans.parts)):
+                steps[index] = trans.model_copy(update={"parts": parts})
+        else:
+            needed = None
+
+    if table.source_type == "resident" and table.source_path:
+        demand(table.source_path, needed)
+
+    read_columns = []
+    if table.source_type == "external" and needed:
+        available = [column.name for column in table.source_columns]
+        if available:
+            read_columns = [name for name in available if name in needed]
+            if len(read_columns) == len(available):
+                read_columns = []
+        elif not any(isinstance(trans, (UnionTransformation, JoinTransformation)) for trans in steps):
+            # Without a schema, only a read no other load was merged into
+            # is known to have every needed column.
+            read_columns = []
+            for column in table.columns:
+                node = try_parse_expression(column.source_expression or column.name)
+                for name in field_references(node) if node is not None else []:
+                    if name in needed and name not in read_columns:
+                        read_columns.append(name)
+            read_columns += sorted(needed - set(read_columns))
+    if read_columns and read_columns != table.read_columns:
+        total = f" of {len(table.source_columns)}" if table.source_columns else ""
+        notes.append(f"read of {table.name} narrowed to {len(read_columns)}{total} columns")
+
+    if read_columns == table.read_columns and all(new is old for new, old in zip(steps, table.transformations)):
+        return table
+    return table.model_copy(update={"read_columns": read_columns, "transformations": steps})
+
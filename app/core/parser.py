@@ -1,192 +1,736 @@
 
+import codecs
 import re
-from typing import List, Optional, Tuple, Dict
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional, Tuple, Dict, Iterator, Iterable, IO, Union
+from app.core.lexer import LOOP_START, QlikLexer, Token, TokenType, group_loops, join_tokens, split_statements
+from app.core.inline import InlineTable, parse_format_spec
+from app.core.expression import ExpressionSyntaxError, parse_expression_tokens
+from app.core.variables import MacroExpander, VariableEnvironment
+from app.core.includes import (
+    INCLUDE_DIRECTIVE, MAX_INCLUDE_DEPTH, IncludeError, IncludeResolver, ParsedInclude
+)
 from app.models.ast_models import (
     Script, LoadStatement, MappingLoad, VariableAssignment,
     FieldExpression, WhereClause, GroupByClause, JoinClause,
-    OrderByClause, FunctionCall, LoadType, JoinType, ApplyMapCall
+    OrderByClause, FunctionCall, LoadType, JoinType, ApplyMapCall, ConcatenateClause, ForLoop, StoreStatement, DropStatement
 )
 
+# Part of cache keys for parsed output; bump when parsing results change.
+PARSER_VERSION = 7
+
+# Loops with more values than this are left for the transformer as written.
+MAX_LOOP_ITERATIONS = 10000
+
+# Keywords that end the field list of a LOAD and start the next clause.
+LOAD_CLAUSE_KEYWORDS = {"FROM", "RESIDENT", "INLINE", "AUTOGENERATE", "WHERE", "WHILE", "GROUP", "ORDER"}
+
+# Statement prefixes that may precede LOAD; they are consumed and ignored
+# unless handled explicitly (joins, DISTINCT).
+LOAD_PREFIXES = {
+    "NOCONCATENATE", "CONCATENATE", "BUFFER", "FIRST", "SAMPLE", "CROSSTABLE",
+    "GENERIC", "ADD", "REPLACE", "MERGE", "ONLY", "SEMANTIC", "INTERVALMATCH",
+    "HIERARCHY", "HIERARCHYBELONGSTO", "KEEP", "LEFT", "RIGHT", "INNER", "OUTER", "JOIN",
+}
+
+JOIN_KEYWORDS = {"LEFT", "RIGHT", "INNER", "OUTER", "JOIN"}
+
+_SINGLE_STRING = re.compile(r"'[^']*(?:''[^']*)*'")
+
+# Token types whose text may contain dollar-sign macros.
+EXPANDABLE_TOKENS = {TokenType.STRING, TokenType.BRACKET, TokenType.QUOTED_IDENT}
+
+# Characters of statement text handed to each worker by parse_parallel.
+PARALLEL_CHUNK_SIZE = 1 << 20
+
+# Cheap pre-filter for statements that may read or change variables.
+_VARIABLE_HINT = re.compile(r"\$\(|\b(?:LET|SET)\b", re.IGNORECASE)
+
+class _TokenStream:
+
+    def __init__(self, tokens: Iterable[Token]):
+        # A fully tokenized script is used in place; an iterator is pulled
+        # from lazily, one statement at a time.
+        if isinstance(tokens, list):
+            self._source = iter(())
+            self._buffer = tokens
+            self._streaming = False
+        else:
+            self._source = iter(tokens)
+            self._buffer = []
+            self._streaming = True
+        self._pos = 0
+
+    def peek(self, offset: int = 0) -> Token:
+
+        try:
+            return self._buffer[self._pos + offset]
+        except IndexError:
+            return self._fill(self._pos + offset)
+
+    def _fill(self, index: int) -> Token:
+
+        # Pull a whole statement at a time; EOF is repeated once reached. A
+        # NEXT also stops the pull, so what follows a loop is only expanded
+        # once the loop's body has run.
+        buffer = self._buffer
+        for token in self._source:
+            buffer.append(token)
+            if token.type is TokenType.SEMICOLON or (
+                    token.type is TokenType.IDENT and len(token.value) == 4 and token.value.upper() == "NEXT"):
+                if len(buffer) > index:
+                    break
+        return buffer[index] if index < len(buffer) else buffer[-1]
+
+    def advance(self) -> Token:
+
+        token = self.peek()
+        if token.type is not TokenType.EOF:
+            self._pos += 1
+        return token
+
+    def statement_window(self) -> Tuple[List[Token], int]:
+
+        # Buffer the rest of the current statement and expose it for tight
+        # scanning loops; callers report how far they got through ``seek``.
+        buffer = self._buffer
+        while not buffer or buffer[-1].type not in (TokenType.SEMICOLON, TokenType.EOF):
+            self._fill(len(buffer))
+        return buffer, self._pos
+
+    def seek(self, pos: int):
+
+        self._pos = pos
+
+    def position(self) -> int:
+
+        return self._pos
+
+    def since(self, pos: int) -> List[Token]:
+
+        # Tokens consumed since ``pos``; valid until the next ``release``.
+        return self._buffer[pos:self._pos]
+
+    def at_end(self) -> bool:
+
+        return self.peek().type == TokenType.EOF
+
+    def release(self):
+
+        # Drop consumed tokens so streaming parses hold only the current statement.
+        if self._streaming and self._pos:
+            del self._buffer[:self._pos]
+            self._pos = 0
+
 class QlikParser:
 
-    def __init__(self):
-        self.script_lines: List[str] = []
-        self.current_line = 0
-        self.variables: Dict[str, str] = {}
+    def __init__(self, variables: Optional[Dict[str, str]] = None, expand_variables: bool = True,
+                 include_resolver: Optional[IncludeResolver] = None):
+        self.environment = VariableEnvironment(variables)
+        self.expander = MacroExpander(self.environment)
+        self.expand_variables = expand_variables
+        self.include_resolver = include_resolver
+        # Include paths read while parsing, with their content hashes (None
+        # when missing), so cached results can be checked against them.
+        self.includes: Dict[str, Optional[str]] = {}
+        self._include_stack: List[str] = []
+        self._tokens: Optional[_TokenStream] = None
+        self._source: Optional[str] = None
 
     def parse(self, script_text: str) -> Script:
 
-        self.script_lines = self._preprocess(script_text)
-        self.current_line = 0
+        if self.include_resolver is not None:
+            self.include_resolver.prefetch(script_text)
+        statements = list(self._parse_text(script_text))
+        return Script(statements=statements)
 
-        statements = []
-        while self.current_line < len(self.script_lines):
-            statement = self._parse_statement()
-            if statement:
-                statements.append(statement)
-            else:
-                self.current_line += 1
+    def parse_parallel(self, script_text: str, max_workers: Optional[int] = None,
+                       chunk_size: int = PARALLEL_CHUNK_SIZE) -> Script:
+
+        # Statements depend on each other only through variables. LET/SET,
+        # includes and statements opening with a macro are parsed here in
+        # order; every other statement has its macros substituted as text
+        # and is parsed in a worker process with expansion switched off.
+        if self.include_resolver is not None:
+            self.include_resolver.prefetch(script_text)
+        self._source = None
+
+        parts: List[Union[list, int]] = []
+        batches: List[str] = []
+        pending: List[str] = []
+        pending_size = 0
+        for text in group_loops(split_statements(script_text)):
+            # Loops are unrolled with their variable set, so run in order.
+            in_order = LOOP_START.search(text) is not None
+            if in_order or _VARIABLE_HINT.search(text):
+                tokens = QlikLexer().tokenize(text)
+                first = tokens[0]
+                expanded = None
+                if not (in_order or first.type is TokenType.VARIABLE or first.is_keyword("LET", "SET")):
+                    expanded = self._substitute_macros(text, tokens) if self.expand_variables else text
+                if expanded is None:
+                    if pending:
+                        parts.append(len(batches))
+                        batches.append("".join(pending))
+                        pending, pending_size = [], 0
+                    parts.append(list(self._parse_text(text, tokens)))
+                    continue
+                text = expanded
+            pending.append(text)
+            pending_size += len(text)
+            if pending_size >= chunk_size:
+                parts.append(len(batches))
+                batches.append("".join(pending))
+                pending, pending_size = [], 0
+        if pending:
+            parts.append(len(batches))
+            batches.append("".join(pending))
+
+        if len(batches) > 1 and max_workers != 1:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                results = list(pool.map(_parse_batch, batches))
+        else:
+            results = [_parse_batch(batch) for batch in batches]
 
+        statements = []
+        for part in parts:
+            statements.extend(results[part] if isinstance(part, int) else part)
         return Script(statements=statements)
 
-    def _preprocess(self, script_text: str) -> List[str]:
+    def _substitute_macros(self, text: str, tokens: List[Token], split: bool = False) -> Optional[str]:
 
-        lines = []
-        current_line = ""
+        # Splices macro values into the statement text, as Qlik does. Returns
+        # None when a value holds a ';', since it may then define variables,
+        # unless ``split`` allows the statement to be split in place.
+        expand = self.expander.expand
+        parts = []
+        pos = 0
+        for token in tokens:
+            if token.type is TokenType.VARIABLE or (token.type in EXPANDABLE_TOKENS and "$(" in token.value):
+                expanded = expand(token.value)
+                if expanded != token.value:
+                    if ";" in expanded and not split:
+                        return None
+                    parts.append(text[pos:token.start])
+                    parts.append(expanded)
+                    pos = token.end
+        parts.append(text[pos:])
+        return "".join(parts)
+
+    def _parse_text(self, script_text: str, tokens: Optional[List[Token]] = None) -> Iterator[object]:
+
+        self._source = script_text
+        if tokens is None:
+            tokens = QlikLexer().tokenize(script_text)
+        if self.expand_variables and "$(" in script_text:
+            # Expansion depends on earlier SET/LET statements, so the tokens
+            # are fed through lazily instead of being parsed in place.
+            tokens = self._expand_tokens(tokens)
+        return self._parse_tokens(tokens)
+
+    @property
+    def variables(self) -> Dict[str, str]:
+
+        return self.environment.values
+
+    def parse_iter(self, fileobj: IO, chunk_size: int = 1 << 16,
+                   encoding: str = "utf-8"
+                   ) -> Iterator[Union[LoadStatement, MappingLoad, VariableAssignment, StoreStatement, DropStatement,
+                                       ForLoop]]:
+
+        # Statements are yielded as soon as their terminating token has been
+        # read, so only the current statement's tokens are held in memory.
+        self._source = None
+        tokens = QlikLexer().iter_tokens(self._read_chunks(fileobj, chunk_size, encoding))
+        if self.expand_variables:
+            tokens = self._expand_tokens(tokens)
+        return self._parse_tokens(tokens)
+
+    def _expand_tokens(self, tokens: Iterable[Token]) -> Iterator[Token]:
+
+        # Tokens are pulled one statement at a time, so each macro sees the
+        # variables assigned by the statements before it. A statement holding
+        # macros has them spliced into its text, which is then lexed again,
+        # so text touching a macro joins the token it completes; later
+        # positions are shifted to stay consistent with the expanded text.
+        shift = 0
+        statement: List[Token] = []
+        at_statement_start = True
+        for token in tokens:
+            if not (token.type is TokenType.SEMICOLON or token.type is TokenType.EOF or (
+                    token.type is TokenType.IDENT and len(token.value) == 4 and token.value.upper() == "NEXT")):
+                statement.append(token)
+                continue
+            if token.type is not TokenType.EOF:
+                statement.append(token)
+            if any(t.type is TokenType.VARIABLE or (t.type in EXPANDABLE_TOKENS and "$(" in t.value) for t in statement):
+                text, relative = _statement_text(statement)
+                expanded = self._substitute_macros(text, relative, split=True)
+                first = statement[0]
+                base = first.start + shift
+                lexer = QlikLexer(at_statement_start=at_statement_start)
+                for replacement in lexer.tokenize(expanded)[:-1]:
+                    yield replacement._replace(
+                        start=replacement.start + base,
+                        end=replacement.end + base,
+                        line=replacement.line + first.line - 1
+                    )
+                shift += len(expanded) - len(text)
+            elif shift:
+                for pending in statement:
+                    yield pending._replace(start=pending.start + shift, end=pending.end + shift)
+            else:
+                yield from statement
+            if token.type is TokenType.EOF:
+                yield token._replace(start=token.start + shift, end=token.end + shift) if shift else token
+            at_statement_start = token.type is TokenType.SEMICOLON
+            statement = []
+        if statement:
+            yield from statement
+
+    @staticmethod
+    def _read_chunks(fileobj: IO, chunk_size: int, encoding: str) -> Iterator[str]:
+
+        decoder = None
+        while True:
+            chunk = fileobj.read(chunk_size)
+            if not chunk:
+                break
+            if isinstance(chunk, bytes):
+                decoder = decoder or codecs.getincrementaldecoder(encoding)()
+                chunk = decoder.decode(chunk)
+            yield chunk
+        if decoder is not None:
+            tail = decoder.decode(b"", final=True)
+            if tail:
+                yield tail
+
+    def _parse_tokens(self, tokens: Iterable[Token]) -> Iterator[object]:
+
+        self._tokens = _TokenStream(tokens)
+        self._peek = self._tokens.peek
+        self._advance = self._tokens.advance
+
+        while not self._tokens.at_end():
+            statement = self._parse_statement()
+            self._tokens.release()
+            if isinstance(statement, list):
+                yield from statement
+            elif statement:
+                yield statement
 
-        for line in script_text.split('\n'):
+    def _at_statement_end(self) -> bool:
 
-            if '//' in line:
-                line = line[:line.index('//')]
-            if 'REM' in line.upper():
-                line = re.sub(r'\bREM\b.*', '', line, flags=re.IGNORECASE)
+        token_type = self._peek().type
+        return token_type is TokenType.SEMICOLON or token_type is TokenType.EOF
 
-            line = line.strip()
-            if not line:
-                continue
+    def _expect_statement_end(self):
+
+        if self._peek().type == TokenType.SEMICOLON:
+            self._advance()
 
-            current_line += " " + line
+    def _skip_statement(self):
 
-            if line.endswith(';'):
-                lines.append(current_line.strip())
-                current_line = ""
+        while not self._at_statement_end():
+            self._advance()
+        self._expect_statement_end()
 
-        if current_line.strip():
-            lines.append(current_line.strip())
+    def _skip_line(self, line: int) -> List[Token]:
 
-        return lines
+        # Control statements end at the line break rather than at a ';'.
+        tokens = []
+        while self._peek().line == line and not self._at_statement_end():
+            tokens.append(self._advance())
+        if self._peek().type is TokenType.SEMICOLON and self._peek().line == line:
+            self._advance()
+        return tokens
 
     def _parse_statement(self) -> Optional[object]:
 
-        if self.current_line >= len(self.script_lines):
-            return None
+        token = self._peek()
 
-        line = self.script_lines[self.current_line].strip()
+        if token.type == TokenType.SEMICOLON:
+            self._advance()
+            return None
 
-        if re.match(r'\b(LET|SET)\b', line, re.IGNORECASE):
+        if token.is_keyword("LET", "SET") and self._peek(1).type in (TokenType.IDENT, TokenType.BRACKET):
             return self._parse_variable_assignment()
-        elif re.search(r'\bMAPPING\s+LOAD\b', line, re.IGNORECASE):
-            return self._parse_mapping_load()
-        elif re.search(r'\b(LOAD|LEFT\s+JOIN|INNER\s+JOIN|RIGHT\s+JOIN|OUTER\s+JOIN|JOIN)\b', line, re.IGNORECASE):
-            return self._parse_load_statement()
 
-        self.current_line += 1
-        return None
+        if token.is_keyword("FOR") and (self._peek(1).is_keyword("EACH") or self._peek(2).value == "="):
+            return self._parse_for_loop()
 
-    def _parse_variable_assignment(self) -> VariableAssignment:
+        if token.is_keyword("STORE") and self._peek(1).type is not TokenType.COLON:
+            return self._parse_store()
 
-        line = self.script_lines[self.current_line].strip().rstrip(';')
-        self.current_line += 1
+        if token.is_keyword("DROP") and self._peek(1).is_keyword("TABLE", "TABLES"):
+            return self._parse_drop()
 
-        match = re.match(r'\b(LET|SET)\s+(\w+)\s*=\s*(.+)', line, re.IGNORECASE)
-        if match:
-            is_let = match.group(1).upper() == 'LET'
-            var_name = match.group(2)
-            value = match.group(3).strip()
+        if token.is_keyword("NEXT") and self._peek(1).type is not TokenType.COLON:
+            # A NEXT without its FOR.
+            self._skip_line(token.line)
+            return None
 
-            self.variables[var_name] = value
+        if token.type == TokenType.VARIABLE:
+            directive = INCLUDE_DIRECTIVE.fullmatch(token.value)
+            if directive:
+                self._advance()
+                self._expect_statement_end()
+                return self._parse_include(directive.group(2), directive.group(1).lower() == "must_include")
+
+        table_name = None
+        if token.type in (TokenType.IDENT, TokenType.BRACKET, TokenType.QUOTED_IDENT) \
+                and self._peek(1).type == TokenType.COLON:
+            table_name = self._unquote(token.value)
+            self._advance()
+            self._advance()
+            token = self._peek()
+
+        if token.is_keyword("MAPPING"):
+            self._advance()
+            if self._peek().is_keyword("LOAD"):
+                return self._parse_mapping_load(table_name)
+        elif self._starts_load():
+            return self._parse_load_statement(table_name)
+
+        self._skip_statement()
+        return None
 
-            return VariableAssignment(
-                variable_name=var_name,
-                value=value,
-                is_let=is_let
-            )
+    def _starts_load(self) -> bool:
+
+        offset = 0
+        while True:
+            token = self._peek(offset)
+            if token.is_keyword("LOAD"):
+                return True
+            if not token.is_keyword(*LOAD_PREFIXES):
+                return False
+            offset += 1
+            if self._peek(offset).type == TokenType.LPAREN:
+                offset = self._skip_parens_ahead(offset)
+            elif self._peek(offset).type == TokenType.NUMBER:
+                offset += 1
+
+    def _skip_parens_ahead(self, offset: int) -> int:
+
+        depth = 0
+        while True:
+            token = self._peek(offset)
+            if token.type == TokenType.EOF:
+                return offset
+            if token.type == TokenType.LPAREN:
+                depth += 1
+            elif token.type == TokenType.RPAREN:
+                depth -= 1
+                if depth == 0:
+                    return offset + 1
+            offset += 1
+
+    def _parse_variable_assignment(self) -> Optional[VariableAssignment]:
+
+        is_let = self._advance().upper == 'LET'
+        var_name = self._unquote(self._advance().value)
+
+        if self._peek().type != TokenType.OPERATOR or self._peek().value != '=':
+            self._skip_statement()
+            return None
+        self._advance()
 
-        return None
+        value_tokens = []
+        while not self._at_statement_end():
+            value_tokens.append(self._advance())
+        self._expect_statement_end()
 
-    def _parse_mapping_load(self) -> MappingLoad:
+        value = join_tokens(value_tokens)
+        self.assign_variable(var_name, value, is_let)
 
-        statement_text = self._get_full_statement()
+        return VariableAssignment(
+            variable_name=var_name,
+            value=value,
+            is_let=is_let
+        )
 
-        match = re.search(r'(\w+):\s*MAPPING\s+LOAD', statement_text, re.IGNORECASE)
-        mapping_name = match.group(1) if match else "UnnamedMapping"
+    def assign_variable(self, var_name: str, value: str, is_let: bool):
+
+        # LET stores the folded value when it is constant; SET stores its
+        # text, without the quotes of a single string literal.
+        if is_let:
+            stored = self.expander.evaluate(value)
+        elif _SINGLE_STRING.fullmatch(value):
+            stored = value[1:-1].replace("''", "'")
+        else:
+            stored = None
+        self.environment.set(var_name, stored if stored is not None else value)
+
+    def _parse_for_loop(self) -> ForLoop:
+
+        line = self._advance().line
+        each = self._peek().is_keyword("EACH")
+        if each:
+            self._advance()
+        variable = self._unquote(self._advance().value)
+        self._advance()
+        header = self._skip_line(line)
+        values, file_pattern = self._loop_values(header) if each else (self._loop_range(header), None)
+
+        # The body is parsed with the variable unset, so its macros are kept
+        # as written, then once more per value from the same tokens.
+        self.environment.unset(variable)
+        start = self._tokens.position()
+        statements = []
+        while not self._tokens.at_end() and not self._peek().is_keyword("NEXT"):
+            statement = self._parse_statement()
+            if isinstance(statement, list):
+                statements.extend(statement)
+            elif statement:
+                statements.append(statement)
+        body = self._tokens.since(start)
+
+        unrolled = None
+        iterations = [file_pattern] if file_pattern is not None else values
+        if iterations is not None and self.expand_variables:
+            end = body[-1].end if body else 0
+            tokens = body + [Token(TokenType.EOF, "", end, end, body[-1].line if body else line)]
+            unrolled = []
+            for value in iterations:
+                self.environment.set(variable, value)
+                child = self._child_parser()
+                unrolled.extend(child._parse_tokens(child._expand_tokens(tokens)))
+            self.environment.unset(variable)
+
+        if self._peek().is_keyword("NEXT"):
+            self._skip_line(self._advance().line)
+        return ForLoop(
+            variable=variable,
+            values=values,
+            file_pattern=file_pattern,
+            statements=statements,
+            unrolled=unrolled
+        )
 
-        fields_match = re.search(r'MAPPING\s+LOAD\s+(.*?)\s+FROM', statement_text, re.IGNORECASE | re.DOTALL)
-        fields_text = fields_match.group(1) if fields_match else ""
-        fields = [f.strip() for f in fields_text.split(',')]
+    def _loop_range(self, header: List[Token]) -> Optional[List[str]]:
 
-        key_field = fields[0] if len(fields) > 0 else "key"
-        value_field = fields[1] if len(fields) > 1 else "value"
+        # FOR i = a TO b [STEP s], when the bounds are constant.
+        bounds: List[List[Token]] = [[]]
+        for token in header:
+            if token.is_keyword("TO", "STEP") and len(bounds) < 3:
+                bounds.append([])
+            else:
+                bounds[-1].append(token)
+        if len(bounds) < 2:
+            return None
+        numbers = []
+        for tokens in bounds:
+            value = self.expander.evaluate(join_tokens(tokens)) if tokens else None
+            try:
+                numbers.append(float(value))
+            except (TypeError, ValueError):
+                return None
+        start, end = numbers[0], numbers[1]
+        step = numbers[2] if len(numbers) > 2 else 1.0
+        if step == 0 or (end - start) / step >= MAX_LOOP_ITERATIONS:
+            return None
 
-        source_match = re.search(r'FROM\s+(.*?)(?:WHERE|;)', statement_text, re.IGNORECASE)
-        source = source_match.group(1).strip() if source_match else ""
+        values = []
+        current = start
+        while (current <= end) if step > 0 else (current >= end):
+            values.append(str(int(current)) if current.is_integer() else str(current))
+            current = start + step * len(values)
+        return values
+
+    def _loop_values(self, header: List[Token]) -> Tuple[Optional[List[str]], Optional[str]]:
+
+        # FOR EACH v IN FileList('pattern') or a list of constant values.
+        if len(header) == 4 and header[0].value.lower() == "filelist" \
+                and header[1].type is TokenType.LPAREN and header[2].type is TokenType.STRING:
+            return None, header[2].value[1:-1].replace("''", "'")
+
+        parts: List[List[Token]] = [[]]
+        depth = 0
+        for token in header:
+            if token.type is TokenType.COMMA and depth == 0:
+                parts.append([])
+                continue
+            if token.type is TokenType.LPAREN:
+                depth += 1
+            elif token.type is TokenType.RPAREN:
+                depth -= 1
+            parts[-1].append(token)
+        values = []
+        for tokens in parts:
+            value = self.expander.evaluate(join_tokens(tokens)) if tokens else None
+            if value is None or len(parts) > MAX_LOOP_ITERATIONS:
+                return None, None
+            values.append(value)
+        return values, None
+
+    def _parse_store(self) -> Optional[StoreStatement]:
+
+        # STORE [fields FROM] table INTO file [(format)]
+        self._advance()
+        fields = []
+        if not self._peek(1).is_keyword("INTO"):
+            fields = self._parse_fields()
+            if not self._peek().is_keyword("FROM"):
+                self._skip_statement()
+                return None
+            self._advance()
+        table_name = self._unquote(self._advance().value)
+        if not self._peek().is_keyword("INTO"):
+            self._skip_statement()
+            return None
+        self._advance()
 
-        where_clause = self._parse_where_clause(statement_text)
+        target = self._parse_path()
+        file_format = None
+        if self._peek().type == TokenType.LPAREN:
+            spec = [token for token in self._collect_parens() if token.type == TokenType.IDENT]
+            file_format = spec[0].value.lower() if spec else None
+        self._skip_statement()
 
-        return MappingLoad(
-            mapping_name=mapping_name,
-            key_field=key_field,
-            value_field=value_field,
-            source=source,
-            where_clause=where_clause
+        return StoreStatement(
+            table_name=table_name,
+            target=target,
+            file_format=file_format,
+            fields=fields
         )
 
-    def _parse_load_statement(self) -> LoadStatement:
+    def _parse_drop(self) -> DropStatement:
+
+        # DROP TABLE[S] a, b
+        self._advance()
+        self._advance()
+        table_names = []
+        while self._peek().type in (TokenType.IDENT, TokenType.BRACKET, TokenType.QUOTED_IDENT):
+            table_names.append(self._unquote(self._advance().value))
+            if self._peek().type != TokenType.COMMA:
+                break
+            self._advance()
+        self._skip_statement()
+        return DropStatement(table_names=table_names)
+
+    def _child_parser(self) -> "QlikParser":
+
+        # Shares this parser's variables while keeping its token stream intact.
+        child = QlikParser(expand_variables=self.expand_variables, include_resolver=self.include_resolver)
+        child.environment = self.environment
+        child.expander = self.expander
+        child.includes = self.includes
+        child._include_stack = self._include_stack
+        return child
+
+    def _parse_include(self, path: str, must_include: bool) -> Optional[list]:
+
+        resolver = self.include_resolver
+        loaded = resolver.read(path) if resolver is not None else None
+        if resolver is not None:
+            self.includes[path] = loaded[1] if loaded is not None else None
+        if loaded is None:
+            if must_include and resolver is not None:
+                raise IncludeError(f"Must_Include file not found: {path}")
+            return None
 
-        statement_text = self._get_full_statement()
+        text, digest = loaded
+        if digest in self._include_stack or len(self._include_stack) >= MAX_INCLUDE_DEPTH:
+            raise IncludeError(f"Circular or too deeply nested include: {path}")
 
-        load_type = LoadType.EXTERNAL
-        join_clause = None
-
-        join_match = re.match(r'(LEFT\s+JOIN|RIGHT\s+JOIN|INNER\s+JOIN|OUTER\s+JOIN|JOIN)\s*(\((\w+)\))?\s+LOAD', 
-                             statement_text, re.IGNORECASE)
-        if join_match:
-            join_type_str = join_match.group(1).strip().upper()
-            if 'LEFT' in join_type_str:
-                join_type_str = 'left'
-            elif 'RIGHT' in join_type_str:
-                join_type_str = 'right'
-            elif 'OUTER' in join_type_str:
-                join_type_str = 'outer'
-            elif 'INNER' in join_type_str or join_type_str == 'JOIN':
-                join_type_str = 'inner'
-            join_table = join_match.group(3) if join_match.group(3) else None
-
-            join_clause = JoinClause(
-                join_type=JoinType(join_type_str),
-                table_name=join_table,
-                on_fields=None  
-            )
+        child = self._child_parser()
+        child._include_stack = self._include_stack + [digest]
 
-        distinct = bool(re.search(r'\bDISTINCT\b', statement_text, re.IGNORECASE))
+        cached = resolver.cache.get(digest)
+        if cached is not None and cached.statements is not None:
+            for statement in cached.statements:
+                if isinstance(statement, VariableAssignment):
+                    self.assign_variable(statement.variable_name, statement.value, statement.is_let)
+            return list(cached.statements)
 
-        table_match = re.match(r'(\w+):\s*(?:(?:LEFT|RIGHT|INNER|OUTER)?\s*JOIN\s*)?LOAD', statement_text, re.IGNORECASE)
-        table_name = table_match.group(1) if table_match else None
+        tokens = cached.tokens if cached is not None else QlikLexer().tokenize(text)
+        statements = list(child._parse_text(text, tokens))
+        if cached is None:
+            static = "$(" not in text
+            resolver.cache.put(digest, ParsedInclude(tokens, statements if static else None))
+        return statements
 
-        fields = self._parse_fields(statement_text)
+    def _parse_mapping_load(self, mapping_name: Optional[str]) -> MappingLoad:
 
-        source = None
-        inline_data = None
+        load_stmt = self._parse_load_statement(mapping_name)
 
-        if re.search(r'\bFROM\s+\[', statement_text, re.IGNORECASE):
+        fields = [f.raw_expression for f in load_stmt.fields if f.raw_expression != '*']
+        if not fields and load_stmt.inline_data:
+            fields = load_stmt.inline_data.headers
 
-            load_type = LoadType.EXTERNAL
-            source_match = re.search(r'FROM\s+\[([^\]]+)\]', statement_text, re.IGNORECASE)
-            if source_match:
-                source = source_match.group(1)
+        key_field = fields[0] if len(fields) > 0 else "key"
+        value_field = fields[1] if len(fields) > 1 else "value"
 
-        elif re.search(r'\bFROM\b', statement_text, re.IGNORECASE):
+        return MappingLoad(
+            mapping_name=mapping_name or "UnnamedMapping",
+            key_field=key_field,
+            value_field=value_field,
+            source=load_stmt.source or "",
+            where_clause=load_stmt.where_clause,
+            load_type=load_stmt.load_type,
+            inline_data=load_stmt.inline_data
+        )
 
-            load_type = LoadType.EXTERNAL
-            source_match = re.search(r'FROM\s+([\w\./\\:]+)', statement_text, re.IGNORECASE)
-            if source_match:
-                source = source_match.group(1)
+    def _parse_load_statement(self, table_name: Optional[str]) -> LoadStatement:
 
-        elif re.search(r'\bRESIDENT\b', statement_text, re.IGNORECASE):
+        join_clause, concatenate, no_concatenate = self._parse_load_prefixes()
+        self._advance()
 
-            load_type = LoadType.RESIDENT
-            resident_match = re.search(r'RESIDENT\s+(\w+)', statement_text, re.IGNORECASE)
-            if resident_match:
-                source = resident_match.group(1)
+        distinct = False
+        if self._peek().is_keyword("DISTINCT"):
+            self._advance()
+            distinct = True
 
-        elif re.search(r'\bINLINE\b', statement_text, re.IGNORECASE):
+        fields = self._parse_fields()
 
+        load_type = LoadType.EXTERNAL
+        source = None
+        inline_data = None
+
+        token = self._peek()
+        if token.is_keyword("FROM"):
+            self._advance()
+            load_type = LoadType.EXTERNAL
+            source = self._parse_source()
+        elif token.is_keyword("RESIDENT"):
+            self._advance()
+            load_type = LoadType.RESIDENT
+            source = self._unquote(self._advance().value)
+        elif token.is_keyword("INLINE"):
+            self._advance()
             load_type = LoadType.INLINE
-            inline_data = self._parse_inline_data(statement_text)
+            inline_data = self._parse_inline_data()
+        elif token.is_keyword("AUTOGENERATE"):
+            self._advance()
+            self._collect_until(LOAD_CLAUSE_KEYWORDS)
+
+        where_clause = None
+        group_by = None
+        order_by = None
+
+        while not self._at_statement_end():
+            token = self._peek()
+            if token.is_keyword("WHERE", "WHILE"):
+                self._advance()
+                condition_tokens = self._collect_until({"GROUP", "ORDER"})
+                condition = join_tokens(condition_tokens)
+                if token.upper == "WHERE":
+                    where_clause = WhereClause(
+                        condition=condition,
+                        expression=self._parse_expression(condition_tokens, condition)
+                    )
+            elif token.is_keyword("GROUP") and self._peek(1).is_keyword("BY"):
+                self._advance()
+                self._advance()
+                group_by = GroupByClause(fields=self._parse_name_list({"ORDER"}))
+            elif token.is_keyword("ORDER") and self._peek(1).is_keyword("BY"):
+                self._advance()
+                self._advance()
+                order_by = self._parse_order_by()
+            else:
+                self._advance()
 
-        where_clause = self._parse_where_clause(statement_text)
-        group_by = self._parse_group_by(statement_text)
-        order_by = self._parse_order_by(statement_text)
+        self._expect_statement_end()
 
         return LoadStatement(
             load_type=load_type,
@@ -198,160 +742,250 @@ class QlikParser:
             group_by=group_by,
             order_by=order_by,
             join_clause=join_clause,
+            concatenate=concatenate,
+            no_concatenate=no_concatenate,
             distinct=distinct
         )
 
-    def _get_full_statement(self) -> str:
-
-        statement = self.script_lines[self.current_line]
-        self.current_line += 1
-        return statement
-
-    def _parse_fields(self, statement_text: str) -> List[FieldExpression]:
-
-        fields_match = re.search(
-            r'LOAD(?:\s+DISTINCT)?\s+(.*?)\s+(?:FROM|RESIDENT|INLINE|WHERE|GROUP\s+BY|ORDER\s+BY|;)',
-            statement_text,
-            re.IGNORECASE | re.DOTALL
+    def _parse_load_prefixes(self) -> Tuple[Optional[JoinClause], Optional[ConcatenateClause], bool]:
+
+        join_type = None
+        join_table = None
+        keep = False
+        concatenate = None
+        no_concatenate = False
+
+        while not self._peek().is_keyword("LOAD"):
+            token = self._advance()
+            keyword = token.upper
+
+            if keyword == "CONCATENATE":
+                table = None
+                if self._peek().type == TokenType.LPAREN:
+                    table = self._unquote(join_tokens(self._collect_parens()[1:-1]))
+                concatenate = ConcatenateClause(table_name=table)
+            elif keyword == "NOCONCATENATE":
+                no_concatenate = True
+            elif keyword == "KEEP":
+                keep = True
+                join_type = join_type or "inner"
+                if self._peek().type == TokenType.LPAREN:
+                    join_table = self._unquote(join_tokens(self._collect_parens()[1:-1]))
+            elif keyword in JOIN_KEYWORDS:
+                if keyword != "JOIN":
+                    join_type = keyword.lower()
+                elif join_type is None:
+                    join_type = "inner"
+                if keyword == "JOIN" and self._peek().type == TokenType.LPAREN:
+                    join_table = self._unquote(join_tokens(self._collect_parens()[1:-1]))
+            elif self._peek().type == TokenType.LPAREN:
+                self._collect_parens()
+            elif self._peek().type == TokenType.NUMBER:
+                self._advance()
+
+        if join_type is None:
+            return None, concatenate, no_concatenate
+
+        join_clause = JoinClause(
+            join_type=JoinType(join_type),
+            table_name=join_table,
+            on_fields=None,
+            keep=keep
         )
+        return join_clause, concatenate, no_concatenate
+
+    def _collect_until(self, keywords) -> List[Token]:
+
+        # Collect tokens up to the first top-level keyword in ``keywords``,
+        # a closing parenthesis of an enclosing group, or the statement end.
+        tokens = []
+        depth = 0
+        while not self._at_statement_end():
+            token = self._peek()
+            if depth == 0:
+                if token.type == TokenType.RPAREN:
+                    break
+                if token.type == TokenType.IDENT and token.upper in keywords:
+                    break
+            if token.type == TokenType.LPAREN:
+                depth += 1
+            elif token.type == TokenType.RPAREN:
+                depth -= 1
+            tokens.append(self._advance())
+        return tokens
+
+    def _collect_parens(self) -> List[Token]:
+
+        tokens = [self._advance()]
+        tokens.extend(self._collect_until(set()))
+        if self._peek().type == TokenType.RPAREN:
+            tokens.append(self._advance())
+        return tokens
+
+    def _split_top_level(self, stop_keywords) -> List[List[Token]]:
+
+        buffer, pos = self._tokens.statement_window()
+        items: List[List[Token]] = []
+        current: List[Token] = []
+        depth = 0
+
+        for pos in range(pos, len(buffer)):
+            token = buffer[pos]
+            token_type = token.type
+            if token_type is TokenType.SEMICOLON or token_type is TokenType.EOF:
+                break
+            if token_type is TokenType.COMMA and depth == 0:
+                items.append(current)
+                current = []
+                continue
+            if token_type is TokenType.LPAREN:
+                depth += 1
+            elif token_type is TokenType.RPAREN:
+                depth -= 1
+            elif depth == 0 and token_type is TokenType.IDENT and token.value.upper() in stop_keywords:
+                break
+            current.append(token)
+        else:
+            pos = len(buffer)
+
+        self._tokens.seek(pos)
+        if current:
+            items.append(current)
+        return items
 
-        if not fields_match:
-            return []
+    def _parse_fields(self) -> List[FieldExpression]:
 
-        fields_text = fields_match.group(1).strip()
+        field_expressions = []
 
-        if fields_text.strip() == '*':
-            return [FieldExpression(raw_expression="*", alias=None)]
+        for tokens in self._split_top_level(LOAD_CLAUSE_KEYWORDS):
+            if not tokens:
+                continue
 
-        fields = self._smart_split(fields_text, ',')
+            alias = None
+            if len(tokens) >= 3 and tokens[-2].is_keyword("AS"):
+                alias = self._unquote(tokens[-1].value)
+                tokens = tokens[:-2]
 
-        field_expressions = []
-        for field in fields:
-            field = field.strip()
-            if not field:
+            expression = join_tokens(tokens)
+            if expression == '*':
+                field_expressions.append(FieldExpression(raw_expression="*", alias=None))
                 continue
 
-            alias_match = re.search(r'\s+(?:AS|as)\s+(\w+)$', field, re.IGNORECASE)
-            if alias_match:
-                alias = alias_match.group(1)
-                expression = field[:alias_match.start()].strip()
-            else:
-                alias = None
-                expression = field
-
-            is_calculated = bool(re.search(r'[+\-*/()]|\b(?:If|Year|Month|Upper|Lower|Sum|Count|Avg)\b', 
-                                          expression, re.IGNORECASE))
+            is_calculated = any(
+                t.type in (TokenType.LPAREN, TokenType.OPERATOR) for t in tokens
+            )
 
             field_expressions.append(FieldExpression(
                 raw_expression=expression,
                 alias=alias,
-                is_calculated=is_calculated
+                is_calculated=is_calculated,
+                expression=self._parse_expression(tokens, expression)
             ))
 
         return field_expressions
 
-    def _parse_where_clause(self, statement_text: str) -> Optional[WhereClause]:
-
-        where_match = re.search(
-            r'\bWHERE\s+(.*?)(?:\s+GROUP\s+BY|\s+ORDER\s+BY|;|$)',
-            statement_text,
-            re.IGNORECASE | re.DOTALL
-        )
-        if where_match:
-            condition = where_match.group(1).strip()
-            return WhereClause(condition=condition)
-        return None
+    def _parse_expression(self, tokens: List[Token], text: str):
 
-    def _parse_group_by(self, statement_text: str) -> Optional[GroupByClause]:
-
-        group_match = re.search(
-            r'\bGROUP\s+BY\s+(.*?)(?:\s+ORDER\s+BY|;|$)',
-            statement_text,
-            re.IGNORECASE
-        )
-        if group_match:
-            fields_text = group_match.group(1).strip()
-            fields = [f.strip() for f in fields_text.split(',')]
-            return GroupByClause(fields=fields)
-        return None
-
-    def _parse_order_by(self, statement_text: str) -> Optional[OrderByClause]:
-
-        order_match = re.search(
-            r'\bORDER\s+BY\s+(.*?)(?:;|$)',
-            statement_text,
-            re.IGNORECASE
-        )
-        if order_match:
-            fields_text = order_match.group(1).strip()
-
-            ascending = 'DESC' not in fields_text.upper()
-            fields_text = fields_text.replace('DESC', '').replace('ASC', '')
-            fields = [f.strip() for f in fields_text.split(',')]
-            return OrderByClause(fields=fields, ascending=ascending)
-        return None
+        try:
+            return parse_expression_tokens(tokens, text)
+        except ExpressionSyntaxError:
+            return None
 
-    def _parse_inline_data(self, statement_text: str) -> List[List[str]]:
+    def _parse_source(self) -> str:
 
-        inline_match = re.search(
-            r'INLINE\s*\[(.*?)\]',
-            statement_text,
-            re.IGNORECASE | re.DOTALL
-        )
-        if not inline_match:
-            return []
+        path = self._parse_path()
+        if self._peek().type == TokenType.LPAREN:
+            self._collect_parens()
+        return path
 
-        data_text = inline_match.group(1).strip()
-        rows = []
+    def _parse_path(self) -> str:
 
-        for line in data_text.split('\n'):
-            line = line.strip()
-            if not line:
-                continue
+        tokens = []
+        while not self._at_statement_end():
+            token = self._peek()
+            if tokens and token.start > tokens[-1].end:
+                break
+            if token.type in (TokenType.LPAREN, TokenType.COMMA):
+                break
+            if token.type == TokenType.IDENT and token.upper in LOAD_CLAUSE_KEYWORDS:
+                break
+            tokens.append(self._advance())
 
-            if ',' in line:
-                values = [v.strip() for v in line.split(',')]
-            else:
-                values = [v.strip() for v in re.split(r'\s+', line)]
-            rows.append(values)
+        if len(tokens) == 1:
+            return self._unquote(tokens[0].value)
+        return "".join(t.value for t in tokens)
 
-        return rows
+    def _parse_name_list(self, stop_keywords) -> List[str]:
 
-    def _smart_split(self, text: str, delimiter: str) -> List[str]:
+        return [join_tokens(item) for item in self._split_top_level(stop_keywords) if item]
 
-        parts = []
-        current = ""
-        paren_depth = 0
-        in_quotes = False
-        quote_char = None
-
-        for char in text:
-            if char in ('"', "'") and (not in_quotes or char == quote_char):
-                in_quotes = not in_quotes
-                quote_char = char if in_quotes else None
-                current += char
-            elif char == '(' and not in_quotes:
-                paren_depth += 1
-                current += char
-            elif char == ')' and not in_quotes:
-                paren_depth -= 1
-                current += char
-            elif char == delimiter and paren_depth == 0 and not in_quotes:
-                parts.append(current)
-                current = ""
-            else:
-                current += char
+    def _parse_order_by(self) -> OrderByClause:
 
-        if current:
-            parts.append(current)
+        fields = []
+        ascending = True
 
-        return parts
+        for item in self._split_top_level(set()):
+            if item and item[-1].is_keyword("DESC", "ASC"):
+                if item[-1].upper == "DESC":
+                    ascending = False
+                item = item[:-1]
+            if item:
+                fields.append(join_tokens(item))
 
-    def _substitute_variables(self, text: str) -> str:
+        return OrderByClause(fields=fields, ascending=ascending)
 
-        for var_name, var_value in self.variables.items():
+    def _parse_inline_data(self) -> Optional[InlineTable]:
 
-            text = text.replace(f"$({var_name})", var_value)
+        token = self._peek()
+        if token.type != TokenType.BRACKET:
+            return None
+        self._advance()
+
+        options = {}
+        if self._peek().type == TokenType.LPAREN:
+            options = parse_format_spec(join_tokens(self._collect_parens()))
+
+        # Keep an offset range into the script instead of copying the block;
+        # streamed or macro-expanded blocks fall back to the token's own text.
+        if self._source is not None and self._source.startswith(token.value, token.start):
+            source, start, end = self._source, token.start + 1, token.end - 1
+        else:
+            source, start, end = token.value, 1, len(token.value) - 1
+
+        return InlineTable(
+            source, start, end,
+            delimiter=options.get("delimiter", ","),
+            has_labels=options.get("has_labels", True)
+        )
 
-            text = re.sub(rf'\$\({var_name}\)', var_value, text)
-        return text
+    @staticmethod
+    def _unquote(name: str) -> str:
+
+        if len(name) >= 2 and (name[0], name[-1]) in (('[', ']'), ('"', '"'), ("'", "'")):
+            return name[1:-1]
+        return name
+
+def _statement_text(tokens: List[Token]) -> Tuple[str, List[Token]]:
+
+    # Rebuilds a statement's text from its tokens, keeping adjacent tokens
+    # joined and line breaks in place, with tokens positioned in that text.
+    parts = []
+    relative = []
+    pos = 0
+    previous: Optional[Token] = None
+    for token in tokens:
+        if previous is not None and token.start > previous.end:
+            breaks = token.line - previous.line - previous.value.count("\n")
+            gap = "\n" * breaks if breaks > 0 else " "
+            parts.append(gap)
+            pos += len(gap)
+        parts.append(token.value)
+        relative.append(token._replace(start=pos, end=pos + len(token.value)))
+        pos += len(token.value)
+        previous = token
+    return "".join(parts), relative
+
+def _parse_batch(script_text: str) -> list:
+
+    # Runs in worker processes; macros were already substituted.
+    return QlikParser(expand_variables=False).parse(script_text).statements
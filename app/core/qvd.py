@@ -0,0 +1,431 @@
+
+import hashlib
+import mmap
+import struct
+import xml.etree.ElementTree as ET
+from typing import Dict, Iterator, List, NamedTuple, Optional, Tuple
+import numpy as np
+import pandas as pd
+from app.models.ir_models import DataType
+
+HEADER_END = b"</QvdTableHeader>"
+
+HEADER_READ_SIZE = 1 << 16
+
+# Rows decoded at a time, which bounds memory for multi-GB files.
+DEFAULT_BATCH_ROWS = 1 << 20
+
+# Symbol type bytes: int32, float64, string, and the two dual forms
+# (a number followed by its display text).
+SYMBOL_INT = 1
+SYMBOL_FLOAT = 2
+SYMBOL_STRING = 4
+SYMBOL_DUAL_INT = 5
+SYMBOL_DUAL_FLOAT = 6
+
+# Qlik dates and timestamps count days from this day.
+QLIK_EPOCH = np.datetime64("1899-12-30", "D")
+
+MICROSECONDS_PER_DAY = 86400 * 1000 * 1000
+
+_NUMPY_TYPES = {
+    DataType.LONG: np.dtype(np.int64),
+    DataType.DOUBLE: np.dtype(np.float64),
+    DataType.DATE: np.dtype("datetime64[D]"),
+    DataType.TIMESTAMP: np.dtype("datetime64[us]"),
+}
+
+_INT = struct.Struct("<i")
+_FLOAT = struct.Struct("<d")
+
+class QvdError(Exception):
+    pass
+
+class QvdField(NamedTuple):
+
+    name: str
+    bit_offset: int
+    bit_width: int
+    bias: int
+    symbol_count: int
+    # Symbol table position, relative to the end of the header.
+    offset: int
+    length: int
+    number_format: str
+    tags: Tuple[str, ...]
+
+class QvdHeader(NamedTuple):
+
+    table_name: str
+    fields: List[QvdField]
+    record_size: int
+    record_count: int
+    # Index table position, relative to the end of the header.
+    offset: int
+    length: int
+
+def qvd_field_type(field: QvdField) -> Optional[DataType]:
+
+    # The type Qlik's field tags describe, which is also what QvdReader
+    # decodes the field to; None when the writer left the tags out.
+    tags = {tag.lower() for tag in field.tags}
+    if not tags:
+        return None
+    if "$numeric" not in tags:
+        return DataType.STRING
+    if "$date" in tags or field.number_format.upper() == "DATE":
+        return DataType.DATE
+    if "$timestamp" in tags or field.number_format.upper() == "TIMESTAMP":
+        return DataType.TIMESTAMP
+    if "$integer" in tags:
+        return DataType.LONG
+    return DataType.DOUBLE
+
+def read_qvd_header(path: str) -> QvdHeader:
+
+    # Reads only up to the end of the XML header.
+    return _parse_header(_read_header_bytes(path)[0])
+
+def qvd_header_digest(path: str) -> str:
+
+    # Changes whenever the table's layout, row count or symbols change.
+    return hashlib.sha256(_read_header_bytes(path)[0]).hexdigest()
+
+def _read_header_bytes(path: str) -> Tuple[bytes, int]:
+
+    # Returns the header XML and the offset where the data begins.
+    data = bytearray()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(HEADER_READ_SIZE)
+            if not chunk:
+                raise QvdError(f"No QVD header found in {path}")
+            searched = max(0, len(data) - len(HEADER_END))
+            data += chunk
+            end = data.find(HEADER_END, searched)
+            if end >= 0:
+                break
+
+        # Writers follow the header with CR LF and a NUL byte; no symbol
+        # or index table starts with one of those.
+        header_end = end + len(HEADER_END)
+        f.seek(header_end)
+        data_start = header_end
+        while True:
+            chunk = f.read(16)
+            padding = len(chunk) - len(chunk.lstrip(b"\r\n\0"))
+            data_start += padding
+            if padding < len(chunk) or not chunk:
+                break
+    return bytes(data[:header_end]), data_start
+
+def _parse_header(xml: bytes) -> QvdHeader:
+
+    try:
+        root = ET.fromstring(xml.decode("utf-8", errors="replace"))
+    except ET.ParseError as e:
+        raise QvdError(f"Malformed QVD header: {e}") from e
+
+    fields = []
+    for node in root.iterfind("Fields/QvdFieldHeader"):
+        fields.append(QvdField(
+            name=node.findtext("FieldName", ""),
+            bit_offset=int(node.findtext("BitOffset", "0")),
+            bit_width=int(node.findtext("BitWidth", "0")),
+            bias=int(node.findtext("Bias", "0")),
+            symbol_count=int(node.findtext("NoOfSymbols", "0")),
+            offset=int(node.findtext("Offset", "0")),
+            length=int(node.findtext("Length", "0")),
+            number_format=node.findtext("NumberFormat/Type", "UNKNOWN"),
+            tags=tuple(tag.text or "" for tag in node.iterfind("Tags/String"))
+        ))
+
+    return QvdHeader(
+        table_name=root.findtext("TableName", ""),
+        fields=fields,
+        record_size=int(root.findtext("RecordByteSize", "0")),
+        record_count=int(root.findtext("NoOfRecords", "0")),
+        offset=int(root.findtext("Offset", "0")),
+        length=int(root.findtext("Length", "0"))
+    )
+
+class QvdReader:
+
+    # The file is memory-mapped; symbol tables are decoded per field on
+    # first use and the bit-packed index table a batch of rows at a time,
+    # so only the rows being converted are ever resident.
+
+    def __init__(self, path: str, dual: str = "text"):
+        # ``dual`` picks the display text or the number of dual symbols.
+        if dual not in ("text", "number"):
+            raise ValueError(f"dual must be 'text' or 'number', not {dual!r}")
+        self.path = path
+        self.dual = dual
+        header_xml, self.data_start = _read_header_bytes(path)
+        self.header = _parse_header(header_xml)
+        self._symbols: Dict[str, np.ndarray] = {}
+
+        self._file = open(path, "rb")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        header = self.header
+        start = self.data_start + header.offset
+        if start + header.record_count * header.record_size > len(self._map):
+            self.close()
+            raise QvdError(f"QVD index table runs past the end of {path}")
+        if header.record_count:
+            self._records = np.frombuffer(
+                self._map, dtype=np.uint8, count=header.record_count * header.record_size, offset=start
+            ).reshape(header.record_count, header.record_size)
+        else:
+            self._records = np.empty((0, header.record_size), dtype=np.uint8)
+
+    def __enter__(self) -> "QvdReader":
+
+        return self
+
+    def __exit__(self, *exc_info):
+
+        self.close()
+
+    def close(self):
+
+        # Views into the map have to go before it can be closed.
+        self._records = None
+        try:
+            self._map.close()
+        except BufferError:
+            pass
+        self._file.close()
+
+    @property
+    def columns(self) -> List[str]:
+        return [field.name for field in self.header.fields]
+
+    def arrow_schema(self):
+
+        import pyarrow as pa
+
+        return pa.schema([(name, _arrow_type(self.symbols(name))) for name in self.columns])
+
+    def data_types(self) -> Dict[str, DataType]:
+
+        # Types of the decoded columns, as written to Parquet.
+        return {name: _data_type(self.symbols(name)) for name in self.columns}
+
+    def symbols(self, name: str) -> np.ndarray:
+
+        symbols = self._symbols.get(name)
+        if symbols is None:
+            field = self._field(name)
+            data_type = qvd_field_type(field)
+            # Fields tagged numeric use the number of dual symbols; text
+            # fields follow ``dual``.
+            if data_type is DataType.STRING and self.dual == "number":
+                data_type = None
+            dual = self.dual if data_type in (None, DataType.STRING) else "number"
+            start = self.data_start + field.offset
+            symbols = _decode_symbols(self._map[start:start + field.length], field.symbol_count, dual)
+            symbols = _convert_symbols(symbols, data_type)
+            self._symbols[name] = symbols
+        return symbols
+
+    def indices(self, name: str, start: int = 0, stop: Optional[int] = None) -> np.ndarray:
+
+        # Symbol indices of rows ``start:stop``; negative means null.
+        field = self._field(name)
+        rows = self._records[start:stop]
+        if field.bit_width == 0:
+            return np.full(len(rows), field.bias, dtype=np.int64)
+
+        # Gather the bytes spanning the field into one little-endian word
+        # per row, then shift and mask every row at once.
+        first = field.bit_offset // 8
+        last = (field.bit_offset + field.bit_width - 1) // 8
+        packed = np.zeros(len(rows), dtype=np.uint64)
+        for shift, column in enumerate(range(first, last + 1)):
+            packed |= rows[:, column].astype(np.uint64) << np.uint64(8 * shift)
+        packed >>= np.uint64(field.bit_offset % 8)
+        packed &= np.uint64((1 << field.bit_width) - 1)
+        return packed.astype(np.int64) + field.bias
+
+    def column(self, name: str, start: int = 0, stop: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+
+        # Returns the values of rows ``start:stop`` and their null mask.
+        symbols = self.symbols(name)
+        indices = self.indices(name, start, stop)
+        nulls = (indices < 0) | (indices >= len(symbols))
+        if not len(symbols):
+            return np.zeros(len(indices), dtype=symbols.dtype), np.ones(len(indices), dtype=bool)
+        return symbols.take(np.where(nulls, 0, indices)), nulls
+
+    def iter_batches(self, batch_size: int = DEFAULT_BATCH_ROWS,
+                     columns: Optional[List[str]] = None) -> Iterator[pd.DataFrame]:
+
+        for start in range(0, self.header.record_count, batch_size):
+            yield self._frame(start, start + batch_size, columns)
+
+    def iter_record_batches(self, batch_size: int = DEFAULT_BATCH_ROWS, columns: Optional[List[str]] = None):
+
+        import pyarrow as pa
+
+        names = columns or self.columns
+        for start in range(0, self.header.record_count, batch_size):
+            arrays = []
+            for name in names:
+                values, nulls = self.column(name, start, start + batch_size)
+                arrays.append(pa.array(values, mask=nulls, type=_arrow_type(values)))
+            yield pa.RecordBatch.from_arrays(arrays, names=names)
+
+    def to_pandas(self, columns: Optional[List[str]] = None) -> pd.DataFrame:
+
+        return self._frame(0, self.header.record_count, columns)
+
+    def to_arrow(self, columns: Optional[List[str]] = None):
+
+        import pyarrow as pa
+
+        batches = list(self.iter_record_batches(columns=columns))
+        if batches:
+            return pa.Table.from_batches(batches)
+        names = columns or self.columns
+        return pa.table({name: pa.array([], type=_arrow_type(self.symbols(name))) for name in names})
+
+    def _frame(self, start: int, stop: int, columns: Optional[List[str]]) -> pd.DataFrame:
+
+        data = {}
+        for name in columns or self.columns:
+            values, nulls = self.column(name, start, stop)
+            if values.dtype == np.int64 and nulls.any():
+                data[name] = pd.arrays.IntegerArray(values, nulls)
+            elif values.dtype == np.float64:
+                data[name] = np.where(nulls, np.nan, values)
+            elif values.dtype.kind == "M":
+                data[name] = np.where(nulls, np.datetime64("NaT"), values)
+            elif values.dtype == object and nulls.any():
+                values = values.copy()
+                values[nulls] = None
+                data[name] = values
+            else:
+                data[name] = values
+        return pd.DataFrame(data)
+
+    def _field(self, name: str) -> QvdField:
+
+        for field in self.header.fields:
+            if field.name == name:
+                return field
+        raise KeyError(name)
+
+def qvd_parquet_path(path: str) -> str:
+
+    # Where a migrated QVD's Parquet copy lives: same place, new extension.
+    return path[:-len(".qvd")] + ".parquet" if path.lower().endswith(".qvd") else path + ".parquet"
+
+def read_qvd(path: str, columns: Optional[List[str]] = None) -> pd.DataFrame:
+
+    with QvdReader(path) as reader:
+        return reader.to_pandas(columns)
+
+def _convert_symbols(symbols: np.ndarray, data_type: Optional[DataType]) -> np.ndarray:
+
+    # Brings decoded symbols to the field's tagged type. Empty tables take
+    # the tagged type directly; values that do not fit are left as decoded.
+    if data_type is None:
+        return symbols
+    if not len(symbols):
+        return np.empty(0, dtype=_NUMPY_TYPES.get(data_type, object))
+    if symbols.dtype == object:
+        return symbols
+    if data_type is DataType.STRING:
+        return np.array([_format_number(v) for v in symbols.tolist()], dtype=object)
+    if data_type is DataType.DATE:
+        return QLIK_EPOCH + np.floor(symbols).astype(np.int64).astype("timedelta64[D]")
+    if data_type is DataType.TIMESTAMP:
+        microseconds = np.round(symbols.astype(np.float64) * MICROSECONDS_PER_DAY).astype(np.int64)
+        return QLIK_EPOCH.astype("datetime64[us]") + microseconds.astype("timedelta64[us]")
+    if data_type is DataType.LONG and symbols.dtype == np.float64 and np.all(symbols == np.floor(symbols)):
+        return symbols.astype(np.int64)
+    if data_type is DataType.DOUBLE:
+        return symbols.astype(np.float64)
+    return symbols
+
+def _decode_symbols(data: bytes, count: int, dual: str) -> np.ndarray:
+
+    # Symbol tables of a single plain type are decoded without a Python
+    # loop; anything else is walked symbol by symbol.
+    if count == 0:
+        return np.empty(0, dtype=object)
+    kind = data[0]
+    if kind == SYMBOL_INT and len(data) == 5 * count:
+        table = np.frombuffer(data, dtype=np.dtype([("kind", "u1"), ("value", "<i4")]))
+        if (table["kind"] == SYMBOL_INT).all():
+            return table["value"].astype(np.int64)
+    if kind == SYMBOL_FLOAT and len(data) == 9 * count:
+        table = np.frombuffer(data, dtype=np.dtype([("kind", "u1"), ("value", "<f8")]))
+        if (table["kind"] == SYMBOL_FLOAT).all():
+            return table["value"].astype(np.float64)
+    if kind == SYMBOL_STRING and data[-1] == 0 and data.count(b"\0") == count \
+            and data.count(b"\0\x04") == count - 1:
+        # Every NUL terminates a string and is followed by the next type
+        # byte, so no number can be hiding in the table.
+        values = data[1:-1].decode("utf-8", errors="replace").split("\0\x04")
+        return np.array(values, dtype=object)
+    return _decode_mixed_symbols(data, count, dual)
+
+def _decode_mixed_symbols(data: bytes, count: int, dual: str) -> np.ndarray:
+
+    values = []
+    pos = 0
+    for _ in range(count):
+        if pos >= len(data):
+            raise QvdError("QVD symbol table is shorter than its symbol count")
+        kind = data[pos]
+        pos += 1
+        number = None
+        if kind in (SYMBOL_INT, SYMBOL_DUAL_INT):
+            number = _INT.unpack_from(data, pos)[0]
+            pos += 4
+        elif kind in (SYMBOL_FLOAT, SYMBOL_DUAL_FLOAT):
+            number = _FLOAT.unpack_from(data, pos)[0]
+            pos += 8
+        elif kind != SYMBOL_STRING:
+            raise QvdError(f"Unknown QVD symbol type {kind}")
+
+        if kind in (SYMBOL_STRING, SYMBOL_DUAL_INT, SYMBOL_DUAL_FLOAT):
+            end = data.index(b"\0", pos)
+            text = data[pos:end].decode("utf-8", errors="replace")
+            pos = end + 1
+            values.append(number if kind != SYMBOL_STRING and dual == "number" else text)
+        else:
+            values.append(number)
+
+    # A field is numeric only if every symbol is; otherwise it is text.
+    if all(isinstance(v, int) for v in values):
+        return np.array(values, dtype=np.int64)
+    if all(isinstance(v, (int, float)) for v in values):
+        return np.array(values, dtype=np.float64)
+    return np.array([v if isinstance(v, str) else _format_number(v) for v in values], dtype=object)
+
+def _format_number(value) -> str:
+
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+def _data_type(values: np.ndarray) -> DataType:
+
+    for data_type, dtype in _NUMPY_TYPES.items():
+        if values.dtype == dtype:
+            return data_type
+    return DataType.STRING
+
+def _arrow_type(values: np.ndarray):
+
+    import pyarrow as pa
+
+    return {
+        DataType.LONG: pa.int64(),
+        DataType.DOUBLE: pa.float64(),
+        DataType.DATE: pa.date32(),
+        DataType.TIMESTAMP: pa.timestamp("us"),
+    }.get(_data_type(values), pa.string())
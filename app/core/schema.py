@@ -0,0 +1,260 @@
+
+import csv
+import hashlib
+import io
+import json
+from pathlib import Path
+from stat import S_ISREG
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional, Tuple
+from app.core.includes import IncludeResolver
+from app.core.migration import MigrationManifest
+from app.core.qvd import QvdError, qvd_field_type, read_qvd_header
+from app.models.ir_models import ColumnDefinition, DataType
+
+# Type names accepted in schema files, besides the DataType values.
+SCHEMA_TYPE_NAMES = {
+    "text": DataType.STRING,
+    "number": DataType.DOUBLE,
+    "numeric": DataType.DOUBLE,
+    "int": DataType.LONG,
+    "datetime": DataType.TIMESTAMP,
+    "bool": DataType.BOOLEAN,
+}
+
+SCHEMA_COLUMNS = ("table", "field", "type")
+
+class SchemaError(Exception):
+    pass
+
+class SourceSchema(NamedTuple):
+
+    columns: List[ColumnDefinition]
+    row_count: Optional[int]
+    # Size of the source file, for estimating sources without a row count.
+    size_bytes: Optional[int] = None
+    # Set when the columns are the schema file's for the table loaded. They
+    # describe the model table, derived fields included, not the file.
+    declared: bool = False
+
+class SchemaResolver:
+
+    # Field names, types and row counts of external sources, taken from the
+    # migration manifest, QVD headers or Parquet footers without reading
+    # any data. Other sources use the schema file's columns for the table
+    # they load, if it lists that table, and their file size; those are
+    # the model table's types, applied after the read rather than as the
+    # file's layout. Row counts
+    # the user supplies per table override what the sources say.
+
+    def __init__(self, paths: Optional[IncludeResolver] = None, manifest: Optional[MigrationManifest] = None,
+                 tables: Optional[Dict[str, List[ColumnDefinition]]] = None,
+                 row_counts: Optional[Dict[str, int]] = None):
+        # ``paths`` resolves lib:// and relative source paths to files.
+        self.paths = paths
+        self.manifest = manifest
+        self.tables = tables or {}
+        self.row_counts = row_counts or {}
+        # Sources looked up, with a token for what the schema came from
+        # (None if nothing), so cached conversions can be checked.
+        self.sources: Dict[str, Optional[str]] = {}
+        self._schemas: Dict[str, Tuple[str, Optional[SourceSchema]]] = {}
+
+    def schema(self, source_path: str, table_name: Optional[str] = None) -> Optional[SourceSchema]:
+
+        token, read = self._locate(source_path)
+        self.sources[source_path] = token
+        if read is None:
+            declared = self.tables.get(table_name) if table_name else None
+            size = int(token.split(":")[0]) if token is not None else None
+            schema = SourceSchema(columns=declared or [], row_count=None, size_bytes=size, declared=bool(declared)) \
+                if declared or size is not None else None
+        else:
+            cached = self._schemas.get(source_path)
+            if cached is not None and cached[0] == token:
+                schema = cached[1]
+            else:
+                schema = read()
+                self._schemas[source_path] = (token, schema)
+
+        rows = self.row_counts.get(table_name) if table_name else None
+        if rows is not None:
+            schema = (schema or SourceSchema(columns=[], row_count=None))._replace(row_count=rows)
+        return schema
+
+    def fingerprint(self) -> str:
+
+        # Identifies the schema file's content and row counts, for cache keys.
+        if not self.tables and not self.row_counts:
+            return ""
+        payload = {name: [(c.name, c.data_type.value) for c in columns] for name, columns in self.tables.items()}
+        if self.row_counts:
+            payload = {"tables": payload, "rows": self.row_counts}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+    def token(self, source_path: str) -> Optional[str]:
+
+        return self._locate(source_path)[0]
+
+    def _locate(self, source_path: str) -> Tuple[Optional[str], Optional[Callable[[], Optional[SourceSchema]]]]:
+
+        lowered = source_path.lower()
+        if lowered.endswith(".qvd") and self.manifest is not None:
+            # Generated code reads the migrated copy, so its types win.
+            entry = self.manifest.entry(source_path)
+            if entry is not None and entry.get("columns"):
+                return f"manifest:{entry['header_sha256']}:{entry['format']}", lambda: _manifest_schema(entry)
+
+        if lowered.endswith(".qvd"):
+            read_file = _qvd_schema
+        elif lowered.endswith(".parquet"):
+            read_file = _parquet_schema
+        else:
+            read_file = None
+
+        resolved = self.paths.resolve_path(source_path) if self.paths is not None else None
+        try:
+            stat = resolved.stat() if resolved is not None else None
+        except OSError:
+            stat = None
+        if stat is None:
+            return None, None
+        token = f"{stat.st_size}:{stat.st_mtime_ns}"
+        if read_file is None:
+            # Only the size of other files is known.
+            return (token, None) if S_ISREG(stat.st_mode) else (None, None)
+        return token, lambda: read_file(resolved)
+
+def load_schema_csv(text: str) -> Dict[str, List[ColumnDefinition]]:
+
+    # table,field,type rows, as uploaded for the validator.
+    reader = csv.DictReader(io.StringIO(text.lstrip("\ufeff")))
+    header = [name.strip().lower() for name in reader.fieldnames or []]
+    missing = [name for name in SCHEMA_COLUMNS if name not in header]
+    if missing:
+        raise SchemaError(f"Schema CSV must have columns: table, field, type. Missing: {', '.join(missing)}")
+    reader.fieldnames = header
+    return _table_columns(reader, first_row=2)
+
+def load_schema_json(data) -> Dict[str, List[ColumnDefinition]]:
+
+    # A list of {"table": ..., "field": ..., "type": ...} objects.
+    if isinstance(data, (str, bytes)):
+        try:
+            data = json.loads(data)
+        except ValueError as e:
+            raise SchemaError(f"Invalid schema JSON: {e}") from e
+    if not isinstance(data, list) or not all(isinstance(row, dict) for row in data):
+        raise SchemaError("Schema JSON must be a list of {table, field, type} objects")
+    return _table_columns(data, first_row=1)
+
+def load_schema_file(path: str) -> Dict[str, List[ColumnDefinition]]:
+
+    with open(path, encoding="utf-8") as f:
+        text = f.read()
+    return load_schema_json(text) if path.lower().endswith(".json") else load_schema_csv(text)
+
+def parse_row_counts(text: str) -> Dict[str, int]:
+
+    # "Orders=300000000;Regions=12", as in QLIK_TABLE_ROWS.
+    counts = {}
+    for entry in text.split(";"):
+        table, _, rows = entry.partition("=")
+        if not table.strip():
+            continue
+        try:
+            counts[table.strip()] = int(rows.strip().replace("_", ""))
+        except ValueError:
+            raise SchemaError(f"Invalid row count for table '{table.strip()}': '{rows.strip()}'") from None
+    return counts
+
+def _table_columns(rows: Iterable[dict], first_row: int) -> Dict[str, List[ColumnDefinition]]:
+
+    tables: Dict[str, List[ColumnDefinition]] = {}
+    for row_num, row in enumerate(rows, first_row):
+        values = {}
+        for name in SCHEMA_COLUMNS:
+            value = str(row.get(name) or "").strip()
+            if not value:
+                raise SchemaError(f"Row {row_num}: Missing value in '{name}' column")
+            values[name] = value
+
+        columns = tables.setdefault(values["table"], [])
+        if any(column.name == values["field"] for column in columns):
+            raise SchemaError(f"Row {row_num}: Duplicate field '{values['field']}' in table '{values['table']}'")
+        columns.append(ColumnDefinition(name=values["field"], data_type=_schema_data_type(values["type"], row_num)))
+    return tables
+
+def _schema_data_type(name: str, row_num: int) -> DataType:
+
+    lowered = name.lower()
+    if lowered in SCHEMA_TYPE_NAMES:
+        return SCHEMA_TYPE_NAMES[lowered]
+    try:
+        return DataType(lowered)
+    except ValueError:
+        raise SchemaError(f"Row {row_num}: Unknown type '{name}'") from None
+
+def _manifest_schema(entry: dict) -> SourceSchema:
+
+    columns = [ColumnDefinition(name=name, data_type=DataType(data_type)) for name, data_type in entry["columns"].items()]
+    return SourceSchema(columns=columns, row_count=entry.get("rows"))
+
+def _qvd_schema(path: Path) -> Optional[SourceSchema]:
+
+    try:
+        header = read_qvd_header(str(path))
+    except (OSError, QvdError):
+        return None
+    types = [qvd_field_type(field) for field in header.fields]
+    if None in types:
+        return None
+    columns = [ColumnDefinition(name=field.name, data_type=data_type) for field, data_type in zip(header.fields, types)]
+    return SourceSchema(columns=columns, row_count=header.record_count)
+
+def _parquet_schema(path: Path) -> Optional[SourceSchema]:
+
+    # A file, or a directory of part files; hive-partitioned directories
+    # keep columns outside the footers and are left to Spark.
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        return None
+    files = [path] if path.is_file() else sorted(p for p in path.rglob("*.parquet") if p.is_file())
+    if not files or any("=" in part for f in files for part in f.relative_to(path).parts[:-1]):
+        return None
+    try:
+        footers = [pq.read_metadata(str(f)) for f in files]
+    except (OSError, ValueError):
+        return None
+
+    fields = footers[0].schema.to_arrow_schema()
+    types = [_arrow_data_type(field.type) for field in fields]
+    if None in types:
+        return None
+    columns = [
+        ColumnDefinition(name=field.name, data_type=data_type, nullable=field.nullable)
+        for field, data_type in zip(fields, types)
+    ]
+    return SourceSchema(columns=columns, row_count=sum(footer.num_rows for footer in footers))
+
+def _arrow_data_type(arrow_type) -> Optional[DataType]:
+
+    # None for types a flat Spark schema here cannot state exactly
+    # (decimals of any precision, nested and binary columns).
+    import pyarrow as pa
+
+    if pa.types.is_boolean(arrow_type):
+        return DataType.BOOLEAN
+    if pa.types.is_int8(arrow_type) or pa.types.is_int16(arrow_type) or pa.types.is_int32(arrow_type):
+        return DataType.INTEGER
+    if pa.types.is_integer(arrow_type):
+        return DataType.LONG
+    if pa.types.is_floating(arrow_type):
+        return DataType.DOUBLE
+    if pa.types.is_date(arrow_type):
+        return DataType.DATE
+    if pa.types.is_timestamp(arrow_type):
+        return DataType.TIMESTAMP
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return DataType.STRING
+    return None
@@ -26,6 +26,8 @@ class SemanticModelGenerator:
         tables = []
 
         for table_name, table_def in data_model.tables.items():
+            if table_name in data_model.dropped_tables:
+                continue
             table_json = {
                 "name": table_name,
                 "source": {
@@ -73,6 +75,8 @@ class SemanticModelGenerator:
         relationships = []
 
         for rel in data_model.relationships:
+            if rel.from_table in data_model.dropped_tables or rel.to_table in data_model.dropped_tables:
+                continue
             rel_json = {
                 "name": f"{rel.from_table}_to_{rel.to_table}",
                 "fromTable": rel.from_table,
@@ -97,6 +101,8 @@ class SemanticModelGenerator:
         measures = []
 
         for table_name, table_def in data_model.tables.items():
+            if table_name in data_model.dropped_tables:
+                continue
             for trans in table_def.transformations:
                 if hasattr(trans, 'aggregations'):
                     for col_name, agg_expr in trans.aggregations.items():
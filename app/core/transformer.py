@@ -1,36 +1,251 @@
 
 import re
-from typing import List, Dict, Set, Optional, Tuple
+from typing import List, Dict, Set, Optional, Tuple, Iterable, Sequence, Union
 from app.models.ast_models import (
     Script, LoadStatement, MappingLoad, VariableAssignment,
-    FieldExpression, LoadType, JoinType
+    FieldExpression, LoadType, JoinType, JoinClause, Expression, FunctionCall,
+    FieldReference, Literal, UnaryOperation, BinaryOperation, ForLoop, VariableReference, StoreStatement,
+    DropStatement
 )
 from app.models.ir_models import (
     DataModel, TableDefinition, ColumnDefinition, Relationship,
     SelectTransformation, FilterTransformation, JoinTransformation,
-    AggregationTransformation, MappingDefinition, DataType
+    AggregationTransformation, MappingDefinition, SemiJoinTransformation, UnionTransformation, DataType,
+    StoreDefinition
 )
+from app.core.expression import try_parse_expression, conjuncts, field_references, replace_nodes, to_qlik, walk
+from app.core.schema import SchemaResolver
+from app.utils.qlik_functions import QlikFunctionMapper
+
+FUNCTION_RETURN_TYPES = {
+    "Year": DataType.LONG, "Month": DataType.LONG, "Day": DataType.LONG,
+    "Week": DataType.LONG, "WeekDay": DataType.LONG, "Quarter": DataType.LONG,
+    "Hour": DataType.LONG, "Minute": DataType.LONG, "Second": DataType.LONG,
+    "Count": DataType.LONG, "Len": DataType.LONG,
+    "Sum": DataType.DOUBLE, "Avg": DataType.DOUBLE, "Round": DataType.DOUBLE,
+    "Floor": DataType.DOUBLE, "Ceil": DataType.DOUBLE, "Sqrt": DataType.DOUBLE,
+    "Pow": DataType.DOUBLE, "Exp": DataType.DOUBLE, "Log": DataType.DOUBLE,
+    "Log10": DataType.DOUBLE, "Num": DataType.DOUBLE, "Mod": DataType.DOUBLE,
+    "Date": DataType.DATE, "Today": DataType.DATE, "MakeDate": DataType.DATE,
+    "MonthStart": DataType.DATE, "MonthEnd": DataType.DATE, "YearStart": DataType.DATE,
+    "AddMonths": DataType.DATE, "AddYears": DataType.DATE, "Date#": DataType.DATE,
+    "Now": DataType.TIMESTAMP, "Timestamp": DataType.TIMESTAMP, "Timestamp#": DataType.TIMESTAMP,
+    "Upper": DataType.STRING, "Lower": DataType.STRING, "Trim": DataType.STRING,
+    "LTrim": DataType.STRING, "RTrim": DataType.STRING, "Left": DataType.STRING,
+    "Right": DataType.STRING, "Mid": DataType.STRING, "Text": DataType.STRING,
+    "Capitalize": DataType.STRING, "Replace": DataType.STRING, "SubField": DataType.STRING,
+    "IsNull": DataType.BOOLEAN,
+}
+
+# Functions whose result has the type of one of their arguments.
+PASSTHROUGH_TYPE_FUNCTIONS = {"If", "Min", "Max", "Only", "FirstValue", "LastValue", "Alt", "Abs", "Dual"}
+
+BOOLEAN_OPERATORS = {"=", "<>", "<", ">", "<=", ">=", "AND", "OR", "XOR", "LIKE"}
+
+INTEGRAL_TYPES = {DataType.INTEGER, DataType.LONG}
+
+# Typecodes of the decoded INLINE column arrays.
+INLINE_TYPE_MAP = {
+    "q": DataType.LONG,
+    "d": DataType.DOUBLE,
+}
+
+def _exists_call(node: Expression) -> Optional[Tuple[bool, str, Optional[str]]]:
+
+    # (anti, field, key expression) of an Exists() or NOT Exists() test.
+    anti = isinstance(node, UnaryOperation) and node.operator == "NOT"
+    if anti:
+        node = node.operand
+    if not isinstance(node, FunctionCall) or node.function_name.lower() != "exists" or not node.arguments:
+        return None
+    field = node.arguments[0]
+    if isinstance(field, FieldReference):
+        name = field.name
+    elif isinstance(field, Literal) and field.kind == "string":
+        name = field.value
+    else:
+        return None
+    expression = to_qlik(node.arguments[1]) if len(node.arguments) > 1 else None
+    return anti, name, expression
+
+def _read_files(table: TableDefinition) -> List[str]:
+
+    files = list(table.source_paths or [table.source_path]) if table.source_type == "external" else []
+    for trans in table.transformations:
+        if isinstance(trans, UnionTransformation):
+            for part in trans.parts:
+                files.extend(_read_files(part))
+        elif isinstance(trans, JoinTransformation) and trans.right is not None:
+            files.extend(_read_files(trans.right))
+    return [path for path in files if path]
+
+def _parenthesized(node: Expression) -> str:
+
+    text = to_qlik(node)
+    return f"({text})" if isinstance(node, BinaryOperation) and node.operator in ("OR", "XOR") else text
+
+def expand_loops(statements: Iterable[object]) -> list:
+
+    # Replaces each FOR loop with what it loads: one read of all its files
+    # when the body is a single plain file LOAD, else the unrolled body.
+    expanded = []
+    for statement in statements:
+        if not isinstance(statement, ForLoop):
+            expanded.append(statement)
+            continue
+        load = _vectorized_load(statement)
+        if load is not None:
+            expanded.append(load)
+        else:
+            expanded.extend(expand_loops(statement.unrolled if statement.unrolled is not None else statement.statements))
+    return expanded
+
+def _vectorized_load(loop: ForLoop) -> Optional[LoadStatement]:
+
+    # GROUP BY, DISTINCT or a WHERE on the loop variable apply per file, and
+    # NoConcatenate makes a table per file, so those loops stay unrolled.
+    if len(loop.statements) != 1 or not isinstance(loop.statements[0], LoadStatement):
+        return None
+    load = loop.statements[0]
+    marker = f"$({loop.variable})"
+    if load.load_type != LoadType.EXTERNAL or not load.source or marker not in load.source:
+        return None
+    if load.join_clause or load.group_by or load.distinct or load.no_concatenate or load.preceding_load:
+        return None
+    if load.where_clause and marker in load.where_clause.condition:
+        return None
+
+    if loop.file_pattern is not None:
+        sources = [load.source.replace(marker, loop.file_pattern)]
+        value = FunctionCall(function_name="FilePath")
+        number = None
+    elif loop.values:
+        sources = [load.source.replace(marker, value) for value in loop.values]
+        value = _file_name_value(load.source, marker, loop.values)
+        number = FunctionCall(function_name="Num", arguments=[value]) \
+            if value is not None and all(_is_number(v) for v in loop.values) else None
+    else:
+        return None
+
+    def substitute(node: Expression) -> Optional[Expression]:
+
+        if isinstance(node, VariableReference) and node.text == loop.variable:
+            return number
+        if isinstance(node, Literal) and node.kind == "string" and marker in node.value:
+            parts = []
+            for index, piece in enumerate(node.value.split(marker)):
+                if index:
+                    parts.append(value)
+                if piece:
+                    parts.append(Literal(value=piece, kind="string"))
+            combined = parts[0]
+            for part in parts[1:]:
+                combined = BinaryOperation(operator="&", left=combined, right=part)
+            return combined
+        return None
+
+    # Fields using the variable read it back from each row's file.
+    fields = []
+    for field in load.fields:
+        if marker not in field.raw_expression:
+            fields.append(field)
+            continue
+        if value is None or field.expression is None:
+            return None
+        node = replace_nodes(field.expression, substitute)
+        text = to_qlik(node)
+        if marker in text:
+            return None
+        fields.append(field.model_copy(update={
+            "raw_expression": text,
+            "expression": node,
+            "is_calculated": True,
+            "alias": field.alias or field.raw_expression,
+        }))
+
+    return load.model_copy(update={
+        "source": sources[0],
+        "sources": sources if len(sources) > 1 else [],
+        "fields": fields,
+    })
+
+def _file_name_value(source: str, marker: str, values: Sequence[str]) -> Optional[Expression]:
+
+    # The part of the file name the variable filled in. Migrated QVDs are
+    # read from other file names, and a variable naming a directory, or a
+    # value holding one, has no fixed place in the file name, so neither can
+    # be read back.
+    start = source.index(marker)
+    head, tail = source[:start], source[start + len(marker):]
+    if source.lower().endswith(".qvd") or re.search(r"[/\\]", tail) or marker in tail:
+        return None
+    if any(re.search(r"[/\\]", value) for value in values):
+        return None
+    prefix = re.split(r"[/\\]", head)[-1]
+    return FunctionCall(function_name="TextBetween", arguments=[
+        FunctionCall(function_name="FileName"),
+        Literal(value=prefix, kind="string"),
+        Literal(value=tail, kind="string"),
+    ])
+
+def _is_number(value: str) -> bool:
+
+    try:
+        float(value)
+    except ValueError:
+        return False
+    return True
 
 class ASTTransformer:
 
-    def __init__(self):
+    def __init__(self, schema_resolver: Optional[SchemaResolver] = None):
         self.data_model = DataModel()
         self.table_counter = 0
         self.column_types: Dict[str, DataType] = {}
+        self.schema_resolver = schema_resolver
 
     def transform(self, ast: Script) -> DataModel:
 
-        for statement in ast.statements:
-            if isinstance(statement, VariableAssignment):
-                self._process_variable(statement)
-            elif isinstance(statement, MappingLoad):
-                self._process_mapping(statement)
-            elif isinstance(statement, LoadStatement):
-                self._process_load_statement(statement)
-
+        return self.transform_iter(ast.statements)
+
+    def transform_iter(self, statements: Iterable[Union[LoadStatement, MappingLoad, VariableAssignment, StoreStatement,
+                                                         DropStatement, ForLoop]]) -> DataModel:
+
+        for statement in statements:
+            self.add_statement(statement)
+
+        return self.finalize()
+
+    def add_statement(self, statement: Union[LoadStatement, MappingLoad, VariableAssignment, StoreStatement,
+                                             DropStatement, ForLoop]
+                      ) -> Optional[Union[TableDefinition, MappingDefinition, StoreDefinition]]:
+
+        # Returns the table, mapping or store the statement defined, if any.
+        if isinstance(statement, VariableAssignment):
+            self._process_variable(statement)
+        elif isinstance(statement, MappingLoad):
+            return self._process_mapping(statement)
+        elif isinstance(statement, LoadStatement):
+            return self._process_load_statement(statement)
+        elif isinstance(statement, StoreStatement):
+            return self._process_store(statement)
+        elif isinstance(statement, DropStatement):
+            self._process_drop(statement)
+        elif isinstance(statement, ForLoop):
+            result = None
+            for expanded in expand_loops([statement]):
+                result = self.add_statement(expanded) or result
+            return result
+        return None
+
+    def finalize(self, previous: Optional[DataModel] = None) -> DataModel:
+
+        # ``previous`` is an earlier model whose unchanged tables (the same
+        # objects) keep their relationships without being compared again.
         self._build_execution_order()
+        self._build_execution_stages()
 
-        self._detect_relationships()
+        self._detect_relationships(previous)
 
         return self.data_model
 
@@ -38,18 +253,110 @@ class ASTTransformer:
 
         self.data_model.variables[var_stmt.variable_name] = var_stmt.value
 
-    def _process_mapping(self, mapping_stmt: MappingLoad):
+    def _process_store(self, store_stmt: StoreStatement) -> StoreDefinition:
+
+        columns = []
+        for field_expr in store_stmt.fields:
+            if field_expr.raw_expression == '*':
+                continue
+            name = self._extract_field_name(field_expr.raw_expression)
+            columns.append(ColumnDefinition(
+                name=field_expr.alias or name,
+                data_type=self.column_types.get(name, DataType.STRING),
+                source_expression=field_expr.raw_expression if field_expr.alias else None
+            ))
+
+        store = StoreDefinition(
+            table_name=store_stmt.table_name,
+            target_path=store_stmt.target,
+            file_format=store_stmt.file_format or "qvd",
+            columns=columns
+        )
+        table = self.data_model.tables.get(store_stmt.table_name)
+        incremental = self._incremental_pattern(table, store) if table is not None and not columns else None
+        if incremental is not None:
+            store.merge_keys, store.watermark_column, store.changes_condition = incremental
+        self.data_model.stores.append(store)
+        return store
+
+    def _incremental_pattern(self, table: TableDefinition, store: StoreDefinition
+                             ) -> Optional[Tuple[List[str], str, Optional[str]]]:
+
+        # The (keys, watermark field, other conditions) of a table built as
+        #   T: LOAD ... FROM source WHERE Modified > '$(vLastReload)';
+        #   CONCATENATE (T) LOAD ... FROM stored file WHERE NOT Exists(Key);
+        # right before STORE T INTO the stored file.
+        if table.source_type != "external" or not table.transformations:
+            return None
+        union, base = table.transformations[-1], table.transformations[:-1]
+        if not isinstance(union, UnionTransformation) or len(union.parts) != 1:
+            return None
+        history = union.parts[0]
+        if history.source_type != "external" or not history.source_path \
+                or history.source_path.replace("\\", "/").lower() != store.target_path.replace("\\", "/").lower():
+            return None
+        if len(history.transformations) != 1:
+            return None
+        exclusion = history.transformations[0]
+        if not isinstance(exclusion, SemiJoinTransformation) or not exclusion.anti \
+                or exclusion.key_tables != [table.name] \
+                or exclusion.key_expressions != [to_qlik(FieldReference(name=key)) for key in exclusion.key_columns]:
+            return None
+
+        filters = [trans for trans in base if isinstance(trans, FilterTransformation)]
+        if len(filters) != 1 or any(not isinstance(trans, (FilterTransformation, SelectTransformation)) for trans in base):
+            return None
+        node = try_parse_expression(filters[0].condition)
+        if node is None:
+            return None
+        fields = {column.name for column in table.columns}
+        watermark = None
+        others = []
+        for conjunct in conjuncts(node):
+            if watermark is None and isinstance(conjunct, BinaryOperation) and conjunct.operator in (">", ">=") \
+                    and isinstance(conjunct.left, FieldReference) and conjunct.left.name in fields \
+                    and not field_references(conjunct.right):
+                watermark = conjunct.left.name
+            else:
+                others.append(conjunct)
+        if watermark is None:
+            return None
+        changes = " AND ".join(_parenthesized(c) for c in others) or None
+        return list(exclusion.key_columns), watermark, changes
+
+    def _process_drop(self, drop_stmt: DropStatement):
+
+        for name in drop_stmt.table_names:
+            if name in self.data_model.tables and name not in self.data_model.dropped_tables:
+                self.data_model.dropped_tables.append(name)
+
+    def _process_mapping(self, mapping_stmt: MappingLoad) -> MappingDefinition:
 
         mapping_def = MappingDefinition(
             mapping_name=mapping_stmt.mapping_name,
             source_table=mapping_stmt.source,
             key_column=mapping_stmt.key_field,
             value_column=mapping_stmt.value_field,
-            filter_condition=mapping_stmt.where_clause.condition if mapping_stmt.where_clause else None
+            filter_condition=mapping_stmt.where_clause.condition if mapping_stmt.where_clause else None,
+            source_type=mapping_stmt.load_type.value
         )
+
+        if mapping_stmt.load_type == LoadType.INLINE and mapping_stmt.inline_data is not None:
+            mapping_def.inline_data = mapping_stmt.inline_data
+            mapping_def.row_count = mapping_stmt.inline_data.row_count
+        elif mapping_stmt.load_type == LoadType.EXTERNAL and self.schema_resolver and mapping_stmt.source:
+            schema = self.schema_resolver.schema(mapping_stmt.source)
+            if schema is not None:
+                mapping_def.source_columns = schema.columns
+                mapping_def.row_count = schema.row_count
+        elif mapping_stmt.load_type == LoadType.RESIDENT:
+            source = self.data_model.tables.get(mapping_stmt.source)
+            if source is not None:
+                mapping_def.row_count = source.row_count
         self.data_model.mappings[mapping_stmt.mapping_name] = mapping_def
+        return mapping_def
 
-    def _process_load_statement(self, load_stmt: LoadStatement):
+    def _process_load_statement(self, load_stmt: LoadStatement) -> TableDefinition:
 
         table_name = load_stmt.table_name or self._generate_table_name()
 
@@ -65,20 +372,20 @@ class ASTTransformer:
         elif load_stmt.load_type == LoadType.INLINE:
             self._process_inline_load(load_stmt, table)
 
-        if load_stmt.join_clause:
-            self._process_join(load_stmt, table)
-
         if load_stmt.where_clause:
-            filter_trans = FilterTransformation(
-                table_name=table_name,
-                source_table=load_stmt.source or table_name,
-                condition=self._convert_condition(load_stmt.where_clause.condition),
-                dependencies=[load_stmt.source] if load_stmt.source else []
-            )
-            table.transformations.append(filter_trans)
+            self._process_where(load_stmt, table)
 
         if load_stmt.group_by:
             self._process_group_by(load_stmt, table)
+        elif load_stmt.load_type == LoadType.EXTERNAL and self._needs_projection(load_stmt, table):
+            # Calculated fields of a file load are computed after the WHERE
+            # clause, which sees the file's own fields.
+            table.transformations.append(SelectTransformation(
+                table_name=table_name,
+                source_table=table_name,
+                columns=table.columns,
+                dependencies=[table_name]
+            ))
 
         if load_stmt.distinct:
             table.transformations.append(SelectTransformation(
@@ -89,32 +396,158 @@ class ASTTransformer:
                 dependencies=[table_name]
             ))
 
+        if load_stmt.join_clause and load_stmt.join_clause.keep:
+            self._process_keep(load_stmt, table)
+
+        if load_stmt.join_clause and not load_stmt.join_clause.keep:
+            target = load_stmt.join_clause.table_name or self._get_previous_table()
+            if target in self.data_model.tables:
+                return self._join(target, load_stmt.join_clause, table)
+
+        target = self._concatenation_target(load_stmt, table)
+        if target is not None:
+            return self._concatenate(target, table)
+
         self.data_model.tables[table_name] = table
+        if table_name in self.data_model.dropped_tables:
+            self.data_model.dropped_tables.remove(table_name)
+        return table
+
+    def _concatenation_target(self, load_stmt: LoadStatement, table: TableDefinition) -> Optional[str]:
+
+        # CONCATENATE appends to the named or previous table; otherwise Qlik
+        # appends a load to any earlier table with exactly the same fields.
+        if load_stmt.concatenate is not None:
+            target = load_stmt.concatenate.table_name or self._get_previous_table()
+            return target if target in self.data_model.tables else None
+        if load_stmt.no_concatenate or load_stmt.join_clause or not table.columns:
+            return None
+        fields = {column.name for column in table.columns}
+        for name, existing in self.data_model.tables.items():
+            if {column.name for column in existing.columns} == fields and name not in self.data_model.dropped_tables:
+                return name
+        return None
+
+    def _concatenate(self, target_name: str, part: TableDefinition) -> TableDefinition:
+
+        # The target is copied rather than changed, since earlier results
+        # may share it.
+        target = self.data_model.tables[target_name]
+        transformations = list(target.transformations)
+        if transformations and isinstance(transformations[-1], UnionTransformation):
+            previous = transformations.pop()
+            union = previous.model_copy(update={
+                "source_tables": list(previous.source_tables),
+                "parts": list(previous.parts),
+                "dependencies": list(previous.dependencies),
+            })
+        else:
+            union = UnionTransformation(table_name=target_name, source_tables=[target_name])
+
+        dependencies = [dep for trans in part.transformations for dep in trans.dependencies]
+        if part.source_type == "resident" and part.source_path:
+            dependencies.append(part.source_path)
+        union.parts.append(part)
+        union.source_tables.append(part.name)
+        for dep in dependencies:
+            if dep not in (target_name, part.name) and dep not in union.dependencies:
+                union.dependencies.append(dep)
+        transformations.append(union)
+
+        names = {column.name for column in target.columns}
+        merged = target.model_copy(update={
+            "columns": target.columns + [column for column in part.columns if column.name not in names],
+            "transformations": transformations,
+            "row_count": target.row_count + part.row_count
+            if target.row_count is not None and part.row_count is not None else None,
+        })
+        self.data_model.tables[target_name] = merged
+        return merged
 
     def _process_external_load(self, load_stmt: LoadStatement, table: TableDefinition):
 
         table.source_path = load_stmt.source
+        table.source_paths = list(load_stmt.sources)
+
+        schema = self.schema_resolver.schema(load_stmt.source, table.name) \
+            if self.schema_resolver and load_stmt.source else None
+        source_types = {}
+        declared_types = {}
+        if schema is not None and schema.declared:
+            # The schema file lists the table's fields, derived ones too, so
+            # its types are cast onto fields read as they are.
+            declared_types = {column.name: column.data_type for column in schema.columns}
+        if schema is not None:
+            if not schema.declared:
+                table.source_columns = schema.columns
+            table.row_count = schema.row_count
+            table.size_bytes = schema.size_bytes
+            source_types = {column.name: column.data_type for column in schema.columns}
+            for path in load_stmt.sources[1:]:
+                other = self.schema_resolver.schema(path, table.name)
+                rows = other.row_count if other is not None else None
+                size = other.size_bytes if other is not None else None
+                table.row_count = table.row_count + rows if table.row_count is not None and rows is not None else None
+                table.size_bytes = table.size_bytes + size \
+                    if table.size_bytes is not None and size is not None else None
 
         for field_expr in load_stmt.fields:
             if field_expr.raw_expression == '*':
 
+                columns = table.source_columns
+                if declared_types:
+                    # Fields the load names itself are not among the file's.
+                    named = {f.alias or self._extract_field_name(f.raw_expression) for f in load_stmt.fields}
+                    columns = [column for column in schema.columns if column.name not in named]
+                    table.cast_columns.extend(column.model_copy() for column in columns)
+                for column in columns:
+                    table.columns.append(column.model_copy())
+                    self.column_types[column.name] = column.data_type
                 continue
 
             col_name = field_expr.alias or self._extract_field_name(field_expr.raw_expression)
-            data_type = self._infer_data_type(field_expr.raw_expression)
+            if field_expr.is_calculated:
+                data_type = declared_types.get(col_name) \
+                    or self._infer_data_type(field_expr.raw_expression, source_types)
+            else:
+                field_name = self._extract_field_name(field_expr.raw_expression)
+                data_type = source_types.get(field_name) or declared_types.get(col_name) \
+                    or self._infer_data_type(field_expr.raw_expression)
+                if col_name in declared_types and all(c.name != field_name for c in table.cast_columns):
+                    table.cast_columns.append(ColumnDefinition(name=field_name, data_type=data_type))
 
             column = ColumnDefinition(
                 name=col_name,
                 data_type=data_type,
-                source_expression=field_expr.raw_expression if field_expr.is_calculated else None
+                source_expression=self._source_expression(field_expr)
             )
             table.columns.append(column)
             self.column_types[col_name] = data_type
 
+    def _source_expression(self, field_expr: FieldExpression) -> Optional[str]:
+
+        # Calculated and renamed fields record what they are read from.
+        if field_expr.is_calculated \
+                or field_expr.alias and field_expr.alias != self._extract_field_name(field_expr.raw_expression):
+            return field_expr.raw_expression
+        return None
+
+    def _needs_projection(self, load_stmt: LoadStatement, table: TableDefinition) -> bool:
+
+        # Without a known schema, LOAD * cannot be spelled out as a select.
+        if any(f.raw_expression == '*' for f in load_stmt.fields) and not table.source_columns:
+            return False
+        return any(column.source_expression for column in table.columns)
+
     def _process_resident_load(self, load_stmt: LoadStatement, table: TableDefinition):
 
         source_table = load_stmt.source
         table.source_path = source_table
+        source = self.data_model.tables.get(source_table)
+        if source is not None:
+            # A resident load has at most the rows of its source.
+            table.row_count = source.row_count
+            table.size_bytes = source.size_bytes
 
         select_trans = SelectTransformation(
             table_name=table.name,
@@ -125,8 +558,8 @@ class ASTTransformer:
         for field_expr in load_stmt.fields:
             if field_expr.raw_expression == '*':
 
-                if source_table in self.data_model.tables:
-                    select_trans.columns = self.data_model.tables[source_table].columns.copy()
+                if source is not None:
+                    select_trans.columns = source.columns.copy()
                 continue
 
             col_name = field_expr.alias or self._extract_field_name(field_expr.raw_expression)
@@ -135,7 +568,7 @@ class ASTTransformer:
             column = ColumnDefinition(
                 name=col_name,
                 data_type=data_type,
-                source_expression=field_expr.raw_expression if field_expr.is_calculated else None
+                source_expression=self._source_expression(field_expr)
             )
             select_trans.columns.append(column)
             table.columns.append(column)
@@ -146,42 +579,130 @@ class ASTTransformer:
 
         table.source_type = "inline"
 
-        if load_stmt.inline_data and len(load_stmt.inline_data) > 0:
-            headers = load_stmt.inline_data[0]
+        if load_stmt.inline_data:
+            table.inline_data = load_stmt.inline_data
+            table.row_count = load_stmt.inline_data.row_count
 
-            for header in headers:
+            for header, values in load_stmt.inline_data.columns.items():
+                data_type = INLINE_TYPE_MAP.get(getattr(values, "typecode", None), DataType.STRING)
                 column = ColumnDefinition(
                     name=header,
-                    data_type=DataType.STRING,  
+                    data_type=data_type,
                     nullable=True
                 )
                 table.columns.append(column)
+                self.column_types[header] = data_type
 
-    def _process_join(self, load_stmt: LoadStatement, table: TableDefinition):
-
-        join_clause = load_stmt.join_clause
-
-        if join_clause.table_name:
+    def _join(self, target_name: str, join_clause: JoinClause, part: TableDefinition) -> TableDefinition:
 
-            left_table = join_clause.table_name
-        else:
-
-            left_table = self._get_previous_table()
+        # JOIN merges the load into the target table on every field they
+        # share, or the ON fields; like CONCATENATE, it copies the target.
+        target = self.data_model.tables[target_name]
+        names = {column.name for column in target.columns}
+        keys = join_clause.on_fields or [column.name for column in part.columns if column.name in names]
 
-        right_table = table.name
-
-        join_keys = join_clause.on_fields or self._detect_join_keys(left_table, right_table)
+        dependencies = []
+        for dep in [dep for trans in part.transformations for dep in trans.dependencies] \
+                + ([part.source_path] if part.source_type == "resident" and part.source_path else []):
+            if dep not in (target_name, part.name) and dep not in dependencies:
+                dependencies.append(dep)
 
         join_trans = JoinTransformation(
-            table_name=table.name,
-            left_table=left_table,
-            right_table=right_table,
+            table_name=target_name,
+            left_table=target_name,
+            right_table=part.name,
             join_type=join_clause.join_type.value,
-            join_keys=join_keys,
-            dependencies=[left_table, right_table]
+            join_keys=keys,
+            right=part,
+            dependencies=dependencies
         )
+        merged = target.model_copy(update={
+            "columns": target.columns + [column for column in part.columns if column.name not in names],
+            "transformations": target.transformations + [join_trans],
+            # A LEFT JOIN onto unique keys keeps the row count.
+            "row_count": target.row_count if join_clause.join_type == JoinType.LEFT else None,
+        })
+        self.data_model.tables[target_name] = merged
+        return merged
+
+    def _process_where(self, load_stmt: LoadStatement, table: TableDefinition):
+
+        # Exists()/NOT Exists() conditions ANDed into the WHERE clause become
+        # semi/anti joins; the rest stays a filter.
+        where_clause = load_stmt.where_clause
+        node = where_clause.expression or try_parse_expression(where_clause.condition)
+        conditions = []
+        semi_joins = []
+        for conjunct in conjuncts(node) if node is not None else []:
+            exists = _exists_call(conjunct)
+            if exists is None:
+                conditions.append(conjunct)
+            else:
+                semi_joins.append(self._exists_join(table, *exists))
+
+        if not semi_joins:
+            condition = where_clause.condition
+        else:
+            condition = " AND ".join(_parenthesized(c) for c in conditions)
+        if condition:
+            table.transformations.append(FilterTransformation(
+                table_name=table.name,
+                source_table=load_stmt.source or table.name,
+                condition=condition,
+                dependencies=[load_stmt.source] if load_stmt.source else []
+            ))
+        table.transformations.extend(semi_joins)
+
+    def _exists_join(self, table: TableDefinition, anti: bool, field: str,
+                     expression: Optional[str]) -> SemiJoinTransformation:
+
+        # Exists(Field[, Expr]) looks the value up among every value of Field
+        # loaded so far, in any table.
+        key_tables = [
+            name for name, loaded in self.data_model.tables.items()
+            if any(column.name == field for column in loaded.columns) and name not in self.data_model.dropped_tables
+        ]
+        # Rows of this load count too, so NOT Exists() also keeps only the
+        # first row per value of a field the load creates.
+        creates_field = expression is None and any(column.name == field for column in table.columns)
+        return SemiJoinTransformation(
+            table_name=table.name,
+            source_table=table.name,
+            key_tables=key_tables,
+            key_expressions=[expression or to_qlik(FieldReference(name=field))],
+            key_columns=[field],
+            anti=anti,
+            distinct_columns=[field] if anti and creates_field else [],
+            dependencies=[table.name] + key_tables
+        )
+
+    def _process_keep(self, load_stmt: LoadStatement, table: TableDefinition):
+
+        # LEFT KEEP reduces the new table to keys of the earlier one, RIGHT
+        # KEEP the earlier table to keys of the new one, INNER KEEP both.
+        join_clause = load_stmt.join_clause
+        other = join_clause.table_name or self._get_previous_table()
+        other_columns = {column.name for column in self.data_model.tables[other].columns} \
+            if other in self.data_model.tables else set()
+        keys = join_clause.on_fields or [column.name for column in table.columns if column.name in other_columns]
+        if not keys:
+            # Without common fields Qlik keeps every row.
+            return
+
+        def reduce(target: str, key_table: str) -> SemiJoinTransformation:
+            return SemiJoinTransformation(
+                table_name=target,
+                source_table=target,
+                key_tables=[key_table],
+                key_expressions=[to_qlik(FieldReference(name=key)) for key in keys],
+                key_columns=keys,
+                dependencies=[target, key_table]
+            )
 
-        table.transformations.append(join_trans)
+        if join_clause.join_type in (JoinType.LEFT, JoinType.INNER):
+            table.transformations.append(reduce(table.name, other))
+        if join_clause.join_type in (JoinType.RIGHT, JoinType.INNER):
+            table.transformations.append(reduce(other, table.name))
 
     def _process_group_by(self, load_stmt: LoadStatement, table: TableDefinition):
 
@@ -205,41 +726,62 @@ class ASTTransformer:
 
         table.transformations.append(agg_trans)
 
-    def _detect_join_keys(self, left_table: str, right_table: str) -> List[str]:
-
-        if left_table not in self.data_model.tables or right_table not in self.data_model.tables:
-            return []
-
-        left_cols = {col.name for col in self.data_model.tables[left_table].columns}
-        right_cols = {col.name for col in self.data_model.tables[right_table].columns}
-
-        common_cols = left_cols & right_cols
-
-        return list(common_cols)
-
-    def _detect_relationships(self):
-
-        table_names = list(self.data_model.tables.keys())
-
-        for i, table1_name in enumerate(table_names):
-            for table2_name in table_names[i+1:]:
-                table1 = self.data_model.tables[table1_name]
-                table2 = self.data_model.tables[table2_name]
-
-                cols1 = {col.name for col in table1.columns}
-                cols2 = {col.name for col in table2.columns}
-                common = cols1 & cols2
-
-                if common:
-
-                    rel = Relationship(
-                        from_table=table1_name,
-                        to_table=table2_name,
-                        from_columns=list(common),
-                        to_columns=list(common),
-                        relationship_type="many_to_one"
-                    )
-                    self.data_model.relationships.append(rel)
+    def _detect_relationships(self, previous: Optional[DataModel] = None):
+
+        tables = self.data_model.tables
+        positions = {name: index for index, name in enumerate(tables)}
+
+        unchanged: Set[str] = set()
+        if previous is not None:
+            unchanged = {name for name, table in tables.items() if previous.tables.get(name) is table}
+            if [name for name in previous.tables if name in unchanged] != [name for name in tables if name in unchanged]:
+                unchanged = set()
+
+        relationships = [
+            rel for rel in (previous.relationships if unchanged else [])
+            if rel.from_table in unchanged and rel.to_table in unchanged
+        ]
+
+        column_sets: Dict[str, Set[str]] = {}
+
+        def columns_of(name: str) -> Set[str]:
+            if name not in column_sets:
+                column_sets[name] = {col.name for col in tables[name].columns}
+            return column_sets[name]
+
+        changed = [name for name in tables if name not in unchanged]
+        watched = set().union(*(columns_of(name) for name in changed))
+
+        # Only pairs sharing a column can be related, so partners are looked
+        # up through an inverted index of the changed tables' columns
+        # instead of comparing every pair.
+        tables_by_column: Dict[str, List[str]] = {}
+        for name, table in tables.items():
+            for col in table.columns:
+                if col.name in watched:
+                    tables_by_column.setdefault(col.name, []).append(name)
+
+        for name in changed:
+            partners = set()
+            for column in columns_of(name):
+                partners.update(tables_by_column[column])
+            partners.discard(name)
+
+            for partner in partners:
+                if partner not in unchanged and positions[partner] < positions[name]:
+                    continue
+                first, second = sorted((name, partner), key=positions.__getitem__)
+                common = columns_of(first) & columns_of(second)
+                relationships.append(Relationship.model_construct(
+                    from_table=first,
+                    to_table=second,
+                    from_columns=list(common),
+                    to_columns=list(common),
+                    relationship_type="many_to_one"
+                ))
+
+        relationships.sort(key=lambda rel: (positions[rel.from_table], positions[rel.to_table]))
+        self.data_model.relationships = relationships
 
     def _build_execution_order(self):
 
@@ -271,6 +813,37 @@ class ASTTransformer:
 
         self.data_model.execution_order = order
 
+    def _build_execution_stages(self):
+
+        # Each table's stage follows those of the tables it reads, of the
+        # tables that STOREd a file it loads, and of loads that KEEP-reduced
+        # a table it reads.
+        tables = self.data_model.tables
+        writers: Dict[str, List[str]] = {}
+        for store in self.data_model.stores:
+            writers.setdefault(store.target_path.replace("\\", "/").lower(), []).append(store.table_name)
+        reducers: Dict[str, List[str]] = {}
+        stage: Dict[str, int] = {}
+        for table_name in self.data_model.execution_order:
+            table = tables[table_name]
+            inputs = {dep for trans in table.transformations for dep in trans.dependencies}
+            if table.source_type == "resident" and table.source_path:
+                inputs.add(table.source_path)
+            for path in _read_files(table):
+                inputs.update(writers.get(path.replace("\\", "/").lower(), ()))
+            for name in list(inputs):
+                inputs.update(reducers.get(name, ()))
+            inputs.discard(table_name)
+            stage[table_name] = max((stage[name] + 1 for name in inputs if name in stage), default=0)
+            for trans in table.transformations:
+                if isinstance(trans, SemiJoinTransformation) and trans.table_name != table_name:
+                    reducers.setdefault(trans.table_name, []).append(table_name)
+
+        stages: List[List[str]] = [[] for _ in range(max(stage.values(), default=-1) + 1)]
+        for table_name in self.data_model.execution_order:
+            stages[stage[table_name]].append(table_name)
+        self.data_model.execution_stages = stages
+
     def _generate_table_name(self) -> str:
 
         self.table_counter += 1
@@ -278,52 +851,80 @@ class ASTTransformer:
 
     def _get_previous_table(self) -> str:
 
-        if self.data_model.execution_order:
-            return self.data_model.execution_order[-1]
+        # Tables are kept in load order until finalize() sorts them.
+        for name in reversed(self.data_model.tables):
+            if name not in self.data_model.dropped_tables:
+                return name
         return "UnknownTable"
 
     def _extract_field_name(self, expression: str) -> str:
 
-        expression = expression.strip().strip('"').strip("'")
-
-        if re.match(r'^\w+$', expression):
-            return expression
-
-        func_match = re.search(r'\w+\((.+?)\)', expression)
-        if func_match:
-            inner = func_match.group(1)
+        node = try_parse_expression(expression)
 
-            return self._extract_field_name(inner)
+        if isinstance(node, FieldReference):
+            return node.name
 
-        return expression.replace(' ', '_').replace('(', '').replace(')', '')
+        if node is not None:
+            references = field_references(node)
+            if references:
+                return references[0]
 
-    def _infer_data_type(self, expression: str) -> DataType:
+        expression = expression.strip().strip('"').strip("'")
+        return re.sub(r'\W+', '_', expression).strip('_') or expression
 
-        expression_lower = expression.lower()
+    def _infer_data_type(self, expression: str, source_types: Optional[Dict[str, DataType]] = None) -> DataType:
 
-        if any(func in expression_lower for func in ['date', 'today', 'now', 'timestamp']):
-            return DataType.TIMESTAMP if 'timestamp' in expression_lower or 'now' in expression_lower else DataType.DATE
+        # ``source_types`` are the fields of the file being loaded, which
+        # shadow earlier tables' columns of the same name.
+        node = try_parse_expression(expression)
+        if node is None:
+            return DataType.STRING
+        return self._infer_node_type(node, source_types or {})
 
-        if any(func in expression_lower for func in ['year', 'month', 'day', 'count', 'sum', 'round', 'floor', 'ceil']):
-            return DataType.LONG if any(f in expression_lower for f in ['year', 'month', 'day', 'count']) else DataType.DOUBLE
+    def _infer_node_type(self, node: Expression, source_types: Dict[str, DataType]) -> DataType:
 
-        if any(func in expression_lower for func in ['upper', 'lower', 'trim', 'concat', 'substr']):
+        if isinstance(node, Literal):
+            if node.kind == "number":
+                return DataType.DOUBLE if any(c in node.value for c in ".eE") else DataType.LONG
             return DataType.STRING
 
-        return DataType.STRING
-
-    def _is_aggregate_expression(self, expression: str) -> bool:
+        if isinstance(node, FieldReference):
+            if node.name in source_types:
+                return source_types[node.name]
+            return self.column_types.get(node.name, DataType.STRING)
+
+        if isinstance(node, FunctionCall):
+            name = QlikFunctionMapper.canonical_name(node.function_name)
+            if name in FUNCTION_RETURN_TYPES:
+                return FUNCTION_RETURN_TYPES[name]
+            if name in PASSTHROUGH_TYPE_FUNCTIONS and node.arguments:
+                index = 1 if name == "If" and len(node.arguments) > 1 else 0
+                return self._infer_node_type(node.arguments[index], source_types)
+            return DataType.STRING
 
-        agg_functions = ['sum', 'count', 'avg', 'min', 'max', 'first', 'last']
-        expression_lower = expression.lower()
-        return any(func in expression_lower for func in agg_functions)
+        if isinstance(node, UnaryOperation):
+            if node.operator == "NOT":
+                return DataType.BOOLEAN
+            return self._infer_node_type(node.operand, source_types)
 
-    def _convert_condition(self, condition: str) -> str:
+        if node.operator in BOOLEAN_OPERATORS:
+            return DataType.BOOLEAN
+        if node.operator == "&":
+            return DataType.STRING
+        left = self._infer_node_type(node.left, source_types)
+        right = self._infer_node_type(node.right, source_types)
+        if node.operator != "/" and left in INTEGRAL_TYPES and right in INTEGRAL_TYPES:
+            return DataType.LONG
+        if node.operator in ("+", "-") and DataType.DATE in (left, right):
+            return DataType.DATE
+        return DataType.DOUBLE
 
-        condition = condition.replace(' AND ', ' & ')
-        condition = condition.replace(' OR ', ' | ')
-        condition = condition.replace(' NOT ', ' ~ ')
-        condition = condition.replace('=', '==')
-        condition = condition.replace('<>', '!=')
+    def _is_aggregate_expression(self, expression: str) -> bool:
 
-        return condition
+        node = try_parse_expression(expression)
+        if node is None:
+            return False
+        return any(
+            isinstance(n, FunctionCall) and QlikFunctionMapper.is_aggregate_function(n.function_name)
+            for n in walk(node)
+        )
@@ -0,0 +1,349 @@
+
+import math
+import re
+from typing import Callable, Dict, List, Optional, Tuple, Union
+from app.core.expression import try_parse_expression
+from app.models.ast_models import (
+    Expression, FunctionCall, FieldReference, Literal,
+    BinaryOperation, UnaryOperation
+)
+
+MAX_EXPANSION_DEPTH = 64
+
+MAX_EXPANSION_CACHE_SIZE = 65536
+
+# Folded values and expanded text longer than this are left as written, so
+# Repeat('x', 1e10) or a variable doubling itself cannot exhaust memory.
+MAX_VALUE_LENGTH = 1 << 20
+
+# Qlik represents true as -1 and false as 0.
+QLIK_TRUE = -1
+QLIK_FALSE = 0
+
+Value = Union[int, float, str]
+
+_MACRO_START = re.compile(r"\$\(")
+_MACRO_SCAN = re.compile(r"\$\(|[()]")
+_MACRO_CALL = re.compile(r"\s*([^()]*?)\s*(?:\((.*)\))?\s*", re.DOTALL)
+_PARAMETER = re.compile(r"\$(\d+)")
+_ARGUMENT_SEPARATOR = re.compile(r"'[^']*'|\"[^\"]*\"|[(),]")
+
+class VariableEnvironment:
+
+    # Every change bumps ``version`` so expansions cached against an older
+    # set of values are discarded.
+
+    def __init__(self, values: Optional[Dict[str, str]] = None):
+        self.values: Dict[str, str] = dict(values or {})
+        self.version = 0
+
+    def set(self, name: str, value: str):
+
+        if self.values.get(name) != value:
+            self.values[name] = value
+            self.version += 1
+
+    def unset(self, name: str):
+
+        if self.values.pop(name, None) is not None:
+            self.version += 1
+
+    def get(self, name: str) -> Optional[str]:
+
+        return self.values.get(name)
+
+    def __contains__(self, name: str) -> bool:
+
+        return name in self.values
+
+class _NotConstant(Exception):
+    pass
+
+class MacroExpander:
+
+    def __init__(self, environment: Optional[VariableEnvironment] = None):
+        self.environment = environment if environment is not None else VariableEnvironment()
+        self._cache: Dict[str, str] = {}
+        self._cache_version = self.environment.version
+
+    def expand(self, text: str) -> str:
+
+        if "$(" not in text:
+            return text
+
+        if self._cache_version != self.environment.version:
+            self._cache.clear()
+            self._cache_version = self.environment.version
+
+        expanded = self._cache.get(text)
+        if expanded is None:
+            expanded = self._expand_text(text)
+            if len(self._cache) >= MAX_EXPANSION_CACHE_SIZE:
+                self._cache.clear()
+            self._cache[text] = expanded
+        return expanded
+
+    def evaluate(self, text: str) -> Optional[str]:
+
+        # Folds a LET or ``$(=...)`` expression to its text value; None if it
+        # depends on anything other than literals and known variables.
+        node = try_parse_expression(text)
+        if node is None:
+            return None
+        try:
+            value = _format_value(self._evaluate(node))
+        except (_NotConstant, ArithmeticError, ValueError, TypeError):
+            return None
+        return value if len(value) <= MAX_VALUE_LENGTH else None
+
+    def _expand_text(self, text: str) -> str:
+
+        parts = []
+        pos = 0
+        length = 0
+        while True:
+            m = _MACRO_START.search(text, pos)
+            if m is None:
+                parts.append(text[pos:])
+                return "".join(parts)
+            parts.append(text[pos:m.start()])
+            inner, pos = self._expand_macro(text, m.end(), 1)
+            parts.append(inner)
+            length += len(parts[-2]) + len(inner)
+            if length > MAX_VALUE_LENGTH:
+                return text
+
+    def _expand_macro(self, text: str, pos: int, depth: int) -> Tuple[str, int]:
+
+        # Expands the body of a ``$(`` starting at ``pos`` (inner macros
+        # first, so ``$(v$(i))`` works) and resolves it. Returns the
+        # replacement and the position after the closing parenthesis.
+        parts = []
+        open_parens = 0
+        while True:
+            m = _MACRO_SCAN.search(text, pos)
+            if m is None:
+                # Unterminated: keep the text as written.
+                parts.append(text[pos:])
+                return "$(" + "".join(parts), len(text)
+            parts.append(text[pos:m.start()])
+            pos = m.end()
+            token = m.group()
+            if token == "$(" and depth < MAX_EXPANSION_DEPTH:
+                inner, pos = self._expand_macro(text, pos, depth + 1)
+                parts.append(inner)
+            elif token != ")":
+                # A plain "(" or, past the depth limit, a macro kept as written.
+                open_parens += 1
+                parts.append(token)
+            elif open_parens:
+                open_parens -= 1
+                parts.append(token)
+            else:
+                return self._resolve("".join(parts)), pos
+
+    def _resolve(self, body: str) -> str:
+
+        if body.startswith("="):
+            value = self.evaluate(body[1:])
+            return value if value is not None else f"$({body})"
+
+        m = _MACRO_CALL.fullmatch(body)
+        value = self.environment.get(m.group(1)) if m else None
+        if value is None:
+            # Unknown variables are kept so they can still be resolved later.
+            return f"$({body})"
+
+        if m.group(2) is not None:
+            arguments = _split_arguments(m.group(2))
+            if len(value) + len(_PARAMETER.findall(value)) * max(map(len, arguments)) > MAX_VALUE_LENGTH:
+                return f"$({body})"
+            value = _PARAMETER.sub(
+                lambda p: arguments[int(p.group(1)) - 1] if 0 < int(p.group(1)) <= len(arguments) else "",
+                value
+            )
+        return value
+
+    def _evaluate(self, node: Expression) -> Value:
+
+        if isinstance(node, Literal):
+            if node.kind == "number":
+                return _to_number(node.value)
+            return node.value
+
+        if isinstance(node, FieldReference):
+            value = self.environment.get(node.name)
+            if value is None:
+                raise _NotConstant(node.name)
+            try:
+                return _to_number(value)
+            except ValueError:
+                return value
+
+        if isinstance(node, UnaryOperation):
+            operand = self._evaluate(node.operand)
+            if node.operator == "NOT":
+                return QLIK_FALSE if _to_bool(operand) else QLIK_TRUE
+            return -_to_number(operand)
+
+        if isinstance(node, BinaryOperation):
+            return self._evaluate_binary(node)
+
+        if isinstance(node, FunctionCall):
+            name = node.function_name.lower()
+            if name == "if":
+                return self._evaluate_if(node)
+            handler = CONSTANT_FUNCTIONS.get(name)
+            if handler is None or node.distinct:
+                raise _NotConstant(node.function_name)
+            return handler(*[self._evaluate(argument) for argument in node.arguments])
+
+        raise _NotConstant(type(node).__name__)
+
+    def _evaluate_if(self, node: FunctionCall) -> Value:
+
+        # Only the selected branch is evaluated.
+        if len(node.arguments) not in (2, 3):
+            raise _NotConstant("If")
+        if _to_bool(self._evaluate(node.arguments[0])):
+            return self._evaluate(node.arguments[1])
+        if len(node.arguments) == 3:
+            return self._evaluate(node.arguments[2])
+        raise _NotConstant("If")
+
+    def _evaluate_binary(self, node: BinaryOperation) -> Value:
+
+        operator = node.operator
+        left = self._evaluate(node.left)
+        right = self._evaluate(node.right)
+
+        if operator == "&":
+            left, right = _format_value(left), _format_value(right)
+            _check_length(len(left) + len(right))
+            return left + right
+        if operator in ("AND", "OR", "XOR"):
+            a, b = _to_bool(left), _to_bool(right)
+            result = a and b if operator == "AND" else a or b if operator == "OR" else a != b
+            return QLIK_TRUE if result else QLIK_FALSE
+        if operator in COMPARISONS:
+            try:
+                left, right = _to_number(left), _to_number(right)
+            except ValueError:
+                left, right = _format_value(left), _format_value(right)
+            return QLIK_TRUE if COMPARISONS[operator](left, right) else QLIK_FALSE
+        if operator in ARITHMETIC:
+            return ARITHMETIC[operator](_to_number(left), _to_number(right))
+        raise _NotConstant(operator)
+
+def _check_length(length: Union[int, float]):
+
+    if length > MAX_VALUE_LENGTH:
+        raise _NotConstant("value too long")
+
+def _repeat(s: Value, n: Value = 1) -> str:
+
+    text, count = _format_value(s), int(_to_number(n))
+    _check_length(len(text) * count)
+    return text * count
+
+def _replace(s: Value, old: Value, new: Value) -> str:
+
+    text, old, new = _format_value(s), _format_value(old), _format_value(new)
+    _check_length(len(text) + text.count(old) * (len(new) - len(old)))
+    return text.replace(old, new)
+
+def _split_arguments(text: str) -> List[str]:
+
+    arguments = []
+    depth = 0
+    start = 0
+    for m in _ARGUMENT_SEPARATOR.finditer(text):
+        token = m.group()
+        if token == "(":
+            depth += 1
+        elif token == ")":
+            depth -= 1
+        elif token == "," and depth == 0:
+            arguments.append(text[start:m.start()].strip())
+            start = m.end()
+    arguments.append(text[start:].strip())
+    return arguments
+
+def _to_number(value: Value) -> Union[int, float]:
+
+    if isinstance(value, (int, float)):
+        return value
+    text = value.strip()
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+def _to_bool(value: Value) -> bool:
+
+    try:
+        return _to_number(value) != 0
+    except ValueError:
+        return False
+
+def _format_value(value: Value) -> str:
+
+    if isinstance(value, float):
+        if value.is_integer():
+            return str(int(value))
+        return repr(value)
+    return str(value)
+
+def _divide(a: Union[int, float], b: Union[int, float]) -> Union[int, float]:
+
+    result = a / b
+    return int(result) if result.is_integer() else result
+
+def _round(value: Value, step: Value = 1) -> Union[int, float]:
+
+    value, step = _to_number(value), _to_number(step)
+    return _format_number(math.floor(value / step + 0.5) * step)
+
+def _format_number(value: Union[int, float]) -> Union[int, float]:
+
+    return int(value) if float(value).is_integer() else value
+
+COMPARISONS: Dict[str, Callable] = {
+    "=": lambda a, b: a == b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    ">": lambda a, b: a > b,
+    "<=": lambda a, b: a <= b,
+    ">=": lambda a, b: a >= b,
+}
+
+ARITHMETIC: Dict[str, Callable] = {
+    "+": lambda a, b: a + b,
+    "-": lambda a, b: a - b,
+    "*": lambda a, b: a * b,
+    "/": _divide,
+}
+
+# Functions folded when a LET or $(=...) expression is fully constant.
+CONSTANT_FUNCTIONS: Dict[str, Callable] = {
+    "upper": lambda s: _format_value(s).upper(),
+    "lower": lambda s: _format_value(s).lower(),
+    "trim": lambda s: _format_value(s).strip(),
+    "ltrim": lambda s: _format_value(s).lstrip(),
+    "rtrim": lambda s: _format_value(s).rstrip(),
+    "len": lambda s: len(_format_value(s)),
+    "left": lambda s, n: _format_value(s)[:int(_to_number(n))],
+    "right": lambda s, n: _format_value(s)[-int(_to_number(n)):] if int(_to_number(n)) else "",
+    "mid": lambda s, start, n=None: _format_value(s)[int(_to_number(start)) - 1:][:None if n is None else int(_to_number(n))],
+    "replace": _replace,
+    "repeat": _repeat,
+    "chr": lambda n: chr(int(_to_number(n))),
+    "num": lambda n, *_: _to_number(n),
+    "text": lambda s: _format_value(s),
+    "round": _round,
+    "floor": lambda n: math.floor(_to_number(n)),
+    "ceil": lambda n: math.ceil(_to_number(n)),
+    "fabs": lambda n: abs(_to_number(n)),
+    "mod": lambda a, b: _to_number(a) % _to_number(b),
+    "div": lambda a, b: int(_to_number(a) // _to_number(b)),
+}
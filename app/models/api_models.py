@@ -7,12 +7,38 @@ class ConversionOptions(BaseModel):
     fabric_compatible: bool = True
     include_comments: bool = True
     optimize_joins: bool = True
+    # How STORE statements are written: "delta" or "parquet".
+    output_format: str = "delta"
+    # Table name -> columns its output is partitioned by.
+    partition_by: Dict[str, List[str]] = Field(default_factory=dict)
+    target_file_size: Optional[str] = None
+    optimize_write: bool = False
+    v_order: bool = False
+    lakehouse_schema: Optional[str] = None
+    # Tables read two or more times are persisted at this StorageLevel
+    # (None turns it off), unless known to have fewer rows than the minimum.
+    persist_storage_level: Optional[str] = "MEMORY_AND_DISK"
+    persist_min_rows: int = 100_000
+    # Optimizer rules to skip: dead_tables, predicate_pushdown,
+    # sargable_predicates, fuse_steps, common_subexpressions, prune_columns.
+    disabled_optimizations: List[str] = Field(default_factory=list)
+    # Tables of one execution stage built at once; 1 builds them in turn.
+    concurrent_tables: int = 1
+
+class SchemaField(BaseModel):
+
+    table: str
+    field: str
+    type: str
 
 class ConvertRequest(BaseModel):
 
     script: str = Field(..., description="Qlik script content")
     mode: str = Field(default="transformation", description="Mode: 'extraction' or 'transformation'")
     options: Optional[ConversionOptions] = Field(default_factory=ConversionOptions)
+    schema_csv: Optional[str] = Field(default=None, description="Schema CSV content with table, field and type columns")
+    schema_fields: Optional[List[SchemaField]] = Field(default=None, description="The same table/field/type rows as JSON")
+    table_rows: Optional[Dict[str, int]] = Field(default=None, description="Known row counts of loaded tables, for join planning")
 
 class ExecutionStep(BaseModel):
 
@@ -21,6 +47,14 @@ class ExecutionStep(BaseModel):
     operation: str
     dependencies: List[str] = Field(default_factory=list)
     description: str
+    # Steps sharing a stage read none of each other and may run at once.
+    stage: Optional[int] = None
+
+class AppliedRewrite(BaseModel):
+
+    rule: str
+    table: str
+    description: str
 
 class ConvertResponse(BaseModel):
 
@@ -28,6 +62,7 @@ class ConvertResponse(BaseModel):
     pyspark_code: str
     semantic_model: Dict[str, Any]
     execution_plan: List[ExecutionStep]
+    optimizations: List[AppliedRewrite] = Field(default_factory=list)
     warnings: List[str] = Field(default_factory=list)
     errors: List[str] = Field(default_factory=list)
 
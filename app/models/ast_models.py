@@ -1,7 +1,8 @@
 
 from typing import List, Optional, Dict, Any, Union
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from enum import Enum
+from app.core.inline import InlineTable
 
 class LoadType(str, Enum):
     EXTERNAL = "external"
@@ -19,24 +20,58 @@ class ASTNode(BaseModel):
 
     node_type: str
 
-class FieldExpression(ASTNode):
+class Literal(ASTNode):
 
-    node_type: str = "field_expression"
-    raw_expression: str
-    alias: Optional[str] = None
-    is_calculated: bool = False
+    node_type: str = "literal"
+    value: str
+    kind: str = "string"
+
+class FieldReference(ASTNode):
+
+    node_type: str = "field_ref"
+    name: str
+
+class VariableReference(ASTNode):
+
+    node_type: str = "variable_ref"
+    text: str
 
 class FunctionCall(ASTNode):
 
     node_type: str = "function_call"
     function_name: str
-    arguments: List[Union[str, 'FunctionCall']]
+    arguments: List['Expression'] = Field(default_factory=list)
+    distinct: bool = False
+    alias: Optional[str] = None
+
+class UnaryOperation(ASTNode):
+
+    node_type: str = "unary_op"
+    operator: str
+    operand: 'Expression'
+
+class BinaryOperation(ASTNode):
+
+    node_type: str = "binary_op"
+    operator: str
+    left: 'Expression'
+    right: 'Expression'
+
+Expression = Union[Literal, FieldReference, VariableReference, FunctionCall, UnaryOperation, BinaryOperation]
+
+class FieldExpression(ASTNode):
+
+    node_type: str = "field_expression"
+    raw_expression: str
     alias: Optional[str] = None
+    is_calculated: bool = False
+    expression: Optional[Expression] = None
 
 class WhereClause(ASTNode):
 
     node_type: str = "where_clause"
     condition: str
+    expression: Optional[Expression] = None
 
 class GroupByClause(ASTNode):
 
@@ -47,8 +82,16 @@ class JoinClause(ASTNode):
 
     node_type: str = "join"
     join_type: JoinType
-    table_name: str
+    table_name: Optional[str] = None
     on_fields: Optional[List[str]] = None  
+    # KEEP reduces the tables to matching rows without merging them.
+    keep: bool = False
+
+class ConcatenateClause(ASTNode):
+
+    node_type: str = "concatenate"
+    # None appends to the previously loaded table.
+    table_name: Optional[str] = None
 
 class OrderByClause(ASTNode):
 
@@ -58,6 +101,8 @@ class OrderByClause(ASTNode):
 
 class LoadStatement(ASTNode):
 
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     node_type: str = "load_statement"
     load_type: LoadType
     table_name: Optional[str] = None
@@ -67,19 +112,27 @@ class LoadStatement(ASTNode):
     group_by: Optional[GroupByClause] = None
     order_by: Optional[OrderByClause] = None
     join_clause: Optional[JoinClause] = None
+    concatenate: Optional[ConcatenateClause] = None
+    no_concatenate: bool = False
     distinct: bool = False
     preceding_load: Optional['LoadStatement'] = None  
-    inline_data: Optional[List[List[str]]] = None
+    # Every file read, when one load reads several (a FOR loop's files).
+    sources: List[str] = Field(default_factory=list)
+    inline_data: Optional[InlineTable] = None
     is_mapping: bool = False
 
 class MappingLoad(ASTNode):
 
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     node_type: str = "mapping_load"
     mapping_name: str
     key_field: str
     value_field: str
     source: str
     where_clause: Optional[WhereClause] = None
+    load_type: LoadType = LoadType.RESIDENT
+    inline_data: Optional[InlineTable] = None
 
 class ApplyMapCall(ASTNode):
 
@@ -96,10 +149,46 @@ class VariableAssignment(ASTNode):
     value: str
     is_let: bool = True  
 
+class StoreStatement(ASTNode):
+
+    node_type: str = "store"
+    table_name: str
+    target: str
+    # The format given after the target (qvd, txt, parquet), if any.
+    file_format: Optional[str] = None
+    # Fields written, when listed; otherwise all of the table's.
+    fields: List[FieldExpression] = Field(default_factory=list)
+
+class DropStatement(ASTNode):
+
+    # DROP TABLE[S] a, b
+    node_type: str = "drop"
+    table_names: List[str] = Field(default_factory=list)
+
+class ForLoop(ASTNode):
+
+    # FOR i = a TO b and FOR EACH v IN ... loops. ``statements`` is the body
+    # with the loop variable left unexpanded; ``unrolled`` repeats it with
+    # each value substituted, when the values are known.
+    node_type: str = "for_loop"
+    variable: str
+    values: Optional[List[str]] = None
+    # The wildcard path of FOR EACH v IN FileList('...').
+    file_pattern: Optional[str] = None
+    statements: List[Union[LoadStatement, MappingLoad, VariableAssignment, StoreStatement, DropStatement, 'ForLoop']] \
+        = Field(default_factory=list)
+    unrolled: Optional[List[Union[LoadStatement, MappingLoad, VariableAssignment, StoreStatement, DropStatement, 'ForLoop']]] = None
+
 class Script(ASTNode):
 
     node_type: str = "script"
-    statements: List[Union[LoadStatement, MappingLoad, VariableAssignment]] = Field(default_factory=list)
+    statements: List[Union[LoadStatement, MappingLoad, VariableAssignment, StoreStatement, DropStatement, ForLoop]] \
+        = Field(default_factory=list)
 
 LoadStatement.model_rebuild()
+ForLoop.model_rebuild()
 FunctionCall.model_rebuild()
+UnaryOperation.model_rebuild()
+BinaryOperation.model_rebuild()
+FieldExpression.model_rebuild()
+WhereClause.model_rebuild()
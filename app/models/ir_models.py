@@ -1,7 +1,8 @@
 
 from typing import List, Optional, Dict, Any, Set
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from enum import Enum
+from app.core.inline import InlineTable
 
 class DataType(str, Enum):
     STRING = "string"
@@ -51,6 +52,31 @@ class JoinTransformation(Transformation):
     join_type: str  
     join_keys: List[str] = Field(default_factory=list)
     join_condition: Optional[str] = None
+    # The joined load, built like a table of its own.
+    right: Optional["TableDefinition"] = None
+
+class SemiJoinTransformation(Transformation):
+
+    # Keeps the rows of ``source_table`` whose key values do (or, when
+    # ``anti``, do not) appear in the ``key_columns`` of any ``key_tables``.
+    operation: str = "semi_join"
+    table_name: str
+    source_table: str
+    key_tables: List[str] = Field(default_factory=list)
+    # Qlik expressions over source rows, one per key column.
+    key_expressions: List[str] = Field(default_factory=list)
+    key_columns: List[str] = Field(default_factory=list)
+    anti: bool = False
+    # Keep one row per value of these columns (NOT Exists() on a field
+    # the load itself creates).
+    distinct_columns: List[str] = Field(default_factory=list)
+
+class DeriveTransformation(Transformation):
+
+    # Adds computed columns, keeping every other column of the table.
+    operation: str = "derive"
+    table_name: str
+    columns: List[ColumnDefinition] = Field(default_factory=list)
 
 class AggregationTransformation(Transformation):
 
@@ -65,24 +91,64 @@ class UnionTransformation(Transformation):
     operation: str = "union"
     table_name: str
     source_tables: List[str] = Field(default_factory=list)
+    # Loads appended to the table, each built like a table of its own.
+    parts: List["TableDefinition"] = Field(default_factory=list)
 
 class MappingDefinition(BaseModel):
 
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     mapping_name: str
     source_table: str
     key_column: str
     value_column: str
     filter_condition: Optional[str] = None
+    source_type: str = "resident"
+    inline_data: Optional[InlineTable] = None
+    source_columns: List[ColumnDefinition] = Field(default_factory=list)
+    # Rows in the mapping source, when known; picks how ApplyMap is compiled.
+    row_count: Optional[int] = None
 
 class TableDefinition(BaseModel):
 
+    model_config = ConfigDict(arbitrary_types_allowed=True)
+
     name: str
     columns: List[ColumnDefinition] = Field(default_factory=list)
     primary_keys: List[str] = Field(default_factory=list)
     source_type: str = "external"  
     source_path: Optional[str] = None
+    # Every file read, when the table is loaded from several at once.
+    source_paths: List[str] = Field(default_factory=list)
+    inline_data: Optional[InlineTable] = None
+    # Schema of the external source, when its format records one.
+    source_columns: List[ColumnDefinition] = Field(default_factory=list)
+    row_count: Optional[int] = None
+    # Bytes in the source files, when only their size is known.
+    size_bytes: Optional[int] = None
+    # Columns the read is narrowed to, when later steps use only some.
+    read_columns: List[str] = Field(default_factory=list)
+    # File columns cast to the schema file's types once read.
+    cast_columns: List[ColumnDefinition] = Field(default_factory=list)
     transformations: List[Transformation] = Field(default_factory=list)
 
+class StoreDefinition(BaseModel):
+
+    table_name: str
+    target_path: str
+    # The format the script wrote (qvd, txt, parquet); output is Delta or
+    # Parquet either way.
+    file_format: str = "qvd"
+    # Fields written, when the STORE lists them.
+    columns: List[ColumnDefinition] = Field(default_factory=list)
+    # Set when the STORE ends Qlik's incremental-load pattern: the table's
+    # new rows are merged into the stored file on these keys instead.
+    merge_keys: List[str] = Field(default_factory=list)
+    # Field the new rows are selected by (ModifiedDate > last reload), and
+    # the rest of that WHERE clause.
+    watermark_column: Optional[str] = None
+    changes_condition: Optional[str] = None
+
 class Relationship(BaseModel):
 
     from_table: str
@@ -95,6 +161,16 @@ class DataModel(BaseModel):
 
     tables: Dict[str, TableDefinition] = Field(default_factory=dict)
     mappings: Dict[str, MappingDefinition] = Field(default_factory=dict)
+    stores: List[StoreDefinition] = Field(default_factory=list)
+    # Tables a DROP TABLE removed from the final model; they are still
+    # built when loads before the DROP read them.
+    dropped_tables: List[str] = Field(default_factory=list)
     relationships: List[Relationship] = Field(default_factory=list)
     variables: Dict[str, str] = Field(default_factory=dict)
     execution_order: List[str] = Field(default_factory=list)  
+    # The execution order cut into stages whose tables read none of each
+    # other, each stage after the ones before it.
+    execution_stages: List[List[str]] = Field(default_factory=list)
+
+JoinTransformation.model_rebuild()
+UnionTransformation.model_rebuild()
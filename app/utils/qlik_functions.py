@@ -1,4 +1,6 @@
 
+import ast
+import re
 from typing import Dict, Callable, List
 
 class QlikFunctionMapper:
@@ -50,15 +52,18 @@ class QlikFunctionMapper:
         "Max": "max",
         "FirstValue": "first",
         "LastValue": "last",
+        "Only": "first",
 
         "If": "when",
         "Null": "lit(None)",
         "IsNull": "isnull",
         "Alt": "coalesce",
 
-        "Num": "cast({}, 'double')",
-        "Text": "cast({}, 'string')",
+        "Num": "{}.cast('double')",
+        "Text": "{}.cast('string')",
         "Dual": "{}",  
+
+        "FilePath": "input_file_name",
     }
 
     SPECIAL_FUNCTIONS = {
@@ -67,13 +72,22 @@ class QlikFunctionMapper:
         "MakeDate", "Timestamp", "Date#", "Timestamp#",
         "SubField", "TextBetween", "MapSubString",
         "If", "Pick", "Match", "WildMatch",
-        "ApplyMap", "Lookup"
+        "ApplyMap", "Lookup", "Null", "Today", "Now",
+        "FileName", "FileBaseName"
     }
 
+    AGGREGATE_FUNCTIONS = {"Sum", "Count", "Avg", "Min", "Max", "FirstValue", "LastValue", "Only"}
+
+    @classmethod
+    def canonical_name(cls, qlik_func: str) -> str:
+
+        # Qlik function names are case-insensitive.
+        return _CANONICAL_NAMES.get(qlik_func.strip().lower(), qlik_func.strip())
+
     @classmethod
     def map_function(cls, qlik_func: str, args: List[str]) -> str:
 
-        func_upper = qlik_func.strip()
+        func_upper = cls.canonical_name(qlik_func)
 
         if func_upper in cls.SPECIAL_FUNCTIONS:
             return cls._handle_special_function(func_upper, args)
@@ -135,6 +149,18 @@ class QlikFunctionMapper:
             else:
                 return f"when({args[0]}, True).otherwise(False)"
 
+        elif func == "Null":
+
+            return "lit(None)"
+
+        elif func == "Today":
+
+            return "current_date()"
+
+        elif func == "Now":
+
+            return "current_timestamp()"
+
         elif func == "ApplyMap":
 
             return f"# ApplyMap({', '.join(args)})"
@@ -143,6 +169,21 @@ class QlikFunctionMapper:
 
             return f"# Lookup({', '.join(args)})"
 
+        elif func == "FileName":
+
+            return "element_at(split(input_file_name(), '/'), -1)"
+
+        elif func == "FileBaseName":
+
+            return "regexp_extract(input_file_name(), '([^/]*?)(?:\\\\.[^./]*)?$', 1)"
+
+        elif func == "TextBetween" and len(args) >= 3 and all(_is_string_literal(a) for a in args[1:3]):
+
+            # An empty delimiter matches the start or end of the text.
+            start, end = (ast.literal_eval(a) for a in args[1:3])
+            pattern = (re.escape(start) if start else "^") + "(.*?)" + (re.escape(end) if end else "$")
+            return f"regexp_extract({args[0]}, {pattern!r}, 1)"
+
         elif func in ["Date#", "Timestamp#"]:
 
             format_map = {
@@ -162,5 +203,14 @@ class QlikFunctionMapper:
     @classmethod
     def is_aggregate_function(cls, func_name: str) -> bool:
 
-        aggregate_funcs = {"Sum", "Count", "Avg", "Min", "Max", "FirstValue", "LastValue"}
-        return func_name in aggregate_funcs
+        return cls.canonical_name(func_name) in cls.AGGREGATE_FUNCTIONS
+
+def _is_string_literal(code: str) -> bool:
+
+    return code[:1] in ("'", '"') and code[-1:] == code[:1]
+
+_CANONICAL_NAMES = {
+    name.lower(): name
+    for name in (*QlikFunctionMapper.FUNCTION_MAP, *QlikFunctionMapper.SPECIAL_FUNCTIONS,
+                 *QlikFunctionMapper.AGGREGATE_FUNCTIONS)
+}
@@ -0,0 +1,71 @@
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+from app.core.parser import QlikParser
+
+def wide_load(n: int) -> str:
+
+    fields = ",\n".join(f"If(Len(F{i}) > 0, Upper(F{i}), 'n/a') as C{i}" for i in range(n))
+    return f"Wide:\nLOAD {fields}\nFROM wide.csv\nWHERE F0 > 0;\n"
+
+def nested_parens(n: int) -> str:
+
+    return "Deep:\nLOAD " + "(" * n + "x" + ")" * n + " as y FROM deep.csv;\n"
+
+def unterminated_quote(n: int) -> str:
+
+    fields = ", ".join(f"F{i}" for i in range(n))
+    return f"Broken:\nLOAD {fields}, 'never closed FROM broken.csv WHERE {fields};\n"
+
+def no_terminator(n: int) -> str:
+
+    return "LOAD " + " ".join(f"F{i}" for i in range(n))
+
+def repeated_keyword(n: int) -> str:
+
+    return "LOAD " * n
+
+def many_statements(n: int) -> str:
+
+    return "".join(f"T{i}:\nLOAD A, B, Sum(C) as S RESIDENT Src GROUP BY A, B;\n" for i in range(n))
+
+def many_variables(n: int) -> str:
+
+    definitions = "".join(f"SET vField{i} = F{i};\n" for i in range(n))
+    fields = ", ".join(f"$(vField{i})" for i in range(0, n, 10))
+    return definitions + "".join(f"T{j}:\nLOAD {fields} FROM t{j}.csv;\n" for j in range(10))
+
+CASES = {
+    "wide_load": wide_load,
+    "nested_parens": nested_parens,
+    "unterminated_quote": unterminated_quote,
+    "no_terminator": no_terminator,
+    "repeated_keyword": repeated_keyword,
+    "many_statements": many_statements,
+    "many_variables": many_variables,
+}
+
+def time_parse(script: str, repeat: int = 3) -> float:
+
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        QlikParser().parse(script)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+def main(base: int = 2000, steps: int = 4):
+
+    print(f"{'case':<20}{'size':>10}{'chars':>12}{'seconds':>12}{'us/char':>10}")
+    for name, build in CASES.items():
+        for step in range(steps):
+            size = base * (2 ** step)
+            script = build(size)
+            elapsed = time_parse(script)
+            print(f"{name:<20}{size:>10}{len(script):>12}{elapsed:>12.4f}{elapsed / len(script) * 1e6:>10.3f}")
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
@@ -1,30 +1,81 @@
 import sys
+import os
 import json
 from app.core.parser import QlikParser
+from app.core.includes import IncludeResolver
+from app.core.cache import ConversionCache, file_conversion_key
+from app.models.ast_models import Script
 from app.core.transformer import ASTTransformer
-from app.core.codegen import PySparkCodeGenerator
+from app.core.codegen import ConcurrencyOptions, PersistOptions, PySparkCodeGenerator, WriteOptions
+from app.core.migration import MigrationManifest
+from app.core.optimizer import IROptimizer
+from app.core.schema import SchemaResolver, load_schema_file, parse_row_counts
 from app.core.semantic import SemanticModelGenerator
 
-def convert_qlik_file(input_file, output_file=None):
+def convert_qlik_file(input_file, output_file=None, schema_file=None):
     print(f"Reading Qlik script from: {input_file}")
     
-    with open(input_file, 'r', encoding='utf-8') as f:
-        qlik_script = f.read()
+    print("Parsing and transforming Qlik script...")
+    # Relative includes resolve against the script's folder; lib:// roots
+    # come from QLIK_LIB_ROOTS.
+    resolver = IncludeResolver.from_environment(base_dir=os.path.dirname(os.path.abspath(input_file)))
+    # QVD and Parquet sources found the same way type their columns; the
+    # schema file types the tables it lists. QLIK_TABLE_ROWS="Orders=300000000"
+    # sizes tables for join planning.
+    qvd_manifest = MigrationManifest.from_environment()
+    schemas = SchemaResolver(resolver, qvd_manifest, load_schema_file(schema_file) if schema_file else None,
+                             parse_row_counts(os.getenv("QLIK_TABLE_ROWS") or ""))
     
-    print("Parsing Qlik script...")
-    parser = QlikParser()
-    ast = parser.parse(qlik_script)
-    print(f"  Parsed {len(ast.statements)} statements")
+    cache_dir = os.getenv("QLIK_CONVERSION_CACHE_DIR")
+    cache = ConversionCache(cache_dir) if cache_dir else None
+    cache_key = file_conversion_key(input_file, schemas.fingerprint()) if cache else None
+    cached = cache.get(cache_key, resolver, schemas) if cache else None
     
-    print("Transforming to internal representation...")
-    transformer = ASTTransformer()
-    data_model = transformer.transform(ast)
+    if cached is not None:
+        script, data_model = cached
+        print("  Reusing cached conversion (script unchanged)")
+    else:
+        parser = QlikParser(include_resolver=resolver)
+        transformer = ASTTransformer(schema_resolver=schemas)
+        # QLIK_PARSE_WORKERS=N parses very large scripts in N processes.
+        workers = int(os.getenv("QLIK_PARSE_WORKERS") or 0)
+        
+        if workers > 1:
+            with open(input_file, 'r', encoding='utf-8') as f:
+                script = parser.parse_parallel(f.read(), max_workers=workers)
+            data_model = transformer.transform(script)
+        else:
+            statements = []
+            with open(input_file, 'r', encoding='utf-8') as f:
+                for statement in parser.parse_iter(f):
+                    transformer.add_statement(statement)
+                    statements.append(statement)
+            script = Script(statements=statements)
+            data_model = transformer.finalize()
+        if cache:
+            cache.put(cache_key, script, data_model, parser.includes, schemas.sources)
+    
+    print(f"  Parsed {len(script.statements)} statements")
     print(f"  Created {len(data_model.tables)} table(s)")
     print(f"  Execution order: {data_model.execution_order}")
     
+    # QLIK_OPTIMIZER_DISABLE="fuse_steps,common_subexpressions" skips rules.
+    data_model, rewrites = IROptimizer.from_environment().optimize(data_model)
+    for rewrite in rewrites:
+        print(f"  Optimized {rewrite.table} ({rewrite.rule}): {rewrite.description}")
+    
     print("Generating PySpark code...")
-    codegen = PySparkCodeGenerator(fabric_compatible=True)
+    # QVD sources read their migrated copies listed in QLIK_QVD_MANIFEST;
+    # STORE statements are written as QLIK_WRITE_FORMAT and friends say,
+    # reused tables persisted per QLIK_PERSIST_LEVEL, and QLIK_CONCURRENT_TABLES
+    # tables of a stage built at once.
+    codegen = PySparkCodeGenerator(fabric_compatible=True, qvd_manifest=qvd_manifest,
+                                   write_options=WriteOptions.from_environment(),
+                                   persist_options=PersistOptions.from_environment(),
+                                   concurrency_options=ConcurrencyOptions.from_environment())
     pyspark_code = codegen.generate(data_model, mode="transformation")
+    for warning in codegen.warnings:
+        print(f"  WARNING: {warning}")
     
     print("Generating semantic model...")
     semantic_gen = SemanticModelGenerator()
@@ -50,18 +101,26 @@ def convert_qlik_file(input_file, output_file=None):
     print("="*60)
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: python convert_qlik.py <input_file.qvs> [output_file.py]")
+    args = sys.argv[1:]
+    schema_file = None
+    if "--schema" in args:
+        index = args.index("--schema")
+        schema_file = args[index + 1] if index + 1 < len(args) else None
+        del args[index:index + 2]
+    
+    if not args or ("--schema" in sys.argv and schema_file is None):
+        print("Usage: python convert_qlik.py <input_file.qvs> [output_file.py] [--schema schema.csv|schema.json]")
         print("\nExamples:")
         print("  python convert_qlik.py my_script.qvs")
         print("  python convert_qlik.py my_script.qvs my_output.py")
+        print("  python convert_qlik.py my_script.qvs --schema data/sample_schema.csv")
         sys.exit(1)
     
-    input_file = sys.argv[1]
-    output_file = sys.argv[2] if len(sys.argv) > 2 else None
+    input_file = args[0]
+    output_file = args[1] if len(args) > 1 else None
     
     try:
-        convert_qlik_file(input_file, output_file)
+        convert_qlik_file(input_file, output_file, schema_file)
     except FileNotFoundError:
         print(f"ERROR: File not found: {input_file}")
         sys.exit(1)
@@ -0,0 +1,39 @@
+import argparse
+import sys
+from app.core.migration import MANIFEST_NAME, MigrationError, migrate_directory
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert a directory tree of QVD files to Parquet or Delta.")
+    parser.add_argument("source_dir", help="Directory searched recursively for .qvd files")
+    parser.add_argument("target_dir", help="Output directory; keeps the source layout")
+    parser.add_argument("--format", choices=["parquet", "delta"], default="parquet")
+    parser.add_argument("--partition-by", help="Column to partition output by, where present")
+    parser.add_argument("--workers", type=int, default=None, help="Worker processes (default: all cores)")
+    parser.add_argument("--target-uri", help="Location generated PySpark code reads the output from")
+    parser.add_argument("--force", action="store_true", help="Convert files the manifest lists as unchanged")
+    args = parser.parse_args(argv)
+
+    print(f"Migrating QVD files from: {args.source_dir}")
+    try:
+        result = migrate_directory(
+            args.source_dir, args.target_dir,
+            output_format=args.format,
+            partition_by=args.partition_by,
+            max_workers=args.workers,
+            target_uri=args.target_uri,
+            force=args.force
+        )
+    except MigrationError as e:
+        print(f"ERROR: {e}")
+        return 1
+
+    print(f"  Migrated {len(result.migrated)} file(s)")
+    print(f"  Skipped {len(result.skipped)} unchanged file(s)")
+    for path, error in result.failed.items():
+        print(f"  FAILED {path}: {error}")
+    print(f"\nManifest saved to: {args.target_dir}/{MANIFEST_NAME}")
+    print("Set QLIK_QVD_MANIFEST to it so converted scripts read the migrated data.")
+    return 1 if result.failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+import pytest
+from app.core.cache import ConversionCache, conversion_key
+from app.core.includes import IncludeResolver
+from app.core.parser import QlikParser
+from app.core.transformer import ASTTransformer
+
+SCRIPT = """
+Orders: LOAD OrderID, Amount FROM orders.csv;
+Totals: LOAD OrderID, Sum(Amount) as Total RESIDENT Orders GROUP BY OrderID;
+"""
+
+def convert(script, resolver=None):
+
+    parser = QlikParser(include_resolver=resolver)
+    ast = parser.parse(script)
+    return parser, ast, ASTTransformer().transform(ast)
+
+class TestConversionCache:
+
+    def test_memory_hit_returns_copy(self):
+
+        cache = ConversionCache()
+        _, ast, data_model = convert(SCRIPT)
+        key = conversion_key(SCRIPT)
+        cache.put(key, ast, data_model)
+
+        cached_ast, cached_model = cache.get(key)
+
+        assert cached_ast == ast
+        assert cached_model == data_model
+        assert cached_model is not cache.get(key)[1]
+        assert cache.get(conversion_key(SCRIPT + " ")) is None
+
+    def test_disk_tier_shared_between_instances(self, tmp_path):
+
+        _, ast, data_model = convert(SCRIPT)
+        key = conversion_key(SCRIPT)
+        ConversionCache(str(tmp_path)).put(key, ast, data_model)
+
+        cached = ConversionCache(str(tmp_path)).get(key)
+
+        assert cached is not None
+        assert cached[1].execution_order == data_model.execution_order
+
+    def test_memory_lru_and_disk_eviction(self, tmp_path):
+
+        _, ast, data_model = convert(SCRIPT)
+        cache = ConversionCache(str(tmp_path), max_memory_entries=2, max_disk_bytes=1)
+        for i in range(3):
+            cache.put(f"k{i}", ast, data_model)
+
+        assert list(cache._entries) == ["k1", "k2"]
+        assert len(list(tmp_path.iterdir())) <= 1
+
+    def test_changed_include_invalidates_entry(self, tmp_path):
+
+        (tmp_path / "config.qvs").write_text("SET vTable = Orders;")
+        script = "$(Must_Include=lib://Shared/config.qvs);\nLOAD * FROM $(vTable).csv;"
+        resolver = IncludeResolver(roots={"Shared": str(tmp_path)})
+        parser, ast, data_model = convert(script, resolver)
+        cache = ConversionCache()
+        cache.put(conversion_key(script), ast, data_model, parser.includes)
+
+        assert cache.get(conversion_key(script), IncludeResolver(roots={"Shared": str(tmp_path)})) is not None
+
+        (tmp_path / "config.qvs").write_text("SET vTable = Customers;")
+        assert cache.get(conversion_key(script), IncludeResolver(roots={"Shared": str(tmp_path)})) is None
+
+    def test_corrupt_disk_entry_is_a_miss(self, tmp_path):
+
+        key = conversion_key(SCRIPT)
+        (tmp_path / f"conversion-{key}.pickle").write_bytes(b"not a pickle")
+
+        assert ConversionCache(str(tmp_path)).get(key) is None
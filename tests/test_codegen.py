@@ -2,7 +2,8 @@
 import pytest
 from app.core.parser import QlikParser
 from app.core.transformer import ASTTransformer
-from app.core.codegen import PySparkCodeGenerator
+from app.core.codegen import ConcurrencyOptions, PersistOptions, PySparkCodeGenerator, WriteOptions
+from app.core.schema import SchemaResolver, load_schema_csv
 
 class TestPySparkCodeGenerator:
 
@@ -97,6 +98,19 @@ class TestPySparkCodeGenerator:
         assert ".groupBy(" in code
         assert ".agg(" in code
 
+    def test_aliased_arithmetic_parenthesized(self):
+
+        script = """
+        Orders: LOAD OrderID, Amount * 1.2 as AmountWithTax, -Amount as Negated FROM orders.csv;
+        Ratios: LOAD CustomerID, Sum(Amount) / Count(OrderID) as AvgOrder RESIDENT Orders GROUP BY CustomerID;
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "(col('Amount') * 1.2).alias('AmountWithTax')" in code
+        assert "(-col('Amount')).alias('Negated')" in code
+        assert ".agg((sum(col('Amount')) / count(col('OrderID'))).alias('AvgOrder'))" in code
+
     def test_distinct_generation(self):
 
         script = "LOAD DISTINCT CustomerID FROM orders.csv;"
@@ -110,3 +124,395 @@ class TestPySparkCodeGenerator:
         code = codegen.generate(data_model)
 
         assert ".distinct()" in code
+
+    def test_inline_data_generation(self):
+
+        script = """
+        Categories:
+        LOAD * INLINE [
+        CategoryID, CategoryName
+        1, Electronics
+        2, 'Home, Garden'
+        ];
+        """
+        parser = QlikParser()
+        ast = parser.parse(script)
+
+        transformer = ASTTransformer()
+        data_model = transformer.transform(ast)
+
+        codegen = PySparkCodeGenerator()
+        code = codegen.generate(data_model)
+
+        assert "StructField('CategoryID', LongType(), True)" in code
+        assert "(2, 'Home, Garden')," in code
+
+    def test_nested_condition_translation(self):
+
+        script = """
+        Orders: LOAD * FROM orders.csv;
+        Bands: LOAD OrderID, If(Amount > 100 AND Region = 'EU', 'High', 'Low') as Band
+        RESIDENT Orders WHERE Year(OrderDate) >= 2020 OR Status = 'Open';
+        """
+        ast = QlikParser().parse(script)
+        data_model = ASTTransformer().transform(ast)
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "when((col('Amount') > 100) & (col('Region') == 'EU'), 'High').otherwise('Low')" in code
+        assert "(year(col('OrderDate')) >= 2020) | (col('Status') == 'Open')" in code
+
+    def test_qvd_source_reads_migrated_parquet(self):
+
+        script = "Sales: LOAD OrderID, Amount FROM [lib://Data/sales.qvd] (qvd);"
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "spark.read.parquet('lib://Data/sales.parquet')" in code
+        assert "spark.read.csv" not in code
+
+    def test_inline_mapping_becomes_literal_map(self):
+
+        script = """
+        CountryMap: MAPPING LOAD * INLINE [
+        Code, Name
+        US, United States
+        DE, Germany
+        US, Duplicate
+        ];
+        Orders: LOAD OrderID, ApplyMap('CountryMap', Country, 'Unknown') AS CountryName FROM orders.csv;
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "map_CountryMap_expr = create_map(lit('US'), lit('United States'), lit('DE'), lit('Germany'))" in code
+        assert "coalesce(map_CountryMap_expr[col('Country')], lit('Unknown')).alias('CountryName')" in code
+        assert "collectAsMap" not in code
+
+    @pytest.mark.parametrize("rows, strategy", [
+        (500, "collect"),
+        (100_000, "broadcast"),
+        (40_000_000, "join"),
+        (None, "join"),
+    ])
+    def test_mapping_strategy_follows_size(self, rows, strategy):
+
+        script = """
+        CostMap: MAPPING LOAD CC, Centre FROM cost_centres.parquet;
+        Orders: LOAD OrderID, CC RESIDENT Source;
+        Costs: LOAD OrderID, ApplyMap('CostMap', CC) AS Centre RESIDENT Orders;
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+        data_model.mappings["CostMap"].row_count = rows
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        if strategy == "collect":
+            assert "for key, value in map_CostMap.collect():" in code
+            assert "coalesce(map_CostMap_expr[col('CC')], col('CC'))" in code
+        else:
+            join_line = next(line for line in code.splitlines() if line.startswith("df_costs = df_costs.join("))
+            assert ("broadcast(map_CostMap" in join_line) == (strategy == "broadcast")
+            assert "map_CostMap = map_CostMap.dropDuplicates(['CC'])" in code
+            assert "coalesce(col('__CostMap_" in code
+        assert "collectAsMap" not in code
+
+    def test_resident_join_sized_by_its_source(self):
+
+        script = """
+        Facts: LOAD id, d, amount FROM facts.csv;
+        Dim: LOAD d, name FROM dim.csv;
+        LEFT JOIN (Facts) LOAD d, name RESIDENT Dim;
+        """
+        schemas = SchemaResolver(row_counts={"Dim": 1000})
+        data_model = ASTTransformer(schema_resolver=schemas).transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "df_facts = df_facts.join(broadcast(df_facts_join1), ['d'], 'left')" in code
+
+    def test_exists_and_keep_generate_semi_and_anti_joins(self):
+
+        script = """
+        Regions: LOAD * INLINE [
+        Code, Region
+        N, North
+        ];
+        Orders: LOAD OrderID, Code FROM orders.csv WHERE Exists(Code);
+        History: LOAD OrderID FROM history.csv WHERE NOT Exists(OrderID);
+        Sales: LEFT KEEP (Orders) LOAD SaleID, OrderID FROM sales.csv;
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert ("df_orders = df_orders.join(broadcast(df_regions.select(col('Code').alias('__key0'))), "
+                "col('Code') == col('__key0'), 'left_semi')") in code
+        assert ("df_history = df_history.join(df_orders.select(col('OrderID').alias('__key0')), "
+                "col('OrderID') == col('__key0'), 'left_anti')") in code
+        assert "df_history = df_history.dropDuplicates(['OrderID'])" in code
+        assert "col('OrderID') == col('__key0'), 'left_semi')" in code
+        assert "Exists(" not in code
+
+    def test_concatenated_loads_use_balanced_union(self):
+
+        script = """
+        Sales: LOAD OrderID, Amount FROM jan.csv WHERE Amount > 0;
+        CONCATENATE (Sales) LOAD OrderID, Amount FROM feb.csv;
+        CONCATENATE (Sales) LOAD OrderID, Region FROM mar.csv;
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "df_sales_part3 = spark.read.csv('mar.csv', header=True, inferSchema=True)" in code
+        assert "df_sales_parts = [df_sales, df_sales_part2, df_sales_part3]" in code
+        assert "unionByName(df_sales_parts[i + 1], allowMissingColumns=True)" in code
+        assert code.count("unionByName") == 1
+
+    def test_same_layout_files_read_in_one_call(self):
+
+        script = "Sales: LOAD OrderID, Amount FROM sales_01.parquet;\n" + "".join(
+            f"CONCATENATE (Sales) LOAD OrderID, Amount FROM sales_{m:02d}.parquet;\n" for m in range(2, 4)
+        )
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "df_sales = spark.read.parquet('sales_01.parquet', 'sales_02.parquet', 'sales_03.parquet')" in code
+        assert "unionByName" not in code
+
+    def test_declared_csv_read_skips_inference(self):
+
+        schemas = SchemaResolver(tables=load_schema_csv("table,field,type\nT,a,integer\nT,b,text\nT,c,date\nU,a,integer\n"))
+        script = "T: LOAD * FROM t.csv;\nU: LOAD a, d FROM u.csv;"
+        data_model = ASTTransformer(schema_resolver=schemas).transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "df_t = spark.read.csv('t.csv', header=True, inferSchema=False)" in code
+        assert ("df_t = df_t.withColumns({'a': col('a').cast(IntegerType()), 'b': col('b').cast(StringType()), "
+                "'c': col('c').cast(DateType())})") in code
+        assert "df_u = spark.read.csv('u.csv', header=True, inferSchema=True)" in code
+
+    def test_csv_files_keep_their_own_reads(self):
+
+        script = "Sales: LOAD OrderID, Amount FROM jan.csv;\nCONCATENATE (Sales) LOAD OrderID, Amount FROM feb.csv;\n"
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "df_sales = spark.read.csv('jan.csv', header=True, inferSchema=True)" in code
+        assert "df_sales_part2 = spark.read.csv('feb.csv', header=True, inferSchema=True)" in code
+        assert "df_sales = df_sales.unionByName(df_sales_part2, allowMissingColumns=True)" in code
+
+    def test_file_loop_compiles_to_one_read(self):
+
+        script = """
+        FOR i = 1 TO 3
+          Sales: LOAD OrderID, Amount, $(i) AS Month FROM [lib://Data/sales_$(i).csv];
+        NEXT i
+        FOR EACH vFile IN FileList('lib://Data/orders_*.parquet')
+          Orders: LOAD OrderID, '$(vFile)' AS SourceFile FROM [$(vFile)];
+        NEXT vFile
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert data_model.tables["Sales"].source_paths == [f"lib://Data/sales_{m}.csv" for m in (1, 2, 3)]
+        assert ("df_sales = spark.read.csv(['lib://Data/sales_1.csv', 'lib://Data/sales_2.csv', "
+                "'lib://Data/sales_3.csv'], header=True, inferSchema=True)") in code
+        assert ("regexp_extract(element_at(split(input_file_name(), '/'), -1), 'sales_(.*?)\\\\.csv', 1)"
+                ".cast('double').alias('Month')") in code
+        assert "df_orders = spark.read.parquet('lib://Data/orders_*.parquet')" in code
+        assert "input_file_name().alias('SourceFile')" in code
+        assert "unionByName" not in code
+
+    def test_loop_over_paths_in_directories_stays_unrolled(self):
+
+        script = """
+        FOR EACH f IN 'lib://Data/2023/x.csv', 'lib://Data/2024/x.csv'
+          T: LOAD k, '$(f)' AS src FROM [$(f)];
+        NEXT f
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "lit('lib://Data/2023/x.csv').alias('src')" in code
+        assert "lit('lib://Data/2024/x.csv').alias('src')" in code
+        assert "input_file_name()" not in code
+
+    def test_loop_with_per_file_aggregation_stays_unrolled(self):
+
+        script = "FOR i = 1 TO 2\nTotals: LOAD Region, Sum(Amount) AS Total FROM [m_$(i).csv] GROUP BY Region;\nNEXT i"
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "df_totals_part2 = spark.read.csv('m_2.csv', header=True, inferSchema=True)" in code
+        assert "unionByName" in code
+
+    def test_store_writes_after_last_use_and_before_read_back(self):
+
+        script = """
+        Sales: LOAD OrderID, Year, Amount FROM sales.csv;
+        STORE Sales INTO [lib://Out/sales.qvd] (qvd);
+        Totals: LOAD Year, Sum(Amount) AS Total RESIDENT Sales GROUP BY Year;
+        Again: LOAD OrderID, Amount FROM [lib://Out/sales.qvd] (qvd);
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+        options = WriteOptions(partition_by={"Sales": ["Year", "Missing"]}, target_file_size="128mb",
+                               optimize_write=True)
+
+        code = PySparkCodeGenerator(write_options=options).generate(data_model)
+
+        write = ("df_sales.write.format('delta').mode('overwrite').option('optimizeWrite', 'true')"
+                 ".partitionBy('Year').save('lib://Out/sales.delta')")
+        assert write in code
+        assert "spark.conf.set('spark.databricks.delta.properties.defaults.targetFileSize', '128mb')" in code
+        assert code.index("df_totals = ") < code.index(write) < code.index("df_again = ")
+        assert "spark.read.format('delta').load('lib://Out/sales.delta')" in code
+
+    def test_store_to_lakehouse_table(self):
+
+        script = """
+        Orders: LOAD OrderID, Amount FROM orders.csv;
+        STORE OrderID, Amount AS Total FROM Orders INTO [lib://Out/orders.parquet] (parquet);
+        STORE Missing INTO [lib://Out/missing.qvd];
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+        options = WriteOptions(format="parquet", v_order=True, lakehouse_schema="sales")
+
+        code = PySparkCodeGenerator(write_options=options).generate(data_model)
+
+        assert "select(col('OrderID'), col('Amount').alias('Total'))" in code
+        assert ".write.format('parquet').mode('overwrite').option('parquet.vorder.enabled', 'true')" in code
+        assert ".saveAsTable('sales.orders')" in code
+        assert "# STORE Missing INTO lib://Out/missing.qvd: the table is not loaded" in code
+        with pytest.raises(ValueError):
+            PySparkCodeGenerator(write_options=WriteOptions(format="qvd"))
+
+    def test_incremental_pattern_generates_merge(self):
+
+        script = """
+        Sales: LOAD OrderID, Amount, ModifiedDate FROM [lib://Src/sales.csv] WHERE ModifiedDate > '2024-01-01';
+        CONCATENATE (Sales) LOAD OrderID, Amount, ModifiedDate FROM [lib://Out/sales.qvd] (qvd) WHERE NOT Exists(OrderID);
+        STORE Sales INTO [lib://Out/sales.qvd] (qvd);
+        Totals: LOAD Sum(Amount) AS Total RESIDENT Sales;
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model)
+
+        assert "from delta.tables import DeltaTable" in code
+        assert "df_sales = df_sales.filter(col('ModifiedDate') >= lit(df_sales_watermark))" in code
+        assert ("df_sales_target.alias('t').merge(df_sales.alias('s'), \"t.`OrderID` = s.`OrderID`\")"
+                ".whenMatchedUpdateAll().whenNotMatchedInsertAll().execute()") in code
+        # The first run seeds the table from the migrated QVD.
+        assert "df_sales_part2 = spark.read.parquet('lib://Out/sales.parquet')" in code
+        assert "SET TBLPROPERTIES ('qlik.watermark' = '{df_sales_high}')" in code
+        assert code.index("df_sales = spark.read.format('delta').load('lib://Out/sales.delta')") < code.index("df_totals")
+        assert code.count(".mode('overwrite')") == 1
+
+        parquet = PySparkCodeGenerator(write_options=WriteOptions(format="parquet")).generate(data_model)
+        assert ".merge(" not in parquet
+
+    def test_reused_tables_persisted_until_last_read(self):
+
+        script = """
+        Orders: LOAD OrderID, CustomerID, Amount FROM orders.parquet;
+        Big: LOAD OrderID, Amount RESIDENT Orders WHERE Amount > 10;
+        ByCustomer: LOAD CustomerID, Sum(Amount) AS Total RESIDENT Orders GROUP BY CustomerID;
+        Small: LOAD * INLINE [
+        Code
+        A
+        ];
+        Codes1: LOAD Code AS First RESIDENT Small;
+        Codes2: LOAD Code AS Other RESIDENT Small;
+        Last: LOAD CustomerID RESIDENT ByCustomer;
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        code = PySparkCodeGenerator().generate(data_model).splitlines()
+
+        assert "from pyspark import StorageLevel" in code
+        persist = code.index("df_orders = df_orders.persist(StorageLevel.MEMORY_AND_DISK)")
+        unpersist = code.index("df_orders.unpersist()")
+        assert code.index("df_orders = spark.read.parquet('orders.parquet')") < persist
+        assert code.index("# Table: ByCustomer") < unpersist < code.index("# Table: Small")
+        # Known to be tiny, and read once.
+        assert not any("df_small.persist" in line or "df_bycustomer.persist" in line for line in code)
+
+        level = PersistOptions(storage_level="DISK_ONLY", min_rows=0)
+        code = PySparkCodeGenerator(persist_options=level).generate(data_model)
+        assert "df_small = df_small.persist(StorageLevel.DISK_ONLY)" in code
+        assert ".persist(" not in PySparkCodeGenerator(persist_options=PersistOptions(None)).generate(data_model)
+        with pytest.raises(ValueError):
+            PySparkCodeGenerator(persist_options=PersistOptions("MEMORY"))
+
+    def test_joins_planned_by_size(self):
+
+        script = """
+        Orders: LOAD OrderID, CustomerID, ProductID FROM orders.parquet;
+        LEFT JOIN (Orders) LOAD CustomerID, CustomerName FROM customers.csv;
+        LEFT JOIN (Orders) LOAD ProductID, ProductName FROM products.csv;
+        INNER JOIN (Orders) LOAD * INLINE [
+        ProductID, Colour
+        1, red
+        ];
+        JOIN (Orders) LOAD Region FROM regions.csv;
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+        orders = data_model.tables["Orders"]
+        joins = [trans for trans in orders.transformations if trans.operation == "join"]
+        joins[0].right.row_count = 5_000_000
+        joins[1].right.size_bytes = 40_000
+
+        codegen = PySparkCodeGenerator()
+        code = codegen.generate(data_model)
+
+        colours = "df_orders = df_orders.join(broadcast(df_orders_join1), ['ProductID'], 'inner')"
+        products = "df_orders = df_orders.join(broadcast(df_orders_join2), ['ProductID'], 'left')"
+        customers = "df_orders = df_orders.join(df_orders_join3, ['CustomerID'], 'left')"
+        assert code.index(colours) < code.index(products) < code.index(customers)
+        assert "df_orders_join3 = spark.read.csv('customers.csv', header=True, inferSchema=True)" in code
+        assert "df_orders = df_orders.crossJoin(df_orders_join4)" in code
+        assert codegen.warnings == ["JOIN of Table4 into Orders has no common fields "
+                                    "and becomes a cross join of every row with every row"]
+
+    def test_independent_tables_run_concurrently(self):
+
+        script = """
+        Orders: LOAD OrderID, CustomerID FROM orders.csv;
+        Customers: LOAD CustomerID, Name FROM customers.csv;
+        STORE Orders INTO [lib://Out/orders.qvd] (qvd);
+        Again: LOAD OrderID FROM [lib://Out/orders.qvd] (qvd);
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+        code = PySparkCodeGenerator(concurrency_options=ConcurrencyOptions(max_workers=4)).generate(data_model)
+
+        assert "from concurrent.futures import ThreadPoolExecutor" in code
+        assert "with ThreadPoolExecutor(max_workers=min(len(loads), 4)) as executor:" in code
+        assert "def load_orders():\n    global df_orders\n    spark.sparkContext.setLocalProperty('spark.scheduler.pool', 'orders')" in code
+        # Orders is written as it is built, so the file is read a stage later.
+        assert code.index("run_stage(load_orders, load_customers)") < code.index("def load_again():")
+        assert "run_stage(load_again)" in code
+        assert "ThreadPoolExecutor" not in PySparkCodeGenerator().generate(data_model)
+
+        with pytest.raises(ValueError):
+            PySparkCodeGenerator(concurrency_options=ConcurrencyOptions(max_workers=0))
+
+    def test_translations_shared_and_bounded(self, monkeypatch):
+
+        from app.core import codegen
+
+        monkeypatch.setattr(codegen, "MAX_TRANSLATION_CACHE_SIZE", 8)
+        first = PySparkCodeGenerator()
+        for i in range(50):
+            first._convert_expression(f"A + {i}")
+
+        assert len(codegen._TRANSLATIONS) <= 8
+        assert PySparkCodeGenerator()._convert_expression("A + 49") == codegen._TRANSLATIONS["A + 49"]
@@ -0,0 +1,76 @@
+import pytest
+from app.core.expression import (
+    ExpressionSyntaxError, MAX_NESTING_DEPTH, field_references,
+    parse_expression, to_qlik, try_parse_expression
+)
+from app.models.ast_models import BinaryOperation, FieldReference, FunctionCall, Literal
+
+class TestExpressionParser:
+
+    def test_arithmetic_precedence(self):
+
+        node = parse_expression("Price + Quantity * 2")
+
+        assert isinstance(node, BinaryOperation)
+        assert node.operator == "+"
+        assert node.left == FieldReference(name="Price")
+        assert node.right.operator == "*"
+
+    def test_logical_and_comparison_precedence(self):
+
+        node = parse_expression("A > 1 AND B = 'x' OR NOT C < 2")
+
+        assert node.operator == "OR"
+        assert node.left.operator == "AND"
+        assert node.right.operator == "NOT"
+        assert node.right.operand.operator == "<"
+
+    def test_nested_function_calls(self):
+
+        node = parse_expression("If(Year(OrderDate) = 2024, Upper([Customer Name]), 'n/a')")
+
+        assert isinstance(node, FunctionCall)
+        assert node.function_name == "If"
+        assert len(node.arguments) == 3
+        assert node.arguments[0].left.function_name == "Year"
+        assert node.arguments[2] == Literal(value="n/a", kind="string")
+        assert field_references(node) == ["OrderDate", "Customer Name"]
+
+    def test_distinct_qualifier(self):
+
+        node = parse_expression("Count(DISTINCT CustomerID)")
+
+        assert node.distinct
+        assert node.arguments == [FieldReference(name="CustomerID")]
+
+    def test_parsed_trees_are_cached(self):
+
+        assert parse_expression("Sum(Sales) / 100") is parse_expression("Sum(Sales) / 100")
+
+    def test_round_trip_to_qlik(self):
+
+        text = "(A + B) * C & Upper([Full Name])"
+
+        assert to_qlik(parse_expression(text)) == text
+
+    def test_syntax_errors(self):
+
+        with pytest.raises(ExpressionSyntaxError):
+            parse_expression("Sum(Sales")
+        assert try_parse_expression("A +") is None
+
+    def test_nesting_depth_limit(self):
+
+        text = "(" * (MAX_NESTING_DEPTH + 1) + "1" + ")" * (MAX_NESTING_DEPTH + 1)
+
+        assert try_parse_expression(text) is None
+
+    def test_cache_stays_bounded(self, monkeypatch):
+
+        from app.core import expression
+
+        monkeypatch.setattr(expression, "MAX_CACHE_SIZE", 8)
+        for i in range(50):
+            parse_expression(f"A  +  {i}")
+
+        assert len(expression._EXPRESSION_CACHE) <= 8
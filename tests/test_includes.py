@@ -0,0 +1,93 @@
+import pytest
+from app.core.includes import IncludeCache, IncludeError, IncludeResolver
+from app.core.parser import QlikParser
+from app.models.ast_models import LoadStatement, VariableAssignment
+
+class TestIncludes:
+
+    def _write_library(self, root):
+
+        (root / "config.qvs").write_text("SET vPath = 'lib://Data/';\nLET vYear = 2024;\n")
+        (root / "tables.qvs").write_text(
+            "$(Must_Include=lib://Shared/config.qvs);\n"
+            "Sales: LOAD * FROM [$(vPath)sales.qvd] (qvd) WHERE Year = $(vYear);\n"
+        )
+
+    def test_must_include_resolves_lib_root(self, tmp_path):
+
+        self._write_library(tmp_path)
+        resolver = IncludeResolver(roots={"Shared": str(tmp_path)})
+        parser = QlikParser(include_resolver=resolver)
+
+        ast = parser.parse("$(Must_Include=lib://Shared/tables.qvs);\nLOAD * RESIDENT Sales;")
+
+        assert [type(s) for s in ast.statements] == [VariableAssignment, VariableAssignment, LoadStatement, LoadStatement]
+        assert ast.statements[2].source == "lib://Data/sales.qvd"
+        assert ast.statements[2].where_clause.condition == "Year = 2024"
+        assert parser.variables["vYear"] == "2024"
+
+    def test_missing_includes(self, tmp_path):
+
+        parser = QlikParser(include_resolver=IncludeResolver(roots={"Shared": str(tmp_path)}))
+
+        assert parser.parse("$(Include=lib://Shared/missing.qvs);").statements == []
+        with pytest.raises(IncludeError):
+            parser.parse("$(Must_Include=lib://Shared/missing.qvs);")
+
+    def test_paths_outside_root_are_rejected(self, tmp_path):
+
+        resolver = IncludeResolver(roots={"Shared": str(tmp_path / "lib")})
+
+        assert resolver.resolve_path("lib://Shared/../secret.qvs") is None
+        assert resolver.resolve_path("other.qvs") is None
+
+    def test_relative_paths_stay_in_base_dir(self, tmp_path):
+
+        (tmp_path / "secret.qvs").write_text("SET vSecret = 1;")
+        (tmp_path / "scripts").mkdir()
+        (tmp_path / "scripts" / "config.qvs").write_text("SET vPath = 'x';")
+        resolver = IncludeResolver(base_dir=str(tmp_path / "scripts"))
+
+        assert resolver.resolve_path("config.qvs") == (tmp_path / "scripts" / "config.qvs").resolve()
+        assert resolver.resolve_path("../secret.qvs") is None
+        assert resolver.resolve_path(str(tmp_path / "secret.qvs")) is None
+        with pytest.raises(IncludeError):
+            QlikParser(include_resolver=resolver).parse("$(Must_Include=../secret.qvs);")
+
+    def test_static_include_parsed_once_and_replayed(self, tmp_path):
+
+        self._write_library(tmp_path)
+        cache = IncludeCache()
+        script = "$(Must_Include=lib://Shared/config.qvs);\nLOAD * FROM [$(vPath)x.csv];"
+
+        first = QlikParser(include_resolver=IncludeResolver(roots={"Shared": str(tmp_path)}, cache=cache)).parse(script)
+        parser = QlikParser(include_resolver=IncludeResolver(roots={"Shared": str(tmp_path)}, cache=cache))
+        second = parser.parse(script)
+
+        assert second.statements[0] is first.statements[0]
+        assert parser.variables["vPath"] == "lib://Data/"
+        assert second.statements[2].source == "lib://Data/x.csv"
+
+    def test_disk_cache_shared_between_instances(self, tmp_path):
+
+        self._write_library(tmp_path)
+        cache_dir = tmp_path / "cache"
+        script = "$(Must_Include=lib://Shared/config.qvs);"
+
+        QlikParser(include_resolver=IncludeResolver(
+            roots={"Shared": str(tmp_path)}, cache=IncludeCache(str(cache_dir)))).parse(script)
+        parser = QlikParser(include_resolver=IncludeResolver(
+            roots={"Shared": str(tmp_path)}, cache=IncludeCache(str(cache_dir))))
+        ast = parser.parse(script)
+
+        assert len(list(cache_dir.iterdir())) == 1
+        assert ast.statements[1].value == "2024"
+        assert parser.variables["vYear"] == "2024"
+
+    def test_circular_include(self, tmp_path):
+
+        (tmp_path / "loop.qvs").write_text("$(Must_Include=lib://Shared/loop.qvs);")
+        parser = QlikParser(include_resolver=IncludeResolver(roots={"Shared": str(tmp_path)}))
+
+        with pytest.raises(IncludeError):
+            parser.parse("$(Must_Include=lib://Shared/loop.qvs);")
@@ -0,0 +1,165 @@
+import pytest
+from app.core.codegen import PySparkCodeGenerator
+from app.core.incremental import IncrementalConverter
+from app.core.optimizer import IROptimizer
+from app.core.parser import QlikParser
+from app.core.transformer import ASTTransformer
+
+SCRIPT = """
+LET vYear = 2023;
+Orders: LOAD OrderID, CustomerID, Amount FROM orders.csv WHERE Year = $(vYear);
+Customers: LOAD CustomerID, Name FROM customers.csv;
+Totals: LOAD CustomerID, Sum(Amount) as Total RESIDENT Orders GROUP BY CustomerID;
+"""
+
+def full_conversion(script):
+
+    data_model, _ = IROptimizer().optimize(ASTTransformer().transform(QlikParser().parse(script)))
+    return data_model, PySparkCodeGenerator().generate(data_model, "transformation")
+
+class TestIncrementalConverter:
+
+    def test_first_run_matches_full_pipeline(self):
+
+        result = IncrementalConverter().convert(SCRIPT)
+        data_model, code = full_conversion(SCRIPT)
+
+        assert result.data_model == data_model
+        assert result.pyspark_code == code
+        assert result.reparsed_statements == 4
+
+    def test_unchanged_script_reparses_nothing(self):
+
+        converter = IncrementalConverter()
+        converter.convert(SCRIPT)
+        result = converter.convert(SCRIPT)
+
+        assert result.reparsed_statements == 0
+        assert result.retransformed_tables == []
+
+    def test_field_edit_reparses_one_statement(self):
+
+        converter = IncrementalConverter()
+        converter.convert(SCRIPT)
+        edited = SCRIPT.replace("CustomerID, Name", "CustomerID, Name, City")
+        result = converter.convert(edited)
+        data_model, code = full_conversion(edited)
+
+        assert result.reparsed_statements == 1
+        # Totals looks among every table for one with its fields to append
+        # to, so it is transformed again once Customers' fields change.
+        assert result.retransformed_tables == ["Customers", "Totals"]
+        assert result.data_model == data_model
+        assert result.pyspark_code == code
+
+    def test_variable_edit_reparses_dependent_statements(self):
+
+        converter = IncrementalConverter()
+        converter.convert(SCRIPT)
+        edited = SCRIPT.replace("2023", "2024")
+        result = converter.convert(edited)
+        data_model, code = full_conversion(edited)
+
+        assert result.reparsed_statements == 2
+        assert "Customers" not in result.retransformed_tables
+        assert result.pyspark_code == code
+        assert "2024" in result.pyspark_code
+
+    def test_unclosed_quote_falls_back_to_full_split(self):
+
+        converter = IncrementalConverter()
+        converter.convert(SCRIPT)
+        # The string now runs past the edited statement, swallowing Totals.
+        edited = SCRIPT.replace("FROM customers.csv;", "FROM customers.csv WHERE Name <> 'x;")
+        edited += "Extra: LOAD A FROM extra.csv WHERE B = 'y';\n"
+        result = converter.convert(edited)
+
+        assert result.pyspark_code == full_conversion(edited)[1]
+        assert converter.convert(SCRIPT).pyspark_code == full_conversion(SCRIPT)[1]
+
+    def test_loops_match_full_pipeline(self):
+
+        script = SCRIPT + "FOR EACH r IN 'a', 'b'\nLET w = '$(r)';\nR: LOAD A FROM [r_$(r).csv] WHERE A > 1;\nNEXT r\n" \
+            + "X: LOAD C FROM [x_$(w).csv];\n"
+        converter = IncrementalConverter()
+        converter.convert(script)
+
+        edited = script.replace("'a', 'b'", "'a', 'b', 'c'")
+        result = converter.convert(edited)
+
+        assert result.pyspark_code == full_conversion(edited)[1]
+        assert "x_c.csv" in result.pyspark_code
+        assert result.reparsed_statements <= 2
+
+    def test_stores_survive_replay(self):
+
+        script = SCRIPT + "STORE Totals INTO [totals.qvd] (qvd);\n"
+        converter = IncrementalConverter()
+        converter.convert(script)
+
+        edited = script.replace("Name FROM", "Name, City FROM")
+        result = converter.convert(edited)
+
+        assert [store.table_name for store in result.data_model.stores] == ["Totals"]
+        assert result.pyspark_code == full_conversion(edited)[1]
+        assert ".save('totals.delta')" in result.pyspark_code
+
+    def test_renamed_table_redoes_loads_reading_it(self):
+
+        script = SCRIPT + "LEFT JOIN (Orders) LOAD OrderID, Status FROM status.csv;\n"
+        converter = IncrementalConverter()
+        converter.convert(script)
+
+        edited = script.replace("Orders: LOAD", "Orders2: LOAD")
+        result = converter.convert(edited)
+        data_model, code = full_conversion(edited)
+
+        assert result.data_model == data_model
+        assert result.pyspark_code == code
+        assert "Orders" not in result.data_model.tables
+        assert len(result.retransformed_tables) == len(set(result.retransformed_tables))
+
+    def test_schemas_and_manifest_used(self):
+
+        from app.core.migration import MigrationManifest
+        from app.core.schema import SchemaResolver, load_schema_csv
+
+        manifest = MigrationManifest(entries={"orders.qvd": {
+            "output": "migrated/orders.parquet", "format": "parquet", "header_sha256": "abc",
+            "columns": {"OrderID": "long", "Amount": "double"}, "rows": 10,
+        }})
+        schemas = SchemaResolver(manifest=manifest, tables=load_schema_csv("table,field,type\nCustomers,CustomerID,integer\n"))
+        script = "Orders: LOAD OrderID, Amount FROM [orders.qvd] (qvd);\nCustomers: LOAD CustomerID FROM customers.csv;\n"
+        result = IncrementalConverter(schema_resolver=schemas, qvd_manifest=manifest).convert(script)
+
+        data_model, _ = IROptimizer().optimize(ASTTransformer(schema_resolver=schemas).transform(QlikParser().parse(script)))
+        assert result.data_model == data_model
+        assert result.data_model.tables["Orders"].row_count == 10
+        assert result.pyspark_code == PySparkCodeGenerator(qvd_manifest=manifest).generate(data_model)
+        assert "migrated/orders.parquet" in result.pyspark_code
+
+    @pytest.mark.parametrize("script, old, new", [
+        # Exists() looks the field up in every table loaded so far.
+        ("A: LOAD k, x FROM a.csv;\nC: LOAD k, z FROM c.csv;\nD: LOAD k, w FROM d.csv WHERE Exists(z);\n",
+         "k, z FROM c.csv", "k, q FROM c.csv"),
+        # An unnamed KEEP or JOIN applies to the previous table, which changes
+        # when U stops being appended to T.
+        ("T: LOAD k, v FROM t.csv;\nU: LOAD k, v FROM u.csv;\nKEEP LOAD k FROM e.csv;\n",
+         "k, v FROM u.csv", "k, v, y FROM u.csv"),
+        ("T: LOAD k, v FROM t.csv;\nU: LOAD k, v FROM u.csv;\nLEFT JOIN LOAD k, n FROM e.csv;\n",
+         "k, v FROM u.csv", "k, v, y FROM u.csv"),
+        # Auto-concatenation compares the fields of every earlier table.
+        ("T: LOAD k, v FROM t.csv;\nU: LOAD k, y FROM u.csv;\nV: LOAD k, y FROM v.csv;\n",
+         "k, y FROM u.csv", "k, z FROM u.csv"),
+    ])
+    def test_tables_found_by_scanning_redo_dependent_loads(self, script, old, new):
+
+        converter = IncrementalConverter()
+        converter.convert(script)
+
+        edited = script.replace(old, new)
+        result = converter.convert(edited)
+        data_model, code = full_conversion(edited)
+
+        assert result.data_model == data_model
+        assert result.pyspark_code == code
@@ -0,0 +1,78 @@
+
+import pickle
+import pytest
+from app.core.parser import QlikParser
+from app.core.inline import InlineTable, StringColumn, parse_format_spec
+
+class TestInlineTable:
+
+    def test_block_is_offset_range_into_script(self):
+
+        script = """
+        Categories:
+        LOAD * INLINE [
+        CategoryID, CategoryName
+        1, Electronics
+        2, Clothing
+        ];
+        """
+        ast = QlikParser().parse(script)
+        inline = ast.statements[0].inline_data
+
+        assert inline.source is script
+        assert inline._columns is None
+        assert inline.headers == ["CategoryID", "CategoryName"]
+        assert inline._columns is None
+
+    def test_typed_columns(self):
+
+        text = "Id, Price, Name\n1, 9.5, Pen\n2, 12, Book\n"
+        inline = InlineTable(text, 0, len(text))
+
+        columns = inline.columns
+        assert columns["Id"].typecode == "q"
+        assert list(columns["Id"]) == [1, 2]
+        assert columns["Price"].typecode == "d"
+        assert list(columns["Price"]) == [9.5, 12.0]
+        assert isinstance(columns["Name"], StringColumn)
+        assert list(columns["Name"]) == ["Pen", "Book"]
+        assert list(inline.rows()) == [(1, 9.5, "Pen"), (2, 12.0, "Book")]
+
+    def test_quoting_and_empty_cells(self):
+
+        text = "Code, Label\n'A', 'Hello, world'\nB, \"say \"\"hi\"\"\"\nC,\n"
+        inline = InlineTable(text, 0, len(text))
+
+        assert list(inline.columns["Label"]) == ["Hello, world", 'say "hi"', None]
+
+    def test_format_spec(self):
+
+        script = """
+        T:
+        LOAD * INLINE [
+        1;a,b
+        2;c
+        ] (delimiter is ';', no labels);
+        """
+        inline = QlikParser().parse(script).statements[0].inline_data
+
+        assert inline.delimiter == ";"
+        assert inline.headers == ["@1", "@2"]
+        assert list(inline.rows()) == [(1, "a,b"), (2, "c")]
+
+    def test_parse_format_spec(self):
+
+        assert parse_format_spec("(txt, delimiter is ',', embedded labels)") == {
+            "format": "txt", "delimiter": ",", "has_labels": True
+        }
+        assert parse_format_spec("(delimiter is '\\t')")["delimiter"] == "\t"
+
+    def test_pickle_keeps_only_the_block(self):
+
+        script = "x" * 10000 + "A, B\n1, 2\n"
+        inline = InlineTable(script, 10000, len(script))
+
+        restored = pickle.loads(pickle.dumps(inline))
+        assert restored == inline
+        assert len(restored.source) == len(script) - 10000
+        assert list(restored.rows()) == [(1, 2)]
@@ -0,0 +1,67 @@
+
+import pytest
+from app.core.lexer import QlikLexer, TokenType, join_tokens, split_statements
+
+class TestQlikLexer:
+
+    def test_basic_tokens(self):
+
+        tokens = QlikLexer().tokenize("Sales: LOAD Amount * 1.2 as Net FROM [lib://Data/sales.qvd] (qvd);")
+        types = [t.type for t in tokens]
+
+        assert types[:3] == [TokenType.IDENT, TokenType.COLON, TokenType.IDENT]
+        assert tokens[4].value == "*"
+        assert tokens[5].type == TokenType.NUMBER
+        assert any(t.type == TokenType.BRACKET and t.value == "[lib://Data/sales.qvd]" for t in tokens)
+        assert types[-2:] == [TokenType.SEMICOLON, TokenType.EOF]
+
+    def test_comments_are_skipped(self):
+
+        script = """
+        REM this isn't code;
+        LOAD A, // trailing comment
+        /* block
+           comment */ B FROM x.csv;
+        """
+        values = [t.value for t in QlikLexer().tokenize(script) if t.type != TokenType.EOF]
+
+        assert values == ["LOAD", "A", ",", "B", "FROM", "x.csv", ";"]
+
+    def test_strings_and_variables(self):
+
+        tokens = QlikLexer().tokenize("LET v = 'it''s' & $(=Max(Year(d)));")
+
+        assert tokens[3].type == TokenType.STRING
+        assert tokens[3].value == "'it''s'"
+        assert tokens[5].type == TokenType.VARIABLE
+        assert tokens[5].value == "$(=Max(Year(d)))"
+
+    def test_line_numbers(self):
+
+        tokens = QlikLexer().tokenize("LOAD A\nFROM\n\nx.csv;")
+
+        assert [t.line for t in tokens[:4]] == [1, 1, 2, 4]
+
+    @pytest.mark.parametrize("chunk_size", [1, 3, 7, 64])
+    def test_chunked_input_matches_whole_input(self, chunk_size):
+
+        script = "REM note;\nT: LOAD 'a''b' as X, 1.5e+3 as Y, $(v) FROM [p.csv] /* c */ WHERE A <> 1;\n"
+        chunks = [script[i:i + chunk_size] for i in range(0, len(script), chunk_size)]
+
+        assert list(QlikLexer().iter_tokens(chunks)) == QlikLexer().tokenize(script)
+
+    def test_join_tokens_normalizes_whitespace(self):
+
+        tokens = QlikLexer().tokenize("If(A >\n   1,  'x')")
+
+        assert join_tokens(tokens[:-1]) == "If(A > 1, 'x')"
+
+    def test_split_statements_matches_lexer_semicolons(self):
+
+        script = "REM a; b;\nT: LOAD 'x;y', [c;d], \"e;f\" FROM t.csv; // g;\n/* h; */ LOAD $(v(';')) FROM u.csv;\nLOAD z"
+        statements = split_statements(script)
+        ends = [t.end for t in QlikLexer().tokenize(script) if t.type == TokenType.SEMICOLON]
+
+        assert "".join(statements) == script
+        assert [len("".join(statements[:i + 1])) for i in range(len(ends))] == ends
+        assert len(statements) == len(ends) + 1
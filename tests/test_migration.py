@@ -0,0 +1,65 @@
+
+import os
+import pytest
+from app.core.codegen import PySparkCodeGenerator
+from app.core.migration import MANIFEST_NAME, MigrationManifest, migrate_directory
+from app.core.parser import QlikParser
+from app.core.transformer import ASTTransformer
+from tests.test_qvd import write_qvd
+
+pq = pytest.importorskip("pyarrow.parquet")
+
+@pytest.fixture
+def qvd_tree(tmp_path):
+
+    source = tmp_path / "qvd"
+    (source / "sales").mkdir(parents=True)
+    write_qvd(source / "sales" / "orders.qvd", {"OrderID": [1, 2, 3, 4], "Year": [2023, 2024, 2024, 2023]})
+    write_qvd(source / "customers.qvd", {"CustomerID": [7, 8], "Name": ["Ann", None]})
+    return source, tmp_path / "out"
+
+class TestQvdMigration:
+
+    def test_migrates_tree_and_records_manifest(self, qvd_tree):
+
+        source, target = qvd_tree
+        result = migrate_directory(str(source), str(target), partition_by="Year", max_workers=1, batch_rows=2)
+
+        assert sorted(result.migrated) == ["customers.qvd", "sales/orders.qvd"]
+        assert result.failed == {}
+        orders = pq.read_table(str(target / "sales" / "orders.parquet"))
+        assert sorted(orders.column("OrderID").to_pylist()) == [1, 2, 3, 4]
+        assert sorted(p.name for p in (target / "sales" / "orders.parquet").iterdir()) == ["Year=2023", "Year=2024"]
+        customers = pq.read_table(str(target / "customers.parquet"))
+        assert customers.column("Name").to_pylist() == ["Ann", None]
+
+        manifest = MigrationManifest.load(str(target / MANIFEST_NAME))
+        assert manifest.entries["sales/orders.qvd"]["rows"] == 4
+        assert manifest.entries["customers.qvd"]["columns"] == {"CustomerID": "long", "Name": "string"}
+
+    def test_rerun_skips_unchanged_files(self, qvd_tree):
+
+        source, target = qvd_tree
+        migrate_directory(str(source), str(target), max_workers=1)
+
+        write_qvd(source / "customers.qvd", {"CustomerID": [7, 8, 9], "Name": ["Ann", "Bo", "Cy"]})
+        stat = (source / "sales" / "orders.qvd").stat()
+        os.utime(source / "sales" / "orders.qvd", ns=(stat.st_atime_ns, stat.st_mtime_ns))
+        result = migrate_directory(str(source), str(target), max_workers=1)
+
+        assert result.migrated == ["customers.qvd"]
+        assert result.skipped == ["sales/orders.qvd"]
+        assert pq.read_table(str(target / "customers.parquet")).num_rows == 3
+
+    def test_generated_code_reads_migrated_paths(self, qvd_tree):
+
+        source, target = qvd_tree
+        migrate_directory(str(source), str(target), max_workers=1, target_uri="abfss://lake/Files/qvd")
+        manifest = MigrationManifest.load(str(target / MANIFEST_NAME))
+
+        script = "Orders: LOAD OrderID, Year FROM [lib://Data/sales/orders.qvd] (qvd);"
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+        code = PySparkCodeGenerator(qvd_manifest=manifest).generate(data_model)
+
+        assert "spark.read.parquet('abfss://lake/Files/qvd/sales/orders.parquet')" in code
+        assert manifest.locate("lib://Data/other/orders.qvd") is None
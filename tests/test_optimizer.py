@@ -0,0 +1,176 @@
+
+import pytest
+from app.core.parser import QlikParser
+from app.core.transformer import ASTTransformer
+from app.core.codegen import PySparkCodeGenerator
+from app.core.optimizer import IROptimizer
+from app.core.schema import SchemaResolver, load_schema_csv
+from app.models.ir_models import ColumnDefinition, FilterTransformation
+
+def _model(script, schema_csv=None):
+
+    schemas = SchemaResolver(tables=load_schema_csv(schema_csv)) if schema_csv else None
+    return ASTTransformer(schema_resolver=schemas).transform(QlikParser().parse(script))
+
+class TestIROptimizer:
+
+    def test_dropped_and_unread_tables_removed(self):
+
+        script = """
+        Temp: LOAD OrderID, Amount FROM orders.csv;
+        Totals: LOAD OrderID, Amount * 2 AS Doubled RESIDENT Temp;
+        Scratch: LOAD A, B FROM scratch.csv;
+        Unused: MAPPING LOAD * INLINE [
+        Code, Name
+        1, One
+        ];
+        DROP TABLES Temp, Scratch;
+        """
+        data_model = _model(script)
+        optimized, rewrites = IROptimizer(disabled=["prune_columns"]).optimize(data_model)
+
+        assert list(optimized.tables) == ["Temp", "Totals"]
+        assert optimized.mappings == {} and optimized.dropped_tables == ["Temp"]
+        assert "Scratch" not in optimized.execution_order
+        assert [(r.rule, r.table) for r in rewrites] == [("dead_tables", "Scratch"), ("dead_tables", "Unused")]
+        assert "Scratch" in data_model.tables
+
+    def test_repeated_expression_computed_once(self):
+
+        script = """
+        Orders: LOAD OrderID, Amount * Rate AS Net, Amount
+        FROM orders.csv WHERE Amount * Rate >= 100;
+        """
+        optimized, rewrites = IROptimizer(disabled=["prune_columns"]).optimize(_model(script))
+        code = PySparkCodeGenerator().generate(optimized)
+
+        assert [r.rule for r in rewrites] == ["common_subexpressions"]
+        assert [t.operation for t in optimized.tables["Orders"].transformations] == ["derive", "filter", "select"]
+        assert code.count("col('Amount') * col('Rate')") == 1
+        assert "df_orders.filter(col('__cse0') >= 100)" in code
+        assert "col('__cse0').alias('Net')" in code
+
+    def test_consecutive_filters_fused(self):
+
+        data_model = _model("Orders: LOAD OrderID, Amount, Status FROM orders.csv WHERE Amount > 0;")
+        table = data_model.tables["Orders"]
+        status = FilterTransformation(table_name="Orders", source_table="Orders", condition="Status = 'Open'")
+        table = table.model_copy(update={"transformations": table.transformations + [status]})
+
+        optimizer = IROptimizer(disabled=["prune_columns"])
+        optimized, rewrites = optimizer.optimize(data_model.model_copy(update={"tables": {"Orders": table}}))
+
+        filters = optimized.tables["Orders"].transformations
+        assert len(filters) == 1 and filters[0].condition == "Amount > 0 AND Status = 'Open'"
+        assert [r.rule for r in rewrites] == ["fuse_steps"]
+
+    def test_rules_switched_off(self, monkeypatch):
+
+        script = "Orders: LOAD Year(OrderDate) AS OrderYear FROM orders.csv WHERE Year(OrderDate) > 2020;"
+        data_model = _model(script)
+        monkeypatch.setenv("QLIK_OPTIMIZER_DISABLE", "sargable_predicates, common_subexpressions, prune_columns")
+
+        assert IROptimizer.from_environment().optimize(data_model) == (data_model, [])
+        with pytest.raises(ValueError):
+            IROptimizer(disabled=["no_such_rule"])
+
+    def test_unchanged_tables_rewritten_to_same_object(self):
+
+        optimizer = IROptimizer()
+        data_model = _model("Orders: LOAD Year(D) AS Y FROM orders.csv WHERE Year(D) > 2020;")
+
+        first, _ = optimizer.optimize(data_model)
+        second, _ = optimizer.optimize(data_model)
+
+        assert first.tables["Orders"] is second.tables["Orders"]
+
+    def test_condition_on_joined_table_moves_ahead_of_join(self):
+
+        script = """
+        Orders: LOAD OrderID, CustomerID, OrderDate FROM orders.parquet (parquet);
+        LEFT JOIN (Orders) LOAD CustomerID, Name FROM customers.csv;
+        Recent: LOAD OrderID, Name RESIDENT Orders WHERE Year(OrderDate) = 2024 AND Left(Name, 3) = 'Acm';
+        DROP TABLE Orders;
+        """
+        schema = "table,field,type\nOrders,OrderDate,date\n"
+        optimized, _ = IROptimizer().optimize(_model(script, schema))
+        orders = optimized.tables["Orders"].transformations
+        recent = optimized.tables["Recent"].transformations
+
+        assert [t.operation for t in orders] == ["filter", "join"]
+        assert orders[0].condition == "OrderDate >= '2024-01-01' AND OrderDate < '2025-01-01'"
+        assert [t.operation for t in recent] == ["filter", "select"]
+        assert recent[0].condition == "Name LIKE 'Acm*'"
+
+    def test_wrapped_predicates_become_ranges(self):
+
+        optimizer = IROptimizer(disabled=["predicate_pushdown"])
+        cases = {
+            "Year(D) >= 2020": "D >= '2020-01-01'",
+            "2020 < Year(D)": "D >= '2021-01-01'",
+            "Month(D) = 2 AND Year(D) = 2024": "D >= '2024-02-01' AND D < '2024-03-01'",
+            "Date(D) = '2024-02-29'": "D >= '2024-02-29' AND D < '2024-03-01'",
+            "Date(D) <= MakeDate(2024, 12, 31)": "D < '2025-01-01'",
+            "Left(Code, 2) = 'AB'": "Code LIKE 'AB*'",
+            "Left(Code, 3) = 'AB'": "Left(Code, 3) = 'AB'",
+            "Month(D) = 2": "Month(D) = 2",
+        }
+        schema = "table,field,type\nT,D,date\nT,Code,text\n"
+        for condition, expected in cases.items():
+            data_model = _model(f"T: LOAD D, Code FROM t.csv WHERE {condition};", schema)
+            optimized, _ = optimizer.optimize(data_model)
+
+            assert optimized.tables["T"].transformations[0].condition == expected
+
+    def test_ranges_need_a_date_field(self):
+
+        # Unknown or text fields would compare with the range as strings.
+        for schema in (None, "table,field,type\nT,D,text\n"):
+            data_model = _model("T: LOAD D FROM t.csv WHERE Year(D) = 2024 AND Month(D) = 2;", schema)
+            optimized, rewrites = IROptimizer(disabled=["prune_columns"]).optimize(data_model)
+
+            assert optimized.tables["T"].transformations[0].condition == "Year(D) = 2024 AND Month(D) = 2"
+            assert rewrites == []
+
+    def test_reads_narrowed_to_columns_used_downstream(self):
+
+        script = """
+        Orders: LOAD * FROM orders.parquet (parquet);
+        Totals: LOAD OrderID, Amount * 2 AS Doubled RESIDENT Orders WHERE Note <> '';
+        Kept: LOAD * FROM kept.csv;
+        DROP TABLE Orders;
+        """
+        data_model = _model(script)
+        # Columns as a Parquet footer would give them.
+        footer = [ColumnDefinition(name=name) for name in ["OrderID", "Amount", "Note", "Extra"]]
+        orders = data_model.tables["Orders"].model_copy(update={"source_columns": footer, "columns": footer})
+        data_model = data_model.model_copy(update={"tables": {**data_model.tables, "Orders": orders}})
+        optimized, rewrites = IROptimizer().optimize(data_model)
+        code = PySparkCodeGenerator().generate(optimized)
+
+        assert optimized.tables["Orders"].read_columns == ["OrderID", "Amount", "Note"]
+        assert optimized.tables["Kept"].read_columns == []
+        assert "df_orders = df_orders.select('OrderID', 'Amount', 'Note')" in code
+        assert [r.description for r in rewrites if r.rule == "prune_columns"] == ["read of Orders narrowed to 3 of 4 columns"]
+
+    def test_declared_schema_not_trusted_as_file_columns(self):
+
+        schema = "table,field,type\nOrders,OrderID,integer\nOrders,OrderYear,integer\nOrders,Amount,number\n"
+        script = "Orders: LOAD OrderID, Year(OrderDate) as OrderYear, Amount FROM orders.csv;"
+        schemas = SchemaResolver(None, None, load_schema_csv(schema))
+        data_model = ASTTransformer(schema_resolver=schemas).transform(QlikParser().parse(script))
+        optimized, _ = IROptimizer().optimize(data_model)
+
+        assert optimized.tables["Orders"].read_columns == ["OrderID", "OrderDate", "Amount"]
+
+    def test_stored_table_read_whole(self):
+
+        script = """
+        Orders: LOAD * FROM orders.csv;
+        Totals: LOAD OrderID RESIDENT Orders;
+        STORE Orders INTO [lib://Out/orders.qvd] (qvd);
+        DROP TABLE Orders;
+        """
+        optimized, _ = IROptimizer().optimize(_model(script))
+
+        assert optimized.tables["Orders"].read_columns == []
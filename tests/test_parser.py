@@ -1,7 +1,7 @@
 
 import pytest
 from app.core.parser import QlikParser
-from app.models.ast_models import Script, LoadStatement, LoadType, VariableAssignment
+from app.models.ast_models import Script, LoadStatement, LoadType, StoreStatement, VariableAssignment, DropStatement
 
 class TestQlikParser:
 
@@ -58,6 +58,39 @@ class TestQlikParser:
         join_stmt = ast.statements[1]
         assert join_stmt.join_clause is not None
         assert join_stmt.join_clause.join_type.value == "left"
+        assert not join_stmt.join_clause.keep
+
+    def test_keep_prefix(self):
+
+        script = """
+        Customers: LOAD CustomerID FROM customers.csv;
+        Sales: LEFT KEEP (Customers) LOAD SaleID, CustomerID FROM sales.csv;
+        Big: INNER KEEP LOAD CustomerID FROM big.csv;
+        """
+        statements = QlikParser().parse(script).statements
+
+        assert statements[1].join_clause.keep
+        assert statements[1].join_clause.join_type.value == "left"
+        assert statements[1].join_clause.table_name == "Customers"
+        assert statements[1].source == "sales.csv"
+        assert statements[2].join_clause.join_type.value == "inner"
+        assert statements[2].join_clause.table_name is None
+
+    def test_concatenate_prefixes(self):
+
+        script = """
+        Sales: LOAD OrderID FROM jan.csv;
+        CONCATENATE (Sales) LOAD OrderID FROM feb.csv;
+        Concatenate LOAD OrderID FROM mar.csv;
+        Copy: NoConcatenate LOAD OrderID RESIDENT Sales;
+        """
+        statements = QlikParser().parse(script).statements
+
+        assert statements[0].concatenate is None
+        assert statements[1].concatenate.table_name == "Sales"
+        assert statements[1].source == "feb.csv"
+        assert statements[2].concatenate.table_name is None
+        assert statements[3].no_concatenate and statements[3].table_name == "Copy"
 
     def test_variable_assignment(self):
 
@@ -157,3 +190,253 @@ class TestQlikParser:
         year_field = load_stmt.fields[1]
         assert year_field.alias == "OrderYear"
         assert year_field.is_calculated == True
+
+    def test_comments_and_bracketed_source(self):
+
+        script = """
+        // header comment
+        [Sales Data]: /* inline comment */
+        LOAD OrderID, // trailing comment
+             Amount
+        FROM [lib://Data/sales.qvd] (qvd);
+        """
+        parser = QlikParser()
+        ast = parser.parse(script)
+
+        assert len(ast.statements) == 1
+        load_stmt = ast.statements[0]
+        assert load_stmt.table_name == "Sales Data"
+        assert load_stmt.source == "lib://Data/sales.qvd"
+        assert [f.raw_expression for f in load_stmt.fields] == ["OrderID", "Amount"]
+
+    def test_nested_function_fields(self):
+
+        script = "LOAD If(Len(Name) > 0, Upper(Name), 'n/a') as CleanName, Code FROM names.csv;"
+        parser = QlikParser()
+        ast = parser.parse(script)
+
+        fields = ast.statements[0].fields
+        assert len(fields) == 2
+        assert fields[0].raw_expression == "If(Len(Name) > 0, Upper(Name), 'n/a')"
+        assert fields[0].alias == "CleanName"
+
+    def test_order_by(self):
+
+        script = "Sorted: LOAD A, B RESIDENT Src ORDER BY A, B DESC;"
+        parser = QlikParser()
+        ast = parser.parse(script)
+
+        order_by = ast.statements[0].order_by
+        assert order_by.fields == ["A", "B"]
+        assert order_by.ascending == False
+
+    def test_unknown_statements_are_skipped(self):
+
+        script = """
+        DROP FIELD Temp;
+        SQL SELECT * FROM dbo.Orders;
+        LOAD A FROM a.csv;
+        """
+        parser = QlikParser()
+        ast = parser.parse(script)
+
+        assert len(ast.statements) == 1
+        assert ast.statements[0].source == "a.csv"
+
+    def test_wide_statement(self):
+
+        fields = ",\n".join(f"If(Len(F{i}) > 0, Upper(F{i}), 'n/a') as C{i}" for i in range(5000))
+        script = f"Wide:\nLOAD {fields}\nFROM wide.csv;"
+        parser = QlikParser()
+        ast = parser.parse(script)
+
+        assert len(ast.statements[0].fields) == 5000
+        assert ast.statements[0].fields[-1].alias == "C4999"
+
+    def test_pathological_input_scales_linearly(self):
+
+        import time
+
+        def best_time(script):
+            best = float("inf")
+            for _ in range(3):
+                start = time.perf_counter()
+                QlikParser().parse(script)
+                best = min(best, time.perf_counter() - start)
+            return best
+
+        small = best_time("LOAD " * 4000 + "'unterminated " + "(" * 4000)
+        large = best_time("LOAD " * 16000 + "'unterminated " + "(" * 16000)
+
+        # 4x the input; a backtracking parser shows ~16x here.
+        assert large < small * 10
+
+    def test_parse_iter_matches_parse(self):
+
+        import io
+
+        script = """
+        LET vYear = 2024;
+        Orders:
+        LOAD OrderID, Year(OrderDate) as OrderYear FROM [orders.csv]
+        WHERE Year(OrderDate) = 2024;
+        Map: MAPPING LOAD Code, Name FROM codes.csv;
+        Categories:
+        LOAD * INLINE [
+        CategoryID, CategoryName
+        1, Electronics
+        ];
+        """
+        expected = QlikParser().parse(script).statements
+
+        for chunk_size in (1, 5, 64):
+            streamed = list(QlikParser().parse_iter(io.StringIO(script), chunk_size=chunk_size))
+            assert streamed == expected
+
+        streamed = list(QlikParser().parse_iter(io.BytesIO(script.encode("utf-8")), chunk_size=7))
+        assert streamed == expected
+
+    def test_parse_iter_is_lazy(self):
+
+        import io
+
+        class Reader(io.StringIO):
+            reads = 0
+
+            def read(self, size=-1):
+                Reader.reads += 1
+                return super().read(size)
+
+        script = "".join(f"T{i}: LOAD A FROM t{i}.csv;\n" for i in range(1000))
+        statements = QlikParser().parse_iter(Reader(script), chunk_size=64)
+
+        first = next(statements)
+        assert first.table_name == "T0"
+        assert Reader.reads < 5
+
+    def test_variable_expansion(self):
+
+        script = """
+        SET vPath = 'lib://data/';
+        LET vYear = 2020 + 4;
+        SET vFields = CustomerID, Name;
+        LOAD $(vFields) FROM [$(vPath)customers.qvd] (qvd) WHERE Year = $(vYear);
+        """
+        parser = QlikParser()
+        ast = parser.parse(script)
+        load = ast.statements[3]
+
+        assert parser.variables["vPath"] == "lib://data/"
+        assert parser.variables["vYear"] == "2024"
+        assert [f.raw_expression for f in load.fields] == ["CustomerID", "Name"]
+        assert load.source == "lib://data/customers.qvd"
+        assert load.where_clause.condition == "Year = 2024"
+
+    def test_variable_expansion_disabled(self):
+
+        script = "SET vFields = A, B;\nLOAD $(vFields) FROM t.csv;"
+        ast = QlikParser(expand_variables=False).parse(script)
+
+        assert ast.statements[1].fields[0].raw_expression == "$(vFields)"
+
+    def test_parse_parallel_matches_parse(self):
+
+        script = """
+        SET vPath = 'lib://data/';
+        LET vYear = 2020 + 4;
+        Orders: LOAD OrderID, Amount FROM [$(vPath)orders.qvd] (qvd) WHERE Year = $(vYear);
+        LET vYear = $(vYear) + 1;
+        Later: LOAD OrderID FROM [$(vPath)later.qvd] (qvd) WHERE Year = $(vYear);
+        Categories:
+        LOAD * INLINE [
+        CategoryID, CategoryName
+        1, Electronics
+        ];
+        """ + "".join(f"T{i}: LOAD A, Sum(B) as S RESIDENT Orders GROUP BY A;\n" for i in range(20))
+
+        expected = QlikParser().parse(script)
+        parallel = QlikParser().parse_parallel(script, max_workers=2, chunk_size=200)
+
+        assert parallel == expected
+        assert parallel.statements[4].where_clause.condition == "Year = 2025"
+
+    def test_for_loops_unroll_known_values(self):
+
+        script = """
+        FOR i = 1 TO 5 STEP 2
+          Sales: LOAD OrderID FROM [sales_$(i).csv];
+        NEXT i
+        FOR EACH vRegion IN 'North', 'South'
+          LET vLast = '$(vRegion)';
+          Regions: LOAD A FROM [$(vRegion).csv];
+        NEXT
+        FOR EACH vFile IN FileList('lib://Data/orders_*.qvd')
+          Orders: LOAD * FROM [$(vFile)] (qvd);
+        NEXT vFile
+        After: LOAD B FROM [after_$(vLast).csv];
+        """
+        statements = QlikParser().parse(script).statements
+
+        months, regions, files, after = statements
+        assert months.values == ["1", "3", "5"]
+        assert months.statements[0].source == "sales_$(i).csv"
+        assert [s.source for s in months.unrolled] == ["sales_1.csv", "sales_3.csv", "sales_5.csv"]
+        assert [s.source for s in regions.unrolled if isinstance(s, LoadStatement)] == ["North.csv", "South.csv"]
+        assert files.file_pattern == "lib://Data/orders_*.qvd"
+        assert files.unrolled[0].source == "lib://Data/orders_*.qvd"
+        assert after.source == "after_South.csv"
+
+    def test_loop_with_unknown_bounds_keeps_body(self):
+
+        script = "FOR i = 1 TO NoOfRows('T')\nLOAD A FROM [f_$(i).csv];\nNEXT i\nLOAD B FROM g.csv;"
+        loop, following = QlikParser().parse(script).statements
+
+        assert loop.values is None and loop.unrolled is None
+        assert loop.statements[0].source == "f_$(i).csv"
+        assert following.source == "g.csv"
+
+    def test_macros_joined_to_surrounding_text(self):
+
+        import io
+
+        script = """
+        SET vYear = 2024;
+        LET vN = 1 + 2;
+        SET vDir = 'lib://Data';
+        Sales_$(vYear): LOAD OrderID, Amount$(vYear) * 2 AS Double$(vN) FROM [$(vDir)/sales_$(vYear).csv];
+        T$(vN): LOAD A FROM [$(vDir)/t$(vN).qvd] (qvd);
+        """
+        expected = QlikParser().parse(script).statements
+
+        assert [s.table_name for s in expected[3:]] == ["Sales_2024", "T3"]
+        assert [f.raw_expression for f in expected[3].fields] == ["OrderID", "Amount2024 * 2"]
+        assert expected[3].fields[1].alias == "Double3"
+        assert expected[4].source == "lib://Data/t3.qvd"
+        assert list(QlikParser().parse_iter(io.StringIO(script), chunk_size=5)) == expected
+        assert QlikParser().parse_parallel(script, max_workers=1).statements == expected
+
+    def test_parse_parallel_keeps_loops_whole(self):
+
+        script = "FOR EACH v IN 'a', 'b'\nT: LOAD A FROM [t_$(v).csv];\nU: LOAD B FROM u.csv;\nNEXT v\nW: LOAD C FROM w.csv;\n"
+
+        assert QlikParser().parse_parallel(script, max_workers=1, chunk_size=1) == QlikParser().parse(script)
+
+    def test_store_statement(self):
+
+        script = """
+        STORE Sales INTO [lib://Out/sales.qvd] (qvd);
+        STORE OrderID, Amount AS Total FROM Orders INTO [lib://Out/orders.csv] (txt);
+        """
+        sales, orders = QlikParser().parse(script).statements
+
+        assert isinstance(sales, StoreStatement)
+        assert (sales.table_name, sales.target, sales.file_format, sales.fields) == ("Sales", "lib://Out/sales.qvd", "qvd", [])
+        assert orders.table_name == "Orders" and orders.file_format == "txt"
+        assert [f.alias or f.expression.name for f in orders.fields] == ["OrderID", "Total"]
+
+    def test_drop_tables(self):
+
+        drop, = QlikParser().parse("DROP TABLES Temp, [Staging Orders];").statements
+
+        assert isinstance(drop, DropStatement)
+        assert drop.table_names == ["Temp", "Staging Orders"]
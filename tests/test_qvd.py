@@ -0,0 +1,173 @@
+
+import struct
+import numpy as np
+import pytest
+from app.core.qvd import QvdError, QvdReader, qvd_field_type, read_qvd, read_qvd_header
+from app.models.ir_models import DataType
+
+def encode_symbol(value) -> bytes:
+
+    if isinstance(value, tuple):
+        number, text = value
+        if isinstance(number, int):
+            return b"\x05" + struct.pack("<i", number) + text.encode() + b"\0"
+        return b"\x06" + struct.pack("<d", number) + text.encode() + b"\0"
+    if isinstance(value, int):
+        return b"\x01" + struct.pack("<i", value)
+    if isinstance(value, float):
+        return b"\x02" + struct.pack("<d", value)
+    return b"\x04" + value.encode() + b"\0"
+
+def default_tags(values):
+
+    numbers = [v[0] if isinstance(v, tuple) else v for v in values if v is not None]
+    if all(isinstance(v, str) for v in numbers):
+        return ("$ascii", "$text")
+    if all(isinstance(v, int) for v in numbers):
+        return ("$numeric", "$integer")
+    if all(isinstance(v, (int, float)) for v in numbers):
+        return ("$numeric",)
+    return ()
+
+def write_qvd(path, columns, table_name="T", tags=None, formats=None):
+
+    # Minimal QVD writer: one symbol per distinct value, nulls stored with
+    # a bias of -2 the way Qlik does for fields that contain them. Field
+    # tags are derived from the values unless given.
+    tags = tags or {}
+    formats = formats or {}
+    names = list(columns)
+    row_count = len(columns[names[0]])
+    fields = []
+    bit_offset = 0
+    symbol_data = b""
+    codes = []
+    for name in names:
+        values = columns[name]
+        symbols = list(dict.fromkeys(v for v in values if v is not None))
+        bias = -2 if None in values else 0
+        code_of = {v: i - bias for i, v in enumerate(symbols)}
+        codes.append([code_of[v] if v is not None else 0 for v in values])
+        width = max(max(codes[-1], default=0), 0).bit_length() if len(symbols) > 1 or bias else 0
+        table = b"".join(encode_symbol(s) for s in symbols)
+        fields.append((name, bit_offset, width, bias, len(symbols), len(symbol_data), len(table),
+                       formats.get(name, "UNKNOWN"), tags.get(name, default_tags(values))))
+        symbol_data += table
+        bit_offset += width
+
+    record_size = max((bit_offset + 7) // 8, 1)
+    records = bytearray()
+    for row in range(row_count):
+        packed = 0
+        for (_, offset, width, *_), field_codes in zip(fields, codes):
+            packed |= field_codes[row] << offset
+        records += packed.to_bytes(record_size, "little")
+
+    field_xml = "".join(
+        f"<QvdFieldHeader><FieldName>{name}</FieldName><BitOffset>{offset}</BitOffset>"
+        f"<BitWidth>{width}</BitWidth><Bias>{bias}</Bias><NumberFormat><Type>{number_format}</Type></NumberFormat>"
+        f"<NoOfSymbols>{count}</NoOfSymbols><Offset>{start}</Offset><Length>{length}</Length>"
+        f"<Tags>{''.join(f'<String>{tag}</String>' for tag in field_tags)}</Tags></QvdFieldHeader>"
+        for name, offset, width, bias, count, start, length, number_format, field_tags in fields
+    )
+    header = (
+        f'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\r\n<QvdTableHeader>'
+        f"<TableName>{table_name}</TableName><Fields>{field_xml}</Fields>"
+        f"<Compression></Compression><RecordByteSize>{record_size}</RecordByteSize>"
+        f"<NoOfRecords>{row_count}</NoOfRecords><Offset>{len(symbol_data)}</Offset>"
+        f"<Length>{len(records)}</Length></QvdTableHeader>\r\n"
+    ).encode() + b"\0"
+    path.write_bytes(header + symbol_data + bytes(records))
+    return path
+
+class TestQvdReader:
+
+    def test_header(self, tmp_path):
+
+        path = write_qvd(tmp_path / "orders.qvd", {"OrderID": [1, 2, 3], "Region": ["N", "S", "N"]}, "Orders")
+        header = read_qvd_header(str(path))
+
+        assert header.table_name == "Orders"
+        assert header.record_count == 3
+        assert [f.name for f in header.fields] == ["OrderID", "Region"]
+        assert header.fields[1].tags == ("$ascii", "$text")
+
+    def test_typed_columns_with_nulls(self, tmp_path):
+
+        columns = {
+            "ID": [10, 20, 30, 40],
+            "Price": [1.5, None, 2.25, 1.5],
+            "Name": ["a", "b", None, "élan"],
+            "Date": [(45000, "2023-03-15"), (45001, "2023-03-16"), None, (45000, "2023-03-15")],
+            "Code": [(1, "A"), (2, "B"), (1, "A"), (2, "B")],
+            "Const": ["x", "x", "x", "x"],
+            "Mixed": [1, "two", 3, "two"],
+        }
+        path = write_qvd(tmp_path / "t.qvd", columns, tags={"Code": ("$text",)}, formats={"Date": "DATE"})
+
+        frame = read_qvd(str(path))
+
+        assert frame["ID"].tolist() == [10, 20, 30, 40]
+        assert frame["ID"].dtype == np.int64
+        assert np.isnan(frame["Price"][1]) and frame["Price"][2] == 2.25
+        assert frame["Name"].isna().tolist() == [False, False, True, False]
+        assert frame["Name"].dropna().tolist() == ["a", "b", "élan"]
+        assert [str(d.date()) for d in frame["Date"].dropna()] == ["2023-03-15", "2023-03-16", "2023-03-15"]
+        assert frame["Code"].tolist() == ["A", "B", "A", "B"]
+        assert frame["Const"].tolist() == ["x"] * 4
+        assert frame["Mixed"].tolist() == ["1", "two", "3", "two"]
+
+        with QvdReader(str(path), dual="number") as reader:
+            assert reader.to_pandas(["Code"])["Code"].tolist() == [1, 2, 1, 2]
+            assert reader.data_types()["Date"] == DataType.DATE
+
+    def test_batches_match_full_read(self, tmp_path):
+
+        rng = np.random.default_rng(0)
+        columns = {
+            "Key": [int(v) for v in rng.integers(0, 5000, 3000)],
+            "Group": [f"g{v}" for v in rng.integers(0, 37, 3000)],
+        }
+        path = write_qvd(tmp_path / "big.qvd", columns)
+
+        with QvdReader(str(path)) as reader:
+            batches = list(reader.iter_batches(batch_size=1000))
+
+        assert len(batches) == 3
+        assert sum((b["Key"].tolist() for b in batches), []) == columns["Key"]
+        assert sum((b["Group"].tolist() for b in batches), []) == columns["Group"]
+
+    def test_arrow_output(self, tmp_path):
+
+        pytest.importorskip("pyarrow")
+        path = write_qvd(tmp_path / "t.qvd", {"A": [1, None, 3], "B": ["x", "y", None]})
+
+        with QvdReader(str(path)) as reader:
+            table = reader.to_arrow()
+
+        assert table.column("A").to_pylist() == [1, None, 3]
+        assert table.column("B").to_pylist() == ["x", "y", None]
+
+    def test_truncated_file_is_rejected(self, tmp_path):
+
+        path = write_qvd(tmp_path / "t.qvd", {"A": list(range(100))})
+        path.write_bytes(path.read_bytes()[:-10])
+
+        with pytest.raises(QvdError):
+            QvdReader(str(path))
+
+    def test_field_types_from_tags(self, tmp_path):
+
+        columns = {
+            "ID": [1, 2],
+            "Price": [1.5, 2.5],
+            "Name": ["a", "b"],
+            "Stamp": [(45000.5, "2023-03-15 12:00"), (45001.25, "2023-03-16 06:00")],
+            "Untagged": [1, 2],
+        }
+        path = write_qvd(tmp_path / "t.qvd", columns, formats={"Stamp": "TIMESTAMP"}, tags={"Untagged": ()})
+        fields = read_qvd_header(str(path)).fields
+
+        assert [qvd_field_type(f) for f in fields] == [
+            DataType.LONG, DataType.DOUBLE, DataType.STRING, DataType.TIMESTAMP, None
+        ]
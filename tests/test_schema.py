@@ -0,0 +1,167 @@
+
+import os
+from pathlib import Path
+import pytest
+from app.core.cache import ConversionCache, conversion_key
+from app.core.codegen import PySparkCodeGenerator
+from app.core.includes import IncludeResolver
+from app.core.migration import MigrationManifest
+from app.core.parser import QlikParser
+from app.core.schema import SchemaError, SchemaResolver, load_schema_csv, load_schema_file, load_schema_json, parse_row_counts
+from app.core.transformer import ASTTransformer
+from app.models.ir_models import DataType
+from tests.test_qvd import write_qvd
+
+def convert(script, schemas):
+
+    data_model = ASTTransformer(schema_resolver=schemas).transform(QlikParser().parse(script))
+    return data_model, PySparkCodeGenerator().generate(data_model)
+
+class TestSchemaResolver:
+
+    def test_qvd_header_types_columns(self, tmp_path):
+
+        write_qvd(tmp_path / "orders.qvd", {
+            "OrderID": [1, 2, 3],
+            "Amount": [1.5, 2.0, 3.25],
+            "OrderDate": [(45000, "2023-03-15"), (45001, "2023-03-16"), (45000, "2023-03-15")],
+            "Region": ["N", "S", "N"],
+        }, formats={"OrderDate": "DATE"})
+        schemas = SchemaResolver(IncludeResolver(base_dir=str(tmp_path)))
+
+        script = "Orders: LOAD OrderID, Amount, OrderDate, Amount * 2 AS Doubled, Region FROM [orders.qvd] (qvd);"
+        data_model, code = convert(script, schemas)
+
+        table = data_model.tables["Orders"]
+        assert {c.name: c.data_type for c in table.columns} == {
+            "OrderID": DataType.LONG,
+            "Amount": DataType.DOUBLE,
+            "OrderDate": DataType.DATE,
+            "Doubled": DataType.DOUBLE,
+            "Region": DataType.STRING,
+        }
+        assert table.row_count == 3
+        assert "df_orders_schema = StructType([StructField('OrderID', LongType(), True)" in code
+        assert "df_orders = spark.read.schema(df_orders_schema).parquet('orders.parquet')" in code
+
+    def test_star_expands_to_source_columns(self, tmp_path):
+
+        write_qvd(tmp_path / "customers.qvd", {"CustomerID": [1, 2], "Name": ["Ann", "Bo"]})
+        schemas = SchemaResolver(IncludeResolver(base_dir=str(tmp_path)))
+
+        data_model, _ = convert("Customers: LOAD * FROM [customers.qvd] (qvd);", schemas)
+
+        assert [c.name for c in data_model.tables["Customers"].columns] == ["CustomerID", "Name"]
+
+    def test_parquet_footer(self, tmp_path):
+
+        pa = pytest.importorskip("pyarrow")
+        pq = pytest.importorskip("pyarrow.parquet")
+        pq.write_table(pa.table({"Key": pa.array([1, 2], pa.int32()), "Value": ["a", "b"]}), str(tmp_path / "facts.parquet"))
+        schemas = SchemaResolver(IncludeResolver(base_dir=str(tmp_path)))
+
+        data_model, code = convert("Facts: LOAD Key, Value FROM [facts.parquet];", schemas)
+
+        assert [c.data_type for c in data_model.tables["Facts"].columns] == [DataType.INTEGER, DataType.STRING]
+        assert data_model.tables["Facts"].row_count == 2
+        assert "df_facts = spark.read.schema(df_facts_schema).parquet('facts.parquet')" in code
+
+    def test_manifest_columns_and_unknown_sources(self, tmp_path):
+
+        manifest = MigrationManifest(entries={"sales/orders.qvd": {
+            "output": "sales/orders.parquet", "format": "parquet", "header_sha256": "abc",
+            "columns": {"OrderID": "long", "Shipped": "timestamp"}, "rows": 10,
+        }})
+        schemas = SchemaResolver(manifest=manifest)
+
+        schema = schemas.schema("lib://Data/sales/orders.qvd")
+
+        assert [c.data_type for c in schema.columns] == [DataType.LONG, DataType.TIMESTAMP]
+        assert schema.row_count == 10
+        assert schemas.schema("lib://Data/missing.qvd") is None
+        assert schemas.schema("data.csv") is None
+
+    def test_cached_conversion_checks_source_files(self, tmp_path):
+
+        path = write_qvd(tmp_path / "t.qvd", {"A": [1, 2]})
+        schemas = SchemaResolver(IncludeResolver(base_dir=str(tmp_path)))
+        script = "T: LOAD A FROM [t.qvd] (qvd);"
+        ast = QlikParser().parse(script)
+        data_model = ASTTransformer(schema_resolver=schemas).transform(ast)
+        cache = ConversionCache()
+        key = conversion_key(script)
+        cache.put(key, ast, data_model, sources=schemas.sources)
+
+        assert cache.get(key, schemas=schemas) is not None
+        write_qvd(path, {"A": ["x", "y"]})
+        stat = path.stat()
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        assert cache.get(key, schemas=schemas) is None
+
+class TestSchemaFile:
+
+    def test_csv_schema_types_csv_reads(self):
+
+        tables = load_schema_csv("table,field,type\nSales,TransactionID,text\nSales,Amount,number\nSales,SaleDate,date\n")
+        schemas = SchemaResolver(tables=tables)
+
+        script = "Sales: LOAD TransactionID, Amount, SaleDate FROM sales.csv;\nOther: LOAD A FROM other.csv;"
+        data_model, code = convert(script, schemas)
+
+        assert [c.data_type for c in data_model.tables["Sales"].columns] == [DataType.STRING, DataType.DOUBLE, DataType.DATE]
+        assert "df_sales = spark.read.csv('sales.csv', header=True, inferSchema=False)" in code
+        assert ("df_sales = df_sales.withColumns({'TransactionID': col('TransactionID').cast(StringType()), "
+                "'Amount': col('Amount').cast(DoubleType()), 'SaleDate': col('SaleDate').cast(DateType())})") in code
+        assert "df_other = spark.read.csv('other.csv', header=True, inferSchema=True)" in code
+
+    def test_declared_fields_are_not_the_file_layout(self):
+
+        # The schema file lists the model table, derived fields included.
+        tables = load_schema_csv("table,field,type\nOrders,OrderID,integer\nOrders,OrderYear,integer\nOrders,Amount,number\n")
+        script = "Orders: LOAD OrderID, Year(OrderDate) as OrderYear, Amount FROM orders.csv;"
+        data_model, code = convert(script, SchemaResolver(tables=tables))
+
+        orders = data_model.tables["Orders"]
+        assert orders.source_columns == []
+        assert [c.data_type for c in orders.columns] == [DataType.INTEGER, DataType.INTEGER, DataType.DOUBLE]
+        assert [c.name for c in orders.cast_columns] == ["OrderID", "Amount"]
+        assert "StructType" not in code
+
+    def test_json_matches_csv(self):
+
+        rows = [{"table": "Sales", "field": "ID", "type": "integer"}, {"table": "Sales", "field": "Name", "type": "text"}]
+
+        assert load_schema_json(rows) == load_schema_csv("table,field,type\nSales,ID,integer\nSales,Name,text\n")
+        assert SchemaResolver(tables=load_schema_json(rows)).fingerprint() != SchemaResolver().fingerprint()
+
+    def test_sample_schema_file_loads(self):
+
+        tables = load_schema_file(str(Path(__file__).parent.parent / "data" / "sample_schema.csv"))
+
+        assert tables["Sales"][0].name == "TransactionID"
+
+    @pytest.mark.parametrize("text, message", [
+        ("table,field\nSales,ID\n", "Missing: type"),
+        ("table,field,type\nSales,,text\n", "Row 2: Missing value in 'field'"),
+        ("table,field,type\nSales,ID,text\nSales,ID,number\n", "Row 3: Duplicate field 'ID'"),
+        ("table,field,type\nSales,ID,blob\n", "Unknown type 'blob'"),
+    ])
+    def test_invalid_schema_rejected(self, text, message):
+
+        with pytest.raises(SchemaError, match=message):
+            load_schema_csv(text)
+
+    def test_file_sizes_and_supplied_row_counts(self, tmp_path):
+
+        (tmp_path / "regions.csv").write_text("Region\nNorth\nSouth\n")
+        schemas = SchemaResolver(IncludeResolver(base_dir=str(tmp_path)), row_counts=parse_row_counts("Orders=300_000_000; Regions=2"))
+
+        regions = schemas.schema("regions.csv", "Regions")
+        orders = schemas.schema("orders.csv", "Orders")
+
+        assert (regions.columns, regions.row_count, regions.size_bytes) == ([], 2, 19)
+        assert orders.row_count == 300_000_000 and orders.size_bytes is None
+        assert schemas.schema("other.csv", "Other") is None
+        assert schemas.fingerprint() != SchemaResolver().fingerprint()
+        with pytest.raises(SchemaError, match="Orders"):
+            parse_row_counts("Orders=many")
@@ -104,3 +104,178 @@ class TestASTTransformer:
         mapping = data_model.mappings["CountryMap"]
         assert mapping.key_column == "CountryCode"
         assert mapping.value_column == "CountryName"
+
+    def test_incremental_transform_matches_batch(self):
+
+        import io
+
+        script = """
+        Orders:
+        LOAD OrderID, CustomerID, Amount FROM orders.csv;
+
+        Customers:
+        LOAD CustomerID, CustomerName FROM customers.csv;
+
+        Big:
+        LOAD OrderID, Amount RESIDENT Orders WHERE Amount > 100;
+        """
+        batch = ASTTransformer().transform(QlikParser().parse(script))
+
+        transformer = ASTTransformer()
+        for statement in QlikParser().parse_iter(io.StringIO(script), chunk_size=16):
+            transformer.add_statement(statement)
+        streamed = transformer.finalize()
+
+        assert streamed == batch
+        assert streamed.execution_order == ["Orders", "Customers", "Big"]
+
+    def test_relationships_reused_from_previous_model(self):
+
+        script = """
+        Orders: LOAD OrderID, CustomerID, ProductID FROM orders.csv;
+        Customers: LOAD CustomerID, Name FROM customers.csv;
+        Products: LOAD ProductID, Category FROM products.csv;
+        """
+        previous = ASTTransformer().transform(QlikParser().parse(script))
+        edited = script.replace("ProductID, Category", "Category")
+
+        transformer = ASTTransformer()
+        for statement in QlikParser().parse(edited).statements:
+            transformer.add_statement(statement)
+        reused = transformer.finalize(previous)
+
+        assert reused.relationships == ASTTransformer().transform(QlikParser().parse(edited)).relationships
+        assert [(r.from_table, r.to_table) for r in reused.relationships] == [("Orders", "Customers")]
+
+    def test_mapping_sizes_and_calculated_file_fields(self):
+
+        script = """
+        Regions: LOAD * INLINE [
+        Code, Region
+        N, North
+        S, South
+        ];
+        InlineMap: MAPPING LOAD * INLINE [
+        K, V
+        a, 1
+        ];
+        RegionMap: MAPPING LOAD Code, Region RESIDENT Regions;
+        Orders: LOAD OrderID, ApplyMap('RegionMap', Code) AS Region FROM orders.csv WHERE Amount > 0;
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        assert data_model.mappings["InlineMap"].source_type == "inline"
+        assert data_model.mappings["InlineMap"].row_count == 1
+        assert data_model.mappings["RegionMap"].row_count == 2
+        operations = [t.operation for t in data_model.tables["Orders"].transformations]
+        assert operations == ["filter", "select"]
+
+    def test_exists_and_keep_become_semi_joins(self):
+
+        script = """
+        Orders: LOAD OrderID, CustomerID FROM orders.csv;
+        History: LOAD OrderID, Amount FROM history.csv WHERE NOT Exists(OrderID) AND Amount > 0;
+        Matched: LOAD Code FROM codes.csv WHERE Exists(CustomerID, Code);
+        Customers: RIGHT KEEP (Orders) LOAD CustomerID, Name FROM customers.csv;
+        """
+        tables = ASTTransformer().transform(QlikParser().parse(script)).tables
+
+        history = tables["History"].transformations
+        assert [t.operation for t in history] == ["filter", "semi_join"]
+        assert history[0].condition == "Amount > 0"
+        assert history[1].anti and history[1].key_tables == ["Orders"]
+        assert history[1].distinct_columns == ["OrderID"]
+
+        matched = tables["Matched"].transformations[0]
+        assert (matched.anti, matched.key_expressions, matched.key_columns) == (False, ["Code"], ["CustomerID"])
+
+        keep = tables["Customers"].transformations[0]
+        assert (keep.table_name, keep.key_tables, keep.key_columns) == ("Orders", ["Customers"], ["CustomerID"])
+
+    def test_concatenation_builds_union(self):
+
+        script = """
+        Sales: LOAD OrderID, Amount FROM jan.csv;
+        CONCATENATE (Sales) LOAD OrderID, Region FROM feb.csv;
+        LOAD Region, Amount, OrderID FROM mar.csv;
+        Other: NOCONCATENATE LOAD OrderID, Amount FROM apr.csv;
+        """
+        transformer = ASTTransformer()
+        statements = QlikParser().parse(script).statements
+        first = transformer.add_statement(statements[0])
+        for statement in statements[1:]:
+            transformer.add_statement(statement)
+        tables = transformer.finalize().tables
+
+        assert list(tables) == ["Sales", "Other"]
+        union = tables["Sales"].transformations[-1]
+        assert union.operation == "union"
+        assert [part.source_path for part in union.parts] == ["feb.csv", "mar.csv"]
+        assert [c.name for c in tables["Sales"].columns] == ["OrderID", "Amount", "Region"]
+        # The first load's table is left as it was.
+        assert first.transformations == [] and len(first.columns) == 2
+
+    def test_incremental_load_pattern_detected(self):
+
+        script = """
+        Sales: LOAD OrderID, Amount, ModifiedDate FROM src.csv WHERE ModifiedDate > '2024-01-01' AND Amount > 0;
+        CONCATENATE (Sales) LOAD OrderID, Amount, ModifiedDate FROM [out/sales.qvd] (qvd) WHERE NOT Exists(OrderID);
+        STORE Sales INTO [out/sales.qvd] (qvd);
+        Other: LOAD OrderID, Amount FROM other.csv;
+        CONCATENATE (Other) LOAD OrderID, Amount FROM [out/other.qvd] (qvd) WHERE NOT Exists(OrderID);
+        STORE Other INTO [out/other.qvd] (qvd);
+        """
+        stores = ASTTransformer().transform(QlikParser().parse(script)).stores
+
+        assert (stores[0].merge_keys, stores[0].watermark_column, stores[0].changes_condition) == \
+            (["OrderID"], "ModifiedDate", "Amount > 0")
+        # Without a watermark filter the table is rewritten as the script says.
+        assert stores[1].merge_keys == [] and stores[1].watermark_column is None
+
+    def test_join_merges_into_target_table(self):
+
+        script = """
+        Orders: LOAD OrderID, CustomerID FROM orders.csv;
+        LEFT JOIN (Orders) LOAD CustomerID, Name FROM customers.csv WHERE Active = 1;
+        """
+        tables = ASTTransformer().transform(QlikParser().parse(script)).tables
+
+        assert list(tables) == ["Orders"]
+        join = tables["Orders"].transformations[-1]
+        assert (join.operation, join.join_type, join.join_keys) == ("join", "left", ["CustomerID"])
+        assert join.right.source_path == "customers.csv"
+        assert join.right.transformations[0].operation == "filter"
+        assert [c.name for c in tables["Orders"].columns] == ["OrderID", "CustomerID", "Name"]
+
+    def test_drop_table_leaves_loads_reading_it(self):
+
+        script = """
+        Temp: LOAD OrderID, Amount FROM orders.csv;
+        Totals: LOAD OrderID, Amount * 2 AS Doubled RESIDENT Temp;
+        DROP TABLE Temp;
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        assert data_model.dropped_tables == ["Temp"]
+        assert list(data_model.tables) == ["Temp", "Totals"]
+
+    def test_renamed_fields_record_their_source(self):
+
+        script = "Orders: LOAD OrderID, Amount AS Total, [Region] FROM orders.csv;"
+        columns = ASTTransformer().transform(QlikParser().parse(script)).tables["Orders"].columns
+
+        assert [(c.name, c.source_expression) for c in columns] == [("OrderID", None), ("Total", "Amount"), ("Region", None)]
+
+    def test_independent_loads_share_a_stage(self):
+
+        script = """
+        Orders: LOAD OrderID, CustomerID FROM orders.csv;
+        Customers: LOAD CustomerID, Name FROM customers.csv;
+        STORE Orders INTO [lib://Out/orders.qvd] (qvd);
+        Totals: LOAD CustomerID, Count(OrderID) AS Orders RESIDENT Orders GROUP BY CustomerID;
+        Again: LOAD OrderID FROM [lib://Out/orders.qvd] (qvd);
+        Products: LOAD ProductID FROM products.csv;
+        """
+        data_model = ASTTransformer().transform(QlikParser().parse(script))
+
+        assert data_model.execution_stages == [["Orders", "Customers", "Products"], ["Totals", "Again"]]
@@ -0,0 +1,68 @@
+import pytest
+from app.core.parser import QlikParser
+from app.core.variables import MacroExpander, VariableEnvironment
+
+class TestMacroExpander:
+
+    def test_simple_expansion(self):
+
+        expander = MacroExpander(VariableEnvironment({"vPath": "lib://data/"}))
+
+        assert expander.expand("FROM [$(vPath)sales.qvd]") == "FROM [lib://data/sales.qvd]"
+        assert expander.expand("no macros here") == "no macros here"
+
+    def test_nested_expansion(self):
+
+        expander = MacroExpander(VariableEnvironment({"i": "2", "v2": "Second"}))
+
+        assert expander.expand("$(v$(i))") == "Second"
+
+    def test_parameterized_variable(self):
+
+        expander = MacroExpander(VariableEnvironment({"vMargin": "($1 - $2) / $1"}))
+
+        assert expander.expand("$(vMargin(Sales, Cost(1, 2)))") == "(Sales - Cost(1, 2)) / Sales"
+
+    def test_unknown_variable_is_kept(self):
+
+        expander = MacroExpander()
+
+        assert expander.expand("WHERE Year = $(vMissing)") == "WHERE Year = $(vMissing)"
+
+    def test_evaluated_expansion(self):
+
+        expander = MacroExpander(VariableEnvironment({"vYear": "2024"}))
+
+        assert expander.expand("$(=vYear - 1)") == "2023"
+        assert expander.expand("$(=Upper('q') & Len('abc'))") == "Q3"
+        assert expander.expand("$(=Max(Sales))") == "$(=Max(Sales))"
+
+    def test_cache_invalidated_on_change(self):
+
+        environment = VariableEnvironment({"v": "1"})
+        expander = MacroExpander(environment)
+
+        assert expander.expand("$(v)") == "1"
+        environment.set("v", "2")
+        assert expander.expand("$(v)") == "2"
+
+    def test_evaluate(self):
+
+        expander = MacroExpander()
+
+        assert expander.evaluate("7 / 2") == "3.5"
+        assert expander.evaluate("If(1 > 2, 'a', 'b')") == "b"
+        assert expander.evaluate("Today()") is None
+
+    def test_oversized_values_left_unfolded(self):
+
+        expander = MacroExpander()
+
+        assert expander.evaluate("Repeat('x', 1e10)") is None
+        assert expander.evaluate("Replace(Repeat('ab', 500000), 'a', Repeat('y', 100))") is None
+        assert expander.evaluate("Repeat('x', 3)") == "xxx"
+
+        script = "SET v = 'x';\n" + "LET v = '$(v)$(v)' & '$(v)$(v)';\n" * 20 + "T: LOAD '$(v)' AS A AUTOGENERATE 1;"
+        parser = QlikParser()
+        parser.parse(script)
+        assert len(parser.variables["v"]) <= 1 << 21